@@ -0,0 +1,91 @@
+"""
+Change feed: a consumer following the writes of the ledger with
+services.get_changes, from the ring buffer of the feed and, with a feed
+of size 0, from the ledger itself as consumers behind the buffer do,
+against polling the full entry listing of every loan written to
+
+    python -m benchmarks.changes --loans 1000 --entries-per-loan 50 --batch-size 100
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+
+from ledger.adapters import (repository, sqlite_repository)
+from ledger.adapters.feed import ChangeFeed
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import to_minor_units
+from ledger.service_layer import services
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+QUARTER = to_minor_units(0.25)
+
+def create_batches(loans: int, entries_per_loan: int, batch_size: int):
+    today = date.today()
+    entries = []
+    for day in range(entries_per_loan // 2):
+        effective_date = today + timedelta(days=day)
+        for loan_id in range(1, loans + 1):
+            entries.append(LedgerEntry(loan_id, today, effective_date, BUCKETS[0], QUARTER))
+            entries.append(LedgerEntry(loan_id, today, effective_date, BUCKETS[1], -QUARTER))
+    return [entries[index:index + batch_size] for index in range(0, len(entries), batch_size)]
+
+def follow_changes(ledger_repo, batches, limit: int):
+    buckets = [AccountingBucket.create(identifier) for identifier in BUCKETS]
+    after = 0
+    read_entries = 0
+    seconds = 0.0
+    for batch in batches:
+        ledger_repo.add(batch)
+        start = time.perf_counter()
+        while after < ledger_repo.feed.last_sequence:
+            changes, after = services.get_changes(after, ledger_repo, buckets, limit)
+            read_entries += len(changes)
+        seconds += time.perf_counter() - start
+    return read_entries, seconds
+
+def poll_loans(ledger_repo, batches):
+    read_entries = 0
+    seconds = 0.0
+    for batch in batches:
+        ledger_repo.add(batch)
+        start = time.perf_counter()
+        for loan_id in {entry.loan_id for entry in batch}:
+            with ledger_repo.read() as ledger:
+                read_entries += len(services.get_ledger_entries(loan_id, ledger))
+        seconds += time.perf_counter() - start
+    return read_entries, seconds
+
+def report(name: str, written: int, read_entries: int, seconds: float):
+    print(f'{name:<24} {seconds:8.3f}s | {read_entries:12,} entries read for {written:,} written | {written / seconds:12,.0f} new entries/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=1000)
+    parser.add_argument('--entries-per-loan', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--feed-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    batches = create_batches(args.loans, args.entries_per_loan, args.batch_size)
+    written = sum(len(batch) for batch in batches)
+    print(f'{args.loans} loans, {args.entries_per_loan} entries per loan, batches of {args.batch_size}, reads of {args.limit}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        storages = {
+            'memory': lambda feed: repository.LedgerRepository(feed=feed),
+            'columnar': lambda feed: repository.LedgerRepository(columnar=True, feed=feed),
+            'sqlite': lambda feed: sqlite_repository.SqliteLedgerRepository(
+                sqlite_repository.SqliteDatabase(os.path.join(directory, f'ledger-{time.perf_counter_ns()}.db')), feed,
+            ),
+        }
+        for name, create_ledger_repo in storages.items():
+            report(f'{name} feed buffer', written, *follow_changes(create_ledger_repo(ChangeFeed(args.feed_size)), batches, args.limit))
+            report(f'{name} feed ledger', written, *follow_changes(create_ledger_repo(ChangeFeed(0)), batches, args.limit))
+            report(f'{name} loan polling', written, *poll_loans(create_ledger_repo(ChangeFeed(args.feed_size)), batches))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Memory per entry and scan speed of the list-of-dataclasses Ledger
+against the ColumnarLedger storage engine
+
+    python -m benchmarks.columnar --loans 1000 --entries-per-loan 500
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from ledger.domain.columnar_ledger import ColumnarLedger
+from ledger.domain.ledger import (Ledger, LedgerEntry)
+from ledger.domain.money import to_minor_units
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+QUARTER = to_minor_units(0.25)
+
+def generate_batches(loans: int, entries_per_loan: int):
+    # Entries are created per batch so only the ledger keeps them alive
+    start = date(2021, 1, 1)
+    for loan_id in range(1, loans + 1):
+        yield [
+            LedgerEntry(loan_id, start, start + timedelta(days=index // 2), BUCKETS[index % 2], QUARTER if index % 2 == 0 else -QUARTER)
+            for index in range(entries_per_loan)
+        ]
+
+def measure_memory(ledger_class, loans: int, entries_per_loan: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    ledger = ledger_class()
+    for batch in generate_batches(loans, entries_per_loan):
+        ledger.add_new_entries(batch)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return memory
+
+def bench(ledger_class, loans: int, entries_per_loan: int, reads: int):
+    memory = measure_memory(ledger_class, loans, entries_per_loan)
+
+    ledger = ledger_class()
+    start = time.perf_counter()
+    for batch in generate_batches(loans, entries_per_loan):
+        ledger.add_new_entries(batch)
+    write_seconds = time.perf_counter() - start
+
+    entries = loans * entries_per_loan
+    start = time.perf_counter()
+    total = sum(entry.value for entry in ledger.get_all_entries())
+    scan_seconds = time.perf_counter() - start
+
+    loan_ids = [random.randint(1, loans) for _ in range(reads)]
+    start = time.perf_counter()
+    for loan_id in loan_ids:
+        for _ in ledger.get_entries_by_loan_id(loan_id):
+            pass
+    loan_seconds = time.perf_counter() - start
+
+    print(f'{ledger_class.__name__:>14}: {memory / entries:7.1f} bytes/entry | '
+          f'write {entries / write_seconds:10,.0f} entries/s | '
+          f'full scan {entries / scan_seconds:12,.0f} entries/s | '
+          f'loan scan {reads * entries_per_loan / loan_seconds:12,.0f} entries/s (total {total})')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=1000)
+    parser.add_argument('--entries-per-loan', type=int, default=500)
+    parser.add_argument('--reads', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f'{args.loans} loans, {args.entries_per_loan} entries per loan')
+    for ledger_class in (Ledger, ColumnarLedger):
+        bench(ledger_class, args.loans, args.entries_per_loan, args.reads)
+
+if __name__ == '__main__':
+    main()
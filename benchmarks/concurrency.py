@@ -0,0 +1,109 @@
+"""
+Concurrent writes: batches posted through the service layer by N writer
+threads while reader threads compute bucket sums, reporting throughput,
+read latency and whether the totals still match the ledger afterwards
+
+    python -m benchmarks.concurrency --threads 1 2 4 8 16 --batches 2000
+    python -m benchmarks.concurrency --fsync always --batches 200
+"""
+import argparse
+import tempfile
+import threading
+import time
+from typing import List
+
+from ledger.adapters import (repository, wal)
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.money import to_minor_units
+from ledger.service_layer import (schema, services)
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+PAIR_ENTRIES = schema.parse_pair_entries([
+    {
+        'effective_date': '2021-01-21',
+        'debit': {'identifier': BUCKETS[0], 'value': 0.1},
+        'credit': {'identifier': BUCKETS[1], 'value': -0.1},
+    }
+])
+
+def create_repositories(directory: str, fsync_policy: str):
+    write_ahead_log = wal.WriteAheadLog(directory, fsync_policy) if fsync_policy else None
+    ledger_repo = repository.LedgerRepository(write_ahead_log)
+    bucket_repo = repository.BucketRepository(write_ahead_log)
+    for identifier in BUCKETS:
+        bucket_repo.add(AccountingBucket.create(identifier))
+    loan_repo = repository.LoanRepository(ledger_repo, write_ahead_log)
+    return ledger_repo, bucket_repo, loan_repo, write_ahead_log
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    if not latencies:
+        return 0.0
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def run(threads: int, batches: int, loans: int, readers: int, fsync_policy: str):
+    with tempfile.TemporaryDirectory() as directory:
+        ledger_repo, bucket_repo, loan_repo, write_ahead_log = create_repositories(directory, fsync_policy)
+        for loan_id in range(1, loans + 1):
+            services.open_loan(loan_id, loan_repo)
+        writing = threading.Event()
+        read_latencies = [] # type: List[float]
+
+        def write(writer: int):
+            for batch in range(batches):
+                loan_id = (writer * batches + batch) % loans + 1
+                services.add_double_entries(loan_id, PAIR_ENTRIES, bucket_repo, ledger_repo, loan_repo)
+
+        def read(reader: int):
+            loan_id = reader % loans + 1
+            while writing.is_set():
+                start = time.perf_counter()
+                with ledger_repo.read() as ledger:
+                    services.get_buckets_sum(loan_id, list(BUCKETS), bucket_repo.get(), ledger, consistency_check=True)
+                read_latencies.append(time.perf_counter() - start)
+
+        writing.set()
+        reader_threads = [threading.Thread(target=read, args=(reader,)) for reader in range(readers)]
+        writer_threads = [threading.Thread(target=write, args=(writer,)) for writer in range(threads)]
+        for thread in reader_threads:
+            thread.start()
+        start = time.perf_counter()
+        for thread in writer_threads:
+            thread.start()
+        for thread in writer_threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        writing.clear()
+        for thread in reader_threads:
+            thread.join()
+        if write_ahead_log:
+            write_ahead_log.close()
+
+        expected_total = to_minor_units(0.1) * threads * batches
+        ledger = ledger_repo.get()
+        consistent = (
+            bucket_repo.get()[BUCKETS[0]].sum == expected_total
+            and bucket_repo.get()[BUCKETS[1]].sum == -expected_total
+            and sum(entry.value for entry in ledger.get_all_entries()) == 0
+            and ledger.get_balance(None, BUCKETS[0]).sum == expected_total
+        )
+        print(f'{threads:>3} writers: {threads * batches / seconds:10,.0f} batches/s | '
+              f'{len(read_latencies):8,} reads, p50 {percentile(read_latencies, 0.5) * 1000:7.3f}ms '
+              f'p99 {percentile(read_latencies, 0.99) * 1000:7.3f}ms | totals {"exact" if consistent else "DRIFTED"}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--batches', type=int, default=2000, help='batches per writer thread')
+    parser.add_argument('--loans', type=int, default=100)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--fsync', choices=wal.FSYNC_POLICIES, help='log every batch with this fsync policy')
+    args = parser.parse_args()
+
+    print(f'{args.batches} batches per writer over {args.loans} loans, {args.readers} readers, '
+          f'{"fsync " + args.fsync if args.fsync else "in memory"}')
+    for threads in args.threads:
+        run(threads, args.batches, args.loans, args.readers, args.fsync)
+
+if __name__ == '__main__':
+    main()
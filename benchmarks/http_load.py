@@ -0,0 +1,191 @@
+"""
+HTTP load: the Flask app on Werkzeug's threaded server against the ASGI
+app on uvicorn, each started in its own process. Every client connection
+is kept alive and sends a mix of bucket sum reads and entry writes, while
+extra idle connections stay open for the whole run.
+
+    python -m benchmarks.http_load --concurrency 16 64 256 --duration 5 --idle 500
+
+Requires uvicorn (pipenv run pip install uvicorn).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import (Dict, List, Optional, Tuple)
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+LOANS = 100
+WRITE_EVERY = 5
+
+SERVERS = {
+    'flask': (
+        'import logging\n'
+        'from werkzeug.serving import make_server\n'
+        'logging.getLogger("werkzeug").setLevel(logging.ERROR)\n'
+        'from ledger.entrypoints.flask_app import app\n'
+        'make_server("127.0.0.1", {port}, app, threaded=True).serve_forever()\n'
+    ),
+    'asgi': (
+        'import uvicorn\n'
+        'uvicorn.run("ledger.entrypoints.asgi_app:app", host="127.0.0.1", port={port}, log_level="warning", access_log=False)\n'
+    ),
+}
+
+def get_free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def start_server(name: str, port: int) -> subprocess.Popen:
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, ['src', os.environ.get('PYTHONPATH')])))
+    server = subprocess.Popen([sys.executable, '-c', SERVERS[name].format(port=port)], env=environment)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'{name} server did not start')
+
+def get_rss_megabytes(pid: int) -> float:
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def build_request(method: str, path: str, body: Optional[bytes] = None) -> bytes:
+    headers = [f'{method} {path} HTTP/1.1', 'Host: 127.0.0.1', 'Connection: keep-alive']
+    if body is not None:
+        headers += ['Content-Type: application/json', f'Content-Length: {len(body)}']
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode() + (body or b'')
+
+def build_write(loan_id: int) -> bytes:
+    pair_entries = [{
+        'effective_date': '2021-01-21',
+        'debit': {'identifier': BUCKETS[0], 'value': 0.25},
+        'credit': {'identifier': BUCKETS[1], 'value': -0.25},
+    }]
+    return build_request('POST', f'/ledger/entries?loan_id={loan_id}', json.dumps(pair_entries).encode())
+
+def build_read(loan_id: int) -> bytes:
+    return build_request('GET', f'/ledger/buckets/sum?loan_id={loan_id}&bucket_id={BUCKETS[0]}&bucket_id={BUCKETS[1]}')
+
+class Connection:
+    def __init__(self, port: int):
+        self.port = port
+        self.reader = None # type: Optional[asyncio.StreamReader]
+        self.writer = None # type: Optional[asyncio.StreamWriter]
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+    async def request(self, data: bytes) -> Tuple[int, bytes]:
+        if self.writer is None:
+            await self.open()
+        self.writer.write(data)
+        await self.writer.drain()
+
+        head = await self.reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close' or lines[0].startswith('HTTP/1.0'):
+            self.close()
+        return status, body
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def seed(port: int):
+    connection = Connection(port)
+    for identifier in BUCKETS:
+        await connection.request(build_request('POST', f'/ledger/buckets?identifier={identifier}'))
+    for loan_id in range(1, LOANS + 1):
+        await connection.request(build_request('POST', f'/ledger/loans?loan_id={loan_id}'))
+        await connection.request(build_write(loan_id))
+    connection.close()
+
+async def run_load(port: int, concurrency: int, duration: float, idle: int) -> Dict:
+    idle_connections = []
+    for _ in range(idle):
+        connection = Connection(port)
+        await connection.open()
+        idle_connections.append(connection)
+
+    latencies = [] # type: List[float]
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client(number: int):
+        nonlocal errors
+        connection = Connection(port)
+        sent = 0
+        while time.monotonic() < deadline:
+            loan_id = (number * 31 + sent) % LOANS + 1
+            data = build_write(loan_id) if sent % WRITE_EVERY == 0 else build_read(loan_id)
+            start = time.perf_counter()
+            try:
+                status, _ = await connection.request(data)
+            except (OSError, asyncio.IncompleteReadError):
+                connection.close()
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+            sent += 1
+        connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(concurrency)))
+    seconds = time.perf_counter() - start
+    for connection in idle_connections:
+        connection.close()
+
+    latencies.sort()
+    return {
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0.0,
+        'errors': errors,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--idle', type=int, default=500, help='idle keep-alive connections held open during each run')
+    args = parser.parse_args()
+
+    print(f'{args.duration}s per run, 1 write per {WRITE_EVERY} requests, {args.idle} idle connections')
+    for name in args.servers:
+        port = get_free_port()
+        server = start_server(name, port)
+        try:
+            asyncio.run(seed(port))
+            for concurrency in args.concurrency:
+                result = asyncio.run(run_load(port, concurrency, args.duration, args.idle))
+                print(f'{name:>6} x{concurrency:<4}: {result["requests_per_second"]:9,.0f} requests/s | '
+                      f'p50 {result["p50_ms"]:8.2f}ms p99 {result["p99_ms"]:8.2f}ms | '
+                      f'{result["errors"]} errors | server RSS {get_rss_megabytes(server.pid):6.1f}MB')
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Metrics overhead: checks that disabled metrics leave the instrumented
+functions untouched, then runs the HTTP scenarios of the benchmark suite
+with metrics enabled, replaying every block of operations with and
+without the instrumentation. Every wrapper is swapped for the function
+it wraps in between, so both settings share the process, the warmed up
+state and the drift of the machine, which would otherwise hide a 1%
+difference. The overhead is also estimated from the instrumented calls
+made per request and the cost a sampled wrapper adds to a call in a
+tight loop, which is lower than in a request as less of the code stays
+in the CPU caches. With --control the instrumentation stays on in both
+halves, so what it measures is the noise of the machine.
+
+    python -m benchmarks.metrics --rounds 80 --block 50
+    python -m benchmarks.metrics --rounds 80 --block 50 --control
+"""
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import time
+from typing import (Callable, List, Tuple)
+
+INSTRUMENTED = (
+    'ledger.service_layer.services:add_bucket',
+    'ledger.service_layer.services:open_loan',
+    'ledger.service_layer.services:close_loan',
+    'ledger.service_layer.services:validate_double_entries',
+    'ledger.service_layer.services:resolve_buckets',
+    'ledger.service_layer.services:add_double_entries',
+    'ledger.service_layer.services:validate_bulk_rows',
+    'ledger.service_layer.services:resolve_bulk_rows',
+    'ledger.service_layer.services:add_bulk_double_entries',
+    'ledger.service_layer.services:get_ledger_entries',
+    'ledger.service_layer.services:get_ledger_entries_page',
+    'ledger.service_layer.services:get_buckets_sum',
+    'ledger.service_layer.services:get_changes',
+    'ledger.service_layer.services:get_loans',
+    'ledger.service_layer.services:get_portfolio_balances',
+    'ledger.service_layer.services:get_trial_balance',
+    'ledger.service_layer.aggregation:get_portfolio_balances',
+    'ledger.adapters.repository:LedgerRepository.add',
+    'ledger.entrypoints.serialization:StdlibSerializer.dumps_entries',
+    'ledger.entrypoints.serialization:StdlibSerializer.dumps_changes',
+    'ledger.entrypoints.serialization:OrjsonSerializer.dumps_entries',
+    'ledger.entrypoints.serialization:OrjsonSerializer.dumps_changes',
+)
+
+def resolve(path: str) -> Tuple[object, str]:
+    module_name, attributes = path.split(':')
+    owner = importlib.import_module(module_name)
+    *owners, name = attributes.split('.')
+    for attribute in owners:
+        owner = getattr(owner, attribute)
+    return owner, name
+
+def count_wrapped_functions() -> int:
+    return sum(hasattr(getattr(*resolve(path)), '__wrapped__') for path in INSTRUMENTED)
+
+def create_switch() -> Callable[[bool], None]:
+    """
+    Returns a function turning the instrumentation of the Flask views and
+    of every instrumented function on or off within this process
+    """
+    from ledger.entrypoints import flask_app
+    targets = []
+    for path in INSTRUMENTED:
+        owner, name = resolve(path)
+        wrapper = owner.__dict__[name]
+        targets.append((owner, name, wrapper, wrapper.__wrapped__))
+    views = [(endpoint, view, view.__wrapped__) for endpoint, view in flask_app.app.view_functions.items() if hasattr(view, '__wrapped__')]
+
+    def switch(instrumented: bool):
+        for owner, name, wrapper, function in targets:
+            setattr(owner, name, wrapper if instrumented else function)
+        for endpoint, wrapper, view in views:
+            flask_app.app.view_functions[endpoint] = wrapper if instrumented else view
+    return switch
+
+def measure_timed_call(calls: int) -> float:
+    from ledger import metrics
+
+    def noop():
+        pass
+
+    # Timed like the instrumented functions, one call in the sample interval
+    timed_noop = metrics.timed(metrics.Histogram('benchmark_seconds', 'Benchmark durations', sample_interval=metrics.SAMPLE_INTERVAL))(noop)
+    timings = []
+    for function in (noop, timed_noop):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        timings.append(time.perf_counter() - start)
+    return (timings[1] - timings[0]) / calls
+
+def total_timed_calls() -> int:
+    from ledger import metrics
+    # Every sample of a duration histogram stands for as many calls as its weight, timed or not
+    return sum(
+        sum(child.counts) + len(child.pending) * child.weight
+        for metric in metrics.REGISTRY.metrics.values() if isinstance(metric, metrics.Histogram) and metric.name.endswith('_seconds')
+        for child in metric.children.values()
+    )
+
+def median(values: List[float]) -> float:
+    return sorted(values)[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=80, help='blocks run with and without the instrumentation')
+    parser.add_argument('--block', type=int, default=50, help='operations per block')
+    parser.add_argument('--loans', type=int, default=200)
+    parser.add_argument('--entries-per-loan', type=int, default=20)
+    parser.add_argument('--only', nargs='+', default=['http.'], help='only run scenarios starting with one of these prefixes')
+    parser.add_argument('--control', action='store_true', help='keep the instrumentation on in both halves to measure the noise')
+    args = parser.parse_args()
+
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, ['src', '.', os.environ.get('PYTHONPATH')])))
+    script = 'from benchmarks.metrics import count_wrapped_functions; print(count_wrapped_functions())'
+    for enabled in ('0', '1'):
+        wrapped = subprocess.run([sys.executable, '-c', script], env=dict(environment, LEDGER_METRICS=enabled), capture_output=True, text=True, check=True).stdout
+        print(f'LEDGER_METRICS={enabled}: {wrapped.strip()} of {len(INSTRUMENTED)} instrumented functions wrapped')
+
+    os.environ['LEDGER_METRICS'] = '1'
+    os.environ.pop('LEDGER_DATA_DIR', None)
+    os.environ.pop('LEDGER_SQLITE_PATH', None)
+    from benchmarks import suite
+    switch = create_switch()
+    if args.control:
+        switch(True)
+        switch = lambda instrumented: None
+    timed_call = measure_timed_call(10 ** 6)
+    print(f'sampled call: {timed_call * 1e9:.0f}ns added per call')
+    print(f'\nmedian latency without metrics and median added by them, {args.rounds} rounds of {args.block:,} operations'
+          + (', control run with metrics on in both halves' if args.control else ''))
+
+    portfolio = suite.Portfolio(args.loans, 6, args.entries_per_loan, 7)
+    for name, scenario in suite.SCENARIOS.items():
+        if not name.startswith('http.') or not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        switch(True)
+        operation = scenario(portfolio, portfolio.load())
+        # Long enough for every instrumented function to be sampled several times
+        calls = total_timed_calls()
+        for number in range(args.block * 4):
+            operation(number)
+        calls_per_request = (total_timed_calls() - calls) / (args.block * 4)
+
+        # The same block of operations runs with and without the
+        # instrumentation, first one then the other in turns, and every
+        # operation is compared with its own twin
+        differences, latencies = [], []
+        first = args.block * 4
+        for round_number in range(args.rounds):
+            timings = {}
+            for instrumented in ((False, True) if round_number % 2 == 0 else (True, False)):
+                switch(instrumented)
+                timings[instrumented] = []
+                for number in range(first, first + args.block):
+                    # Bucket identifiers must be unique, every other one is left to each setting
+                    number = number * 2 + instrumented if name == 'http.post_bucket' else number
+                    start = time.perf_counter()
+                    operation(number)
+                    timings[instrumented].append(time.perf_counter() - start)
+            differences.extend(enabled - disabled for disabled, enabled in zip(timings[False], timings[True]))
+            latencies.extend(timings[False])
+            first += args.block
+        switch(True)
+
+        latency, difference = median(latencies) * 1000, median(differences) * 1000
+        print(f'{name:<22} {latency:7.3f}ms | measured {difference * 1000:+6.1f}us {difference / latency:+6.2%} | '
+              f'{calls_per_request:.0f} instrumented calls per request, estimated {calls_per_request * timed_call * 1000 / latency:+6.2%}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Exact money: running bucket totals kept as float amounts against the
+integer minor units they are now kept in, timing the additions and
+measuring how far each total drifts from the exact decimal sum
+
+    python -m benchmarks.money --entries 10000000
+"""
+import argparse
+import random
+import time
+from decimal import Decimal
+
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.money import (SCALE, to_major_units, to_minor_units)
+
+def generate_amounts(entries: int):
+    randomizer = random.Random(7)
+    # Interest accruals with six decimal places, debited and reversed
+    return [randomizer.randrange(1, 10 ** 8) / SCALE * (1 if index % 3 else -1) for index in range(entries)]
+
+def add_values(values) -> tuple:
+    bucket = AccountingBucket.create('test-bucket')
+    start = time.perf_counter()
+    for value in values:
+        bucket.add_value(value)
+    return time.perf_counter() - start, bucket.sum
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=10000000)
+    args = parser.parse_args()
+
+    amounts = generate_amounts(args.entries)
+    start = time.perf_counter()
+    minor_units = [to_minor_units(amount) for amount in amounts]
+    conversion_seconds = time.perf_counter() - start
+
+    exact_total = sum(Decimal(value) for value in minor_units) / SCALE
+    float_seconds, float_total = add_values(amounts)
+    integer_seconds, integer_total = add_values(minor_units)
+
+    print(f'{args.entries:,} entries, exact total {exact_total}')
+    print(f'  conversion: {args.entries / conversion_seconds:12,.0f} amounts/s')
+    print(f'       float: {args.entries / float_seconds:12,.0f} additions/s, total {float_total!r}, '
+          f'drift {abs(Decimal(float_total) - exact_total):.3E}')
+    print(f' minor units: {args.entries / integer_seconds:12,.0f} additions/s, total {to_major_units(integer_total)!r}, '
+          f'drift {abs(Decimal(integer_total) / SCALE - exact_total):.3E}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Portfolio balance report: one vectorized pass over the ledger columns
+against the per-loan get_buckets_sum calls it replaces
+
+    python -m benchmarks.reports --loans 10000 --entries-per-loan 100
+"""
+import argparse
+import time
+from datetime import date, timedelta
+
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.columnar_ledger import ColumnarLedger
+from ledger.domain.ledger import (Ledger, LedgerEntry)
+from ledger.domain.money import to_minor_units
+from ledger.service_layer import (aggregation, services)
+
+BUCKETS = ('accounts-receivable-principal', 'accounts-receivable-interest', 'income-interest', 'cash')
+QUARTER = to_minor_units(0.25)
+
+def populate(ledger, loans: int, entries_per_loan: int):
+    start = date(2021, 1, 1)
+    for loan_id in range(1, loans + 1):
+        ledger.add_new_entries([
+            LedgerEntry(loan_id, start, start + timedelta(days=index // 2), BUCKETS[index % len(BUCKETS)], QUARTER if index % 2 == 0 else -QUARTER)
+            for index in range(entries_per_loan)
+        ])
+
+def timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def per_loan_sums(ledger, loans: int, buckets):
+    for loan_id in range(1, loans + 1):
+        services.get_buckets_sum(loan_id, list(BUCKETS), buckets, ledger)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=10000)
+    parser.add_argument('--entries-per-loan', type=int, default=100)
+    args = parser.parse_args()
+
+    buckets = {identifier: AccountingBucket.create(identifier) for identifier in BUCKETS}
+    effective_to = date(2021, 1, 1) + timedelta(days=args.entries_per_loan // 4)
+    print(f'{args.loans} loans, {args.entries_per_loan} entries per loan, numpy {"available" if aggregation.np is not None else "missing"}')
+    for ledger_class in (Ledger, ColumnarLedger):
+        ledger = ledger_class()
+        populate(ledger, args.loans, args.entries_per_loan)
+        print(f'{ledger_class.__name__:>14}: '
+              f'per-loan sums {timed(per_loan_sums, ledger, args.loans, buckets):7.3f}s | '
+              f'python report {timed(aggregation.get_portfolio_balances, ledger, list(BUCKETS), use_numpy=False):7.3f}s | '
+              f'numpy report {timed(aggregation.get_portfolio_balances, ledger, list(BUCKETS)):7.3f}s | '
+              f'numpy date range {timed(aggregation.get_portfolio_balances, ledger, list(BUCKETS), effective_to=effective_to):7.3f}s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Entry serialization: encoding an entry listing with Flask's jsonify of a
+dict per entry, as the routes did before, against the stdlib and orjson
+serializers, plus the NDJSON lines of a stream
+
+    python -m benchmarks.serialization --entries 100000
+"""
+import argparse
+import json
+import time
+from datetime import (date, timedelta)
+from typing import (Callable, List)
+
+from flask import (Flask, jsonify)
+
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import to_major_units
+from ledger.entrypoints.serialization import (SERIALIZERS, create_serializer, generate_ndjson, orjson)
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest', 'accounts-receivable-principal', 'cash')
+
+def generate_entries(entries: int) -> List[LedgerEntry]:
+    first_date = date(2021, 1, 1)
+    return [
+        LedgerEntry(index % 1000 + 1, first_date + timedelta(days=index % 730), first_date + timedelta(days=index % 700), BUCKETS[index % len(BUCKETS)], (index * 7919) % 10 ** 9 - 5 * 10 ** 8)
+        for index in range(entries)
+    ]
+
+def to_entry_response(entry: LedgerEntry) -> dict:
+    return {
+        'loan_id': entry.loan_id,
+        'created_at': entry.created_at,
+        'effective_date': entry.effective_date,
+        'bucket_identifier': entry.bucket_identifier,
+        'value': to_major_units(entry.value),
+    }
+
+def measure(encode: Callable[[], bytes], repeat: int) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content = encode()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(content)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    entries = generate_entries(args.entries)
+    app = Flask(__name__)
+
+    def encode_with_jsonify() -> bytes:
+        with app.app_context():
+            return jsonify({'entries': [to_entry_response(entry) for entry in entries]}).get_data()
+
+    encoders = {'flask jsonify': encode_with_jsonify}
+    for name in SERIALIZERS:
+        if name != 'orjson' or orjson is not None:
+            encoders[name] = lambda serializer=create_serializer(name): serializer.dumps_entries(entries)
+    encoders['ndjson lines'] = lambda: ''.join(generate_ndjson(iter(entries))).encode()
+
+    expected = json.loads(create_serializer('stdlib').dumps_entries(entries))
+    print(f'{args.entries:,} entries, best of {args.repeat}')
+    baseline = None
+    for name, encode in encoders.items():
+        seconds, size = measure(encode, args.repeat)
+        baseline = baseline or seconds
+        if name in SERIALIZERS:
+            assert json.loads(encode()) == expected
+        print(f'{name:>14}: {seconds * 1000:8.1f}ms {args.entries / seconds:12,.0f} entries/s '
+              f'{baseline / seconds:6.1f}x | {size / 2 ** 20:6.1f}MB')
+
+if __name__ == '__main__':
+    main()
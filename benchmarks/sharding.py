@@ -0,0 +1,112 @@
+"""
+Sharded write scaling: the sharded app on uvicorn with an increasing
+number of shard processes, loaded with entry writes over many loans by
+keep-alive clients, next to the unsharded ASGI app as a baseline.
+Write throughput can only scale up to the number of cores of the machine.
+
+    python -m benchmarks.sharding --shards 1 2 4 8 --duration 5
+
+Requires uvicorn (pipenv run pip install uvicorn).
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+
+from benchmarks.http_load import (BUCKETS, Connection, build_request, build_write, get_free_port, get_rss_megabytes)
+
+LOANS = 10000
+
+SERVER = (
+    'import uvicorn\n'
+    'uvicorn.run("ledger.entrypoints.{module}:app", host="127.0.0.1", port={port}, log_level="warning", access_log=False)\n'
+)
+
+def start_server(module: str, port: int, shards: int) -> subprocess.Popen:
+    environment = dict(os.environ, LEDGER_SHARDS=str(shards), PYTHONPATH=os.pathsep.join(filter(None, ['src', os.environ.get('PYTHONPATH')])))
+    environment.pop('LEDGER_DATA_DIR', None)
+    server = subprocess.Popen([sys.executable, '-c', SERVER.format(module=module, port=port)], env=environment)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'{module} server did not start')
+
+def get_tree_rss_megabytes(pid: int) -> float:
+    # The shards are children of the server process
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as children:
+            pids += [int(child) for child in children.read().split()]
+    except OSError:
+        pass
+    return sum(get_rss_megabytes(child) for child in pids)
+
+async def run_writes(port: int, concurrency: int, duration: float):
+    connection = Connection(port)
+    for identifier in BUCKETS:
+        await connection.request(build_request('POST', f'/ledger/buckets?identifier={identifier}'))
+    # Entries are only accepted for open loans
+    for loan_id in range(1, LOANS + 1):
+        await connection.request(build_request('POST', f'/ledger/loans?loan_id={loan_id}'))
+    connection.close()
+
+    written = 0
+    errors = 0
+    latencies = [] # type: List[float]
+    deadline = time.monotonic() + duration
+
+    async def client(number: int):
+        nonlocal written, errors
+        connection = Connection(port)
+        sent = 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            status, _ = await connection.request(build_write((number * 7919 + sent) % LOANS + 1))
+            latencies.append(time.perf_counter() - start)
+            if status == 200:
+                written += 1
+            else:
+                errors += 1
+            sent += 1
+        connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return written / seconds, latencies[int(len(latencies) * 0.99)] * 1000, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} cores, {args.concurrency} clients writing for {args.duration}s over {LOANS} loans')
+    runs = [('asgi_app', 1)] + [('sharded_app', shards) for shards in args.shards]
+    baseline = None
+    for module, shards in runs:
+        port = get_free_port()
+        server = start_server(module, port, shards)
+        try:
+            writes, p99, errors = asyncio.run(run_writes(port, args.concurrency, args.duration))
+            baseline = baseline or writes
+            name = 'unsharded' if module == 'asgi_app' else f'{shards} shards'
+            print(f'{name:>10}: {writes:8,.0f} writes/s ({writes / baseline:4.2f}x) | p99 {p99:8.2f}ms | '
+                  f'{errors} errors | RSS {get_tree_rss_megabytes(server.pid):6.1f}MB')
+        finally:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+In-memory versus SQLite repositories on the write path (batched entry
+inserts) and the read paths (entry listing and bucket sums per loan)
+
+    python -m benchmarks.sqlite --loans 1000 --entries-per-loan 100
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from ledger.adapters import (repository, sqlite_repository)
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import to_minor_units
+from ledger.service_layer import services
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+QUARTER = to_minor_units(0.25)
+
+def create_batches(loans: int, entries_per_loan: int, batch_size: int):
+    today = date.today()
+    entries = []
+    for loan_id in range(1, loans + 1):
+        for day in range(entries_per_loan // 2):
+            effective_date = today + timedelta(days=day)
+            entries.append(LedgerEntry(loan_id, today, effective_date, BUCKETS[0], QUARTER))
+            entries.append(LedgerEntry(loan_id, today, effective_date, BUCKETS[1], -QUARTER))
+    return [entries[index:index + batch_size] for index in range(0, len(entries), batch_size)]
+
+def bench(name: str, ledger_repo, bucket_repo, batches, loans: int, reads: int):
+    for identifier in BUCKETS:
+        bucket_repo.add(AccountingBucket.create(identifier))
+    entries = sum(len(batch) for batch in batches)
+
+    start = time.perf_counter()
+    for batch in batches:
+        ledger_repo.add(batch)
+    write_seconds = time.perf_counter() - start
+
+    loan_ids = [random.randint(1, loans) for _ in range(reads)]
+    start = time.perf_counter()
+    for loan_id in loan_ids:
+        services.get_ledger_entries(loan_id, ledger_repo.get())
+    entries_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for loan_id in loan_ids:
+        services.get_buckets_sum(loan_id, list(BUCKETS), bucket_repo.get(), ledger_repo.get())
+    sum_seconds = time.perf_counter() - start
+
+    print(f'{name:>8}: write {entries / write_seconds:12,.0f} entries/s | '
+          f'entries {reads / entries_seconds:10,.0f} reads/s | '
+          f'sum {reads / sum_seconds:10,.0f} reads/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=1000)
+    parser.add_argument('--entries-per-loan', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--reads', type=int, default=2000)
+    parser.add_argument('--synchronous', choices=sqlite_repository.SYNCHRONOUS_MODES, default='full')
+    args = parser.parse_args()
+
+    batches = create_batches(args.loans, args.entries_per_loan, args.batch_size)
+    print(f'{args.loans} loans, {args.entries_per_loan} entries per loan, batches of {args.batch_size}')
+
+    bench('memory', repository.LedgerRepository(), repository.BucketRepository(), batches, args.loans, args.reads)
+    with tempfile.TemporaryDirectory() as directory:
+        database = sqlite_repository.SqliteDatabase(os.path.join(directory, 'ledger.db'), args.synchronous)
+        bench('sqlite', sqlite_repository.SqliteLedgerRepository(database), sqlite_repository.SqliteBucketRepository(database), batches, args.loans, args.reads)
+        database.close()
+
+if __name__ == '__main__':
+    main()
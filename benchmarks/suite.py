@@ -0,0 +1,304 @@
+"""
+Benchmark suite: every service function and HTTP route run against the
+same synthetic portfolio, reporting throughput, latency percentiles and
+the peak memory allocated by each scenario. Results are saved as JSON
+and can be compared against the results of another commit.
+
+    python -m benchmarks.suite --loans 1000 --buckets 6 --entries-per-loan 50 --output results.json
+    python -m benchmarks.suite --compare results.json --only http
+
+Portfolios are generated from --seed, so runs with the same parameters
+replay the same operations. Repositories are kept in memory, set
+LEDGER_STORAGE=columnar or LEDGER_CACHE_SIZE=0 to benchmark those setups.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import (date, datetime, timedelta, timezone)
+from typing import (Any, Callable, Dict, List, Optional)
+
+from ledger.bootstrap import (create_cache, create_idempotency_store, create_repositories)
+from ledger.service_layer import (schema, services)
+
+Operation = Callable[[int], Any]
+
+# Rows of every request of the bulk scenario, each for another loan. The
+# scenario runs BULK_ROWS times fewer requests, so it writes as many rows
+# to a ledger of the same size as the single loan posts it is compared with
+BULK_ROWS = 100
+
+class Portfolio:
+    """
+    Loans with entries spread over a year and a handful of buckets,
+    every pair entry debiting one bucket and crediting another
+    """
+    def __init__(self, loans: int, buckets: int, entries_per_loan: int, seed: int):
+        self.loans = loans
+        self.randomizer = random.Random(seed)
+        self.bucket_identifiers = [f'bucket-{number:03d}' for number in range(max(buckets, 2))]
+        self.pair_entries = {loan_id: [self.generate_pair_entry() for _ in range(entries_per_loan)] for loan_id in range(1, loans + 1)}
+
+    def generate_pair_entry(self) -> Dict:
+        debit_identifier, credit_identifier = self.randomizer.sample(self.bucket_identifiers, 2)
+        value = self.randomizer.randrange(1, 10 ** 6) / 100
+        return {
+            'effective_date': (date(2021, 1, 1) + timedelta(days=self.randomizer.randrange(365))).isoformat(),
+            'debit': {'identifier': debit_identifier, 'value': value},
+            'credit': {'identifier': credit_identifier, 'value': -value},
+        }
+
+    def get_loan_id(self, number: int) -> int:
+        # Spreads consecutive operations over the loans
+        return number * 7919 % self.loans + 1
+
+    def get_bucket_identifiers(self, number: int) -> List[str]:
+        return [self.bucket_identifiers[(number + offset) % len(self.bucket_identifiers)] for offset in range(2)]
+
+    def load(self) -> Dict:
+        repositories = create_repositories()
+        for identifier in self.bucket_identifiers:
+            services.add_bucket(identifier, repositories['bucket'])
+        for loan_id, pair_entries in self.pair_entries.items():
+            services.open_loan(loan_id, repositories['loan'])
+            services.add_double_entries(loan_id, schema.parse_pair_entries(pair_entries), repositories['bucket'], repositories['ledger'], repositories['loan'])
+        return repositories
+
+def create_bucket(portfolio: Portfolio, repositories: Dict) -> Operation:
+    bucket_repo = repositories['bucket']
+
+    def operation(number: int):
+        services.add_bucket(f'benchmark-bucket-{number}', bucket_repo)
+    return operation
+
+def create_double_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    def operation(number: int):
+        loan_id = portfolio.get_loan_id(number)
+        services.add_double_entries(loan_id, schema.parse_pair_entries(portfolio.pair_entries[loan_id][:1]), repositories['bucket'], repositories['ledger'], repositories['loan'])
+    return operation
+
+def get_ledger_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    def operation(number: int):
+        with repositories['ledger'].read() as ledger:
+            services.get_ledger_entries(portfolio.get_loan_id(number), ledger)
+    return operation
+
+def get_buckets_sum(portfolio: Portfolio, repositories: Dict) -> Operation:
+    def operation(number: int):
+        with repositories['ledger'].read() as ledger:
+            services.get_buckets_sum(portfolio.get_loan_id(number), portfolio.get_bucket_identifiers(number), repositories['bucket'].get(), ledger)
+    return operation
+
+def get_changes(portfolio: Portfolio, repositories: Dict) -> Operation:
+    ledger_repo = repositories['ledger']
+
+    def operation(number: int):
+        # Consumers resume from anywhere in the ledger, most of it behind the feed buffer
+        after = number * 7919 % ledger_repo.feed.last_sequence
+        services.get_changes(after, ledger_repo, repositories['bucket'].get(), 100)
+    return operation
+
+def create_http_client(repositories: Dict):
+    from ledger.entrypoints import flask_app
+    flask_app.repositories = repositories
+    flask_app.read_cache = create_cache()
+    flask_app.idempotency_store = create_idempotency_store()
+    return flask_app.app.test_client()
+
+def check_response(response):
+    if response.status_code != 200:
+        raise RuntimeError(f'{response.request.method} {response.request.path} returned {response.status_code}: {response.get_data(as_text=True)}')
+
+def post_bucket(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        check_response(client.post(f'/ledger/buckets?identifier=benchmark-bucket-{number}'))
+    return operation
+
+def post_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        loan_id = portfolio.get_loan_id(number)
+        check_response(client.post(f'/ledger/entries?loan_id={loan_id}', json=portfolio.pair_entries[loan_id][:1]))
+    return operation
+
+def post_bulk_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        rows = []
+        for row_number in range(number * BULK_ROWS, (number + 1) * BULK_ROWS):
+            loan_id = portfolio.get_loan_id(row_number)
+            rows.append({'loan_id': loan_id, **portfolio.pair_entries[loan_id][0]})
+        check_response(client.post('/ledger/entries/bulk', json=rows))
+    return operation
+
+def retry_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        # Every loan's entries are posted once and then retried with the same key
+        loan_id = portfolio.get_loan_id(number)
+        check_response(client.post(f'/ledger/entries?loan_id={loan_id}', json=portfolio.pair_entries[loan_id][:1], headers={'Idempotency-Key': f'benchmark-{loan_id}'}))
+    return operation
+
+def get_entries(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        check_response(client.get(f'/ledger/entries?loan_id={portfolio.get_loan_id(number)}'))
+    return operation
+
+def get_sum(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+
+    def operation(number: int):
+        bucket_parameters = '&'.join(f'bucket_id={identifier}' for identifier in portfolio.get_bucket_identifiers(number))
+        check_response(client.get(f'/ledger/buckets/sum?loan_id={portfolio.get_loan_id(number)}&{bucket_parameters}'))
+    return operation
+
+def get_feed(portfolio: Portfolio, repositories: Dict) -> Operation:
+    client = create_http_client(repositories)
+    ledger_repo = repositories['ledger']
+
+    def operation(number: int):
+        after = number * 7919 % ledger_repo.feed.last_sequence
+        check_response(client.get(f'/ledger/changes?after={after}&limit=100'))
+    return operation
+
+SCENARIOS = {
+    'service.create_bucket': create_bucket,
+    'service.create_double_entries': create_double_entries,
+    'service.get_ledger_entries': get_ledger_entries,
+    'service.get_buckets_sum': get_buckets_sum,
+    'service.get_changes': get_changes,
+    'http.post_bucket': post_bucket,
+    'http.post_entries': post_entries,
+    'http.post_bulk_entries': post_bulk_entries,
+    'http.retry_entries': retry_entries,
+    'http.get_entries': get_entries,
+    'http.get_buckets_sum': get_sum,
+    'http.get_changes': get_feed,
+} # type: Dict[str, Callable[[Portfolio, Dict], Operation]]
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def run_scenario(scenario: Callable[[Portfolio, Dict], Operation], portfolio: Portfolio, operations: int) -> Dict:
+    """
+    Times every operation of a scenario on a freshly loaded portfolio,
+    then replays them on another one while tracing allocations, which
+    would otherwise distort the timings
+
+    Args:
+        scenario(Callable): Creates the operation from the portfolio and its repositories
+        portfolio(Portfolio): Portfolio to load
+        operations(int): Number of operations
+    Returns:
+        result(Dict): Throughput, latency percentiles in milliseconds and peak memory
+    """
+    operation = scenario(portfolio, portfolio.load())
+    latencies = []
+    start = time.perf_counter()
+    for number in range(operations):
+        operation_start = time.perf_counter()
+        operation(number)
+        latencies.append(time.perf_counter() - operation_start)
+    seconds = time.perf_counter() - start
+
+    operation = scenario(portfolio, portfolio.load())
+    tracemalloc.start()
+    for number in range(operations):
+        operation(number)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'operations': operations,
+        'operations_per_second': operations / seconds,
+        'latency_ms': {name: percentile(latencies, fraction) * 1000 for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+        'peak_memory_kb': peak_memory / 1024,
+    }
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict, baseline: Dict, threshold: float):
+    print(f'\ncompared with {baseline["metadata"].get("commit") or "baseline"}, regressions beyond {threshold:.0%} marked with !')
+    for name, result in results['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        throughput_change = result['operations_per_second'] / previous['operations_per_second'] - 1
+        p99_change = result['latency_ms']['p99'] / previous['latency_ms']['p99'] - 1 if previous['latency_ms']['p99'] else 0.0
+        regressed = throughput_change < -threshold or p99_change > threshold
+        print(f'{"!" if regressed else " "} {name:<30} throughput {throughput_change:+7.1%} | p99 {p99_change:+7.1%}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loans', type=int, default=1000)
+    parser.add_argument('--buckets', type=int, default=6)
+    parser.add_argument('--entries-per-loan', type=int, default=50, help='pair entries of every loan in the portfolio')
+    parser.add_argument('--operations', type=int, default=2000, help='operations per scenario')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--only', nargs='+', default=[], help='only run scenarios starting with one of these prefixes')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with a JSON file saved by an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    # Benchmarks always run on in-memory repositories
+    os.environ.pop('LEDGER_DATA_DIR', None)
+    os.environ.pop('LEDGER_SQLITE_PATH', None)
+
+    portfolio = Portfolio(args.loans, args.buckets, args.entries_per_loan, args.seed)
+    results = {
+        'metadata': {
+            'commit': get_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'parameters': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        },
+        'results': {},
+    }
+
+    print(f'{args.loans:,} loans x {args.entries_per_loan} pair entries over {len(portfolio.bucket_identifiers)} buckets, '
+          f'{args.operations:,} operations per scenario')
+    for name, scenario in SCENARIOS.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        operations = max(1, args.operations // BULK_ROWS) if scenario is post_bulk_entries else args.operations
+        result = results['results'][name] = run_scenario(scenario, portfolio, operations)
+        latency = result['latency_ms']
+        print(f'{name:<30} {result["operations_per_second"]:10,.0f} ops/s | p50 {latency["p50"]:7.3f}ms '
+              f'p90 {latency["p90"]:7.3f}ms p99 {latency["p99"]:7.3f}ms max {latency["max"]:8.3f}ms | '
+              f'peak {result["peak_memory_kb"]:9,.0f}KB')
+
+    single, bulk = (results['results'].get(name) for name in ('http.post_entries', 'http.post_bulk_entries'))
+    if single and bulk:
+        # Both post one pair entry per loan, a bulk request posts BULK_ROWS of them
+        speedup = bulk['operations_per_second'] * BULK_ROWS / single['operations_per_second']
+        print(f'bulk posting: {bulk["operations_per_second"] * BULK_ROWS:,.0f} rows/s, {speedup:.1f}x single loan posting')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline), args.threshold)
+
+if __name__ == '__main__':
+    main()
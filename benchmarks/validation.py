@@ -0,0 +1,129 @@
+"""
+Request validation: the pair entries posted for a loan and the query
+string of bucket sums, validated by the compiled schemas of the routes
+against the checks the routes and services made before them, which are
+kept here as the baseline
+
+    python -m benchmarks.validation --batch-sizes 1 10 100 --repeat 2000
+"""
+import argparse
+import time
+from datetime import (date, timedelta)
+from typing import (Any, Callable, Dict, List, Optional)
+
+from werkzeug.datastructures import MultiDict
+
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.money import to_minor_units
+from ledger.service_layer import (schema, services)
+from ledger.service_layer.schema import validate_buckets_sum_query
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+
+def get_pair_entries_error(entries: Any) -> Optional[str]:
+    # Structure checks the routes made before handing the body to the services
+    if not isinstance(entries, list):
+        return 'Please provide a list of pair entries'
+    for entry in entries:
+        debit_entry = entry.get('debit', None) if isinstance(entry, dict) else None
+        credit_entry = entry.get('credit', None) if isinstance(entry, dict) else None
+        if not isinstance(debit_entry, dict) or not isinstance(credit_entry, dict):
+            return 'Please provide valid debit and credit objects for each pair entry'
+
+        if not isinstance(debit_entry.get('value'), float) or not isinstance(credit_entry.get('value'), float):
+            return 'Please provide valid floating point value for each pair entry'
+    return None
+
+def build_double_entries(loan_id: int, pair_entries: List[Dict], buckets) -> List:
+    # Parsing and checks the services made on the raw body
+    buckets = services.to_bucket_mapping(buckets)
+    ledger_entries = []
+    for pair_entry in pair_entries:
+        debit_entry = pair_entry['debit']
+        credit_entry = pair_entry['credit']
+
+        if not pair_entry.get('effective_date'):
+            effective_date = date.today()
+        else:
+            try:
+                effective_date = date.fromisoformat(pair_entry['effective_date'])
+            except ValueError:
+                raise ValueError('Effective date value must be a string with YYYY-MM-DD format')
+
+        debit_value = to_minor_units(debit_entry['value'])
+        credit_value = to_minor_units(credit_entry['value'])
+        if not services.is_valid_pair_value(debit_value, credit_value):
+            raise services.InvalidPairValue('Debit value must be positive, credit value must be negative and the absolute value must be equal to each other')
+
+        ledger_entries.append(services.build_ledger_entry(loan_id, debit_entry['identifier'], debit_value, effective_date, buckets))
+        ledger_entries.append(services.build_ledger_entry(loan_id, credit_entry['identifier'], credit_value, effective_date, buckets))
+    return ledger_entries
+
+def validate_before(body: Any, buckets) -> List:
+    error = get_pair_entries_error(body)
+    if error:
+        raise ValueError(error)
+    return build_double_entries(1, body, buckets)
+
+def validate_with_schema(body: Any, buckets) -> List:
+    return services.build_double_entries(1, schema.parse_pair_entries(body), buckets)
+
+def parse_optional_date(value: Optional[str]) -> Optional[date]:
+    # The date parsing the services did for the routes
+    return date.fromisoformat(value) if value else None
+
+def validate_query_before(args: MultiDict) -> Any:
+    loan_id = args.get('loan_id', type=int)
+    if not loan_id:
+        raise ValueError('Please enter a valid integer loan id')
+    bucket_identifiers = args.getlist('bucket_id', type=str)
+    if not bucket_identifiers:
+        raise ValueError('Please enter at least one bucket identifier')
+    return loan_id, bucket_identifiers, parse_optional_date(args.get('as_of')), args.get('consistency_check', '').lower() in ('1', 'true', 'yes')
+
+def validate_query_with_schema(args: MultiDict) -> Any:
+    return validate_buckets_sum_query(args.getlist)
+
+def create_body(batch_size: int) -> List[Dict]:
+    return [
+        {
+            'effective_date': (date(2021, 1, 1) + timedelta(days=number % 30)).isoformat(),
+            'debit': {'identifier': BUCKETS[0], 'value': 0.25},
+            'credit': {'identifier': BUCKETS[1], 'value': -0.25},
+        }
+        for number in range(batch_size)
+    ]
+
+def measure(validate: Callable[..., Any], repeat: int, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        validate(*args)
+    return (time.perf_counter() - start) / repeat
+
+def report(name: str, before: float, after: float, items: int):
+    print(f'{name:<22} before {before * 1e6:10.2f}us | schema {after * 1e6:10.2f}us | {after / before - 1:+7.1%} | '
+          f'{after * 1e6 / items:8.3f}us per item')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    buckets = {identifier: AccountingBucket.create(identifier) for identifier in BUCKETS}
+    for batch_size in args.batch_sizes:
+        body = create_body(batch_size)
+        assert [entry.value for entry in validate_before(body, buckets)] == [entry.value for entry in validate_with_schema(body, buckets)]
+        repeat = max(1, args.repeat * 10 // max(batch_size, 10))
+        before = min(measure(validate_before, repeat, body, buckets) for _ in range(3))
+        after = min(measure(validate_with_schema, repeat, body, buckets) for _ in range(3))
+        report(f'{batch_size} pair entries', before, after, batch_size)
+
+    query = MultiDict([('loan_id', '42'), ('bucket_id', BUCKETS[0]), ('bucket_id', BUCKETS[1]), ('as_of', '2021-06-30')])
+    assert validate_query_before(query)[:3] == tuple(validate_query_with_schema(query))[:3]
+    before = min(measure(validate_query_before, args.repeat * 10, query) for _ in range(3))
+    after = min(measure(validate_query_with_schema, args.repeat * 10, query) for _ in range(3))
+    report('bucket sum query', before, after, 1)
+
+if __name__ == '__main__':
+    main()
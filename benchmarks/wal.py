@@ -0,0 +1,89 @@
+"""
+Write-ahead log benchmarks: append throughput per fsync policy and
+recovery time of a populated log, with and without a snapshot
+
+    python -m benchmarks.wal --entries 200000 --batch-size 2
+"""
+import argparse
+import tempfile
+import time
+from datetime import date
+
+from ledger.adapters import (repository, snapshot, wal)
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import to_minor_units
+
+BUCKETS = ('accounts-receivable-interest', 'income-interest')
+QUARTER = to_minor_units(0.25)
+
+def create_batches(entries: int, batch_size: int, loans: int):
+    today = date.today()
+    batches = []
+    for index in range(0, entries, batch_size):
+        loan_id = index % loans + 1
+        batches.append([
+            LedgerEntry(loan_id, today, today, BUCKETS[position % 2], QUARTER if position % 2 == 0 else -QUARTER)
+            for position in range(batch_size)
+        ])
+    return batches
+
+def bench_append(directory: str, fsync_policy: str, batches) -> float:
+    write_ahead_log = wal.WriteAheadLog(directory, fsync_policy)
+    ledger_repo = repository.LedgerRepository(write_ahead_log)
+    bucket_repo = repository.BucketRepository(write_ahead_log)
+    for identifier in BUCKETS:
+        bucket_repo.add(AccountingBucket.create(identifier))
+
+    start = time.perf_counter()
+    for batch in batches:
+        ledger_repo.add(batch)
+    write_ahead_log.close()
+    return time.perf_counter() - start
+
+def bench_recover(directory: str) -> float:
+    start = time.perf_counter()
+    write_ahead_log = wal.WriteAheadLog(directory)
+    repository.recover(write_ahead_log, repository.LedgerRepository(), repository.BucketRepository())
+    return time.perf_counter() - start
+
+def bench_snapshot(directory: str):
+    write_ahead_log = wal.WriteAheadLog(directory)
+    ledger_repo = repository.LedgerRepository(write_ahead_log)
+    bucket_repo = repository.BucketRepository(write_ahead_log)
+    repository.recover(write_ahead_log, ledger_repo, bucket_repo)
+
+    start = time.perf_counter()
+    snapshot.Snapshotter(write_ahead_log, ledger_repo, bucket_repo, interval=0).take_snapshot()
+    write_ahead_log.close()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--loans', type=int, default=1000)
+    parser.add_argument('--policies', nargs='+', default=list(wal.FSYNC_POLICIES))
+    args = parser.parse_args()
+
+    batches = create_batches(args.entries, args.batch_size, args.loans)
+    entries = sum(len(batch) for batch in batches)
+    print(f'{entries} entries in {len(batches)} batches of {args.batch_size}')
+    for fsync_policy in args.policies:
+        with tempfile.TemporaryDirectory() as directory:
+            # fsync on every batch is orders of magnitude slower, keep its run short
+            policy_batches = batches[:1000] if fsync_policy == wal.FSYNC_ALWAYS else batches
+            policy_entries = sum(len(batch) for batch in policy_batches)
+            append_seconds = bench_append(directory, fsync_policy, policy_batches)
+            recover_seconds = bench_recover(directory)
+            print(f'{fsync_policy:>8}: append {policy_entries / append_seconds:12,.0f} entries/s, '
+                  f'{len(policy_batches) / append_seconds:10,.0f} batches/s | '
+                  f'recover {policy_entries / recover_seconds:12,.0f} entries/s ({recover_seconds:.3f}s)')
+
+            snapshot_seconds = bench_snapshot(directory)
+            snapshot_recover_seconds = bench_recover(directory)
+            print(f'{"":>8}  snapshot {snapshot_seconds:.3f}s | '
+                  f'recover from snapshot {policy_entries / snapshot_recover_seconds:12,.0f} entries/s ({snapshot_recover_seconds:.3f}s)')
+
+if __name__ == '__main__':
+    main()
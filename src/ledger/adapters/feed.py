@@ -0,0 +1,103 @@
+import threading
+from typing import (Callable, List, Optional, Set)
+
+from ledger.domain.ledger import LedgerEntry
+
+FEED_SIZE = 10000
+
+class ChangeFeed:
+    """
+    Ring buffer of the latest entries added to a ledger, addressed by
+    their sequence numbers, which consumers of the change feed read from
+    instead of querying the ledger. Entries are published by the ledger
+    repository under its write lock and read under its read lock, so the
+    buffer always matches the ledger.
+
+    Listeners are called after every publish, still under the write lock,
+    and must only wake their consumer up.
+    """
+    def __init__(self, size: int = FEED_SIZE):
+        self.size = size
+        self.buffer = [None] * size # type: List[Optional[LedgerEntry]]
+        # Sequence numbers of the oldest entry buffered and of the latest entry added
+        self.first_sequence = 1
+        self.last_sequence = 0
+        self.listeners_lock = threading.Lock()
+        self.listeners = set() # type: Set[Callable[[], None]]
+
+    def restart(self, last_sequence: int):
+        """
+        Starts the feed after the entries already in the ledger, e.g. once
+        it is recovered, leaving them to be read from the ledger itself
+
+        Args:
+            last_sequence(int): Sequence number of the latest entry in the ledger
+        """
+        self.first_sequence = last_sequence + 1
+        self.last_sequence = last_sequence
+
+    def publish(self, entries: List[LedgerEntry], last_sequence: int):
+        """
+        Args:
+            entries(List[LedgerEntry]): Entries added to the ledger
+            last_sequence(int): Sequence number the ledger assigned to the last of them
+        """
+        if self.size:
+            for sequence, entry in enumerate(entries, last_sequence - len(entries) + 1):
+                self.buffer[(sequence - 1) % self.size] = entry
+        self.last_sequence = last_sequence
+        self.first_sequence = max(self.first_sequence, last_sequence - self.size + 1)
+
+        with self.listeners_lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def get_entries(self, start: int, stop: int) -> Optional[List[LedgerEntry]]:
+        """
+        Returns the entries numbered after start up to stop, None when the
+        oldest of them is no longer buffered
+
+        Args:
+            start(int): Sequence number to read after
+            stop(int): Sequence number of the last entry to read
+        Returns:
+            entries(Optional[List[LedgerEntry]]): Entries in sequence order
+        """
+        if start + 1 < self.first_sequence:
+            return None
+        if stop <= start:
+            return []
+        # The entry numbered start + 1 is at start % size, the range wraps around at most once
+        begin = start % self.size
+        end = begin + stop - start
+        if end <= self.size:
+            return self.buffer[begin:end]
+        return self.buffer[begin:] + self.buffer[:end - self.size]
+
+    def add_listener(self, listener: Callable[[], None]):
+        with self.listeners_lock:
+            self.listeners.add(listener)
+
+    def remove_listener(self, listener: Callable[[], None]):
+        with self.listeners_lock:
+            self.listeners.discard(listener)
+
+    def wait(self, after: int, timeout: float) -> bool:
+        """
+        Blocks until an entry numbered after a sequence number is published
+
+        Args:
+            after(int): Sequence number already read
+            timeout(float): Seconds to wait at most
+        Returns:
+            published(bool): Whether such an entry was published
+        """
+        published = threading.Event()
+        listener = published.set
+        self.add_listener(listener)
+        try:
+            # Checked once listening, an entry published meanwhile is not missed
+            return self.last_sequence > after or published.wait(timeout)
+        finally:
+            self.remove_listener(listener)
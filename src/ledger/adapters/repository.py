@@ -1,30 +1,253 @@
-from typing import (Dict, List)
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import (Callable, Deque, Dict, Iterator, List, Mapping, Optional, Tuple)
 
-from ledger.domain import (ledger, bucket)
+from ledger import (locks, metrics)
+from ledger.adapters import snapshot
+from ledger.adapters import feed as change_feed
+from ledger.adapters import wal as write_ahead_log
+from ledger.domain import (ledger, bucket, columnar_ledger, loan)
+
+REPLAY_BATCH_SIZE = 10000
+
+# Lock order: the bucket repository lock, then the loan repository lock, then
+# the ledger lock. A lock is never taken while holding one that comes after it
 
 class LedgerRepository:
-    def __init__(self):
-        self.ledger = ledger.Ledger()
+    def __init__(self, wal: Optional[write_ahead_log.WriteAheadLog] = None, columnar: bool = False, feed: Optional[change_feed.ChangeFeed] = None):
+        self.ledger = columnar_ledger.ColumnarLedger() if columnar else ledger.Ledger()
+        self.wal = wal
+        self.lock = locks.ReadWriteLock()
+        self.feed = feed if feed is not None else change_feed.ChangeFeed()
+        # Logged batches waiting to be durable before they are published, with their record and sequence numbers
+        self.unpublished = deque() # type: Deque[Tuple[int, List[ledger.LedgerEntry], int]]
+        if wal:
+            wal.add_sync_listener(self.publish_durable)
+
+    @metrics.timed_append
+    def add(self, entries: List[ledger.LedgerEntry], buckets: Optional[Mapping[str, bucket.AccountingBucket]] = None, loans: Optional[Mapping[int, loan.Loan]] = None,
+            check: Optional[Callable[[List[ledger.LedgerEntry]], List[ledger.LedgerEntry]]] = None) -> List[ledger.LedgerEntry]:
+        """
+        Logs and adds a batch of entries, together with its bucket totals
+        and loan summaries when buckets and loans are given, as one write.
+        A batch which cannot be stored is rejected before it is logged.
+        The log is synced after the lock is released so concurrent
+        writers share a single fsync. A logged batch is published to the
+        change feed once it is durable under the fsync policy, so
+        consumers never see entries which a crash would lose and whose
+        sequence numbers recovery would hand out again
 
-    def add(self, entries: List[ledger.LedgerEntry]):
-        self.ledger.add_new_entries(entries)
+        Args:
+            entries(List[LedgerEntry]): Validated entries
+            buckets(Optional[Mapping[str, AccountingBucket]]): Buckets to add
+                the entry values to
+            loans(Optional[Mapping[int, Loan]]): Loans to add the entries to
+            check(Optional[Callable]): Called with the entries under the write
+                lock before anything is logged, e.g. to check that their loans
+                are still open, and returns the entries to add. Raising
+                rejects the batch
+        Returns:
+            entries(List[LedgerEntry]): Added entries
+        """
+        if check is None:
+            ledger.check_new_entries(entries)
+        with self.lock.write():
+            if check is not None:
+                entries = check(entries)
+                ledger.check_new_entries(entries)
+            record_number = self.wal.append_entries(entries, commit=False) if self.wal else 0
+            sequence = self.ledger.add_new_entries(entries)
+            if buckets is not None:
+                for entry in entries:
+                    buckets[entry.bucket_identifier].add_value(entry.value)
+            if loans is not None:
+                for entry in entries:
+                    loans[entry.loan_id].add_entry(entry)
+            if self.wal:
+                self.unpublished.append((record_number, entries, sequence))
+            else:
+                self.feed.publish(entries, sequence)
+        if self.wal:
+            self.wal.commit(record_number)
+            self.publish_durable()
+        return entries
+
+    def publish_durable(self):
+        """
+        Publishes the logged batches which are durable by now, in the
+        order they were added. Called after commits and after every sync
+        of the log, e.g. by the flusher under the interval policy
+        """
+        durable_records = self.wal.durable_records
+        if not self.unpublished or self.unpublished[0][0] > durable_records:
+            return
+        # The feed is read under the read lock, so it is only written under the write lock
+        with self.lock.write():
+            while self.unpublished and self.unpublished[0][0] <= durable_records:
+                _, entries, sequence = self.unpublished.popleft()
+                self.feed.publish(entries, sequence)
 
     def get(self) -> ledger.Ledger:
         return self.ledger
 
+    @contextmanager
+    def read(self) -> Iterator[ledger.Ledger]:
+        # Keeps writers out so balances and entries are read between batches
+        with self.lock.read():
+            yield self.ledger
+
 class LoanRepository:
-    def __init__(self):
-        self.loans = {} # type: Dict[int, List[bucket.AccountingBucket]]
-    
-    def get(self, loan_id: int) -> List[bucket.AccountingBucket]:
-        return self.loans.get(loan_id, [])
+    """
+    Registry of opened loans keyed by loan id, each attached to the
+    partition of the ledger holding its entries
+    """
+    def __init__(self, ledger_repo: LedgerRepository, wal: Optional[write_ahead_log.WriteAheadLog] = None):
+        self.loans = {} # type: Dict[int, loan.Loan]
+        self.ledger_repo = ledger_repo
+        self.wal = wal
+        self.lock = threading.Lock()
+
+    def add(self, loan: loan.Loan) -> bool:
+        """
+        Logs and registers a loan unless one with the same id is
+        registered. The log is synced after the lock is released, a sync
+        publishes entries under the ledger lock which comes after this one
+
+        Args:
+            loan(Loan): Loan to register
+        Returns:
+            added(bool): False when the loan id is taken, nothing is added then
+        """
+        with self.lock:
+            if loan.loan_id in self.loans:
+                return False
+            record_number = self.wal.append_loan(loan.loan_id, loan.status, commit=False) if self.wal else 0
+            loan.entries = self.ledger_repo.get().get_loan_partition(loan.loan_id)
+            self.loans[loan.loan_id] = loan
+        if self.wal:
+            self.wal.commit(record_number)
+        return True
+
+    def close(self, loan: loan.Loan) -> bool:
+        """
+        Logs and closes an open loan under the ledger write lock, so a
+        batch checked against the loan under that lock is either written
+        before the loan is closed or rejected
+
+        Args:
+            loan(Loan): Loan to close
+        Returns:
+            closed(bool): False when the loan was closed already, nothing is logged then
+        """
+        with self.lock, self.ledger_repo.lock.write():
+            if not loan.is_open():
+                return False
+            loan.close()
+            record_number = self.wal.append_loan(loan.loan_id, loan.status, commit=False) if self.wal else 0
+        if self.wal:
+            self.wal.commit(record_number)
+        return True
+
+    def get(self) -> Dict[int, loan.Loan]:
+        return self.loans
+
+    def get_all(self) -> List[loan.Loan]:
+        # Copied under the lock, opening a loan while the dict is iterated would fail the iteration
+        with self.lock:
+            return list(self.loans.values())
 
 class BucketRepository:
-    def __init__(self):
-        self.buckets = [] # type: List[bucket.AccountingBucket]
+    def __init__(self, wal: Optional[write_ahead_log.WriteAheadLog] = None):
+        self.buckets = {} # type: Dict[str, bucket.AccountingBucket]
+        self.wal = wal
+        self.lock = threading.Lock()
+
+    def add(self, bucket: bucket.AccountingBucket) -> bool:
+        """
+        Logs and adds a bucket unless one with the same identifier was
+        added. The log is synced after the lock is released, as in
+        LoanRepository.add
+
+        Args:
+            bucket(AccountingBucket): Bucket to add
+        Returns:
+            added(bool): False when the identifier is taken, nothing is added then
+        """
+        with self.lock:
+            if bucket.identifier in self.buckets:
+                return False
+            record_number = self.wal.append_bucket(bucket.identifier, commit=False) if self.wal else 0
+            self.buckets[bucket.identifier] = bucket
+        if self.wal:
+            self.wal.commit(record_number)
+        return True
+
+    def get(self) -> Dict[str, bucket.AccountingBucket]:
+        return self.buckets
+
+    def get_all(self) -> Dict[str, bucket.AccountingBucket]:
+        # Copied under the lock, adding a bucket while the dict is iterated would fail the iteration
+        with self.lock:
+            return dict(self.buckets)
+
+def recover(wal: write_ahead_log.WriteAheadLog, ledger_repo: LedgerRepository, bucket_repo: BucketRepository, loan_repo: Optional[LoanRepository] = None):
+    """
+    Rebuilds the ledger, its indexes, the bucket totals and the loans
+    from the latest snapshot and the write-ahead log segments after it,
+    without writing the replayed records back to the log. Loans with
+    entries logged before loans were registered are opened
+
+    Args:
+        wal(WriteAheadLog): Log to replay
+        ledger_repo(LedgerRepository): Empty ledger repository to fill
+        bucket_repo(BucketRepository): Empty bucket repository to fill
+        loan_repo(Optional[LoanRepository]): Empty loan repository to fill
+    """
+    buckets = bucket_repo.get()
+    loans = {} # type: Dict[int, loan.Loan]
+    pending_entries = [] # type: List[ledger.LedgerEntry]
+
+    def add_entry(entry: ledger.LedgerEntry):
+        buckets[entry.bucket_identifier].add_value(entry.value)
+        entry_loan = loans.get(entry.loan_id)
+        if entry_loan is None:
+            entry_loan = loans[entry.loan_id] = loan.Loan.create(entry.loan_id)
+        entry_loan.add_entry(entry)
+
+    snapshot_segment_number = 0
+    snapshot_path = snapshot.find_latest_snapshot(wal.directory)
+    if snapshot_path:
+        snapshot_segment_number, bucket_identifiers, pending_entries, loan_statuses = snapshot.read_snapshot(snapshot_path)
+        for identifier in bucket_identifiers:
+            buckets[identifier] = bucket.AccountingBucket.create(identifier)
+        for loan_id, status in loan_statuses:
+            loans[loan_id] = loan.Loan(loan_id, status)
+        for entry in pending_entries:
+            add_entry(entry)
+
+    for record in wal.read_records(snapshot_segment_number):
+        if record['op'] == write_ahead_log.BUCKET_RECORD:
+            buckets[record['identifier']] = bucket.AccountingBucket.create(record['identifier'])
+        elif record['op'] == write_ahead_log.LOAN_RECORD:
+            record_loan = loans.get(record['loan_id'])
+            if record_loan is None:
+                record_loan = loans[record['loan_id']] = loan.Loan.create(record['loan_id'])
+            record_loan.status = record['status']
+        elif record['op'] == write_ahead_log.ENTRIES_RECORD:
+            for row in record['entries']:
+                entry = write_ahead_log.decode_entry(row)
+                add_entry(entry)
+                pending_entries.append(entry)
+
+        if len(pending_entries) >= REPLAY_BATCH_SIZE:
+            ledger_repo.get().add_new_entries(pending_entries)
+            pending_entries = []
 
-    def add(self, bucket: bucket.AccountingBucket):
-        self.buckets.append(bucket)
+    ledger_repo.get().add_new_entries(pending_entries)
+    ledger_repo.feed.restart(ledger_repo.get().count_entries())
 
-    def get(self) -> List[bucket.AccountingBucket]:
-        return self.buckets
\ No newline at end of file
+    if loan_repo is not None:
+        for recovered_loan in loans.values():
+            recovered_loan.entries = ledger_repo.get().get_loan_partition(recovered_loan.loan_id)
+        loan_repo.get().update(loans)
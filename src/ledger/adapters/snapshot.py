@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+from array import array
+from contextlib import nullcontext
+from datetime import date
+from typing import (Dict, List, Optional, Sequence, Tuple)
+
+from ledger.adapters import wal as write_ahead_log
+from ledger.domain.ledger import LedgerEntry
+
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_SUFFIX = '.bin'
+SNAPSHOT_MAGIC = b'LDGSNAP2'
+HEADER_LENGTH = struct.Struct('<I')
+
+logger = logging.getLogger(__name__)
+
+# Column name and array typecode, in file order
+COLUMNS = (
+    ('loan_id', 'q'),
+    ('created_at', 'i'),
+    ('effective_date', 'i'),
+    ('bucket_code', 'i'),
+    ('value', 'q'),
+)
+
+def get_snapshot_path(directory: str, segment_number: int) -> str:
+    return os.path.join(directory, f'{SNAPSHOT_PREFIX}{segment_number:06d}{SNAPSHOT_SUFFIX}')
+
+def get_snapshot_segment_numbers(directory: str) -> List[int]:
+    segment_numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            segment_numbers.append(int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)]))
+    return sorted(segment_numbers)
+
+def write_snapshot(path: str, segment_number: int, bucket_identifiers: Sequence[str], entries: Sequence[LedgerEntry], loan_statuses: Sequence[Tuple[int, str]] = ()):
+    """
+    Writes the buckets, loans and entries covered by the log segments up
+    to segment_number as one JSON header followed by typed columns, then
+    atomically moves the file into place and syncs its directory
+
+    Args:
+        path(str): Final path of the snapshot
+        segment_number(int): Last log segment the snapshot covers
+        bucket_identifiers(Sequence[str]): Identifiers of every created bucket
+        entries(Sequence[LedgerEntry]): Entries in insertion order
+        loan_statuses(Sequence[Tuple[int, str]]): Id and status of every opened loan
+    """
+    bucket_codes = {identifier: code for code, identifier in enumerate(bucket_identifiers)}
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+    for entry in entries:
+        columns['loan_id'].append(entry.loan_id)
+        columns['created_at'].append(entry.created_at.toordinal())
+        columns['effective_date'].append(entry.effective_date.toordinal())
+        columns['bucket_code'].append(bucket_codes[entry.bucket_identifier])
+        columns['value'].append(entry.value)
+
+    header = json.dumps({
+        'segment_number': segment_number,
+        'byteorder': sys.byteorder,
+        'entries': len(entries),
+        'buckets': list(bucket_identifiers),
+        'loans': [list(loan_status) for loan_status in loan_statuses],
+    }).encode()
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as snapshot:
+        snapshot.write(SNAPSHOT_MAGIC)
+        snapshot.write(HEADER_LENGTH.pack(len(header)))
+        snapshot.write(header)
+        for name, _ in COLUMNS:
+            columns[name].tofile(snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary_path, path)
+    # The covered log segments are removed next, the rename must be on disk before
+    write_ahead_log.sync_directory(os.path.dirname(path) or '.')
+
+def read_snapshot(path: str) -> Tuple[int, List[str], List[LedgerEntry], List[Tuple[int, str]]]:
+    """
+    Reads a snapshot written by write_snapshot
+
+    Args:
+        path(str): Path of the snapshot
+    Returns:
+        segment_number(int): Last log segment the snapshot covers
+        bucket_identifiers(List[str]): Identifiers of every created bucket
+        entries(List[LedgerEntry]): Entries in insertion order
+        loan_statuses(List[Tuple[int, str]]): Id and status of every opened
+            loan, empty for snapshots taken before loans were registered
+    """
+    with open(path, 'rb') as snapshot:
+        if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f'"{path}" is not a ledger snapshot')
+        header_length, = HEADER_LENGTH.unpack(snapshot.read(HEADER_LENGTH.size))
+        header = json.loads(snapshot.read(header_length))
+
+        columns = {}
+        for name, typecode in COLUMNS:
+            column = array(typecode)
+            column.fromfile(snapshot, header['entries'])
+            if header['byteorder'] != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+
+    bucket_identifiers = header['buckets']
+    dates = {} # type: Dict[int, date]
+    entries = []
+    for loan_id, created_at, effective_date, bucket_code, value in zip(*(columns[name] for name, _ in COLUMNS)):
+        if created_at not in dates:
+            dates[created_at] = date.fromordinal(created_at)
+        if effective_date not in dates:
+            dates[effective_date] = date.fromordinal(effective_date)
+        entries.append(LedgerEntry(loan_id, dates[created_at], dates[effective_date], bucket_identifiers[bucket_code], value))
+
+    return header['segment_number'], bucket_identifiers, entries, [(loan_id, status) for loan_id, status in header.get('loans', [])]
+
+def find_latest_snapshot(directory: str) -> Optional[str]:
+    segment_numbers = get_snapshot_segment_numbers(directory)
+    if not segment_numbers:
+        return None
+    return get_snapshot_path(directory, segment_numbers[-1])
+
+class Snapshotter:
+    """
+    Periodically snapshots the ledger, bucket and loan repositories and
+    drops the log segments the snapshot covers
+
+    Writers are only paused while the log is rotated and the number of
+    entries is read. The ledger entry list is append-only, so the prefix
+    up to that number is written afterwards without holding any lock.
+    Nothing is written when no record was logged since the previous
+    snapshot, and a failed snapshot is logged and retried on the next
+    interval.
+    """
+    def __init__(self, wal: write_ahead_log.WriteAheadLog, ledger_repo, bucket_repo, interval: float, loan_repo=None):
+        self.wal = wal
+        self.ledger_repo = ledger_repo
+        self.bucket_repo = bucket_repo
+        self.loan_repo = loan_repo
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None # type: Optional[threading.Thread]
+        # Records logged when the previous snapshot was taken, None before the first one
+        self.snapshot_records = None # type: Optional[int]
+
+    def take_snapshot(self) -> Optional[str]:
+        """
+        Returns:
+            path(Optional[str]): Path of the new snapshot, None when nothing
+                was logged since the previous one
+        """
+        with self.bucket_repo.lock, self.loan_repo.lock if self.loan_repo else nullcontext(), self.ledger_repo.lock.write():
+            records = self.wal.written_records
+            if records == self.snapshot_records:
+                return None
+            segment_number = self.wal.rotate()
+            bucket_identifiers = list(self.bucket_repo.get())
+            loan_statuses = [(loan.loan_id, loan.status) for loan in self.loan_repo.get().values()] if self.loan_repo else []
+            entries = self.ledger_repo.get().entries
+            entries_count = len(entries)
+
+        path = get_snapshot_path(self.wal.directory, segment_number)
+        write_snapshot(path, segment_number, bucket_identifiers, entries[:entries_count], loan_statuses)
+
+        self.wal.remove_segments(segment_number)
+        for previous_segment_number in get_snapshot_segment_numbers(self.wal.directory):
+            if previous_segment_number < segment_number:
+                os.remove(get_snapshot_path(self.wal.directory, previous_segment_number))
+        self.snapshot_records = records
+        return path
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.take_snapshot()
+            except Exception:
+                logger.exception('Taking a ledger snapshot failed')
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='ledger-snapshotter', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
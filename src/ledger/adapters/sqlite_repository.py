@@ -0,0 +1,399 @@
+import sqlite3
+import threading
+from collections.abc import Sequence
+from contextlib import contextmanager
+from datetime import date
+from typing import (Callable, Dict, Iterator, List, Mapping, Optional, Tuple)
+
+from ledger import (locks, metrics)
+from ledger.adapters.feed import ChangeFeed
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import (MAXIMUM_STORED_INTEGER, EntryKey, LedgerEntry, TrialBalance, check_new_entries)
+from ledger.domain.loan import (OPEN, Loan)
+
+# Values of PRAGMA synchronous, see SqliteDatabase
+SYNCHRONOUS_MODES = ('full', 'normal', 'off')
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS buckets (
+        identifier TEXT PRIMARY KEY
+    )''',
+    '''CREATE TABLE IF NOT EXISTS loans (
+        loan_id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ledger_entries (
+        id INTEGER PRIMARY KEY,
+        loan_id INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        effective_date TEXT NOT NULL,
+        bucket_identifier TEXT NOT NULL,
+        value INTEGER NOT NULL
+    )''',
+    # Covers bucket sums, as-of sums and per-bucket entry reads of a loan
+    '''CREATE INDEX IF NOT EXISTS ledger_entries_loan_bucket_date
+        ON ledger_entries (loan_id, bucket_identifier, effective_date, value)''',
+    # Covers entry reads of a loan ordered by effective date
+    '''CREATE INDEX IF NOT EXISTS ledger_entries_loan_date
+        ON ledger_entries (loan_id, effective_date)''',
+    '''CREATE INDEX IF NOT EXISTS ledger_entries_bucket
+        ON ledger_entries (bucket_identifier, value)''',
+)
+
+ENTRY_COLUMNS = 'id, loan_id, created_at, effective_date, bucket_identifier, value'
+
+# Sums are written as {sum}, see SqliteDatabase.fetch_sums
+BALANCE_COLUMNS = '''
+    COUNT(*),
+    COALESCE({sum}(CASE WHEN value >= 0 THEN value END), 0),
+    COALESCE({sum}(CASE WHEN value < 0 THEN value END), 0)
+'''
+
+class ExactSum:
+    """
+    Aggregate summing Python ints, which SQLite's SUM cannot do beyond
+    int64. A total which does not fit is returned as text, as SQLite
+    integers are int64 themselves
+    """
+    def __init__(self):
+        self.total = 0
+
+    def step(self, value: Optional[int]):
+        if value is not None:
+            self.total += value
+
+    def finalize(self):
+        return self.total if abs(self.total) <= MAXIMUM_STORED_INTEGER else str(self.total)
+
+class SqliteDatabase:
+    """
+    Single SQLite connection in WAL journal mode shared by the
+    repositories, with a lock serializing its use across threads.
+    With synchronous full every commit is synced to disk before it
+    returns. With normal the log is only synced at checkpoints, so a
+    power loss or OS crash may lose the last commits although they were
+    acknowledged, an application crash loses nothing. Off never syncs
+    """
+    def __init__(self, path: str, synchronous: str = 'full'):
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f'Unknown synchronous mode "{synchronous}", expected one of {", ".join(SYNCHRONOUS_MODES)}')
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(f'PRAGMA synchronous={synchronous.upper()}')
+            self.connection.create_aggregate('EXACT_SUM', 1, ExactSum)
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def fetch_all(self, query: str, parameters: Tuple = ()) -> List[Tuple]:
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def fetch_one(self, query: str, parameters: Tuple = ()) -> Tuple:
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+    def fetch_sums(self, query: str, parameters: Tuple = ()) -> List[Tuple]:
+        """
+        Runs a query whose sums are written as {sum} with SQLite's SUM
+        and again with EXACT_SUM when a sum overflows int64, so totals
+        stay exact like those of the in-memory ledger. Sums must be read
+        with int(), an exact one may be text
+        """
+        try:
+            return self.fetch_all(query.format(sum='SUM'), parameters)
+        except sqlite3.OperationalError as e:
+            if 'integer overflow' not in str(e):
+                raise
+            return self.fetch_all(query.format(sum='EXACT_SUM'), parameters)
+
+    def iterate(self, query: str, parameters: Tuple = ()) -> Iterator[Tuple]:
+        # Every row is collected under the lock, a cursor left open while
+        # other threads use the connection would see their writes or be reset
+        return iter(self.fetch_all(query, parameters))
+
+    def execute_many(self, statement: str, rows: List[Tuple]):
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(statement, rows)
+            except sqlite3.Error:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def to_ledger_entry(row: Tuple) -> LedgerEntry:
+    _, loan_id, created_at, effective_date, bucket_identifier, value = row
+    return LedgerEntry(loan_id, date.fromisoformat(created_at), date.fromisoformat(effective_date), bucket_identifier, value)
+
+def to_balance(identifier: str, row: Tuple) -> Optional[AccountingBucket]:
+    count, debit, credit = row
+    if not count:
+        return None
+    balance = AccountingBucket.create(identifier)
+    balance.debit = int(debit)
+    balance.credit = int(credit)
+    return balance
+
+def to_trial_balance(row: Tuple) -> TrialBalance:
+    trial_balance = TrialBalance()
+    trial_balance.entries, trial_balance.debit, trial_balance.credit = map(int, row)
+    return trial_balance
+
+class SqlitePartition(Sequence):
+    """
+    Entries of a single loan, queried through the loan index on every read
+    """
+    def __init__(self, database: SqliteDatabase, loan_id: int):
+        self.database = database
+        self.loan_id = loan_id
+
+    def __len__(self) -> int:
+        return self.database.fetch_one('SELECT COUNT(*) FROM ledger_entries WHERE loan_id = ?', (self.loan_id,))[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        row = self.database.fetch_one(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE loan_id = ? ORDER BY id LIMIT 1 OFFSET ?', (self.loan_id, index))
+        if row is None:
+            raise IndexError('partition index out of range')
+        return to_ledger_entry(row)
+
+    def __iter__(self) -> Iterator[LedgerEntry]:
+        return map(to_ledger_entry, self.database.iterate(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE loan_id = ? ORDER BY id', (self.loan_id,)))
+
+class SqliteLedger:
+    """
+    Ledger backed by the ledger_entries table, answering the same queries
+    as domain.ledger.Ledger with sums pushed down into SQL aggregates
+    """
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+
+    def add_new_entries(self, new_entries: List[LedgerEntry]) -> int:
+        self.database.execute_many(
+            'INSERT INTO ledger_entries (loan_id, created_at, effective_date, bucket_identifier, value) VALUES (?, ?, ?, ?, ?)',
+            [(entry.loan_id, entry.created_at.isoformat(), entry.effective_date.isoformat(), entry.bucket_identifier, entry.value) for entry in new_entries],
+        )
+        # Ids are the sequence numbers of the entries
+        return self.get_last_sequence()
+
+    def get_last_sequence(self) -> int:
+        return self.database.fetch_one('SELECT COALESCE(MAX(id), 0) FROM ledger_entries')[0]
+
+    def get_balance(self, loan_id: Optional[int], identifier: str) -> Optional[AccountingBucket]:
+        if loan_id:
+            row, = self.database.fetch_sums(f'SELECT {BALANCE_COLUMNS} FROM ledger_entries WHERE loan_id = ? AND bucket_identifier = ?', (loan_id, identifier))
+        else:
+            row, = self.database.fetch_sums(f'SELECT {BALANCE_COLUMNS} FROM ledger_entries WHERE bucket_identifier = ?', (identifier,))
+        return to_balance(identifier, row)
+
+    def get_balance_as_of(self, loan_id: Optional[int], identifier: str, as_of: date) -> int:
+        if loan_id:
+            (total,), = self.database.fetch_sums(
+                'SELECT COALESCE({sum}(value), 0) FROM ledger_entries WHERE loan_id = ? AND bucket_identifier = ? AND effective_date <= ?',
+                (loan_id, identifier, as_of.isoformat()),
+            )
+        else:
+            (total,), = self.database.fetch_sums(
+                'SELECT COALESCE({sum}(value), 0) FROM ledger_entries WHERE bucket_identifier = ? AND effective_date <= ?',
+                (identifier, as_of.isoformat()),
+            )
+        return int(total)
+
+    def get_balances(self, loan_id: Optional[int]) -> Dict[str, AccountingBucket]:
+        if loan_id:
+            rows = self.database.fetch_sums(f'SELECT bucket_identifier, {BALANCE_COLUMNS} FROM ledger_entries WHERE loan_id = ? GROUP BY bucket_identifier', (loan_id,))
+        else:
+            rows = self.database.fetch_sums(f'SELECT bucket_identifier, {BALANCE_COLUMNS} FROM ledger_entries GROUP BY bucket_identifier')
+        return {row[0]: to_balance(row[0], row[1:]) for row in rows}
+
+    def get_trial_balance(self, loan_id: Optional[int]) -> TrialBalance:
+        # Totals are aggregated on every call rather than kept, the indexes cover them
+        if loan_id:
+            return to_trial_balance(self.database.fetch_sums(f'SELECT {BALANCE_COLUMNS} FROM ledger_entries WHERE loan_id = ?', (loan_id,))[0])
+        return to_trial_balance(self.database.fetch_sums(f'SELECT {BALANCE_COLUMNS} FROM ledger_entries')[0])
+
+    def get_unbalanced_loan_ids(self) -> List[int]:
+        # An exact sum beyond int64 is text, which never equals 0
+        rows = self.database.fetch_sums('SELECT loan_id FROM ledger_entries GROUP BY loan_id HAVING {sum}(value) != 0 ORDER BY loan_id')
+        return [loan_id for loan_id, in rows]
+
+    def count_entries(self) -> int:
+        return self.database.fetch_one('SELECT COUNT(*) FROM ledger_entries')[0]
+
+    def get_entries_range(self, start: int, stop: int) -> List[LedgerEntry]:
+        # Rows are never deleted, so ids number the entries from 1 in insertion order
+        return list(map(to_ledger_entry, self.database.fetch_all(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE id > ? AND id <= ? ORDER BY id', (start, stop))))
+
+    def get_all_entries(self) -> Iterator[LedgerEntry]:
+        return map(to_ledger_entry, self.database.iterate(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries ORDER BY id'))
+
+    def get_entries(self, loan_id: Optional[int], identifiers: List[str]) -> Iterator[LedgerEntry]:
+        conditions = []
+        parameters = [] # type: List
+        if loan_id:
+            conditions.append('loan_id = ?')
+            parameters.append(loan_id)
+        if identifiers:
+            conditions.append(f'bucket_identifier IN ({", ".join("?" for _ in identifiers)})')
+            parameters.extend(identifiers)
+
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        return map(to_ledger_entry, self.database.iterate(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries {where} ORDER BY id', tuple(parameters)))
+
+    def get_entries_by_loan_id(self, loan_id: int) -> Iterator[LedgerEntry]:
+        return map(to_ledger_entry, self.database.iterate(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE loan_id = ? ORDER BY id', (loan_id,)))
+
+    def get_loan_partition(self, loan_id: int) -> SqlitePartition:
+        return SqlitePartition(self.database, loan_id)
+
+    def get_entries_by_bucket_identifier(self, identifier: str) -> Iterator[LedgerEntry]:
+        return map(to_ledger_entry, self.database.iterate(f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE bucket_identifier = ? ORDER BY id', (identifier,)))
+
+    def get_entries_by_effective_date(self, loan_id: int, effective_from: Optional[date] = None, effective_to: Optional[date] = None, after: Optional[EntryKey] = None) -> Iterator[Tuple[EntryKey, LedgerEntry]]:
+        conditions = ['loan_id = ?']
+        parameters = [loan_id] # type: List
+        if effective_from:
+            conditions.append('effective_date >= ?')
+            parameters.append(effective_from.isoformat())
+        if effective_to:
+            conditions.append('effective_date <= ?')
+            parameters.append(effective_to.isoformat())
+        if after:
+            conditions.append('(effective_date > ? OR (effective_date = ? AND id > ?))')
+            parameters.extend((after[0].isoformat(), after[0].isoformat(), after[1]))
+
+        rows = self.database.iterate(
+            f'SELECT {ENTRY_COLUMNS} FROM ledger_entries WHERE {" AND ".join(conditions)} ORDER BY effective_date, id',
+            tuple(parameters),
+        )
+        for row in rows:
+            entry = to_ledger_entry(row)
+            yield (entry.effective_date, row[0]), entry
+
+class SqliteLedgerRepository:
+    def __init__(self, database: SqliteDatabase, feed: Optional[ChangeFeed] = None):
+        self.ledger = SqliteLedger(database)
+        self.lock = locks.ReadWriteLock()
+        self.feed = feed if feed is not None else ChangeFeed()
+        self.feed.restart(self.ledger.get_last_sequence())
+
+    @metrics.timed_append
+    def add(self, entries: List[LedgerEntry], buckets: Optional[Mapping[str, AccountingBucket]] = None, loans: Optional[Mapping[int, Loan]] = None,
+            check: Optional[Callable[[List[LedgerEntry]], List[LedgerEntry]]] = None) -> List[LedgerEntry]:
+        # Same contract as LedgerRepository.add
+        if check is None:
+            check_new_entries(entries)
+        with self.lock.write():
+            if check is not None:
+                entries = check(entries)
+                check_new_entries(entries)
+            sequence = self.ledger.add_new_entries(entries)
+            if buckets is not None:
+                for entry in entries:
+                    buckets[entry.bucket_identifier].add_value(entry.value)
+            if loans is not None:
+                for entry in entries:
+                    loans[entry.loan_id].add_entry(entry)
+            self.feed.publish(entries, sequence)
+        return entries
+
+    def get(self) -> SqliteLedger:
+        return self.ledger
+
+    @contextmanager
+    def read(self) -> Iterator[SqliteLedger]:
+        with self.lock.read():
+            yield self.ledger
+
+class SqliteLoanRepository:
+    """
+    Loans are persisted in the loans table and cached in memory, their
+    entry summaries are recomputed from the ledger entries when the cache
+    is loaded. Loans with entries written before loans were registered
+    are registered as open
+    """
+    def __init__(self, database: SqliteDatabase, ledger_repo: SqliteLedgerRepository):
+        self.database = database
+        self.ledger_repo = ledger_repo
+        self.lock = threading.Lock()
+        self.loans = {} # type: Dict[int, Loan]
+        database.execute_many('INSERT OR IGNORE INTO loans (loan_id, status) SELECT DISTINCT loan_id, ? FROM ledger_entries', [(OPEN,)])
+        for loan_id, status in database.fetch_all('SELECT loan_id, status FROM loans'):
+            loan = self.loans[loan_id] = Loan(loan_id, status)
+            loan.entries = ledger_repo.get().get_loan_partition(loan_id)
+
+        rows = database.fetch_all('SELECT loan_id, COUNT(*), MIN(effective_date), MAX(effective_date) FROM ledger_entries GROUP BY loan_id')
+        for loan_id, entry_count, first_effective_date, last_effective_date in rows:
+            loan = self.loans[loan_id]
+            loan.entry_count = entry_count
+            loan.first_effective_date = date.fromisoformat(first_effective_date)
+            loan.last_effective_date = date.fromisoformat(last_effective_date)
+
+    def add(self, loan: Loan) -> bool:
+        with self.lock:
+            if loan.loan_id in self.loans:
+                return False
+            self.database.execute_many('INSERT INTO loans (loan_id, status) VALUES (?, ?)', [(loan.loan_id, loan.status)])
+            loan.entries = self.ledger_repo.get().get_loan_partition(loan.loan_id)
+            self.loans[loan.loan_id] = loan
+        return True
+
+    def close(self, loan: Loan) -> bool:
+        # Under the ledger write lock like LoanRepository.close
+        with self.lock, self.ledger_repo.lock.write():
+            if not loan.is_open():
+                return False
+            loan.close()
+            self.database.execute_many('UPDATE loans SET status = ? WHERE loan_id = ?', [(loan.status, loan.loan_id)])
+        return True
+
+    def get(self) -> Dict[int, Loan]:
+        return self.loans
+
+    def get_all(self) -> List[Loan]:
+        # Copied under the lock, opening a loan while the dict is iterated would fail the iteration
+        with self.lock:
+            return list(self.loans.values())
+
+class SqliteBucketRepository:
+    """
+    Buckets are persisted in the buckets table and cached in memory, their
+    totals are recomputed from the ledger entries when the cache is loaded
+    """
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+        self.lock = threading.Lock()
+        self.buckets = {} # type: Dict[str, AccountingBucket]
+        for identifier, in database.fetch_all('SELECT identifier FROM buckets'):
+            self.buckets[identifier] = AccountingBucket.create(identifier)
+
+        rows = database.fetch_sums(f'SELECT bucket_identifier, {BALANCE_COLUMNS} FROM ledger_entries GROUP BY bucket_identifier')
+        for identifier, _, debit, credit in rows:
+            if identifier in self.buckets:
+                self.buckets[identifier].debit = int(debit)
+                self.buckets[identifier].credit = int(credit)
+
+    def add(self, bucket: AccountingBucket) -> bool:
+        with self.lock:
+            if bucket.identifier in self.buckets:
+                return False
+            self.database.execute_many('INSERT INTO buckets (identifier) VALUES (?)', [(bucket.identifier,)])
+            self.buckets[bucket.identifier] = bucket
+        return True
+
+    def get(self) -> Dict[str, AccountingBucket]:
+        return self.buckets
+
+    def get_all(self) -> Dict[str, AccountingBucket]:
+        # Copied under the lock, adding a bucket while the dict is iterated would fail the iteration
+        with self.lock:
+            return dict(self.buckets)
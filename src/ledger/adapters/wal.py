@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import threading
+from datetime import date
+from typing import (Callable, Dict, Iterator, List, Optional)
+
+from ledger.domain.ledger import LedgerEntry
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+
+BUCKET_RECORD = 'bucket'
+LOAN_RECORD = 'loan'
+ENTRIES_RECORD = 'entries'
+
+logger = logging.getLogger(__name__)
+
+def sync_directory(directory: str):
+    """
+    Syncs the entries of a directory, so a file created, renamed or
+    removed in it is still there, or gone, after a crash
+    """
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def encode_entry(entry: LedgerEntry) -> List:
+    return [entry.loan_id, entry.created_at.toordinal(), entry.effective_date.toordinal(), entry.bucket_identifier, entry.value]
+
+def decode_entry(row: List) -> LedgerEntry:
+    loan_id, created_at, effective_date, bucket_identifier, value = row
+    return LedgerEntry(loan_id, date.fromordinal(created_at), date.fromordinal(effective_date), bucket_identifier, value)
+
+class WriteAheadLog:
+    """
+    Append-only JSON-lines log of accepted buckets, loan status changes
+    and entry batches, split into numbered segment files inside a directory
+
+    Every append reaches the operating system before it returns. The
+    fsync policy decides when it reaches the disk: on every append
+    (always), within fsync_interval seconds (interval) or whenever the
+    operating system flushes (never). Appends that arrive while another
+    thread is syncing are covered by the next single fsync, so concurrent
+    writers share the cost of a sync. With the interval policy a
+    background flusher syncs the pending appends every fsync_interval
+    seconds, so the last appends are synced even when writes stop.
+    Sync listeners are called after every sync, e.g. to release what
+    waited for appends to become durable.
+    """
+    def __init__(self, directory: str, fsync_policy: str = FSYNC_ALWAYS, fsync_interval: float = 0.01):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy "{fsync_policy}", expected one of {", ".join(FSYNC_POLICIES)}')
+
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.write_lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written_records = 0
+        self.synced_records = 0
+        self.stopped = threading.Event()
+        self.flusher = None # type: Optional[threading.Thread]
+        self.sync_listeners = [] # type: List[Callable[[], None]]
+
+        os.makedirs(directory, exist_ok=True)
+        segment_numbers = self.get_segment_numbers()
+        self.segment_number = segment_numbers[-1] if segment_numbers else 1
+        self.file = self.open_segment(self.segment_number)
+
+        if fsync_policy == FSYNC_INTERVAL:
+            self.flusher = threading.Thread(target=self.run_flusher, name='ledger-wal-flusher', daemon=True)
+            self.flusher.start()
+
+    def get_segment_path(self, segment_number: int) -> str:
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{segment_number:06d}{SEGMENT_SUFFIX}')
+
+    def get_segment_numbers(self) -> List[int]:
+        segment_numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                segment_numbers.append(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]))
+        return sorted(segment_numbers)
+
+    def open_segment(self, segment_number: int):
+        path = self.get_segment_path(segment_number)
+        if os.path.exists(path):
+            self.truncate_torn_record(path)
+            return open(path, 'ab')
+        file = open(path, 'ab')
+        # Records synced into the new segment are only durable once its directory entry is
+        sync_directory(self.directory)
+        return file
+
+    def truncate_torn_record(self, path: str):
+        # A crash in the middle of a write leaves a record without its newline
+        with open(path, 'rb+') as segment:
+            content = segment.read()
+            if content and not content.endswith(b'\n'):
+                segment.truncate(content.rfind(b'\n') + 1)
+
+    def append_bucket(self, identifier: str, commit: bool = True) -> int:
+        return self.append({'op': BUCKET_RECORD, 'identifier': identifier}, commit)
+
+    def append_loan(self, loan_id: int, status: str, commit: bool = True) -> int:
+        return self.append({'op': LOAN_RECORD, 'loan_id': loan_id, 'status': status}, commit)
+
+    def append_entries(self, entries: List[LedgerEntry], commit: bool = True) -> int:
+        if not entries:
+            return self.written_records
+        return self.append({'op': ENTRIES_RECORD, 'entries': [encode_entry(entry) for entry in entries]}, commit)
+
+    def append(self, record: Dict, commit: bool = True) -> int:
+        """
+        Writes a record to the current segment
+
+        Args:
+            record(Dict): Record to write
+            commit(bool): Set to False to return before the fsync policy is
+                applied, the caller then commits the returned record number
+        Returns:
+            record_number(int): Number of the written record
+        """
+        line = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+        with self.write_lock:
+            self.file.write(line)
+            self.file.flush()
+            self.written_records += 1
+            record_number = self.written_records
+
+        if commit:
+            self.commit(record_number)
+        return record_number
+
+    @property
+    def durable_records(self) -> int:
+        # Without fsyncs a record is as durable as it gets once written
+        return self.written_records if self.fsync_policy == FSYNC_NEVER else self.synced_records
+
+    def add_sync_listener(self, listener: Callable[[], None]):
+        self.sync_listeners.append(listener)
+
+    def commit(self, record_number: int):
+        # Appends under the interval policy are left to the flusher
+        if self.fsync_policy == FSYNC_ALWAYS:
+            self.sync(record_number)
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except OSError:
+                # Retried on the next interval, the pending appends stay pending until then
+                logger.exception('Syncing the write-ahead log failed')
+
+    def sync(self, record_number: Optional[int] = None):
+        """
+        Makes sure every record up to record_number is on disk, joining
+        an fsync already covering it instead of issuing another one
+
+        Args:
+            record_number(Optional[int]): Last record that must be durable,
+                every written record if empty
+        """
+        if record_number is None:
+            record_number = self.written_records
+        if self.synced_records < record_number:
+            # Holding sync_lock keeps rotate from closing the file during the fsync
+            with self.sync_lock:
+                if self.synced_records < record_number:
+                    with self.write_lock:
+                        covered_records = self.written_records
+                        file = self.file
+                    os.fsync(file.fileno())
+                    self.synced_records = max(self.synced_records, covered_records)
+        # Called after a joined or skipped sync as well, records synced by rotate are released here
+        for listener in self.sync_listeners:
+            listener()
+
+    def rotate(self) -> int:
+        """
+        Seals the current segment and continues in a new one
+
+        Returns:
+            segment_number(int): Number of the sealed segment
+        """
+        with self.sync_lock, self.write_lock:
+            sealed_segment_number = self.segment_number
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced_records = self.written_records
+            self.segment_number += 1
+            self.file = self.open_segment(self.segment_number)
+        return sealed_segment_number
+
+    def remove_segments(self, up_to_segment_number: int):
+        for segment_number in self.get_segment_numbers():
+            if segment_number <= up_to_segment_number and segment_number != self.segment_number:
+                os.remove(self.get_segment_path(segment_number))
+
+    def read_records(self, after_segment_number: int = 0) -> Iterator[Dict]:
+        for segment_number in self.get_segment_numbers():
+            if segment_number <= after_segment_number:
+                continue
+            with open(self.get_segment_path(segment_number), 'rb') as segment:
+                for line in segment:
+                    if not line.endswith(b'\n'):
+                        break
+                    yield json.loads(line)
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher:
+            self.flusher.join()
+        self.sync()
+        self.file.close()
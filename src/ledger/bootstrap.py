@@ -0,0 +1,48 @@
+from ledger import config
+from ledger.adapters import (feed, repository, snapshot, sqlite_repository, wal)
+from ledger.service_layer import (cache, idempotency, verification)
+
+def create_repositories():
+    sqlite_path = config.get_sqlite_path()
+    if sqlite_path:
+        database = sqlite_repository.SqliteDatabase(sqlite_path, config.get_sqlite_synchronous())
+        ledger_repo = sqlite_repository.SqliteLedgerRepository(database, feed.ChangeFeed(config.get_feed_size()))
+        return {
+            'ledger': ledger_repo,
+            'loan': sqlite_repository.SqliteLoanRepository(database, ledger_repo),
+            'bucket': sqlite_repository.SqliteBucketRepository(database),
+        }
+
+    data_directory = config.get_data_directory()
+    if not data_directory:
+        ledger_repo = repository.LedgerRepository(columnar=config.is_columnar_storage(), feed=feed.ChangeFeed(config.get_feed_size()))
+        return {
+            'ledger': ledger_repo,
+            'loan': repository.LoanRepository(ledger_repo),
+            'bucket': repository.BucketRepository(),
+        }
+
+    write_ahead_log = wal.WriteAheadLog(data_directory, config.get_wal_fsync_policy(), config.get_wal_fsync_interval())
+    ledger_repo = repository.LedgerRepository(write_ahead_log, columnar=config.is_columnar_storage(), feed=feed.ChangeFeed(config.get_feed_size()))
+    loan_repo = repository.LoanRepository(ledger_repo, write_ahead_log)
+    bucket_repo = repository.BucketRepository(write_ahead_log)
+    repository.recover(write_ahead_log, ledger_repo, bucket_repo, loan_repo)
+    if config.get_snapshot_interval() > 0:
+        snapshot.Snapshotter(write_ahead_log, ledger_repo, bucket_repo, config.get_snapshot_interval(), loan_repo).start()
+    return {
+        'ledger': ledger_repo,
+        'loan': loan_repo,
+        'bucket': bucket_repo,
+    }
+
+def create_cache():
+    return cache.ReadCache(config.get_cache_size(), config.get_cache_ttl())
+
+def create_idempotency_store():
+    return idempotency.IdempotencyStore(config.get_idempotency_store_size(), config.get_idempotency_ttl())
+
+def create_verifier(get_ledger_repo):
+    verifier = verification.TrialBalanceVerifier(get_ledger_repo, config.get_trial_balance_verify_interval())
+    if verifier.interval > 0:
+        verifier.start()
+    return verifier
@@ -4,4 +4,70 @@ def get_minimum_identifier_size():
     return 3
 
 def get_maximum_identifier_size():
-    return 100
\ No newline at end of file
+    return 100
+
+def get_maximum_page_size():
+    return 1000
+
+def get_data_directory():
+    return os.environ.get('LEDGER_DATA_DIR')
+
+def get_wal_fsync_policy():
+    return os.environ.get('LEDGER_WAL_FSYNC', 'always')
+
+def get_wal_fsync_interval():
+    return float(os.environ.get('LEDGER_WAL_FSYNC_INTERVAL', '0.01'))
+
+def get_snapshot_interval():
+    return float(os.environ.get('LEDGER_SNAPSHOT_INTERVAL', '300'))
+
+def get_sqlite_path():
+    return os.environ.get('LEDGER_SQLITE_PATH')
+
+def get_sqlite_synchronous():
+    return os.environ.get('LEDGER_SQLITE_SYNCHRONOUS', 'full')
+
+def is_columnar_storage():
+    return os.environ.get('LEDGER_STORAGE', 'objects') == 'columnar'
+
+def get_money_decimal_places():
+    return int(os.environ.get('LEDGER_MONEY_DECIMAL_PLACES', '6'))
+
+def get_shard_count():
+    return int(os.environ.get('LEDGER_SHARDS', str(os.cpu_count() or 1)))
+
+def get_shard_timeout():
+    return float(os.environ.get('LEDGER_SHARD_TIMEOUT', '60'))
+
+def get_cache_size():
+    return int(os.environ.get('LEDGER_CACHE_SIZE', '10000'))
+
+def get_cache_ttl():
+    return float(os.environ.get('LEDGER_CACHE_TTL', '60'))
+
+def get_json_serializer():
+    return os.environ.get('LEDGER_JSON_SERIALIZER')
+
+def is_metrics_enabled():
+    return os.environ.get('LEDGER_METRICS', '').lower() in ('1', 'true', 'yes')
+
+def get_metrics_sample_interval():
+    return int(os.environ.get('LEDGER_METRICS_SAMPLE_INTERVAL', '10'))
+
+def get_trial_balance_verify_interval():
+    return float(os.environ.get('LEDGER_TRIAL_BALANCE_VERIFY_INTERVAL', '600'))
+
+def get_feed_size():
+    return int(os.environ.get('LEDGER_FEED_SIZE', '10000'))
+
+def get_maximum_feed_wait():
+    return 30.0
+
+def get_idempotency_store_size():
+    return int(os.environ.get('LEDGER_IDEMPOTENCY_STORE_SIZE', '10000'))
+
+def get_idempotency_ttl():
+    return float(os.environ.get('LEDGER_IDEMPOTENCY_TTL', '86400'))
+
+def get_maximum_idempotency_key_size():
+    return 255
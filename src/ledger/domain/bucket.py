@@ -1,23 +1,24 @@
 class AccountingBucket:
     def __init__(self, identifier: str):
         self.identifier = identifier
-        self.debit = 0.0
-        self.credit = 0.0
+        self.debit = 0
+        self.credit = 0
 
-    def is_debit_value(self, value: float):
-        return value >= 0.0
+    def is_debit_value(self, value: int):
+        return value >= 0
 
-    def is_credit_value(self, value: float):
-        return value <= 0.0
+    def is_credit_value(self, value: int):
+        return value <= 0
 
     @property
     def sum(self):
         return self.debit + self.credit
 
-    def add_value(self, value: float):
-        if self.is_debit_value(value):
+    def add_value(self, value: int):
+        # Compared inline rather than through is_debit_value, every entry is added to three buckets
+        if value >= 0:
             self.debit += value
-        elif self.is_credit_value(value):
+        else:
             self.credit += value
 
     @classmethod
@@ -0,0 +1,228 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ledger.domain.ledger import (BalanceHistory, EntryKey, Ledger, LedgerEntry)
+
+# Effective date index keys pack the day ordinal above the row number so
+# one int64 orders rows by effective date, ties broken by insertion order
+ROW_BITS = 40
+ROW_MASK = (1 << ROW_BITS) - 1
+
+def to_index_key(ordinal: int, row: int) -> int:
+    return (ordinal << ROW_BITS) | row
+
+class ColumnarBalanceHistory(BalanceHistory):
+    """
+    Balance history keeping its values and running totals in int64
+    arrays instead of lists of Python ints, both are widened to lists
+    once a value or running total no longer fits in 64 bits
+    """
+    def __init__(self):
+        super().__init__()
+        self.values = array('q')
+        self.cumulative_sums = array('q')
+
+    def widen(self):
+        self.values = list(self.values)
+        self.cumulative_sums = list(self.cumulative_sums)
+
+    def add_value(self, effective_date: date, value: int):
+        try:
+            super().add_value(effective_date, value)
+        except OverflowError:
+            # Raised before the history is changed, by the sum of the value and its date's
+            self.widen()
+            super().add_value(effective_date, value)
+
+    def replace_sums(self, stale_from: int, sums: Iterable[int]):
+        if isinstance(self.cumulative_sums, list):
+            self.cumulative_sums[stale_from:] = sums
+            return
+        sums = list(sums)
+        try:
+            self.cumulative_sums[stale_from:] = array('q', sums)
+        except OverflowError:
+            self.widen()
+            self.cumulative_sums[stale_from:] = sums
+
+class ColumnarEntries(Sequence):
+    """
+    Ledger entries stored as parallel typed columns, LedgerEntry objects
+    are only materialized when an entry is read
+    """
+    def __init__(self):
+        self.loan_ids = array('q')
+        self.created_at = array('i')
+        self.effective_dates = array('i')
+        self.bucket_codes = array('i')
+        self.values = array('q')
+        self.bucket_identifiers = [] # type: List[str]
+        self.codes_by_bucket_identifier = {} # type: Dict[str, int]
+        self.dates = {} # type: Dict[int, date]
+
+    def get_bucket_code(self, identifier: str) -> int:
+        code = self.codes_by_bucket_identifier.get(identifier)
+        if code is None:
+            code = self.codes_by_bucket_identifier[identifier] = len(self.bucket_identifiers)
+            self.bucket_identifiers.append(identifier)
+        return code
+
+    def get_ordinal(self, day: date) -> int:
+        ordinal = day.toordinal()
+        if ordinal not in self.dates:
+            self.dates[ordinal] = day
+        return ordinal
+
+    def append(self, entry: LedgerEntry) -> int:
+        row = len(self.loan_ids)
+        self.loan_ids.append(entry.loan_id)
+        self.created_at.append(self.get_ordinal(entry.created_at))
+        self.effective_dates.append(self.get_ordinal(entry.effective_date))
+        self.bucket_codes.append(self.get_bucket_code(entry.bucket_identifier))
+        self.values.append(entry.value)
+        return row
+
+    def __len__(self) -> int:
+        return len(self.loan_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.get_rows(range(*index.indices(len(self)))))
+        dates = self.dates
+        return LedgerEntry(
+            self.loan_ids[index],
+            dates[self.created_at[index]],
+            dates[self.effective_dates[index]],
+            self.bucket_identifiers[self.bucket_codes[index]],
+            self.values[index],
+        )
+
+    def __iter__(self) -> Iterator[LedgerEntry]:
+        return self.get_rows(range(len(self)))
+
+    def get_rows(self, rows: Iterable[int]) -> Iterator[LedgerEntry]:
+        """
+        Materializes the entries of the given rows, looking the columns up
+        once for the whole scan instead of once per entry
+
+        Args:
+            rows(Iterable[int]): Row numbers to read
+        Returns:
+            entries(Iterator[LedgerEntry]): Entries of the rows in the given order
+        """
+        loan_ids, created_at, effective_dates, bucket_codes, values = self.loan_ids, self.created_at, self.effective_dates, self.bucket_codes, self.values
+        dates, bucket_identifiers = self.dates, self.bucket_identifiers
+        for row in rows:
+            yield LedgerEntry(loan_ids[row], dates[created_at[row]], dates[effective_dates[row]], bucket_identifiers[bucket_codes[row]], values[row])
+
+class ColumnarPartition(Sequence):
+    """
+    Entries of a single loan, read through the row numbers of the loan
+    """
+    def __init__(self, entries: ColumnarEntries, rows: array):
+        self.entries = entries
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.entries.get_rows(self.rows[index]))
+        return self.entries[self.rows[index]]
+
+    def __iter__(self) -> Iterator[LedgerEntry]:
+        return self.entries.get_rows(self.rows)
+
+class ColumnarLedger(Ledger):
+    """
+    Ledger keeping entries in typed columns and its indexes as arrays of
+    row numbers, trading materialization cost on reads for a much smaller
+    footprint per entry. Balances are maintained exactly like Ledger,
+    their histories kept in arrays too
+    """
+    balance_history_class = ColumnarBalanceHistory
+
+    def __init__(self):
+        super().__init__()
+        self.entries = ColumnarEntries()
+        self.rows_by_loan_id = {} # type: Dict[int, array]
+        self.rows_by_bucket_code = {} # type: Dict[int, array]
+        self.rows_by_loan_and_bucket_code = {} # type: Dict[Tuple[int, int], array]
+        self.effective_date_index = {} # type: Dict[int, array]
+
+    def add_new_entries(self, new_entries: List[LedgerEntry]) -> int:
+        for entry in new_entries:
+            row = self.entries.append(entry)
+            bucket_code = self.entries.bucket_codes[row]
+            self.rows_by_loan_id.setdefault(entry.loan_id, array('q')).append(row)
+            self.rows_by_bucket_code.setdefault(bucket_code, array('q')).append(row)
+            self.rows_by_loan_and_bucket_code.setdefault((entry.loan_id, bucket_code), array('q')).append(row)
+            self._add_to_effective_date_keys(entry.loan_id, to_index_key(self.entries.effective_dates[row], row))
+            self._add_to_balances(entry)
+        self._check_trial_balances({entry.loan_id for entry in new_entries})
+        self.sequence = len(self.entries)
+        return self.sequence
+
+    def _add_to_effective_date_keys(self, loan_id: int, key: int):
+        keys = self.effective_date_index.setdefault(loan_id, array('q'))
+        if not keys or keys[-1] <= key:
+            keys.append(key)
+        else:
+            keys.insert(bisect_right(keys, key), key)
+
+    def _get_rows(self, rows: Optional[array]) -> Iterator[LedgerEntry]:
+        return self.entries.get_rows(rows or ())
+
+    def get_entries(self, loan_id: Optional[int], identifiers: List[str]) -> Iterator[LedgerEntry]:
+        if not identifiers:
+            if loan_id:
+                return self.get_entries_by_loan_id(loan_id)
+            return self.get_all_entries()
+
+        codes = self.entries.codes_by_bucket_identifier
+        if len(identifiers) == 1:
+            code = codes.get(identifiers[0])
+            if code is None:
+                return iter(())
+            if loan_id:
+                return self._get_rows(self.rows_by_loan_and_bucket_code.get((loan_id, code)))
+            return self._get_rows(self.rows_by_bucket_code.get(code))
+
+        selected_codes = {codes[identifier] for identifier in identifiers if identifier in codes}
+        candidate_rows = self.rows_by_loan_id.get(loan_id, ()) if loan_id else range(len(self.entries))
+        bucket_codes = self.entries.bucket_codes
+        return self._get_rows(array('q', (row for row in candidate_rows if bucket_codes[row] in selected_codes)))
+
+    def get_entries_by_loan_id(self, loan_id: int) -> Iterator[LedgerEntry]:
+        return self._get_rows(self.rows_by_loan_id.get(loan_id))
+
+    def get_loan_partition(self, loan_id: int) -> ColumnarPartition:
+        return ColumnarPartition(self.entries, self.rows_by_loan_id.setdefault(loan_id, array('q')))
+
+    def get_entries_by_bucket_identifier(self, identifier: str) -> Iterator[LedgerEntry]:
+        code = self.entries.codes_by_bucket_identifier.get(identifier)
+        if code is None:
+            return iter(())
+        return self._get_rows(self.rows_by_bucket_code.get(code))
+
+    def get_entries_by_effective_date(self, loan_id: int, effective_from: Optional[date] = None, effective_to: Optional[date] = None, after: Optional[EntryKey] = None) -> Iterator[Tuple[EntryKey, LedgerEntry]]:
+        keys = self.effective_date_index.get(loan_id, ())
+
+        start = 0
+        if effective_from:
+            start = bisect_left(keys, to_index_key(effective_from.toordinal(), 0))
+        if after:
+            start = max(start, bisect_right(keys, to_index_key(after[0].toordinal(), after[1])))
+
+        stop = len(keys)
+        if effective_to:
+            stop = bisect_right(keys, to_index_key(effective_to.toordinal(), ROW_MASK))
+
+        for position in range(start, stop):
+            row = keys[position] & ROW_MASK
+            entry = self.entries[row]
+            yield (entry.effective_date, row), entry
@@ -1,6 +1,13 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
 from datetime import date
-from typing import Iterator, List, Optional
+from itertools import accumulate
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from ledger.domain.bucket import AccountingBucket
 
 @dataclass(frozen=True)
 class LedgerEntry:
@@ -8,35 +15,327 @@ class LedgerEntry:
     created_at: date
     effective_date: date
     bucket_identifier: str
-    value: float
+    # Integer minor units, see ledger.domain.money
+    value: int
+
+# Orders entries of a loan by effective date, ties broken by insertion order
+EntryKey = Tuple[date, int]
+
+# Loan ids and values are stored as int64 by the columnar ledger, snapshots and SQLite
+MAXIMUM_STORED_INTEGER = 2 ** 63 - 1
+
+class InvalidEntry(ValueError):
+    """Entry cannot be stored by the ledger"""
+    pass
+
+def check_new_entries(new_entries: Iterable[LedgerEntry]):
+    """
+    Checks that every entry of a batch can be stored before any of them
+    is logged or added, so a batch is added in full or not at all
+
+    Args:
+        new_entries(Iterable[LedgerEntry]): Entries to add
+    """
+    for entry in new_entries:
+        if abs(entry.loan_id) > MAXIMUM_STORED_INTEGER or abs(entry.value) > MAXIMUM_STORED_INTEGER:
+            raise InvalidEntry('Loan ids and values must fit in 64 bits')
+
+class BalanceHistory:
+    """
+    Values added per effective date with their running totals. Writes
+    only mark the totals from their date on as stale and the next read
+    brings them up to date in one pass, so a batch of backdated values
+    costs a single pass instead of one per value
+    """
+    def __init__(self):
+        self.effective_ordinals = array('i')
+        # Python ints, a running total may exceed int64 even though every value fits
+        self.values = [] # type: List[int]
+        self.cumulative_sums = [] # type: List[int]
+        # Position of the first running total which misses values added since
+        self.stale_from = 0
+        # Readers share the ledger's read lock, so the one bringing the totals up to date holds this
+        self.update_lock = threading.Lock()
+
+    def add_value(self, effective_date: date, value: int):
+        """
+        Adds a value to its effective date, the running totals of that
+        date and every later date are updated by the next read
+
+        Args:
+            effective_date(date): Effective date of the value
+            value(int): Debit or credit value in minor units
+        """
+        ordinal = effective_date.toordinal()
+        position = bisect_left(self.effective_ordinals, ordinal)
+        if position == len(self.effective_ordinals) or self.effective_ordinals[position] != ordinal:
+            self.effective_ordinals.insert(position, ordinal)
+            self.values.insert(position, value)
+            self.cumulative_sums.insert(position, 0)
+        else:
+            self.values[position] += value
+        if position < self.stale_from:
+            self.stale_from = position
+
+    def sum_as_of(self, as_of: date) -> int:
+        position = bisect_right(self.effective_ordinals, as_of.toordinal())
+        if not position:
+            return 0
+        if self.stale_from < len(self.values):
+            self.update_sums()
+        return self.cumulative_sums[position - 1]
+
+    def update_sums(self):
+        """
+        Brings the stale running totals up to date. Writers are excluded
+        by the ledger's write lock, concurrent readers take turns and a
+        later one finds the totals already up to date
+        """
+        with self.update_lock:
+            stale_from = self.stale_from
+            if stale_from == len(self.values):
+                return
+            previous_sum = self.cumulative_sums[stale_from - 1] if stale_from else 0
+            sums = accumulate(self.values[stale_from:], initial=previous_sum)
+            # The initial value is the running total of the position before
+            next(sums)
+            self.replace_sums(stale_from, sums)
+            # Set last, a reader which sees the totals up to date reads complete ones
+            self.stale_from = len(self.values)
 
+    def replace_sums(self, stale_from: int, sums: Iterable[int]):
+        self.cumulative_sums[stale_from:] = sums
+
+class TrialBalance:
+    """
+    Debit and credit totals of a loan or of the whole ledger. Every pair
+    entry debits and credits the same value, so the totals of a ledger
+    which holds complete pairs sum to zero
+    """
+    def __init__(self):
+        self.debit = 0
+        self.credit = 0
+        self.entries = 0
+
+    def add_value(self, value: int):
+        if value >= 0:
+            self.debit += value
+        else:
+            self.credit += value
+        self.entries += 1
+
+    def is_balanced(self) -> bool:
+        return self.debit + self.credit == 0
 
 class Ledger:
+    balance_history_class = BalanceHistory
+
     def __init__(self):
         self.entries = [] # type: List[LedgerEntry]
+        self.entries_by_loan_id = {} # type: Dict[int, List[LedgerEntry]]
+        self.entries_by_bucket_identifier = {} # type: Dict[str, List[LedgerEntry]]
+        self.entries_by_loan_and_bucket = {} # type: Dict[Tuple[int, str], List[LedgerEntry]]
+        self.loan_balances = {} # type: Dict[int, Dict[str, AccountingBucket]]
+        self.bucket_balances = {} # type: Dict[str, AccountingBucket]
+        self.loan_balance_histories = {} # type: Dict[int, Dict[str, BalanceHistory]]
+        self.bucket_balance_histories = {} # type: Dict[str, BalanceHistory]
+        self.effective_date_keys = {} # type: Dict[int, List[EntryKey]]
+        self.entries_by_effective_date = {} # type: Dict[int, List[LedgerEntry]]
+        self.trial_balance = TrialBalance()
+        self.loan_trial_balances = {} # type: Dict[int, TrialBalance]
+        self.unbalanced_loan_ids = set() # type: Set[int]
+        self.sequence = 0
+
+    def add_new_entries(self, new_entries: List[LedgerEntry]) -> int:
+        """
+        Adds entries to the ledger and its indexes, numbering them from 1
+        in the order they are added
 
-    def add_new_entries(self, new_entries: List[LedgerEntry]):
+        Args:
+            new_entries(List[LedgerEntry]): Entries to add
+        Returns:
+            sequence(int): Sequence number of the last entry added
+        """
         self.entries.extend(new_entries)
+        for entry in new_entries:
+            self._add_to_effective_date_index(entry, (entry.effective_date, self.sequence))
+            self.sequence += 1
+            self.entries_by_loan_id.setdefault(entry.loan_id, []).append(entry)
+            self.entries_by_bucket_identifier.setdefault(entry.bucket_identifier, []).append(entry)
+            self.entries_by_loan_and_bucket.setdefault((entry.loan_id, entry.bucket_identifier), []).append(entry)
+            self._add_to_balances(entry)
+        self._check_trial_balances({entry.loan_id for entry in new_entries})
+        return self.sequence
+
+    def _add_to_effective_date_index(self, entry: LedgerEntry, key: EntryKey):
+        keys = self.effective_date_keys.setdefault(entry.loan_id, [])
+        entries = self.entries_by_effective_date.setdefault(entry.loan_id, [])
+        if not keys or keys[-1] <= key:
+            keys.append(key)
+            entries.append(entry)
+        else:
+            position = bisect_right(keys, key)
+            keys.insert(position, key)
+            entries.insert(position, entry)
+
+    def _add_to_balances(self, entry: LedgerEntry):
+        loan_balances = self.loan_balances.setdefault(entry.loan_id, {})
+        loan_balance = loan_balances.get(entry.bucket_identifier)
+        if loan_balance is None:
+            loan_balance = loan_balances[entry.bucket_identifier] = AccountingBucket.create(entry.bucket_identifier)
+        loan_balance.add_value(entry.value)
+
+        bucket_balance = self.bucket_balances.get(entry.bucket_identifier)
+        if bucket_balance is None:
+            bucket_balance = self.bucket_balances[entry.bucket_identifier] = AccountingBucket.create(entry.bucket_identifier)
+        bucket_balance.add_value(entry.value)
+
+        loan_histories = self.loan_balance_histories.setdefault(entry.loan_id, {})
+        loan_history = loan_histories.get(entry.bucket_identifier)
+        if loan_history is None:
+            loan_history = loan_histories[entry.bucket_identifier] = self.balance_history_class()
+        loan_history.add_value(entry.effective_date, entry.value)
+
+        bucket_history = self.bucket_balance_histories.get(entry.bucket_identifier)
+        if bucket_history is None:
+            bucket_history = self.bucket_balance_histories[entry.bucket_identifier] = self.balance_history_class()
+        bucket_history.add_value(entry.effective_date, entry.value)
+
+        loan_trial_balance = self.loan_trial_balances.get(entry.loan_id)
+        if loan_trial_balance is None:
+            loan_trial_balance = self.loan_trial_balances[entry.loan_id] = TrialBalance()
+        loan_trial_balance.add_value(entry.value)
+        self.trial_balance.add_value(entry.value)
+
+    def _check_trial_balances(self, loan_ids: Iterable[int]):
+        # Checked once per batch, a loan is unbalanced halfway through its pairs
+        for loan_id in loan_ids:
+            if self.loan_trial_balances[loan_id].is_balanced():
+                self.unbalanced_loan_ids.discard(loan_id)
+            else:
+                self.unbalanced_loan_ids.add(loan_id)
+
+    def get_balance(self, loan_id: Optional[int], identifier: str) -> Optional[AccountingBucket]:
+        """
+        Returns the running debit and credit totals of a bucket,
+        either for a single loan or across every loan
+
+        Args:
+            loan_id(Optional[int]): Loan to restrict the totals to, all loans if empty
+            identifier(str): Identifier for the accounting bucket
+        Returns:
+            balance(Optional[AccountingBucket]): Running totals, None if the
+                bucket has no entries yet
+        """
+        if loan_id:
+            return self.loan_balances.get(loan_id, {}).get(identifier)
+        return self.bucket_balances.get(identifier)
+
+    def get_balance_as_of(self, loan_id: Optional[int], identifier: str, as_of: date) -> int:
+        if loan_id:
+            history = self.loan_balance_histories.get(loan_id, {}).get(identifier)
+        else:
+            history = self.bucket_balance_histories.get(identifier)
+        return history.sum_as_of(as_of) if history else 0
+
+    def get_balances(self, loan_id: Optional[int]) -> Dict[str, AccountingBucket]:
+        """
+        Returns the running totals of every bucket with entries, either
+        for a single loan or across every loan
+
+        Args:
+            loan_id(Optional[int]): Loan to restrict the totals to, all loans if empty
+        Returns:
+            balances(Dict[str, AccountingBucket]): Running totals keyed by bucket identifier
+        """
+        if loan_id:
+            return self.loan_balances.get(loan_id, {})
+        return self.bucket_balances
+
+    def get_trial_balance(self, loan_id: Optional[int]) -> TrialBalance:
+        if loan_id:
+            return self.loan_trial_balances.get(loan_id) or TrialBalance()
+        return self.trial_balance
+
+    def get_unbalanced_loan_ids(self) -> List[int]:
+        return sorted(self.unbalanced_loan_ids)
+
+    def count_entries(self) -> int:
+        return self.sequence
+
+    def get_entries_range(self, start: int, stop: int) -> List[LedgerEntry]:
+        # Entries are only ever appended, so positions are stable and the
+        # entry at a position is numbered one more
+        return self.entries[start:stop]
 
     def get_all_entries(self) -> Iterator[LedgerEntry]:
         yield from self.entries
 
     def get_entries(self, loan_id: Optional[int], identifiers: List[str]) -> Iterator[LedgerEntry]:
-        loan_id_check = lambda entry: True
-        if loan_id:
-            loan_id_check = lambda entry: entry.loan_id == loan_id
+        if not identifiers:
+            if loan_id:
+                yield from self.get_entries_by_loan_id(loan_id)
+            else:
+                yield from self.get_all_entries()
+            return
 
-        identifiers_check = lambda entry: True
-        if identifiers:
-            identifiers_check = lambda entry: entry.bucket_identifier in identifiers
+        if len(identifiers) == 1:
+            if loan_id:
+                yield from self.entries_by_loan_and_bucket.get((loan_id, identifiers[0]), [])
+            else:
+                yield from self.get_entries_by_bucket_identifier(identifiers[0])
+            return
 
-        for entry in self.get_all_entries():
-            if loan_id_check(entry) and identifiers_check(entry):
+        # Scanning the loan partition keeps entries in insertion order across buckets
+        identifiers = set(identifiers)
+        candidates = self.entries_by_loan_id.get(loan_id, []) if loan_id else self.entries
+        for entry in candidates:
+            if entry.bucket_identifier in identifiers:
                 yield entry
 
-
     def get_entries_by_loan_id(self, loan_id: int) -> Iterator[LedgerEntry]:
-        return (entry for entry in self.entries if entry.loan_id == loan_id)
+        return iter(self.entries_by_loan_id.get(loan_id, []))
+
+    def get_loan_partition(self, loan_id: int) -> Sequence[LedgerEntry]:
+        """
+        Returns the partition holding the entries of a loan, created empty
+        for a loan without entries so it sees every entry added later
+
+        Args:
+            loan_id(int): Loan to return the partition of
+        Returns:
+            entries(Sequence[LedgerEntry]): Entries of the loan in insertion order
+        """
+        return self.entries_by_loan_id.setdefault(loan_id, [])
 
     def get_entries_by_bucket_identifier(self, identifier: str) -> Iterator[LedgerEntry]:
-        return (entry for entry in self.entries if entry.bucket_identifier == identifier)
+        return iter(self.entries_by_bucket_identifier.get(identifier, []))
+
+    def get_entries_by_effective_date(self, loan_id: int, effective_from: Optional[date] = None, effective_to: Optional[date] = None, after: Optional[EntryKey] = None) -> Iterator[Tuple[EntryKey, LedgerEntry]]:
+        """
+        Returns the entries of a loan ordered by effective date, located
+        by binary search on the loan's sorted entry keys
+
+        Args:
+            loan_id(int): Loan to return entries for
+            effective_from(Optional[date]): Earliest effective date, inclusive
+            effective_to(Optional[date]): Latest effective date, inclusive
+            after(Optional[EntryKey]): Only return entries ordered after this key
+        Returns:
+            entries(Iterator[Tuple[EntryKey, LedgerEntry]]): Entry keys with their entries
+        """
+        keys = self.effective_date_keys.get(loan_id, [])
+        entries = self.entries_by_effective_date.get(loan_id, [])
+
+        start = 0
+        if effective_from:
+            start = bisect_left(keys, (effective_from, -1))
+        if after:
+            start = max(start, bisect_right(keys, after))
+
+        stop = len(keys)
+        if effective_to:
+            stop = bisect_right(keys, (effective_to, sys.maxsize))
+
+        for position in range(start, stop):
+            yield keys[position], entries[position]
@@ -0,0 +1,48 @@
+from datetime import date
+from typing import (Optional, Sequence)
+
+from ledger.domain.ledger import LedgerEntry
+
+OPEN = 'open'
+CLOSED = 'closed'
+STATUSES = (OPEN, CLOSED)
+
+class Loan:
+    """
+    Loan registered with the ledger, summarizing its entries as they are
+    added so the registry answers questions about a loan without reading
+    any of them
+    """
+    def __init__(self, loan_id: int, status: str = OPEN):
+        self.loan_id = loan_id
+        self.status = status
+        self.first_effective_date = None # type: Optional[date]
+        self.last_effective_date = None # type: Optional[date]
+        self.entry_count = 0
+        # Entries of the loan in insertion order, attached by the loan repository
+        self.entries = () # type: Sequence[LedgerEntry]
+
+    def is_open(self) -> bool:
+        return self.status == OPEN
+
+    def close(self):
+        self.status = CLOSED
+
+    def add_entry(self, entry: LedgerEntry):
+        if self.first_effective_date is None or entry.effective_date < self.first_effective_date:
+            self.first_effective_date = entry.effective_date
+        if self.last_effective_date is None or entry.effective_date > self.last_effective_date:
+            self.last_effective_date = entry.effective_date
+        self.entry_count += 1
+
+    @classmethod
+    def create(cls, loan_id):
+        """
+        Creates a new open loan with given loan id
+
+        Args:
+            loan_id(int): Loan id
+        Returns:
+            loan(Loan): New open Loan without entries
+        """
+        return cls(loan_id)
@@ -0,0 +1,38 @@
+import math
+
+from ledger import config
+
+DECIMAL_PLACES = config.get_money_decimal_places()
+SCALE = 10 ** DECIMAL_PLACES
+MAXIMUM_MINOR_UNITS = 2 ** 63 - 1
+
+class InvalidAmount(ValueError):
+    """Amount cannot be represented in minor units"""
+    pass
+
+def to_minor_units(value: float) -> int:
+    """
+    Converts an amount to an exact integer number of minor units
+
+    Args:
+        value(float): Amount in major units, e.g. 0.241095
+    Returns:
+        minor_units(int): Amount scaled by SCALE, e.g. 241095
+    """
+    if not math.isfinite(value):
+        raise InvalidAmount('Amounts must be finite numbers')
+    scaled = value * SCALE
+    # Scaling an amount close to the largest float overflows to infinity
+    if not math.isfinite(scaled):
+        raise InvalidAmount('Amount is too large')
+    minor_units = round(scaled)
+    # The nearest float to the scaled integer is the input itself only when
+    # the input has no more decimal places than the configured scale
+    if minor_units / SCALE != value:
+        raise InvalidAmount(f'Amounts must have at most {DECIMAL_PLACES} decimal places')
+    if abs(minor_units) > MAXIMUM_MINOR_UNITS:
+        raise InvalidAmount('Amount is too large')
+    return minor_units
+
+def to_major_units(minor_units: int) -> float:
+    return minor_units / SCALE
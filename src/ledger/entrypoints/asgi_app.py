@@ -0,0 +1,193 @@
+"""
+Asyncio entrypoint serving the routes of flask_app as a plain ASGI
+application, e.g. with ``uvicorn ledger.entrypoints.asgi_app:app``. The
+routes are handled by ledger.entrypoints.common, this module only adapts
+ASGI messages to its requests and its responses to ASGI messages
+
+Idle keep-alive connections only cost a coroutine. Route handlers can
+block, decoding and validating a batch, taking a repository lock,
+syncing the log or querying SQLite, so they run in the default executor
+together with the encoding of listings and reports, and the event loop
+keeps serving other connections meanwhile. Long polls of the change
+feed wait on the event loop itself between their reads.
+"""
+import asyncio
+import functools
+import itertools
+import time
+from typing import (Any, Awaitable, Callable, Dict)
+from urllib.parse import parse_qs
+
+from ledger import metrics
+from ledger.bootstrap import (create_cache, create_idempotency_store, create_repositories, create_verifier)
+from ledger.adapters.feed import ChangeFeed
+from ledger.entrypoints import common
+from ledger.entrypoints.common import NDJSON_MIMETYPE
+from ledger.entrypoints.serialization import create_serializer
+
+repositories = create_repositories()
+read_cache = create_cache()
+idempotency_store = create_idempotency_store()
+serializer = create_serializer()
+trial_balance_verifier = create_verifier(lambda: repositories['ledger'])
+metrics.register_ledger_gauge(lambda: repositories)
+
+JSON_MIMETYPE = 'application/json'
+STREAM_CHUNK_SIZE = 1000
+
+def get_dependencies() -> common.Dependencies:
+    return common.Dependencies(repositories, read_cache, idempotency_store, trial_balance_verifier)
+
+def to_request(scope: Dict, body: bytes) -> common.Request:
+    query_string = scope.get('query_string', b'')
+    args = parse_qs(query_string.decode('latin-1'), keep_blank_values=True)
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+    return common.Request(scope['path'], query_string, args, headers, body)
+
+def run_blocking(function: Callable, *args, **kwargs) -> Awaitable:
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+def next_chunk(lines) -> bytes:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            break
+    return ''.join(chunk).encode()
+
+async def send_body(send: Callable[[Dict], Awaitable[None]], status: int, content_type: str, content: bytes, headers: Dict[str, str]):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(content)).encode())]
+            + [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+async def send_response(response, send: Callable[[Dict], Awaitable[None]]):
+    if isinstance(response, common.NdjsonResponse):
+        await send({'type': 'http.response.start', 'status': response.status, 'headers': [(b'content-type', NDJSON_MIMETYPE.encode())]})
+        while True:
+            chunk = await run_blocking(next_chunk, response.lines)
+            if not chunk:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    elif isinstance(response, common.TextResponse):
+        await send_body(send, response.status, response.content_type, response.content.encode(), {})
+    else:
+        content = await run_blocking(response.encode, serializer) if response.large else response.encode(serializer)
+        await send_body(send, response.status, JSON_MIMETYPE, content, response.headers)
+
+async def wait_for_entries(feed: ChangeFeed, after: int, timeout: float) -> bool:
+    """
+    Waits on the event loop, rather than in an executor thread, until an
+    entry numbered after a sequence number is published
+
+    Args:
+        feed(ChangeFeed): Change feed of the ledger
+        after(int): Sequence number already read
+        timeout(float): Seconds to wait at most
+    Returns:
+        published(bool): Whether such an entry was published
+    """
+    loop = asyncio.get_running_loop()
+    published = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(published.set)
+
+    feed.add_listener(listener)
+    try:
+        if feed.last_sequence > after:
+            return True
+        await asyncio.wait_for(published.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        feed.remove_listener(listener)
+
+def route(handler: common.Handler) -> Callable[[common.Request], Awaitable[Any]]:
+    async def view(request: common.Request):
+        return await run_blocking(handler, request, get_dependencies())
+    return view
+
+async def get_changes(request: common.Request):
+    poll = common.ChangesPoll(request, get_dependencies())
+    response = await run_blocking(poll.read)
+    timeout = poll.get_wait_timeout()
+    while timeout is not None and await wait_for_entries(repositories['ledger'].feed, poll.last_sequence, timeout):
+        response = await run_blocking(poll.read)
+        timeout = poll.get_wait_timeout()
+    return response
+
+ROUTES = {
+    '/ledger/buckets': {'POST': route(common.create_bucket)},
+    '/ledger/loans': {'POST': route(common.open_loan), 'GET': route(common.get_loans)},
+    '/ledger/loans/close': {'POST': route(common.close_loan)},
+    '/ledger/entries': {'POST': route(common.create_double_entries), 'GET': route(common.get_ledger_entries)},
+    '/ledger/entries/bulk': {'POST': route(common.create_bulk_double_entries)},
+    '/ledger/buckets/sum': {'GET': route(common.get_buckets_sum)},
+    '/ledger/changes': {'GET': get_changes},
+    '/ledger/reports/balances': {'GET': route(common.get_portfolio_balances)},
+    '/ledger/trial-balance': {'GET': route(common.get_trial_balance)},
+    '/ledger/cache': {'GET': route(common.get_cache_stats)},
+    '/metrics': {'GET': route(common.get_metrics)},
+} # type: Dict[str, Dict[str, Callable[[common.Request], Awaitable[Any]]]]
+
+async def read_body(receive: Callable[[], Awaitable[Dict]]) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def handle_lifespan(receive: Callable[[], Awaitable[Dict]], send: Callable[[Dict], Awaitable[None]]):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope: Dict, receive: Callable[[], Awaitable[Dict]], send: Callable[[Dict], Awaitable[None]]):
+    if scope['type'] == 'lifespan':
+        return await handle_lifespan(receive, send)
+
+    methods = ROUTES.get(scope['path'])
+    if methods is None:
+        return await send_response(common.JsonResponse({'error': 'Not found'}, 404), send)
+    view = methods.get(scope['method'])
+    if view is None:
+        return await send_response(common.JsonResponse({'error': 'Method not allowed'}, 405), send)
+
+    request = to_request(scope, await read_body(receive))
+    response = await view(request)
+    await send_response(response, send)
+
+def observe_requests(application: Callable) -> Callable:
+    # Requests are timed like the Flask views, the first one and then one in the sample interval
+    requests = itertools.count()
+
+    async def instrumented_app(scope: Dict, receive: Callable[[], Awaitable[Dict]], send: Callable[[Dict], Awaitable[None]]):
+        if scope['type'] != 'http':
+            return await application(scope, receive, send)
+
+        start = None if next(requests) % metrics.HTTP_SECONDS.sample_interval else time.perf_counter()
+        statuses = []
+
+        async def send_with_status(message: Dict):
+            if message['type'] == 'http.response.start':
+                statuses.append(str(message['status']))
+            await send(message)
+
+        await application(scope, receive, send_with_status)
+        route = scope['path'] if scope['path'] in ROUTES else 'unmatched'
+        metrics.observe_request(route, scope['method'], statuses[0] if statuses else '500', None if start is None else time.perf_counter() - start)
+    return instrumented_app
+
+if metrics.ENABLED:
+    app = observe_requests(app)
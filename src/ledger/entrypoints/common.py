@@ -0,0 +1,421 @@
+"""
+Request handling shared by the Flask and ASGI apps. Every route is a
+handler taking a framework independent Request and the state of the
+app, and returning a response the app adapts to its framework and
+encodes with its serializer. Handlers block, the ASGI app runs them in
+its executor
+"""
+import functools
+import json
+import time
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple)
+
+from ledger import (config, metrics)
+from ledger.domain.ledger import LedgerEntry
+from ledger.entrypoints.serialization import generate_ndjson
+from ledger.service_layer import (cache, idempotency, schema, services, verification)
+from ledger.service_layer.schema import (
+    is_flag_value, validate_bucket_query, validate_buckets_sum_query, validate_changes_query, validate_entries_query,
+    validate_loan_query, validate_loans_query, validate_optional_loan_query, validate_portfolio_query,
+)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+NDJSON_ENCODING_ERROR = 'Please provide rows encoded as UTF-8'
+PAGE_PARAMETERS = ('limit', 'cursor', 'effective_from', 'effective_to', 'created_from', 'created_to')
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAXIMUM_IDEMPOTENCY_KEY_SIZE = config.get_maximum_idempotency_key_size()
+IDEMPOTENCY_KEY_ERROR = f'Please enter an idempotency key of at most {MAXIMUM_IDEMPOTENCY_KEY_SIZE} characters'
+# Sent by the sharded router, which adds up the totals of its shards exactly
+MINOR_UNITS_HEADER = 'Ledger-Minor-Units'
+
+def read_ndjson_rows(text: str) -> Iterator[Any]:
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+class Request:
+    def __init__(self, path: str, query_string: bytes, args: Dict[str, List[str]], headers: Dict[str, str], body: bytes):
+        self.path = path
+        self.query_string = query_string
+        self.args = args
+        # Keyed by lower case name
+        self.headers = headers
+        self.body = body
+
+    @property
+    def mimetype(self) -> str:
+        return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+    def get(self, name: str) -> Optional[str]:
+        values = self.args.get(name)
+        return values[0] if values else None
+
+    def getlist(self, name: str) -> List[str]:
+        return self.args.get(name, [])
+
+    def get_header(self, name: str) -> Optional[str]:
+        return self.headers.get(name.lower())
+
+    def get_json(self) -> Any:
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def is_stream_requested(self) -> bool:
+        accept = self.headers.get('accept', '')
+        return is_flag_value(self.get('stream')) or accept.split(',')[0].split(';')[0].strip() == NDJSON_MIMETYPE
+
+class Dependencies(NamedTuple):
+    """
+    State of an app, read on every request since tests and benchmarks
+    replace it
+    """
+    repositories: Dict[str, Any]
+    read_cache: cache.ReadCache
+    idempotency_store: idempotency.IdempotencyStore
+    trial_balance_verifier: verification.TrialBalanceVerifier
+
+class JsonResponse:
+    # Listings and reports grow with the ledger and the ASGI app encodes
+    # them in its executor, small documents cost less to encode than the hop
+    large = False
+
+    def __init__(self, body: Any, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+    def encode(self, serializer) -> bytes:
+        return serializer.dumps(self.body)
+
+class ReportResponse(JsonResponse):
+    large = True
+
+class EntriesResponse(JsonResponse):
+    large = True
+
+    def __init__(self, entries: List[LedgerEntry], **fields: Any):
+        super().__init__(fields)
+        self.entries = entries
+
+    def encode(self, serializer) -> bytes:
+        return serializer.dumps_entries(self.entries, **self.body)
+
+class ChangesResponse(JsonResponse):
+    large = True
+
+    def __init__(self, changes: List[Tuple[int, LedgerEntry]], **fields: Any):
+        super().__init__(fields)
+        self.changes = changes
+
+    def encode(self, serializer) -> bytes:
+        return serializer.dumps_changes(self.changes, **self.body)
+
+class NdjsonResponse:
+    status = 200
+
+    def __init__(self, entries: Iterator[LedgerEntry]):
+        self.lines = generate_ndjson(entries)
+
+class TextResponse:
+    status = 200
+
+    def __init__(self, content: str, content_type: str):
+        self.content = content
+        self.content_type = content_type
+
+Handler = Callable[[Request, Dependencies], Any]
+
+def error_response(error: Exception, status: int) -> JsonResponse:
+    return JsonResponse({'error': str(error)}, status)
+
+def schema_error_response(error: schema.SchemaError) -> JsonResponse:
+    return JsonResponse({'error': str(error), 'path': error.path}, 400)
+
+def idempotent(handler: Handler) -> Handler:
+    """
+    Answers a request carrying an Idempotency-Key header already used for
+    the same request from the idempotency store, without running the
+    handler. Duplicates of a request still in flight wait for its response
+    """
+    @functools.wraps(handler)
+    def idempotent_handler(request: Request, dependencies: Dependencies):
+        key = request.get_header(IDEMPOTENCY_KEY_HEADER)
+        if not key:
+            return handler(request, dependencies)
+        if len(key) > MAXIMUM_IDEMPOTENCY_KEY_SIZE:
+            return JsonResponse({'error': IDEMPOTENCY_KEY_ERROR}, 400)
+
+        store = dependencies.idempotency_store
+        fingerprint = idempotency.get_fingerprint(request.path.encode(), request.query_string, request.body)
+        while True:
+            try:
+                idempotent_request, is_new = store.begin(key, fingerprint)
+            except idempotency.IdempotencyKeyReused as e:
+                return error_response(e, 422)
+            if is_new:
+                break
+            # A failed request releases its key and the duplicate runs in its place
+            stored_response = idempotent_request.wait()
+            if stored_response is not None:
+                body, status = stored_response
+                return JsonResponse(body, status, {REPLAYED_HEADER: 'true'})
+
+        stored_response = None
+        try:
+            response = handler(request, dependencies)
+            if response.status == 200:
+                stored_response = (response.body, response.status)
+            return response
+        finally:
+            store.complete(key, idempotent_request, stored_response)
+    return idempotent_handler
+
+def create_bucket(request: Request, dependencies: Dependencies):
+    try:
+        query = validate_bucket_query(request.getlist)
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    try:
+        services.add_bucket(query.identifier, dependencies.repositories['bucket'])
+    except services.InvalidIdentifier as e:
+        return error_response(e, 400)
+
+    return JsonResponse({'message': f'Bucket named "{query.identifier}" created successfully'})
+
+def open_loan(request: Request, dependencies: Dependencies):
+    try:
+        loan_id = validate_loan_query(request.getlist).loan_id
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    try:
+        services.open_loan(loan_id, dependencies.repositories['loan'])
+    except services.InvalidLoanId as e:
+        return error_response(e, 400)
+
+    return JsonResponse({'message': f'Loan "{loan_id}" opened successfully'})
+
+def close_loan(request: Request, dependencies: Dependencies):
+    try:
+        loan_id = validate_loan_query(request.getlist).loan_id
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    try:
+        services.close_loan(loan_id, dependencies.repositories['loan'])
+    except services.UnknownLoan as e:
+        return error_response(e, 404)
+    except services.ClosedLoan as e:
+        return error_response(e, 400)
+
+    return JsonResponse({'message': f'Loan "{loan_id}" closed successfully'})
+
+def get_loans(request: Request, dependencies: Dependencies):
+    try:
+        loan_id, status = validate_loans_query(request.getlist)
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    loan_repo = dependencies.repositories['loan']
+    # Copied before the ledger lock is taken, repository locks always come first
+    loans = None if loan_id else loan_repo.get_all()
+    try:
+        # Summaries are updated by writers under the write lock
+        with dependencies.repositories['ledger'].read():
+            if loan_id:
+                report = services.get_loan_summary(services.get_loan(loan_id, loan_repo.get()))
+            else:
+                report = {'loans': services.get_loans(loans, status)}
+    except services.UnknownLoan as e:
+        return error_response(e, 404)
+
+    return ReportResponse(report)
+
+@idempotent
+def create_double_entries(request: Request, dependencies: Dependencies):
+    try:
+        loan_id = validate_loan_query(request.getlist).loan_id
+        pair_entries = schema.parse_pair_entries(request.get_json())
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    repositories = dependencies.repositories
+    try:
+        ledger_entries = services.add_double_entries(loan_id, pair_entries, repositories['bucket'], repositories['ledger'], repositories['loan'])
+    except services.UnknownLoan as e:
+        return error_response(e, 404)
+    except (services.ClosedLoan, services.InvalidPairValue, services.InvalidIdentifier) as e:
+        return error_response(e, 400)
+
+    dependencies.read_cache.invalidate([loan_id])
+    return JsonResponse({'message': f'"{len(ledger_entries)}" ledger entries created successfully'})
+
+@idempotent
+def create_bulk_double_entries(request: Request, dependencies: Dependencies):
+    if request.mimetype == NDJSON_MIMETYPE:
+        try:
+            rows = list(read_ndjson_rows(request.body.decode()))
+        except UnicodeDecodeError:
+            return JsonResponse({'error': NDJSON_ENCODING_ERROR}, 400)
+    else:
+        rows = request.get_json()
+        if not isinstance(rows, list):
+            return JsonResponse({'error': 'Please provide a list of pair entries with a loan id for each'}, 400)
+
+    repositories = dependencies.repositories
+    ledger_entries, errors = services.add_bulk_double_entries(rows, repositories['bucket'], repositories['ledger'], repositories['loan'])
+    dependencies.read_cache.invalidate({entry.loan_id for entry in ledger_entries})
+    return JsonResponse({'message': f'"{len(ledger_entries)}" ledger entries created successfully', 'created_entries': len(ledger_entries), 'errors': errors})
+
+def get_buckets_sum(request: Request, dependencies: Dependencies):
+    try:
+        loan_id, bucket_identifiers, as_of, consistency_check = validate_buckets_sum_query(request.getlist)
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    bucket_repo = dependencies.repositories['bucket']
+    ledger_repo = dependencies.repositories['ledger']
+    try:
+        services.get_loan(loan_id, dependencies.repositories['loan'].get())
+        if consistency_check:
+            # Checks always recompute, a cached sum would not verify anything
+            with ledger_repo.read() as ledger:
+                buckets_sum = services.get_buckets_sum(loan_id, bucket_identifiers, bucket_repo.get(), ledger, consistency_check, as_of)
+        else:
+            buckets_sum = cache.get_buckets_sum(dependencies.read_cache, loan_id, bucket_identifiers, bucket_repo, ledger_repo, as_of)
+    except services.InvalidIdentifier as e:
+        return error_response(e, 400)
+    except services.UnknownLoan as e:
+        return error_response(e, 404)
+    except services.InconsistentBalance as e:
+        return error_response(e, 500)
+
+    return JsonResponse({'entries': buckets_sum})
+
+def get_ledger_entries(request: Request, dependencies: Dependencies):
+    try:
+        query = validate_entries_query(request.getlist)
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    loan_id = query.loan_id
+    ledger_repo = dependencies.repositories['ledger']
+    if any(name in request.args for name in PAGE_PARAMETERS):
+        try:
+            services.get_loan(loan_id, dependencies.repositories['loan'].get())
+            with ledger_repo.read() as ledger:
+                # The page filters follow the loan id in the order get_ledger_entries_page takes them
+                ledger_entries, next_cursor = services.get_ledger_entries_page(loan_id, ledger, *query[1:])
+        except services.InvalidCursor as e:
+            return error_response(e, 400)
+        except services.UnknownLoan as e:
+            return error_response(e, 404)
+        return EntriesResponse(ledger_entries, next_cursor=next_cursor)
+
+    try:
+        loan = services.get_loan(loan_id, dependencies.repositories['loan'].get())
+    except services.UnknownLoan as e:
+        return error_response(e, 404)
+
+    if request.is_stream_requested():
+        # Streams without the read lock, the entries of a loan are append-only
+        return NdjsonResponse(services.iter_ledger_entries(loan))
+
+    return EntriesResponse(cache.get_ledger_entries(dependencies.read_cache, loan_id, ledger_repo))
+
+class ChangesPoll:
+    """
+    Long poll of the change feed. A read answers the poll unless it finds
+    the feed read to the end before the wait is over, the apps then wait
+    for new entries in their own way and read again
+    """
+    def __init__(self, request: Request, dependencies: Dependencies):
+        self.repositories = dependencies.repositories
+        self.error = None # type: Optional[JsonResponse]
+        self.changes = [] # type: List[Tuple[int, LedgerEntry]]
+        try:
+            loan_id, self.last_sequence, limit, wait, bucket_identifiers = validate_changes_query(request.getlist)
+        except schema.SchemaError as e:
+            self.error = schema_error_response(e)
+            return
+        self.read_filters = {'limit': limit, 'loan_id': loan_id, 'identifiers': bucket_identifiers}
+        self.deadline = time.monotonic() + wait
+        if loan_id:
+            try:
+                services.get_loan(loan_id, self.repositories['loan'].get())
+            except services.UnknownLoan as e:
+                self.error = error_response(e, 404)
+
+    def read(self):
+        if self.error:
+            return self.error
+        try:
+            self.changes, self.last_sequence = services.get_changes(self.last_sequence, self.repositories['ledger'], self.repositories['bucket'].get(), **self.read_filters)
+        except (services.InvalidSequence, services.InvalidIdentifier) as e:
+            self.error = error_response(e, 400)
+            return self.error
+        return ChangesResponse(self.changes, last_sequence=self.last_sequence)
+
+    def get_wait_timeout(self) -> Optional[float]:
+        """
+        Returns:
+            timeout(Optional[float]): Seconds left to wait for new entries
+                after the last read, None when it answers the poll
+        """
+        if self.error or self.changes or self.last_sequence != self.repositories['ledger'].feed.last_sequence:
+            return None
+        remaining = self.deadline - time.monotonic()
+        return remaining if remaining > 0 else None
+
+def get_portfolio_balances(request: Request, dependencies: Dependencies):
+    try:
+        bucket_identifiers, effective_from, effective_to = validate_portfolio_query(request.getlist)
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    bucket_identifiers = [identifier for identifier in bucket_identifiers if identifier]
+    # Copied before the ledger lock is taken, repository locks always come first
+    buckets = dependencies.repositories['bucket'].get_all()
+    try:
+        with dependencies.repositories['ledger'].read() as ledger:
+            report = services.get_portfolio_balances(bucket_identifiers, buckets, ledger, effective_from, effective_to)
+    except services.InvalidIdentifier as e:
+        return error_response(e, 400)
+
+    return ReportResponse(report)
+
+def get_trial_balance(request: Request, dependencies: Dependencies):
+    try:
+        loan_id = validate_optional_loan_query(request.getlist).loan_id
+    except schema.SchemaError as e:
+        return schema_error_response(e)
+
+    if loan_id:
+        try:
+            services.get_loan(loan_id, dependencies.repositories['loan'].get())
+        except services.UnknownLoan as e:
+            return error_response(e, 404)
+
+    minor_units = is_flag_value(request.get_header(MINOR_UNITS_HEADER))
+    with dependencies.repositories['ledger'].read() as ledger:
+        report = services.get_trial_balance(loan_id, ledger, minor_units)
+    if not loan_id:
+        report['verification'] = dependencies.trial_balance_verifier.last_result
+        report['verification_error'] = dependencies.trial_balance_verifier.last_error
+    return ReportResponse(report)
+
+def get_cache_stats(request: Request, dependencies: Dependencies):
+    return JsonResponse(dependencies.read_cache.get_stats())
+
+def get_metrics(request: Request, dependencies: Dependencies):
+    if not metrics.ENABLED:
+        return JsonResponse({'error': 'Metrics are disabled, set LEDGER_METRICS=1 to enable them'}, 404)
+    return TextResponse(metrics.REGISTRY.render(), metrics.CONTENT_TYPE)
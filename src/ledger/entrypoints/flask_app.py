@@ -1,86 +1,99 @@
-from flask import (Flask, request, jsonify)
-from ledger.adapters.repository import LedgerRepository
-from ledger.domain import bucket
+from flask import (Flask, Response, request)
 
-from ledger.service_layer import services
-from ledger.adapters import repository
+from ledger import metrics
+
+from ledger.bootstrap import (create_cache, create_idempotency_store, create_repositories, create_verifier)
+from ledger.entrypoints import common
+from ledger.entrypoints.common import NDJSON_MIMETYPE
+from ledger.entrypoints.serialization import create_serializer
 
 app = Flask(__name__)
-repositories = {
-    'ledger': repository.LedgerRepository(),
-    'loan': repository.LoanRepository(),
-    'bucket': repository.BucketRepository(),
-}
+repositories = create_repositories()
+read_cache = create_cache()
+idempotency_store = create_idempotency_store()
+serializer = create_serializer()
+trial_balance_verifier = create_verifier(lambda: repositories['ledger'])
+metrics.register_ledger_gauge(lambda: repositories)
+
+def get_dependencies() -> common.Dependencies:
+    return common.Dependencies(repositories, read_cache, idempotency_store, trial_balance_verifier)
+
+def to_request() -> common.Request:
+    headers = {name.lower(): value for name, value in request.headers.items()}
+    return common.Request(request.path, request.query_string, request.args.to_dict(flat=False), headers, request.get_data())
+
+def to_response(response):
+    if isinstance(response, common.NdjsonResponse):
+        return Response(response.lines, mimetype=NDJSON_MIMETYPE), response.status
+    if isinstance(response, common.TextResponse):
+        return Response(response.content, mimetype=response.content_type), response.status
+    return Response(response.encode(serializer), headers=response.headers, mimetype='application/json'), response.status
+
+def handle(handler: common.Handler):
+    return to_response(handler(to_request(), get_dependencies()))
 
 @app.route('/ledger/buckets', methods=['POST'])
 def create_bucket():
-    bucket_identifier = request.args.get('identifier', type=str)
-    if not bucket_identifier:
-        return jsonify({'error': 'Please enter a valid string bucket identifier'}), 400
-
-    bucket_repo = repositories['bucket']
-    try:
-        new_bucket = services.create_bucket(bucket_identifier, bucket_repo.get())
-    except services.InvalidIdentifier as e:
-        return jsonify({'error': str(e)}), 400
-    
-    bucket_repo.add(new_bucket)
-    return jsonify({'message': f'Bucket named "{bucket_identifier}" created successfully'}), 200
-
-@app.route('/ledger/entries', methods=['POST'])
-def create_double_entries():
-    loan_id = request.args.get('loan_id', type=int)
-    if not loan_id:
-        return jsonify({'error': 'Please enter a valid integer loan id'}), 400
-
-    entries = request.get_json()
-    for entry in entries:
-        debit_entry = entry.get('debit', None)
-        credit_entry = entry.get('credit', None)
-        if not debit_entry or not credit_entry:
-            return jsonify({'error': 'Please provide valid debit and credit objects for each pair entry'}), 400
-
-        if not isinstance(debit_entry['value'], float) or not isinstance(credit_entry['value'], float):
-            return jsonify({'error': 'Please provide valid floating point value for each pair entry'}), 400
-
-    bucket_repo = repositories['bucket']
-    try:
-        ledger_entries = services.create_double_entries(loan_id, entries, bucket_repo.get())
-    except (services.InvalidDate, services.InvalidPairValue, services.InvalidIdentifier) as e:
-        return jsonify({'error': str(e)}), 400
-    
-    ledger_repo = repositories['ledger']
-    ledger_repo.add(ledger_entries)
-
-    return jsonify({'message': f'"{len(ledger_entries)}" ledger entries created successfully'}), 200
+    return handle(common.create_bucket)
 
-@app.route('/ledger/buckets/sum', methods=['GET'])
-def get_buckets_sum():
-    loan_id = request.args.get('loan_id', type=int)
-    if not loan_id:
-        return jsonify({'error': 'Please enter a valid integer loan id'}), 400
+@app.route('/ledger/loans', methods=['POST'])
+def open_loan():
+    return handle(common.open_loan)
 
-    bucket_identifiers = request.args.getlist('bucket_id', type=str)
-    if not bucket_identifiers:
-        return jsonify({'error': 'Please enter at least one bucket identifier'}), 400
+@app.route('/ledger/loans/close', methods=['POST'])
+def close_loan():
+    return handle(common.close_loan)
 
-    bucket_repo = repositories['bucket']
-    ledger_repo = repositories['ledger']
-    try:
-        buckets_sum = services.get_buckets_sum(loan_id, bucket_identifiers, bucket_repo.get(), ledger_repo.get())
-    except services.InvalidIdentifier as e:
-        return jsonify({'error': str(e)}), 400
+@app.route('/ledger/loans', methods=['GET'])
+def get_loans():
+    return handle(common.get_loans)
 
-    return jsonify({'entries': buckets_sum}), 200
+@app.route('/ledger/entries', methods=['POST'])
+def create_double_entries():
+    return handle(common.create_double_entries)
 
+@app.route('/ledger/entries/bulk', methods=['POST'])
+def create_bulk_double_entries():
+    return handle(common.create_bulk_double_entries)
 
+@app.route('/ledger/buckets/sum', methods=['GET'])
+def get_buckets_sum():
+    return handle(common.get_buckets_sum)
 
 @app.route('/ledger/entries', methods=['GET'])
 def get_ledger_entries():
-    loan_id = request.args.get('loan_id', type=int)
-    if not loan_id:
-        return jsonify({'error': 'Please enter a valid integer loan id'}), 400
-
-    ledger_repo = repositories['ledger']
-    ledger_entries = services.get_ledger_entries(loan_id, ledger_repo.get())
-    return jsonify({'entries': ledger_entries}), 200
\ No newline at end of file
+    return handle(common.get_ledger_entries)
+
+@app.route('/ledger/changes', methods=['GET'])
+def get_changes():
+    poll = common.ChangesPoll(to_request(), get_dependencies())
+    response = poll.read()
+    # Long polls wait for new entries once the feed is read to the end
+    timeout = poll.get_wait_timeout()
+    while timeout is not None and repositories['ledger'].feed.wait(poll.last_sequence, timeout):
+        response = poll.read()
+        timeout = poll.get_wait_timeout()
+    return to_response(response)
+
+@app.route('/ledger/reports/balances', methods=['GET'])
+def get_portfolio_balances():
+    return handle(common.get_portfolio_balances)
+
+@app.route('/ledger/trial-balance', methods=['GET'])
+def get_trial_balance():
+    return handle(common.get_trial_balance)
+
+@app.route('/ledger/cache', methods=['GET'])
+def get_cache_stats():
+    return handle(common.get_cache_stats)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return handle(common.get_metrics)
+
+if metrics.ENABLED:
+    # Wraps the views rather than the WSGI app or request hooks, every view returning its status
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint != 'static':
+            method, = rule.methods - {'HEAD', 'OPTIONS'}
+            app.view_functions[rule.endpoint] = metrics.timed_view(app.view_functions[rule.endpoint], rule.rule, method)
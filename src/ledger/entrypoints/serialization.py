@@ -0,0 +1,146 @@
+"""
+JSON encoding of entry listings, change feed reads and bucket sums,
+which dominate the cost of read responses once the lookup itself is
+indexed.
+
+Entries are encoded by a serializer picked with ``LEDGER_JSON_SERIALIZER``:
+``orjson`` (the default when it is installed) or ``stdlib``, which
+formats every entry straight into JSON text instead of building a dict
+for it, with ISO dates formatted once per day and bucket identifiers
+encoded once per bucket. Both produce documents which decode to the
+same values, though not always the same text: numbers are written as
+Python's repr by stdlib and in orjson's own shortest form, e.g. 1e-06
+and 1e-6 or 1e-05 and 0.00001.
+"""
+import json
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Tuple)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ledger import (config, metrics)
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import SCALE
+
+ENTRY_FORMAT = '{"loan_id":%d,"created_at":"%s","effective_date":"%s","bucket_identifier":%s,"value":%r}'
+CHANGE_FORMAT = '{"sequence":%d,%s'
+
+# Both only grow with the number of distinct days and buckets
+iso_dates = {} # type: Dict[int, str]
+encoded_identifiers = {} # type: Dict[str, str]
+
+class InvalidSerializer(ValueError):
+    """Raised when the configured serializer is unknown or not installed"""
+    pass
+
+def encode_entry(entry: LedgerEntry) -> str:
+    created_ordinal = entry.created_at.toordinal()
+    created_at = iso_dates.get(created_ordinal)
+    if created_at is None:
+        created_at = iso_dates[created_ordinal] = entry.created_at.isoformat()
+
+    effective_ordinal = entry.effective_date.toordinal()
+    effective_date = iso_dates.get(effective_ordinal)
+    if effective_date is None:
+        effective_date = iso_dates[effective_ordinal] = entry.effective_date.isoformat()
+
+    bucket_identifier = encoded_identifiers.get(entry.bucket_identifier)
+    if bucket_identifier is None:
+        bucket_identifier = encoded_identifiers[entry.bucket_identifier] = json.dumps(entry.bucket_identifier)
+
+    return ENTRY_FORMAT % (entry.loan_id, created_at, effective_date, bucket_identifier, entry.value / SCALE)
+
+def generate_ndjson(entries: Iterator[LedgerEntry]) -> Iterator[str]:
+    for entry in entries:
+        yield encode_entry(entry) + '\n'
+
+class StdlibSerializer:
+    name = 'stdlib'
+
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+    @metrics.timed_serialization
+    def dumps_entries(self, entries: Iterable[LedgerEntry], **fields: Any) -> bytes:
+        """
+        Encodes a response listing entries
+
+        Args:
+            entries(Iterable[LedgerEntry]): Entries of the response
+            fields(Any): Other fields of the response, e.g. next_cursor
+        Returns:
+            content(bytes): JSON document with the entries and the fields
+        """
+        content = '{"entries":[' + ','.join(map(encode_entry, entries)) + ']'
+        for name, value in fields.items():
+            content += f',{json.dumps(name)}:{json.dumps(value)}'
+        return (content + '}').encode()
+
+    @metrics.timed_serialization
+    def dumps_changes(self, changes: List[Tuple[int, LedgerEntry]], **fields: Any) -> bytes:
+        """
+        Encodes a response of the change feed
+
+        Args:
+            changes(List[Tuple[int, LedgerEntry]]): Sequence numbers with their entries
+            fields(Any): Other fields of the response, e.g. last_sequence
+        Returns:
+            content(bytes): JSON document with the entries, each with its
+                sequence number, and the fields
+        """
+        content = '{"changes":[' + ','.join(CHANGE_FORMAT % (sequence, encode_entry(entry)[1:]) for sequence, entry in changes) + ']'
+        for name, value in fields.items():
+            content += f',{json.dumps(name)}:{json.dumps(value)}'
+        return (content + '}').encode()
+
+class OrjsonSerializer(StdlibSerializer):
+    name = 'orjson'
+
+    def dumps(self, value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    @metrics.timed_serialization
+    def dumps_entries(self, entries: Iterable[LedgerEntry], **fields: Any) -> bytes:
+        # orjson formats dates as ISO strings itself, faster than looking them up
+        return orjson.dumps({
+            'entries': [
+                {
+                    'loan_id': entry.loan_id,
+                    'created_at': entry.created_at,
+                    'effective_date': entry.effective_date,
+                    'bucket_identifier': entry.bucket_identifier,
+                    'value': entry.value / SCALE,
+                }
+                for entry in entries
+            ],
+            **fields,
+        })
+
+    @metrics.timed_serialization
+    def dumps_changes(self, changes: List[Tuple[int, LedgerEntry]], **fields: Any) -> bytes:
+        return orjson.dumps({
+            'changes': [
+                {
+                    'sequence': sequence,
+                    'loan_id': entry.loan_id,
+                    'created_at': entry.created_at,
+                    'effective_date': entry.effective_date,
+                    'bucket_identifier': entry.bucket_identifier,
+                    'value': entry.value / SCALE,
+                }
+                for sequence, entry in changes
+            ],
+            **fields,
+        })
+
+SERIALIZERS = {serializer.name: serializer for serializer in (StdlibSerializer, OrjsonSerializer)}
+
+def create_serializer(name: Optional[str] = None) -> StdlibSerializer:
+    name = name or config.get_json_serializer() or ('orjson' if orjson else 'stdlib')
+    if name not in SERIALIZERS:
+        raise InvalidSerializer(f'Unknown JSON serializer "{name}", expected one of {", ".join(SERIALIZERS)}')
+    if name == 'orjson' and orjson is None:
+        raise InvalidSerializer('The orjson serializer requires orjson to be installed')
+    return SERIALIZERS[name]()
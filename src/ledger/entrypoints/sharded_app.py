@@ -0,0 +1,594 @@
+"""
+Sharded deployment: loans are partitioned by loan id across worker
+processes, each running asgi_app with repositories of its own, behind a
+thin ASGI router, e.g. with ``LEDGER_SHARDS=4 uvicorn ledger.entrypoints.sharded_app:app``
+
+The router only parses enough of a request to pick its shards and
+forwards it over a pipe. Bucket creation, portfolio reports, loan
+listings, cache counters and metrics go to every shard, bulk rows are
+split by loan and their results merged, each part keeping the
+idempotency key of the request. Change feed reads of the whole
+ledger go to every shard, long polls wait in the router. Shards keep
+the loans they own for good, so the number of shards of a data
+directory must not change. A shard serves the requests it receives
+concurrently, a report or a check of the ledger does not hold up the
+writes to its loans.
+
+A shard which exits or does not answer within LEDGER_SHARD_TIMEOUT
+seconds is answered for by the router with 503 or 504, and so are
+requests sent to every shard, naming the failed shard. Requests are
+only routed once every shard has recovered its repositories, so the
+time a shard takes to start does not count against the timeout.
+
+Requests spanning shards are not atomic, nothing is rolled back when a
+shard fails. Bulk rows added on some shards but not on others are
+reported shard by shard with 207, retrying with the idempotency key
+replays the parts which were added and only adds the others. A bucket
+created on some shards only is reported the same way, and entries
+using it are rejected by the shards missing it until a retry creates
+it there, the shards already holding it counting as created.
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple)
+from urllib.parse import (parse_qs, urlencode)
+
+from ledger import (config, metrics)
+from ledger.domain.money import to_major_units
+from ledger.entrypoints.common import (IDEMPOTENCY_KEY_HEADER, MINOR_UNITS_HEADER, NDJSON_ENCODING_ERROR, NDJSON_MIMETYPE, REPLAYED_HEADER, read_ndjson_rows)
+from ledger.service_layer import schema
+from ledger.service_layer.services import DUPLICATE_BUCKET_ERROR
+
+# Method, path, query string, headers and body of a request
+ShardRequest = Tuple[str, str, bytes, List[Tuple[bytes, bytes]], bytes]
+# Status, headers and body of a response
+ShardResponse = Tuple[int, List[Tuple[bytes, bytes]], bytes]
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+# Seconds between reads of the change feeds of the shards while a long poll waits
+CHANGES_POLL_INTERVAL = 0.05
+SHARD_UNAVAILABLE_ERROR = 'Shard is unavailable, please retry later'
+SHARD_TIMEOUT_ERROR = 'Shard did not answer in time, please retry later'
+PARTIAL_BULK_ERROR = 'Rows were only added on some shards, see shards for the rows of each'
+PARTIAL_BUCKET_ERROR = 'Bucket was only created on some shards, please retry to create it on the others'
+# Sent by a shard once its repositories are recovered, before it reads any request
+READY_MESSAGE = 'ready'
+
+logger = logging.getLogger(__name__)
+
+def to_json_response(body: Any, status: int = 200) -> ShardResponse:
+    content = json.dumps(body).encode()
+    return status, JSON_HEADERS + [(b'content-length', str(len(content)).encode())], content
+
+def get_shard(loan_id: int, shards: int) -> int:
+    return hash(loan_id) % shards
+
+async def call_app(app: Callable, request: ShardRequest) -> ShardResponse:
+    method, path, query_string, headers, body = request
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers}
+    start = {} # type: Dict
+    chunks = [] # type: List[bytes]
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            start.update(message)
+        else:
+            chunks.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return start['status'], list(start.get('headers', [])), b''.join(chunks)
+
+async def serve_shard(app: Callable, connection, shard_number: int):
+    """
+    Serves requests of the router concurrently, each in a task of its own,
+    so a long report or change feed wait does not hold up the writes to
+    the loans of the shard. Responses are sent from a dedicated thread in
+    the order they are ready, the router matches them to their request by id
+
+    Args:
+        app(Callable): ASGI application of the shard
+        connection(Connection): Pipe to the router
+        shard_number(int): Number of the shard
+    """
+    loop = asyncio.get_running_loop()
+    closed = loop.create_future()
+    sender = ThreadPoolExecutor(max_workers=1)
+    tasks = set() # type: Set[asyncio.Task]
+
+    async def serve(request_id: int, request: ShardRequest):
+        try:
+            response = await call_app(app, request)
+        except Exception:
+            # A failing request must not take the shard and every request after it down
+            logger.exception('Request to shard %d failed', shard_number)
+            response = to_json_response({'error': 'Internal server error'}, 500)
+        try:
+            await loop.run_in_executor(sender, connection.send, (request_id, response))
+        except OSError:
+            # The router is gone, the pipe reaches EOF next
+            pass
+
+    def receive_requests():
+        try:
+            while connection.poll():
+                message = connection.recv()
+                if message is None:
+                    raise EOFError
+                task = loop.create_task(serve(*message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (EOFError, OSError):
+            loop.remove_reader(connection.fileno())
+            if not closed.done():
+                closed.set_result(None)
+
+    loop.add_reader(connection.fileno(), receive_requests)
+    await closed
+    if tasks:
+        await asyncio.wait(tasks)
+    sender.shutdown()
+
+def run_shard(connection, shard_number: int):
+    """
+    Serves the requests of one shard until the router closes the pipe,
+    with the data directory or database of the shard
+
+    Args:
+        connection(Connection): Pipe to the router
+        shard_number(int): Number of the shard
+    """
+    if config.get_data_directory():
+        os.environ['LEDGER_DATA_DIR'] = os.path.join(config.get_data_directory(), f'shard-{shard_number:03d}')
+    if config.get_sqlite_path():
+        os.environ['LEDGER_SQLITE_PATH'] = f'{config.get_sqlite_path()}.shard-{shard_number:03d}'
+    from ledger.entrypoints import asgi_app
+
+    # Importing the app recovers the repositories of the shard, the router waits for it
+    connection.send(READY_MESSAGE)
+    asyncio.run(serve_shard(asgi_app.app, connection, shard_number))
+
+class ShardClient:
+    """
+    Router side of the pipe to a shard. Requests are pipelined: they are
+    sent from a dedicated thread, so a busy shard never blocks the event
+    loop, and responses are matched to their request by id. Once the
+    shard exits, requests waiting for it and every later request are
+    answered with 503, requests it does not answer in time with 504
+    """
+    def __init__(self, context, shard_number: int, timeout: float):
+        self.connection, self.shard_connection = context.Pipe()
+        self.process = context.Process(target=run_shard, args=(self.shard_connection, shard_number), name=f'ledger-shard-{shard_number}', daemon=True)
+        self.timeout = timeout
+        self.sender = ThreadPoolExecutor(max_workers=1)
+        self.request_ids = itertools.count()
+        self.pending = {} # type: Dict[int, asyncio.Future]
+        self.loop = None # type: Optional[asyncio.AbstractEventLoop]
+        self.available = True
+
+    def start(self):
+        self.process.start()
+        # Only the shard holds its end from now on, so the pipe reaches EOF when the shard exits
+        self.shard_connection.close()
+
+    def wait_until_ready(self):
+        """
+        Blocks until the shard has recovered its repositories, so the time
+        it takes to start does not count against the timeout of requests.
+        A shard exiting before it is ready answers every request with 503
+        """
+        try:
+            message = self.connection.recv()
+        except (EOFError, OSError):
+            self.fail()
+            return
+        if message != READY_MESSAGE:
+            raise RuntimeError(f'Shard process {self.process.name} sent {message!r} before it was ready')
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        if self.loop is not loop and self.available:
+            self.loop = loop
+            loop.add_reader(self.connection.fileno(), self.receive_responses)
+
+    def receive_responses(self):
+        try:
+            while self.connection.poll():
+                request_id, response = self.connection.recv()
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (EOFError, OSError):
+            self.fail()
+
+    def fail(self):
+        if self.available:
+            logger.error('Shard process %s exited', self.process.name)
+            self.available = False
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.remove_reader(self.connection.fileno())
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_result(to_json_response({'error': SHARD_UNAVAILABLE_ERROR}, 503))
+
+    async def request(self, request: ShardRequest) -> ShardResponse:
+        if not self.available:
+            return to_json_response({'error': SHARD_UNAVAILABLE_ERROR}, 503)
+        loop = asyncio.get_running_loop()
+        self.attach(loop)
+        request_id = next(self.request_ids)
+        future = self.pending[request_id] = loop.create_future()
+        try:
+            await loop.run_in_executor(self.sender, self.connection.send, (request_id, request))
+        except OSError:
+            self.fail()
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # A late response finds no future and is dropped
+            self.pending.pop(request_id, None)
+            return to_json_response({'error': SHARD_TIMEOUT_ERROR}, 504)
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed() and self.available:
+            self.loop.remove_reader(self.connection.fileno())
+        if self.available:
+            try:
+                self.sender.submit(self.connection.send, None).result()
+            except OSError:
+                pass
+        self.process.join()
+        self.sender.shutdown()
+        self.connection.close()
+
+def add_amounts(amounts: Iterable[str]) -> float:
+    # Shards report exact minor units, adding the floats of many shards would drift
+    return to_major_units(sum(map(int, amounts)))
+
+def get_failed_response(responses: List[ShardResponse]) -> Optional[ShardResponse]:
+    """
+    Picks the response a request sent to every shard fails with, if any.
+    Every shard rejects an invalid request alike, a shard failing on its
+    own is named in the error with its number
+
+    Args:
+        responses(List[ShardResponse]): Responses of every shard, shard by shard
+    Returns:
+        response(Optional[ShardResponse]): First response which is not 200, None if there is none
+    """
+    for shard_number, response in enumerate(responses):
+        status, _, body = response
+        if status >= 500:
+            return to_json_response(dict(json.loads(body), shard=shard_number), status)
+        if status != 200:
+            return response
+    return None
+
+def get_loan_id(query_string: bytes) -> Optional[int]:
+    values = parse_qs(query_string.decode('latin-1')).get('loan_id')
+    try:
+        return int(values[0])
+    except (TypeError, ValueError):
+        return None
+
+class ShardedApp:
+    def __init__(self, shards: int, timeout: float = config.get_shard_timeout()):
+        self.shards = shards
+        self.timeout = timeout
+        self.clients = [] # type: List[ShardClient]
+
+    def start(self):
+        if not self.clients:
+            context = multiprocessing.get_context('spawn')
+            self.clients = [ShardClient(context, shard_number, self.timeout) for shard_number in range(self.shards)]
+            # Shards recover in parallel, requests are only routed once every shard is ready
+            for client in self.clients:
+                client.start()
+            for client in self.clients:
+                client.wait_until_ready()
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+        self.clients = []
+
+    def get_client(self, loan_id: Optional[int]) -> ShardClient:
+        # Requests without a valid loan id are rejected by any shard, the first one answers them
+        return self.clients[get_shard(loan_id, self.shards) if loan_id else 0]
+
+    async def broadcast(self, request: ShardRequest) -> List[ShardResponse]:
+        return list(await asyncio.gather(*(client.request(request) for client in self.clients)))
+
+    async def create_bucket(self, request: ShardRequest) -> ShardResponse:
+        responses = await self.broadcast(request)
+        # A shard which already holds the bucket kept it from an earlier, partly failed creation
+        held = [status == 200 or (status == 400 and json.loads(body).get('error') == DUPLICATE_BUCKET_ERROR) for status, _, body in responses]
+        if all(held):
+            # A retry creating the bucket on the shards which missed it succeeds, one finding it everywhere is rejected
+            return next((response for response in responses if response[0] == 200), responses[0])
+        if not any(held):
+            return get_failed_response(responses) or responses[0]
+        return to_json_response({'error': PARTIAL_BUCKET_ERROR, 'shards': [
+            dict(json.loads(body), shard=shard_number, status=status) for shard_number, (status, _, body) in enumerate(responses)
+        ]}, 207)
+
+    async def create_bulk_double_entries(self, request: ShardRequest) -> ShardResponse:
+        method, path, query_string, headers, body = request
+        content_type = dict(headers).get(b'content-type', b'').split(b';')[0].strip().decode('latin-1')
+        # Every shard stores the response to its own part of the rows under the key. The
+        # digest of all the rows is part of the fingerprint the shards compute from the query
+        # string, so a retry changing rows of another shard does not replay this part either
+        shard_headers = JSON_HEADERS + [(name, value) for name, value in headers if name == IDEMPOTENCY_KEY_HEADER.lower().encode()]
+        shard_query_string = urlencode({'rows_digest': hashlib.sha256(body).hexdigest()}).encode() if len(shard_headers) > len(JSON_HEADERS) else b''
+        if content_type == NDJSON_MIMETYPE:
+            try:
+                rows = list(read_ndjson_rows(body.decode()))
+            except UnicodeDecodeError:
+                return to_json_response({'error': NDJSON_ENCODING_ERROR}, 400)
+        else:
+            try:
+                rows = json.loads(body)
+            except ValueError:
+                rows = None
+            if not isinstance(rows, list):
+                return to_json_response({'error': 'Please provide a list of pair entries with a loan id for each'}, 400)
+
+        shard_rows = {} # type: Dict[int, List[Tuple[int, Any]]]
+        for index, row in enumerate(rows):
+            loan_id = row.get('loan_id') if isinstance(row, dict) else None
+            shard_number = get_shard(loan_id, self.shards) if isinstance(loan_id, int) and not isinstance(loan_id, bool) and loan_id else 0
+            shard_rows.setdefault(shard_number, []).append((index, row))
+
+        shard_numbers = sorted(shard_rows)
+        responses = await asyncio.gather(*(
+            self.clients[shard_number].request((method, path, shard_query_string, shard_headers, json.dumps([row for _, row in shard_rows[shard_number]]).encode()))
+            for shard_number in shard_numbers
+        ))
+
+        failed_responses = [response for response in responses if response[0] != 200]
+        if len(failed_responses) == len(responses):
+            # Nothing was added anywhere, the error of the first shard stands for the request
+            status, _, shard_body = failed_responses[0]
+            return status, JSON_HEADERS, shard_body
+
+        created_entries = 0
+        errors = []
+        shard_results = []
+        for shard_number, (status, _, shard_body) in zip(shard_numbers, responses):
+            result = json.loads(shard_body)
+            rows = [index for index, _ in shard_rows[shard_number]]
+            if status == 200:
+                created_entries += result['created_entries']
+                # Row numbers reported by the shard point into its own part of the rows
+                result['errors'] = [dict(error, row=rows[error['row']]) for error in result['errors']]
+                errors.extend(result['errors'])
+            shard_results.append(dict(result, shard=shard_number, status=status, rows=rows))
+        if failed_responses:
+            # Rows of the shards which answered 200 are added, retrying the request with
+            # its idempotency key replays them and only adds the rows of the others
+            return to_json_response({'error': PARTIAL_BULK_ERROR, 'shards': shard_results}, 207)
+        errors.sort(key=lambda error: error['row'])
+        status, response_headers, content = to_json_response({'message': f'"{created_entries}" ledger entries created successfully', 'created_entries': created_entries, 'errors': errors})
+        replayed_header = (REPLAYED_HEADER.lower().encode(), b'true')
+        if responses and all(replayed_header in response[1] for response in responses):
+            response_headers.append(replayed_header)
+        return status, response_headers, content
+
+    async def get_portfolio_balances(self, request: ShardRequest) -> ShardResponse:
+        responses = await self.broadcast(request)
+        failed_response = get_failed_response(responses)
+        if failed_response:
+            return failed_response
+
+        reports = [json.loads(body) for _, _, body in responses]
+        rows = sorted(row for report in reports for row in zip(report['loan_ids'], report['balances']))
+        return to_json_response({
+            'loan_ids': [loan_id for loan_id, _ in rows],
+            'bucket_identifiers': reports[0]['bucket_identifiers'],
+            'balances': [balances for _, balances in rows],
+        })
+
+    async def get_loans(self, request: ShardRequest) -> ShardResponse:
+        responses = await self.broadcast(request)
+        failed_response = get_failed_response(responses)
+        if failed_response:
+            return failed_response
+
+        loans = [loan for _, _, body in responses for loan in json.loads(body)['loans']]
+        return to_json_response({'loans': sorted(loans, key=lambda loan: loan['loan_id'])})
+
+    async def get_trial_balance(self, request: ShardRequest) -> ShardResponse:
+        method, path, query_string, headers, body = request
+        responses = await self.broadcast((method, path, query_string, headers + [(MINOR_UNITS_HEADER.lower().encode(), b'true')], body))
+        failed_response = get_failed_response(responses)
+        if failed_response:
+            return failed_response
+
+        reports = [json.loads(body) for _, _, body in responses]
+        bucket_rows = {} # type: Dict[str, List[Dict]]
+        for report in reports:
+            for row in report['buckets']:
+                bucket_rows.setdefault(row['identifier'], []).append(row)
+
+        # Every shard is verified on its own, the merged result waits for all of them
+        verifications = [report['verification'] for report in reports]
+        verification = None
+        if all(verifications):
+            verification = {
+                'verified_entries': sum(result['verified_entries'] for result in verifications),
+                'verified_loans': sum(result['verified_loans'] for result in verifications),
+                'mismatched_loan_ids': sorted(loan_id for result in verifications for loan_id in result['mismatched_loan_ids']),
+                'totals_match': all(result['totals_match'] for result in verifications),
+                'consistent': all(result['consistent'] for result in verifications),
+                'completed_at': min(result['completed_at'] for result in verifications),
+            }
+        return to_json_response({
+            'loan_id': None,
+            'buckets': [
+                {'identifier': identifier, **{name: add_amounts(row[name] for row in bucket_rows[identifier]) for name in ('debit', 'credit', 'sum')}}
+                for identifier in sorted(bucket_rows)
+            ],
+            'debit': add_amounts(report['debit'] for report in reports),
+            'credit': add_amounts(report['credit'] for report in reports),
+            'entries': sum(report['entries'] for report in reports),
+            'balanced': all(report['balanced'] for report in reports),
+            'unbalanced_loan_ids': sorted(loan_id for report in reports for loan_id in report['unbalanced_loan_ids']),
+            'verification': verification,
+            # A shard whose verifications fail is reported as is, with its number
+            'verification_error': next((dict(report['verification_error'], shard=shard_number) for shard_number, report in enumerate(reports) if report['verification_error']), None),
+        })
+
+    async def read_changes(self, request: ShardRequest, clients: List[ShardClient], afters: List[str], wait: float) -> Tuple[Optional[ShardResponse], List[Dict], List[int]]:
+        """
+        Reads the change feeds of shards, waiting for new entries by reading
+        them again until the wait of the request is over. The wait is kept
+        in the router, so one wait covers every shard and a wait longer than
+        LEDGER_SHARD_TIMEOUT is not answered with 504
+
+        Args:
+            request(ShardRequest): Request to the change feed
+            clients(List[ShardClient]): Shards to read
+            afters(List[str]): Sequence number to read after on each shard
+            wait(float): Seconds to wait for new entries at most
+        Returns:
+            error(Optional[ShardResponse]): Response of the first shard rejecting the request
+            changes(List[Dict]): Changes of every shard, shard by shard
+            last_sequences(List[int]): Sequence number to read after next on each shard
+        """
+        method, path, query_string, headers, body = request
+        arguments = parse_qs(query_string.decode('latin-1'), keep_blank_values=True)
+        arguments.pop('after', None)
+        arguments.pop('wait', None)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            responses = await asyncio.gather(*(
+                client.request((method, path, urlencode(dict(arguments, after=after), doseq=True).encode(), headers, body))
+                for client, after in zip(clients, afters)
+            ))
+            failed_response = get_failed_response(responses)
+            if failed_response:
+                return failed_response, [], []
+
+            results = [json.loads(response_body) for _, _, response_body in responses]
+            changes = [change for result in results for change in result['changes']]
+            last_sequences = [result['last_sequence'] for result in results]
+            remaining = deadline - loop.time()
+            if changes or remaining <= 0:
+                return None, changes, last_sequences
+            # Shards still scanning towards the end of their feed are read again right away
+            if last_sequences == [int(after or 0) for after in afters]:
+                await asyncio.sleep(min(CHANGES_POLL_INTERVAL, remaining))
+            afters = [str(last_sequence) for last_sequence in last_sequences]
+
+    async def get_changes(self, request: ShardRequest) -> ShardResponse:
+        method, path, query_string, headers, body = request
+        arguments = parse_qs(query_string.decode('latin-1'))
+        try:
+            # The shards validate the other parameters, the wait is kept in the router
+            wait = schema.validate_wait_query(lambda name: arguments.get(name, [])).wait
+        except schema.SchemaError as e:
+            return to_json_response({'error': str(e), 'path': e.path}, 400)
+
+        after = arguments.get('after', [''])[0]
+        if 'loan_id' in arguments:
+            error, changes, last_sequences = await self.read_changes(request, [self.get_client(get_loan_id(query_string))], [after], wait)
+            return error or to_json_response({'changes': changes, 'last_sequence': last_sequences[0]})
+
+        # Entries are numbered per shard, the feed of the whole ledger resumes
+        # after the sequence number of every shard, e.g. "12.0.7"
+        afters = after.split('.') if after else ['0'] * self.shards
+        if len(afters) != self.shards or not all(sequence.isdigit() for sequence in afters):
+            return to_json_response({'error': schema.SEQUENCE_ERROR, 'path': 'after'}, 400)
+        error, changes, last_sequences = await self.read_changes(request, self.clients, afters, wait)
+        return error or to_json_response({'changes': changes, 'last_sequence': '.'.join(map(str, last_sequences))})
+
+    async def get_cache_stats(self, request: ShardRequest) -> ShardResponse:
+        responses = await self.broadcast(request)
+        failed_response = get_failed_response(responses)
+        if failed_response:
+            return failed_response
+
+        stats = [json.loads(body) for _, _, body in responses]
+        return to_json_response({name: sum(shard_stats[name] for shard_stats in stats) for name in stats[0]})
+
+    async def get_metrics(self, request: ShardRequest) -> ShardResponse:
+        responses = await self.broadcast(request)
+        failed_response = get_failed_response(responses)
+        if failed_response:
+            return failed_response
+
+        # Samples of every shard are labelled with its number, the descriptions are only kept once
+        lines = []
+        described = set()
+        for shard_number, (_, _, body) in enumerate(responses):
+            for line in body.decode().splitlines():
+                if line.startswith('#'):
+                    if line not in described:
+                        described.add(line)
+                        lines.append(line)
+                elif line:
+                    name, value = line.rsplit(' ', 1)
+                    if name.endswith('}'):
+                        name = f'{name[:-1]},shard="{shard_number}"}}'
+                    else:
+                        name = f'{name}{{shard="{shard_number}"}}'
+                    lines.append(f'{name} {value}')
+        content = ('\n'.join(lines) + '\n').encode()
+        return 200, [(b'content-type', metrics.CONTENT_TYPE.encode()), (b'content-length', str(len(content)).encode())], content
+
+    async def route(self, request: ShardRequest) -> ShardResponse:
+        method, path, query_string, _, _ = request
+        if path == '/ledger/buckets' and method == 'POST':
+            return await self.create_bucket(request)
+        if path == '/ledger/entries/bulk' and method == 'POST':
+            return await self.create_bulk_double_entries(request)
+        if path == '/ledger/reports/balances' and method == 'GET':
+            return await self.get_portfolio_balances(request)
+        if path == '/ledger/loans' and method == 'GET' and get_loan_id(query_string) is None:
+            return await self.get_loans(request)
+        if path == '/ledger/trial-balance' and method == 'GET' and get_loan_id(query_string) is None:
+            return await self.get_trial_balance(request)
+        if path == '/ledger/changes' and method == 'GET':
+            return await self.get_changes(request)
+        if path == '/ledger/cache' and method == 'GET':
+            return await self.get_cache_stats(request)
+        if path == '/metrics' and method == 'GET':
+            return await self.get_metrics(request)
+        return await self.get_client(get_loan_id(query_string)).request(request)
+
+    async def __call__(self, scope: Dict, receive: Callable[[], Awaitable[Dict]], send: Callable[[Dict], Awaitable[None]]):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    self.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.stop()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        self.start()
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        request = (scope['method'], scope['path'], scope.get('query_string', b''), list(scope.get('headers', [])), b''.join(chunks))
+        status, headers, body = await self.route(request)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+app = ShardedApp(config.get_shard_count())
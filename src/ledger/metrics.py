@@ -0,0 +1,333 @@
+"""
+Latency and size histograms of the hot paths, rendered in the
+Prometheus text format by the /metrics routes. Enabled with
+``LEDGER_METRICS=1``.
+
+Instrumentation is applied by decorators when a module is imported.
+While metrics are disabled the decorators return the function itself,
+so disabled metrics add no code at all to the instrumented paths.
+Every HTTP request is counted. Requests, service functions and the
+phases within a request are timed for one call in
+LEDGER_METRICS_SAMPLE_INTERVAL, the others only pass through, and every
+sample counts for that many calls, so counts and sums of the duration
+histograms still estimate every call. Most of what timing costs is
+reading the clock, reading it around every layer of every request
+would add more than 1% to short requests.
+"""
+import functools
+import itertools
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+from typing import (Callable, Dict, List, Optional, Sequence, Tuple, TypeVar)
+
+from ledger import config
+
+F = TypeVar('F', bound=Callable)
+
+ENABLED = config.is_metrics_enabled()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096, 16384, 65536)
+PENDING_OBSERVATIONS = 4096
+SAMPLE_INTERVAL = config.get_metrics_sample_interval()
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    labels = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in zip(names, values))
+    return '{' + labels + '}'
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class HistogramChild:
+    def __init__(self, bounds: Tuple[float, ...], weight: int = 1):
+        self.bounds = bounds
+        # Calls every observation stands for
+        self.weight = weight
+        self.lock = threading.Lock()
+        # The last count holds the observations above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        # Observations are queued and only sorted into the buckets when
+        # the histogram is rendered or enough of them are queued, as
+        # appending to a deque is atomic and much cheaper than bucketing
+        # under a lock on every hot path
+        self.pending = deque()
+
+    def observe(self, value: float):
+        self.pending.append(value)
+        if len(self.pending) >= PENDING_OBSERVATIONS:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            for _ in range(len(self.pending)):
+                value = self.pending.popleft()
+                self.counts[bisect_left(self.bounds, value)] += self.weight
+                self.sum += value * self.weight
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS, sample_interval: int = 1):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.bounds = tuple(buckets)
+        # Timed decorators observe one call in sample_interval
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.children = {} # type: Dict[Tuple[str, ...], HistogramChild]
+
+    def labels(self, *labels: str) -> HistogramChild:
+        child = self.children.get(labels)
+        if child is not None:
+            return child
+        with self.lock:
+            child = self.children.get(labels)
+            if child is None:
+                child = self.children[labels] = HistogramChild(self.bounds, self.sample_interval)
+            return child
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            children = sorted(self.children.items())
+        bucket_names = self.label_names + ('le',)
+        for labels, child in children:
+            child.fold()
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float('inf'),), counts):
+                cumulative += count
+                bound_label = '+Inf' if bound == float('inf') else format_value(bound)
+                lines.append(f'{self.name}_bucket{format_labels(bucket_names, labels + (bound_label,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {repr(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+class Counter:
+    """
+    Number of events per label values, counted exactly however the
+    durations of the events are sampled
+    """
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.children = {} # type: Dict[Tuple[str, ...], CounterChild]
+
+    def labels(self, *labels: str) -> CounterChild:
+        child = self.children.get(labels)
+        if child is not None:
+            return child
+        with self.lock:
+            return self.children.setdefault(labels, CounterChild())
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            children = sorted(self.children.items())
+        for labels, child in children:
+            lines.append(f'{self.name}{format_labels(self.label_names, labels)} {child.value}')
+        return lines
+
+class Gauge:
+    """
+    Value read when the metrics are rendered, for sizes which are cheaper
+    to look up on a scrape than to track on every write
+    """
+    def __init__(self, name: str, documentation: str, read: Callable[[], Optional[float]]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> List[str]:
+        value = self.read()
+        if value is None:
+            return []
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {format_value(value)}']
+
+class Registry:
+    def __init__(self):
+        self.metrics = {} # type: Dict[str, object]
+
+    def register(self, metric):
+        # Registering a name again replaces the metric, e.g. when an app module is reloaded
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+SERVICE_SECONDS = REGISTRY.register(Histogram('ledger_service_duration_seconds', 'Time spent in service layer functions', ('function',), sample_interval=SAMPLE_INTERVAL))
+PHASE_SECONDS = REGISTRY.register(Histogram('ledger_phase_duration_seconds', 'Time spent in each phase of handling entries', ('phase',), sample_interval=SAMPLE_INTERVAL))
+# The sum of the batch sizes is the number of entries written
+BATCH_ENTRIES = REGISTRY.register(Histogram('ledger_batch_entries', 'Entries per batch appended to the ledger', buckets=SIZE_BUCKETS))
+RESPONSE_ENTRIES = REGISTRY.register(Histogram('ledger_response_entries', 'Entries per serialized entry listing', buckets=SIZE_BUCKETS))
+HTTP_REQUESTS = REGISTRY.register(Counter('ledger_http_requests_total', 'HTTP requests handled', ('route', 'method', 'status')))
+HTTP_SECONDS = REGISTRY.register(Histogram('ledger_http_request_duration_seconds', 'Time spent handling HTTP requests', ('route', 'method', 'status'), sample_interval=SAMPLE_INTERVAL))
+
+def sample(function: F, child: HistogramChild) -> F:
+    """
+    Wraps function to record the duration of one call in the sample
+    interval of child, the other calls only pass through. Calls are
+    numbered by next() on a count, which is atomic, so concurrent calls
+    never take the same number
+
+    Args:
+        function(Callable): Function to wrap
+        child(HistogramChild): Histogram child the durations are observed in
+    Returns:
+        wrapper(Callable): Function timing one call in child.weight
+    """
+    interval = child.weight
+    calls = itertools.count(1)
+    pending = child.pending
+
+    # Appends to the queue of the child itself, saving a call per observation
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if next(calls) % interval:
+            return function(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            pending.append(perf_counter() - start)
+            if len(pending) >= PENDING_OBSERVATIONS:
+                child.fold()
+    return wrapper
+
+def timed(histogram: Histogram, *labels: str) -> Callable[[F], F]:
+    """
+    Records the duration of one call in histogram.sample_interval of the
+    decorated function, the other calls only pass through
+
+    Args:
+        histogram(Histogram): Histogram the durations are observed in
+        labels(str): Values of the label names of the histogram
+    """
+    def decorate(function: F) -> F:
+        if not ENABLED:
+            return function
+        return sample(function, histogram.labels(*labels))
+    return decorate
+
+def record_size(sizes: HistogramChild, size: int):
+    sizes.pending.append(size)
+    if len(sizes.pending) >= PENDING_OBSERVATIONS:
+        sizes.fold()
+
+def timed_append(function: F) -> F:
+    """
+    Records the size of every batch appended by the decorated
+    add(entries, ...) method of a ledger repository, which returns the
+    entries it added, and the duration of one append in
+    PHASE_SECONDS.sample_interval
+    """
+    if not ENABLED:
+        return function
+    sizes = BATCH_ENTRIES.labels()
+    append = sample(function, PHASE_SECONDS.labels('ledger_append'))
+
+    @functools.wraps(function)
+    def wrapper(self, entries, *args, **kwargs):
+        result = append(self, entries, *args, **kwargs)
+        record_size(sizes, len(result))
+        return result
+    return wrapper
+
+def timed_serialization(function: F) -> F:
+    """
+    Records the number of entries of every listing encoded by the
+    decorated dumps_entries(entries, ...) or dumps_changes(changes, ...)
+    method, and the duration of one encoding in
+    PHASE_SECONDS.sample_interval
+    """
+    if not ENABLED:
+        return function
+    sizes = RESPONSE_ENTRIES.labels()
+    serialize = sample(function, PHASE_SECONDS.labels('serialization'))
+
+    @functools.wraps(function)
+    def wrapper(self, entries, *args, **kwargs):
+        entries = entries if isinstance(entries, list) else list(entries)
+        result = serialize(self, entries, *args, **kwargs)
+        record_size(sizes, len(entries))
+        return result
+    return wrapper
+
+def timed_view(view: F, route: str, method: str) -> F:
+    """
+    Counts every request handled by the decorated Flask view and records
+    the duration of the first one and then one in
+    HTTP_SECONDS.sample_interval, labelled with the status the view
+    returns in its (body, status) tuple or 500 when it raises
+
+    Args:
+        view(Callable): View function of the route
+        route(str): Rule of the route, e.g. /ledger/entries
+        method(str): HTTP method of the route
+    """
+    if not ENABLED:
+        return view
+    children = {} # type: Dict[int, Tuple[CounterChild, HistogramChild]]
+    interval = HTTP_SECONDS.sample_interval
+    requests = itertools.count()
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        start = None if next(requests) % interval else perf_counter()
+        status = 500
+        try:
+            result = view(*args, **kwargs)
+            status = result[1]
+            return result
+        finally:
+            child = children.get(status)
+            if child is None:
+                child = children[status] = get_request_children(route, method, str(status))
+            child[0].increment()
+            if start is not None:
+                child[1].observe(perf_counter() - start)
+    return wrapper
+
+def get_request_children(route: str, method: str, status: str) -> Tuple[CounterChild, HistogramChild]:
+    return HTTP_REQUESTS.labels(route, method, status), HTTP_SECONDS.labels(route, method, status)
+
+def observe_request(route: str, method: str, status: str, seconds: Optional[float]):
+    """
+    Counts a request, and records its duration unless seconds is None
+    because the request was not sampled
+    """
+    requests, durations = get_request_children(route, method, status)
+    requests.increment()
+    if seconds is not None:
+        durations.observe(seconds)
+
+def register_ledger_gauge(get_repositories: Callable[[], Dict]):
+    """
+    Exposes the number of entries in the ledger of the repositories
+    returned by get_repositories when the metrics are rendered
+    """
+    REGISTRY.register(Gauge('ledger_entries', 'Entries in the ledger', lambda: get_repositories()['ledger'].get().count_entries()))
@@ -0,0 +1,128 @@
+from array import array
+from datetime import date
+from typing import (Dict, List, Optional, Tuple)
+
+from ledger import metrics
+from ledger.domain.columnar_ledger import ColumnarLedger
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bucket identifiers by code, then loan id, effective ordinal, bucket code and value per entry
+EntryColumns = Tuple[List[str], array, array, array, array]
+
+def get_entry_columns(ledger) -> EntryColumns:
+    """
+    Returns the ledger entries as typed columns, copied from the columns
+    of a ColumnarLedger or built by scanning any other ledger
+
+    Args:
+        ledger(Ledger): Ledger to read entries from
+    Returns:
+        columns(EntryColumns): Bucket identifiers by code followed by the
+            loan id, effective ordinal, bucket code and value columns
+    """
+    if isinstance(ledger, ColumnarLedger):
+        entries = ledger.entries
+        # Values are appended last, so every column holds at least that many rows
+        rows = len(entries.values)
+        return (
+            list(entries.bucket_identifiers),
+            entries.loan_ids[:rows],
+            entries.effective_dates[:rows],
+            entries.bucket_codes[:rows],
+            entries.values[:rows],
+        )
+
+    bucket_identifiers = [] # type: List[str]
+    bucket_codes_by_identifier = {} # type: Dict[str, int]
+    loan_ids, effective_ordinals, bucket_codes, values = array('q'), array('i'), array('i'), array('q')
+    for entry in ledger.get_all_entries():
+        code = bucket_codes_by_identifier.get(entry.bucket_identifier)
+        if code is None:
+            code = bucket_codes_by_identifier[entry.bucket_identifier] = len(bucket_identifiers)
+            bucket_identifiers.append(entry.bucket_identifier)
+        loan_ids.append(entry.loan_id)
+        effective_ordinals.append(entry.effective_date.toordinal())
+        bucket_codes.append(code)
+        values.append(entry.value)
+    return bucket_identifiers, loan_ids, effective_ordinals, bucket_codes, values
+
+def aggregate_with_numpy(columns: EntryColumns, identifiers: List[str], effective_from: Optional[date], effective_to: Optional[date]) -> Tuple[List[int], List[List[int]]]:
+    column_identifiers, loan_ids, effective_ordinals, bucket_codes, values = columns
+    loan_ids = np.frombuffer(loan_ids, dtype=np.int64)
+    bucket_codes = np.frombuffer(bucket_codes, dtype=np.int32)
+    values = np.frombuffer(values, dtype=np.int64)
+
+    if effective_from or effective_to:
+        effective_ordinals = np.frombuffer(effective_ordinals, dtype=np.int32)
+        mask = np.ones(len(values), dtype=bool)
+        if effective_from:
+            mask &= effective_ordinals >= effective_from.toordinal()
+        if effective_to:
+            mask &= effective_ordinals <= effective_to.toordinal()
+        loan_ids, bucket_codes, values = loan_ids[mask], bucket_codes[mask], values[mask]
+
+    # Maps column bucket codes onto report columns, -1 for buckets left out of the report
+    report_columns = {identifier: position for position, identifier in enumerate(identifiers)}
+    column_positions = np.array([report_columns.get(identifier, -1) for identifier in column_identifiers] or [-1], dtype=np.int64)
+    positions = column_positions[bucket_codes]
+    selected = positions >= 0
+    loan_ids, positions, values = loan_ids[selected], positions[selected], values[selected]
+
+    report_loan_ids, loan_rows = np.unique(loan_ids, return_inverse=True)
+    # Unbuffered integer addition keeps the sums exact, bincount would go through float64
+    balances = np.zeros((len(report_loan_ids), len(identifiers)), dtype=np.int64)
+    np.add.at(balances, (loan_rows.reshape(-1), positions), values)
+    return report_loan_ids.tolist(), balances.tolist()
+
+def fits_int64(values: array) -> bool:
+    # Float totals are approximate, the halved bound leaves room for their rounding
+    return not len(values) or np.abs(np.frombuffer(values, dtype=np.int64)).sum(dtype=np.float64) < 2 ** 62
+
+def aggregate_with_python(columns: EntryColumns, identifiers: List[str], effective_from: Optional[date], effective_to: Optional[date]) -> Tuple[List[int], List[List[int]]]:
+    column_identifiers, loan_ids, effective_ordinals, bucket_codes, values = columns
+    report_columns = {identifier: position for position, identifier in enumerate(identifiers)}
+    column_positions = [report_columns.get(identifier, -1) for identifier in column_identifiers]
+    first_ordinal = effective_from.toordinal() if effective_from else None
+    last_ordinal = effective_to.toordinal() if effective_to else None
+
+    balances = {} # type: Dict[int, List[int]]
+    for loan_id, ordinal, code, value in zip(loan_ids, effective_ordinals, bucket_codes, values):
+        position = column_positions[code]
+        if position < 0 or (first_ordinal and ordinal < first_ordinal) or (last_ordinal and ordinal > last_ordinal):
+            continue
+        row = balances.get(loan_id)
+        if row is None:
+            row = balances[loan_id] = [0] * len(identifiers)
+        row[position] += value
+
+    report_loan_ids = sorted(balances)
+    return report_loan_ids, [balances[loan_id] for loan_id in report_loan_ids]
+
+@metrics.timed(metrics.PHASE_SECONDS, 'aggregation')
+def get_portfolio_balances(ledger, identifiers: List[str], effective_from: Optional[date] = None, effective_to: Optional[date] = None, use_numpy: bool = True) -> Dict:
+    """
+    Returns the balance of every bucket for every loan in one pass over
+    the ledger columns, grouped with NumPy when it is installed and the
+    sums fit in int64
+
+    Args:
+        ledger(Ledger): Ledger to aggregate
+        identifiers(List[str]): Bucket identifiers to report, in column order
+        effective_from(Optional[date]): Earliest effective date, inclusive
+        effective_to(Optional[date]): Latest effective date, inclusive
+        use_numpy(bool): Set to False to force the pure Python aggregation
+    Returns:
+        report(Dict): Loan ids in row order, bucket identifiers in column
+            order and the loan x bucket balance matrix
+    """
+    columns = get_entry_columns(ledger)
+    # Sums which could exceed int64 are added as Python ints instead of wrapping around
+    if np is not None and use_numpy and fits_int64(columns[4]):
+        loan_ids, balances = aggregate_with_numpy(columns, identifiers, effective_from, effective_to)
+    else:
+        loan_ids, balances = aggregate_with_python(columns, identifiers, effective_from, effective_to)
+    return {'loan_ids': loan_ids, 'bucket_identifiers': list(identifiers), 'balances': balances}
@@ -0,0 +1,126 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from typing import (Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar)
+
+from ledger.domain.ledger import LedgerEntry
+from ledger.service_layer import services
+
+T = TypeVar('T')
+
+class ReadCache:
+    """
+    Bounded LRU cache of read results, each owned by one loan. Entries
+    live at most ttl seconds and all entries of a loan are dropped as
+    soon as it is written to.
+
+    A result is only stored if its loan was not written to while it was
+    computed, so a read racing a write can never cache the state from
+    before the write.
+    """
+    def __init__(self, maximum_size: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maximum_size = maximum_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # type: OrderedDict[Hashable, Tuple[float, int, object]]
+        self.loan_keys = {} # type: Dict[int, Set[Hashable]]
+        self.generations = {} # type: Dict[int, int]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_compute(self, loan_id: int, key: Hashable, compute: Callable[[], T]) -> T:
+        """
+        Returns the cached result of key, computing and storing it first
+        if it is missing or expired
+
+        Args:
+            loan_id(int): Loan the result belongs to
+            key(Hashable): Key of the result, unique across loans
+            compute(Callable[[], T]): Computes the result, exceptions are not cached
+        Returns:
+            result(T): Result of compute
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                expires_at, _, result = cached
+                if expires_at > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                self.remove(key)
+                self.expirations += 1
+            self.misses += 1
+            generation = self.generations.get(loan_id, 0)
+
+        result = compute()
+        if self.maximum_size <= 0:
+            return result
+
+        with self.lock:
+            if self.generations.get(loan_id, 0) == generation:
+                if key in self.entries:
+                    self.remove(key)
+                self.entries[key] = (self.clock() + self.ttl, loan_id, result)
+                self.loan_keys.setdefault(loan_id, set()).add(key)
+                while len(self.entries) > self.maximum_size:
+                    self.remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return result
+
+    def remove(self, key: Hashable):
+        _, loan_id, _ = self.entries.pop(key)
+        keys = self.loan_keys[loan_id]
+        keys.discard(key)
+        if not keys:
+            del self.loan_keys[loan_id]
+
+    def invalidate(self, loan_ids: Iterable[int]):
+        """
+        Drops every cached result of the loans, called once their writes
+        are visible to readers
+
+        Args:
+            loan_ids(Iterable[int]): Loans written to
+        """
+        with self.lock:
+            for loan_id in loan_ids:
+                self.generations[loan_id] = self.generations.get(loan_id, 0) + 1
+                for key in self.loan_keys.pop(loan_id, ()):
+                    del self.entries[key]
+                    self.invalidations += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maximum_size': self.maximum_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+def get_buckets_sum(cache: ReadCache, loan_id: int, identifiers: List[str], bucket_repo, ledger_repo, as_of: Optional[date] = None) -> Dict[str, float]:
+    key = ('buckets_sum', loan_id, tuple(sorted(set(identifiers))), as_of)
+
+    def compute():
+        with ledger_repo.read() as ledger:
+            return services.get_buckets_sum(loan_id, identifiers, bucket_repo.get(), ledger, as_of=as_of)
+
+    buckets_sum = cache.get_or_compute(loan_id, key, compute)
+    # Requests for the same buckets in another order share the result
+    return {identifier: buckets_sum[identifier] for identifier in identifiers}
+
+def get_ledger_entries(cache: ReadCache, loan_id: int, ledger_repo) -> List[LedgerEntry]:
+    def compute():
+        with ledger_repo.read() as ledger:
+            return services.get_ledger_entries(loan_id, ledger)
+
+    return cache.get_or_compute(loan_id, ('ledger_entries', loan_id), compute)
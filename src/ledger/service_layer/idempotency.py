@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import (Any, Callable, Dict, Optional, Tuple)
+
+# Body and status of a response
+StoredResponse = Tuple[Any, int]
+
+class IdempotencyKeyReused(ValueError):
+    """Idempotency key was already used for another request"""
+    pass
+
+def get_fingerprint(*parts: bytes) -> str:
+    """
+    Returns a digest of the parts of a request which must match for a
+    retry to be answered with the response of the first request
+
+    Args:
+        parts(bytes): Route, loan id and body of the request
+    Returns:
+        fingerprint(str): SHA-256 digest of the parts
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+class IdempotentRequest:
+    """
+    Request made with an idempotency key, completed with its response
+    once handled. Duplicates of a request still in flight wait for it
+    """
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.response = None # type: Optional[StoredResponse]
+        self.expires_at = None # type: Optional[float]
+        self.completed = threading.Event()
+
+    def finish(self, response: Optional[StoredResponse]):
+        self.response = response
+        self.completed.set()
+
+    def wait(self) -> Optional[StoredResponse]:
+        self.completed.wait()
+        return self.response
+
+class IdempotencyStore:
+    """
+    Bounded store of the responses of requests made with an idempotency
+    key, each kept for ttl seconds once its request is handled. Only
+    successful responses are kept, the key of a failed request is
+    released so the request can be retried.
+
+    The oldest handled requests are evicted first when the store is
+    full, requests in flight are never evicted. Handled requests are kept
+    in the order they were handled, which is also the order they expire
+    in, so eviction only ever looks at the front of the store.
+    """
+    def __init__(self, maximum_size: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maximum_size = maximum_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.in_flight = {} # type: Dict[str, IdempotentRequest]
+        self.requests = OrderedDict() # type: OrderedDict[str, IdempotentRequest]
+        self.replays = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[IdempotentRequest, bool]:
+        """
+        Registers a request made with an idempotency key, unless a request
+        with the same key is in flight or was handled
+
+        Args:
+            key(str): Idempotency key of the request
+            fingerprint(str): Fingerprint of the request
+        Returns:
+            request(IdempotentRequest): Request registered under the key
+            is_new(bool): Whether the caller registered it and must handle
+                it, otherwise it waits for its response
+        """
+        with self.lock:
+            request = self.in_flight.get(key) or self.requests.get(key)
+            if request is not None and request.expires_at is not None and request.expires_at <= self.clock():
+                del self.requests[key]
+                self.expirations += 1
+                request = None
+            if request is not None:
+                if request.fingerprint != fingerprint:
+                    raise IdempotencyKeyReused('Idempotency key was already used for a different request')
+                self.replays += 1
+                return request, False
+
+            request = self.in_flight[key] = IdempotentRequest(fingerprint)
+            self.evict()
+            return request, True
+
+    def evict(self):
+        # Expired requests and the oldest handled ones, taken from the front until neither is left
+        now = self.clock()
+        while self.requests:
+            key, request = next(iter(self.requests.items()))
+            if len(self.requests) + len(self.in_flight) <= self.maximum_size and request.expires_at > now:
+                break
+            del self.requests[key]
+            if request.expires_at <= now:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def complete(self, key: str, request: IdempotentRequest, response: Optional[StoredResponse]):
+        """
+        Stores the response of a request and hands it to its duplicates
+
+        Args:
+            key(str): Idempotency key of the request
+            request(IdempotentRequest): Request returned by begin
+            response(Optional[StoredResponse]): Response to replay, None when
+                the request failed and its key is released
+        """
+        with self.lock:
+            if self.in_flight.get(key) is request:
+                del self.in_flight[key]
+                if response is not None and self.maximum_size > 0:
+                    request.expires_at = self.clock() + self.ttl
+                    self.requests[key] = request
+        request.finish(response)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'size': len(self.requests) + len(self.in_flight),
+                'maximum_size': self.maximum_size,
+                'replays': self.replays,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
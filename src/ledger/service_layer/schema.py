@@ -0,0 +1,380 @@
+from datetime import date
+from typing import (Any, Callable, Dict, List, NamedTuple, Optional)
+
+from ledger import config
+from ledger.domain.loan import STATUSES
+from ledger.domain.money import to_minor_units
+
+Validator = Callable[[Any], Any]
+
+# Distinct effective dates parsed once per process, batches mostly repeat a few of them
+DATE_CACHE_SIZE = 4096
+MAXIMUM_PAGE_SIZE = config.get_maximum_page_size()
+MAXIMUM_FEED_WAIT = config.get_maximum_feed_wait()
+FLAG_VALUES = ('1', 'true', 'yes')
+LOAN_ID_ERROR = 'Please enter a valid integer loan id'
+DATE_ERROR = 'Date value must be a string with YYYY-MM-DD format'
+PAGE_SIZE_ERROR = f'Page size must be between 1 and {MAXIMUM_PAGE_SIZE}'
+SEQUENCE_ERROR = 'Please provide a sequence number returned by the change feed'
+WAIT_ERROR = f'Please enter a number of seconds to wait between 0 and {MAXIMUM_FEED_WAIT:g}'
+
+class SchemaError(ValueError):
+    """Request does not match its schema"""
+    def __init__(self, message: str, path: str = ''):
+        super().__init__(message)
+        self.path = path
+
+def join_path(name: str, path: str) -> str:
+    """
+    Args:
+        name(str): Field name or list index, e.g. debit or [2]
+        path(str): Path within the field, e.g. value
+    Returns:
+        path(str): Path from the outer value, e.g. [2].debit.value
+    """
+    if not path:
+        return name
+    return name + path if path.startswith('[') else f'{name}.{path}'
+
+class Posting(NamedTuple):
+    identifier: str
+    value: int
+
+class PairEntry(NamedTuple):
+    # None when the pair entry takes effect on the day it is added
+    effective_date: Optional[date]
+    debit: Posting
+    credit: Posting
+
+class BulkPairEntry(NamedTuple):
+    loan_id: int
+    effective_date: Optional[date]
+    debit: Posting
+    credit: Posting
+
+class Integer:
+    """JSON integer other than 0, booleans are rejected"""
+    def __init__(self, message: str):
+        self.message = message
+
+    def compile(self) -> Validator:
+        message = self.message
+
+        def validate(value: Any) -> int:
+            if type(value) is not int or not value:
+                raise SchemaError(message)
+            return value
+        return validate
+
+class Float:
+    """JSON number with a fractional part, converted by convert"""
+    def __init__(self, message: str, convert: Callable[[float], Any] = float):
+        self.message = message
+        self.convert = convert
+
+    def compile(self) -> Validator:
+        message = self.message
+        convert = self.convert
+
+        def validate(value: Any) -> Any:
+            if type(value) is not float:
+                raise SchemaError(message)
+            try:
+                return convert(value)
+            except ValueError as e:
+                raise SchemaError(str(e)) from None
+        return validate
+
+class String:
+    def __init__(self, message: str):
+        self.message = message
+
+    def compile(self) -> Validator:
+        message = self.message
+
+        def validate(value: Any) -> str:
+            if type(value) is not str:
+                raise SchemaError(message)
+            return value
+        return validate
+
+class IsoDate:
+    """Optional YYYY-MM-DD string, missing or empty dates are None"""
+    def __init__(self, message: str):
+        self.message = message
+
+    def compile(self) -> Validator:
+        message = self.message
+        dates = {} # type: Dict[str, date]
+
+        def validate(value: Any) -> Optional[date]:
+            if not value:
+                return None
+            parsed = dates.get(value) if type(value) is str else None
+            if parsed is None:
+                try:
+                    parsed = date.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise SchemaError(message) from None
+                if len(dates) < DATE_CACHE_SIZE:
+                    dates[value] = parsed
+            return parsed
+        return validate
+
+class Object:
+    """JSON object whose fields are validated in order into make"""
+    def __init__(self, make: Callable[..., Any], message: str, **fields: Any):
+        self.make = make
+        self.message = message
+        self.fields = fields
+
+    def compile(self) -> Validator:
+        make = self.make
+        message = self.message
+        fields = tuple((name, field.compile()) for name, field in self.fields.items())
+
+        def validate(value: Any) -> Any:
+            if type(value) is not dict:
+                raise SchemaError(message)
+            values = []
+            for name, validate_field in fields:
+                try:
+                    values.append(validate_field(value.get(name)))
+                except SchemaError as e:
+                    raise SchemaError(str(e), join_path(name, e.path)) from None
+            return make(*values)
+        return validate
+
+class ListOf:
+    def __init__(self, item: Any, message: str):
+        self.item = item
+        self.message = message
+
+    def compile(self) -> Validator:
+        message = self.message
+        validate_item = self.item.compile()
+
+        def validate(value: Any) -> List[Any]:
+            if type(value) is not list:
+                raise SchemaError(message)
+            items = []
+            for index, item in enumerate(value):
+                try:
+                    items.append(validate_item(item))
+                except SchemaError as e:
+                    raise SchemaError(str(e), join_path(f'[{index}]', e.path)) from None
+            return items
+        return validate
+
+class Parameter:
+    """
+    Query string parameter parsed from its first value, or from all its
+    values with many. Missing parameters are default, or an empty list
+    with many, unless they are required
+    """
+    def __init__(self, parse: Callable[[str], Any], message: str, required: bool = False, many: bool = False, default: Any = None):
+        self.parse = parse
+        self.message = message
+        self.required = required
+        self.many = many
+        self.default = default
+
+    def compile(self) -> Callable[[List[str]], Any]:
+        parse = self.parse
+        message = self.message
+        required = self.required
+        many = self.many
+        default = self.default
+
+        def validate(values: List[str]) -> Any:
+            if not values or (not values[0] and not many):
+                if required:
+                    raise SchemaError(message)
+                return [] if many else default
+            try:
+                return [parse(value) for value in values] if many else parse(values[0])
+            except ValueError:
+                raise SchemaError(message) from None
+        return validate
+
+class Query:
+    """Query string whose parameters are validated in order into make"""
+    def __init__(self, make: Callable[..., Any], **parameters: Parameter):
+        self.make = make
+        self.parameters = parameters
+
+    def compile(self) -> Callable[[Callable[[str], List[str]]], Any]:
+        make = self.make
+        parameters = tuple((name, parameter.compile()) for name, parameter in self.parameters.items())
+
+        def validate(getlist: Callable[[str], List[str]]) -> Any:
+            values = []
+            for name, validate_parameter in parameters:
+                try:
+                    values.append(validate_parameter(getlist(name)))
+                except SchemaError as e:
+                    raise SchemaError(str(e), name) from None
+            return make(*values)
+        return validate
+
+def is_flag_value(value: Optional[str]) -> bool:
+    return (value or '').lower() in FLAG_VALUES
+
+def parse_loan_id(value: str) -> int:
+    # Same as the routes always did, any integer other than 0
+    loan_id = int(value)
+    if not loan_id:
+        raise ValueError(value)
+    return loan_id
+
+def parse_loan_status(value: str) -> str:
+    if value not in STATUSES:
+        raise ValueError(value)
+    return value
+
+def parse_page_size(value: str) -> int:
+    limit = int(value)
+    if not 1 <= limit <= MAXIMUM_PAGE_SIZE:
+        raise ValueError(value)
+    return limit
+
+def parse_sequence(value: str) -> int:
+    sequence = int(value)
+    if sequence < 0:
+        raise ValueError(value)
+    return sequence
+
+def parse_wait(value: str) -> float:
+    wait = float(value)
+    # NaN fails both comparisons
+    if not 0 <= wait <= MAXIMUM_FEED_WAIT:
+        raise ValueError(value)
+    return wait
+
+POSTING = Object(
+    Posting,
+    'Please provide valid debit and credit objects for each pair entry',
+    identifier=String('Please provide a string bucket identifier for each pair entry'),
+    value=Float('Please provide valid floating point value for each pair entry', to_minor_units),
+)
+EFFECTIVE_DATE = IsoDate('Effective date value must be a string with YYYY-MM-DD format')
+
+validate_pair_entries = ListOf(
+    Object(PairEntry, 'Please provide valid debit and credit objects for each pair entry', effective_date=EFFECTIVE_DATE, debit=POSTING, credit=POSTING),
+    'Please provide a list of pair entries',
+).compile()
+
+validate_bulk_pair_entry = Object(
+    BulkPairEntry,
+    'Please provide a valid JSON object for each row',
+    loan_id=Integer('Please enter a valid integer loan id'),
+    effective_date=EFFECTIVE_DATE,
+    debit=POSTING,
+    credit=POSTING,
+).compile()
+
+def parse_pair_entries(value: Any) -> List[PairEntry]:
+    """
+    Validates the decoded body posted for a loan in a single pass, failing
+    at the first field which does not match
+
+    Args:
+        value(Any): Decoded request body
+    Returns:
+        pair_entries(List[PairEntry]): Pair entries with parsed effective
+            dates and values in minor units
+    """
+    return validate_pair_entries(value)
+
+class BucketQuery(NamedTuple):
+    identifier: str
+
+class LoanQuery(NamedTuple):
+    loan_id: int
+
+class OptionalLoanQuery(NamedTuple):
+    # None for every loan of the ledger
+    loan_id: Optional[int]
+
+class LoansQuery(NamedTuple):
+    loan_id: Optional[int]
+    status: Optional[str]
+
+class BucketsSumQuery(NamedTuple):
+    loan_id: int
+    bucket_identifiers: List[str]
+    as_of: Optional[date]
+    consistency_check: Optional[bool]
+
+class EntriesQuery(NamedTuple):
+    loan_id: int
+    limit: Optional[int]
+    cursor: Optional[str]
+    effective_from: Optional[date]
+    effective_to: Optional[date]
+    created_from: Optional[date]
+    created_to: Optional[date]
+
+class ChangesQuery(NamedTuple):
+    loan_id: Optional[int]
+    after: int
+    limit: Optional[int]
+    wait: float
+    bucket_identifiers: List[str]
+
+class WaitQuery(NamedTuple):
+    wait: float
+
+class PortfolioQuery(NamedTuple):
+    bucket_identifiers: List[str]
+    effective_from: Optional[date]
+    effective_to: Optional[date]
+
+LOAN_ID = Parameter(parse_loan_id, LOAN_ID_ERROR, required=True)
+OPTIONAL_LOAN_ID = Parameter(parse_loan_id, LOAN_ID_ERROR)
+DATE = Parameter(date.fromisoformat, DATE_ERROR)
+PAGE_SIZE = Parameter(parse_page_size, PAGE_SIZE_ERROR)
+WAIT = Parameter(parse_wait, WAIT_ERROR, default=0.0)
+BUCKET_IDENTIFIERS = Parameter(str, 'Please enter valid string bucket identifiers', many=True)
+
+# Query strings of the routes, each validated in one pass into its typed query
+validate_bucket_query = Query(BucketQuery, identifier=Parameter(str, 'Please enter a valid string bucket identifier', required=True)).compile()
+validate_loan_query = Query(LoanQuery, loan_id=LOAN_ID).compile()
+validate_optional_loan_query = Query(OptionalLoanQuery, loan_id=OPTIONAL_LOAN_ID).compile()
+validate_loans_query = Query(
+    LoansQuery,
+    loan_id=OPTIONAL_LOAN_ID,
+    status=Parameter(parse_loan_status, f'Loan status must be one of {", ".join(STATUSES)}'),
+).compile()
+validate_buckets_sum_query = Query(
+    BucketsSumQuery,
+    loan_id=LOAN_ID,
+    bucket_id=Parameter(str, 'Please enter at least one bucket identifier', required=True, many=True),
+    as_of=DATE,
+    consistency_check=Parameter(is_flag_value, 'Please enter a flag value'),
+).compile()
+validate_entries_query = Query(
+    EntriesQuery,
+    loan_id=LOAN_ID,
+    limit=PAGE_SIZE,
+    cursor=Parameter(str, 'Please provide a cursor returned by a previous page'),
+    effective_from=DATE,
+    effective_to=DATE,
+    created_from=DATE,
+    created_to=DATE,
+).compile()
+validate_changes_query = Query(
+    ChangesQuery,
+    loan_id=OPTIONAL_LOAN_ID,
+    after=Parameter(parse_sequence, SEQUENCE_ERROR, default=0),
+    limit=PAGE_SIZE,
+    wait=WAIT,
+    bucket_id=BUCKET_IDENTIFIERS,
+).compile()
+validate_wait_query = Query(WaitQuery, wait=WAIT).compile()
+validate_portfolio_query = Query(
+    PortfolioQuery,
+    bucket_id=BUCKET_IDENTIFIERS,
+    effective_from=DATE,
+    effective_to=DATE,
+).compile()
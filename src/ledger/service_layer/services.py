@@ -1,32 +1,60 @@
+import base64
+import binascii
+import itertools
 from datetime import date
-from typing import (Dict, List, Optional)
+from typing import (Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union)
 
-from ledger import config
-from ledger.domain.ledger import (Ledger, LedgerEntry)
+from ledger import (config, metrics)
+from ledger.domain.ledger import (MAXIMUM_STORED_INTEGER, EntryKey, Ledger, LedgerEntry)
 from ledger.domain.bucket import (AccountingBucket)
+from ledger.domain.loan import (STATUSES, Loan)
+from ledger.domain.money import to_major_units
+from ledger.service_layer import (aggregation, schema)
+from ledger.service_layer.schema import (BulkPairEntry, PairEntry)
 
 MINIMUM_IDENTIFIER_LENGTH = config.get_minimum_identifier_size()
 MAXIMUM_IDENTIFIER_LENGTH = config.get_maximum_identifier_size()
+MAXIMUM_PAGE_SIZE = config.get_maximum_page_size()
+# Entries scanned per read of the change feed, a consumer far behind catches up over several reads
+FEED_SCAN_SIZE = 10000
+DUPLICATE_BUCKET_ERROR = 'Duplicate bucket identifier found, please provide a unique value'
+UNKNOWN_BUCKET_ERROR = 'Please provide a bucket identifier which is already created'
 
-def is_valid_new_identifier(identifier: str, buckets: List[AccountingBucket]) -> bool:
+Buckets = Union[Mapping[str, AccountingBucket], Iterable[AccountingBucket]]
+
+def to_bucket_mapping(buckets: Buckets) -> Mapping[str, AccountingBucket]:
+    """
+    Returns the buckets keyed by identifier, building the mapping
+    for callers which still pass a list of buckets
+
+    Args:
+        buckets(Buckets): Mapping of identifier to bucket or iterable of buckets
+    Returns:
+        buckets(Mapping[str, AccountingBucket]): Buckets keyed by identifier
+    """
+    if isinstance(buckets, Mapping):
+        return buckets
+    return {bucket.identifier: bucket for bucket in buckets}
+
+def is_valid_new_identifier(identifier: str, buckets: Buckets) -> bool:
     if len(identifier) < MINIMUM_IDENTIFIER_LENGTH:
         return False
     if len(identifier) > MAXIMUM_IDENTIFIER_LENGTH:
         return False
-    if any(identifier == bucket.identifier for bucket in buckets):
+    if identifier in to_bucket_mapping(buckets):
         return False
     return True
 
-def is_bucket_present(identifier: str, buckets: List[AccountingBucket]) -> bool:
-    return any(identifier == bucket.identifier for bucket in buckets)
+def is_bucket_present(identifier: str, buckets: Buckets) -> bool:
+    return identifier in to_bucket_mapping(buckets)
 
-def is_valid_pair_value(debit_value: float, credit_value: float) -> bool:
+def is_valid_pair_value(debit_value: int, credit_value: int) -> bool:
     if debit_value < 0 or credit_value > 0:
         return False
     return abs(debit_value) == abs(credit_value)
 
-def get_bucket_by_identifier(identifier: str, buckets: List[AccountingBucket]) -> Optional[AccountingBucket]:
-    return next((bucket for bucket in buckets if identifier == bucket.identifier), None)
+def get_bucket_by_identifier(identifier: str, buckets: Buckets) -> Optional[AccountingBucket]:
+    return to_bucket_mapping(buckets).get(identifier)
 
 class InvalidIdentifier(ValueError):
     """Bucket identifier cannot be accepted"""
@@ -36,65 +64,546 @@ class InvalidPairValue(ValueError):
     """Pair value cannot be accepted"""
     pass
 
-class InvalidDate(ValueError):
-    """String date value cannot be accepted"""
+class InvalidLoanId(ValueError):
+    """Loan id cannot be accepted"""
+    pass
+
+class UnknownLoan(ValueError):
+    """Loan has not been opened"""
+    pass
+
+class ClosedLoan(ValueError):
+    """Closed loan cannot accept entries"""
+    pass
+
+class InvalidLoanStatus(ValueError):
+    """Loan status cannot be accepted"""
+    pass
+
+class InvalidCursor(ValueError):
+    """Pagination cursor cannot be accepted"""
     pass
 
-def create_bucket(identifier: str, buckets: List[AccountingBucket]) -> AccountingBucket: # uow: unit_of_work.AbstractUnitOfWork
+class InvalidPageSize(ValueError):
+    """Page size cannot be accepted"""
+    pass
+
+class InvalidSequence(ValueError):
+    """Change feed sequence number cannot be accepted"""
+    pass
+
+class InconsistentBalance(Exception):
+    """Running bucket balance does not match the ledger entries"""
+    pass
+
+def create_bucket(identifier: str, buckets: Buckets) -> AccountingBucket: # uow: unit_of_work.AbstractUnitOfWork
     if not is_valid_new_identifier(identifier, buckets):
-        raise InvalidIdentifier('Duplicate bucket identifier found, please provide a unique value')
+        raise InvalidIdentifier(DUPLICATE_BUCKET_ERROR)
     
     return AccountingBucket.create(identifier)
 
-def create_ledger_entry(loan_id: int, identifier: str, value: float, effective_date: date, buckets: List[AccountingBucket]) -> LedgerEntry:
-    if not is_bucket_present(identifier, buckets):
-        raise InvalidIdentifier('Please provide a bucket identifier which is already created')
+@metrics.timed(metrics.SERVICE_SECONDS, 'add_bucket')
+def add_bucket(identifier: str, bucket_repo) -> AccountingBucket:
+    """
+    Creates a bucket and adds it to the repository, which checks the
+    identifier again under its lock, so of two concurrent creations of
+    the same bucket the second is rejected instead of replacing the first
+
+    Args:
+        identifier(str): Identifier of the new bucket
+        bucket_repo(BucketRepository): Repository the bucket is added to
+    Returns:
+        bucket(AccountingBucket): Added bucket
+    """
+    bucket = create_bucket(identifier, bucket_repo.get())
+    if not bucket_repo.add(bucket):
+        raise InvalidIdentifier(DUPLICATE_BUCKET_ERROR)
+    return bucket
+
+def get_loan(loan_id: int, loans: Mapping[int, Loan]) -> Loan:
+    loan = loans.get(loan_id)
+    if loan is None:
+        raise UnknownLoan('Loan not found, please open the loan first')
+    return loan
+
+def get_open_loan(loan_id: int, loans: Mapping[int, Loan]) -> Loan:
+    loan = get_loan(loan_id, loans)
+    if not loan.is_open():
+        raise ClosedLoan('Loan is closed and accepts no more entries')
+    return loan
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'open_loan')
+def open_loan(loan_id: int, loan_repo) -> Loan:
+    """
+    Registers a new open loan, entries can only be added to open loans
+
+    Args:
+        loan_id(int): Id of the new loan
+        loan_repo(LoanRepository): Repository the loan is added to
+    Returns:
+        loan(Loan): Opened loan
+    """
+    if abs(loan_id) > MAXIMUM_STORED_INTEGER:
+        raise InvalidLoanId('Loan id must fit in 64 bits')
+    loan = Loan.create(loan_id)
+    if not loan_repo.add(loan):
+        raise InvalidLoanId('Duplicate loan id found, please provide a unique value')
+    return loan
 
-    current_bucket = get_bucket_by_identifier(identifier, buckets)
-    current_bucket.add_value(value)
+@metrics.timed(metrics.SERVICE_SECONDS, 'close_loan')
+def close_loan(loan_id: int, loan_repo) -> Loan:
+    """
+    Closes an open loan once the batches being added to it are written,
+    its entries can still be read
+
+    Args:
+        loan_id(int): Loan to close
+        loan_repo(LoanRepository): Repository of the loans
+    Returns:
+        loan(Loan): Closed loan
+    """
+    loan = get_open_loan(loan_id, loan_repo.get())
+    if not loan_repo.close(loan):
+        raise ClosedLoan('Loan is closed and accepts no more entries')
+    return loan
+
+def build_ledger_entry(loan_id: int, identifier: str, value: int, effective_date: date, buckets: Buckets) -> LedgerEntry:
+    if get_bucket_by_identifier(identifier, buckets) is None:
+        raise InvalidIdentifier(UNKNOWN_BUCKET_ERROR)
 
     created_at = date.today()
     return LedgerEntry(loan_id, created_at, effective_date, identifier, value)
 
-def create_double_entries(loan_id: int, pair_entries: List[Dict], buckets: List[AccountingBucket]) -> List[LedgerEntry]:
-    ledger_entries = []
-    for pair_entry in pair_entries:
-        debit_entry = pair_entry['debit']
-        credit_entry = pair_entry['credit']
+def create_ledger_entry(loan_id: int, identifier: str, value: int, effective_date: date, buckets: Buckets) -> LedgerEntry:
+    ledger_entry = build_ledger_entry(loan_id, identifier, value, effective_date, buckets)
+    get_bucket_by_identifier(identifier, buckets).add_value(value)
+    return ledger_entry
 
-        if not pair_entry.get('effective_date'):
-            effective_date = date.today()
-        else:
-            try:
-                effective_date = date.fromisoformat(pair_entry['effective_date'])
-            except ValueError as e:
-                raise InvalidDate('Effective date value must be a string with YYYY-MM-DD format')
+def add_to_buckets(ledger_entries: Iterable[LedgerEntry], buckets: Mapping[str, AccountingBucket]):
+    for entry in ledger_entries:
+        buckets[entry.bucket_identifier].add_value(entry.value)
+
+@metrics.timed(metrics.PHASE_SECONDS, 'validation')
+def validate_double_entries(loan_id: int, pair_entries: Sequence[PairEntry]) -> List[LedgerEntry]:
+    """
+    Checks the values of every pair entry of a batch and builds its
+    ledger entries
 
-        if not is_valid_pair_value(debit_entry['value'], credit_entry['value']):
+    Args:
+        loan_id(int): Loan the entries belong to
+        pair_entries(Sequence[PairEntry]): Pair entries parsed by schema.parse_pair_entries
+    Returns:
+        ledger_entries(List[LedgerEntry]): Debit and credit entry of every pair
+    """
+    today = date.today()
+    ledger_entries = []
+    for effective_date, debit, credit in pair_entries:
+        if not is_valid_pair_value(debit.value, credit.value):
             raise InvalidPairValue('Debit value must be positive, credit value must be negative and the absolute value must be equal to each other')
-            
-        try:
-            debit_ledger_entry = create_ledger_entry(loan_id, debit_entry['identifier'], debit_entry['value'], effective_date, buckets)
-            credit_ledger_entry = create_ledger_entry(loan_id, credit_entry['identifier'], credit_entry['value'], effective_date, buckets)
-        except InvalidIdentifier as e:
-            raise e
 
-        ledger_entries.append(debit_ledger_entry)
-        ledger_entries.append(credit_ledger_entry)
+        effective_date = effective_date or today
+        ledger_entries.append(LedgerEntry(loan_id, today, effective_date, debit.identifier, debit.value))
+        ledger_entries.append(LedgerEntry(loan_id, today, effective_date, credit.identifier, credit.value))
 
     return ledger_entries
 
+@metrics.timed(metrics.PHASE_SECONDS, 'bucket_resolution')
+def resolve_buckets(ledger_entries: Iterable[LedgerEntry], buckets: Buckets) -> Mapping[str, AccountingBucket]:
+    """
+    Looks up the bucket of every entry of a batch, so an entry of a
+    bucket which is not created rejects the batch
+
+    Args:
+        ledger_entries(Iterable[LedgerEntry]): Entries of the batch
+        buckets(Buckets): Buckets keyed by identifier
+    Returns:
+        buckets(Mapping[str, AccountingBucket]): Buckets keyed by identifier
+    """
+    buckets = to_bucket_mapping(buckets)
+    for entry in ledger_entries:
+        if entry.bucket_identifier not in buckets:
+            raise InvalidIdentifier(UNKNOWN_BUCKET_ERROR)
+    return buckets
+
+def build_double_entries(loan_id: int, pair_entries: Sequence[PairEntry], buckets: Buckets) -> List[LedgerEntry]:
+    """
+    Checks the values and buckets of every pair entry of a batch and
+    builds its ledger entries without mutating any bucket, so a rejected
+    pair rejects the batch
+
+    Args:
+        loan_id(int): Loan the entries belong to
+        pair_entries(Sequence[PairEntry]): Pair entries parsed by schema.parse_pair_entries
+        buckets(Buckets): Buckets keyed by identifier
+    Returns:
+        ledger_entries(List[LedgerEntry]): Debit and credit entry of every pair
+    """
+    ledger_entries = validate_double_entries(loan_id, pair_entries)
+    resolve_buckets(ledger_entries, buckets)
+    return ledger_entries
+
+def create_double_entries(loan_id: int, pair_entries: Sequence[PairEntry], buckets: Buckets) -> List[LedgerEntry]:
+    buckets = to_bucket_mapping(buckets)
+    ledger_entries = build_double_entries(loan_id, pair_entries, buckets)
+    add_to_buckets(ledger_entries, buckets)
+    return ledger_entries
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'add_double_entries')
+def add_double_entries(loan_id: int, pair_entries: Sequence[PairEntry], bucket_repo, ledger_repo, loan_repo) -> List[LedgerEntry]:
+    """
+    Validates a batch of pair entries for an open loan and adds it with
+    its bucket totals and loan summary to the ledger as a single write.
+    The loan is checked again under the ledger write lock, which closing
+    a loan takes as well, so no batch is written after the loan is closed
+
+    Args:
+        loan_id(int): Loan the entries belong to
+        pair_entries(Sequence[PairEntry]): Pair entries parsed by schema.parse_pair_entries
+        bucket_repo(BucketRepository): Repository of the buckets
+        ledger_repo(LedgerRepository): Repository the entries are added to
+        loan_repo(LoanRepository): Repository of the loans
+    Returns:
+        ledger_entries(List[LedgerEntry]): Added entries
+    """
+    loans = loan_repo.get()
+    get_open_loan(loan_id, loans)
+    buckets = bucket_repo.get()
+    ledger_entries = build_double_entries(loan_id, pair_entries, buckets)
+
+    def check_loan(entries: List[LedgerEntry]) -> List[LedgerEntry]:
+        get_open_loan(loan_id, loans)
+        return entries
+
+    return ledger_repo.add(ledger_entries, buckets, loans, check_loan)
+
+def parse_bulk_row(row: Any) -> BulkPairEntry:
+    """
+    Validates the fields and values of a single bulk ingestion row
+    without looking up its loan or buckets
+
+    Args:
+        row(Any): Pair entry with an additional loan_id field
+    Returns:
+        row(BulkPairEntry): Row with its parsed effective date and values in minor units
+    """
+    row = schema.validate_bulk_pair_entry(row)
+    if not is_valid_pair_value(row.debit.value, row.credit.value):
+        raise InvalidPairValue('Debit value must be positive, credit value must be negative and the absolute value must be equal to each other')
+    return row
+
+@metrics.timed(metrics.PHASE_SECONDS, 'validation')
+def validate_bulk_rows(rows: Iterable[Dict]) -> Tuple[List[Tuple[int, LedgerEntry, LedgerEntry]], List[Dict]]:
+    """
+    Checks the fields and values of every bulk ingestion row and builds
+    the ledger entries of the rows which pass. Reads no repository, so
+    it runs before any lock is taken
+
+    Args:
+        rows(Iterable[Dict]): Pair entries, each with a loan_id field
+    Returns:
+        accepted_rows(List[Tuple[int, LedgerEntry, LedgerEntry]]): Row index, debit and credit entry of every accepted row
+        errors(List[Dict]): Row index and error message for every rejected row
+    """
+    today = date.today()
+    accepted_rows = []
+    errors = []
+    for index, row in enumerate(rows):
+        try:
+            loan_id, effective_date, debit, credit = parse_bulk_row(row)
+        except schema.SchemaError as e:
+            errors.append({'row': index, 'error': str(e), 'path': e.path})
+            continue
+        except InvalidPairValue as e:
+            errors.append({'row': index, 'error': str(e)})
+            continue
+
+        effective_date = effective_date or today
+        accepted_rows.append((
+            index,
+            LedgerEntry(loan_id, today, effective_date, debit.identifier, debit.value),
+            LedgerEntry(loan_id, today, effective_date, credit.identifier, credit.value),
+        ))
+
+    return accepted_rows, errors
+
+@metrics.timed(metrics.PHASE_SECONDS, 'bucket_resolution')
+def resolve_bulk_rows(accepted_rows: List[Tuple[int, LedgerEntry, LedgerEntry]], buckets: Buckets, loans: Mapping[int, Loan]) -> Tuple[List[LedgerEntry], List[Dict]]:
+    """
+    Looks up the loan and the buckets of every accepted bulk row,
+    rejecting the rows of loans which are not open and the rows with a
+    bucket which is not created
+
+    Args:
+        accepted_rows(List[Tuple[int, LedgerEntry, LedgerEntry]]): Rows returned by validate_bulk_rows
+        buckets(Buckets): Buckets keyed by identifier
+        loans(Mapping[int, Loan]): Loans keyed by loan id
+    Returns:
+        ledger_entries(List[LedgerEntry]): Entries of the rows of open loans whose buckets are created
+        errors(List[Dict]): Row index and error message for every rejected row
+    """
+    buckets = to_bucket_mapping(buckets)
+    ledger_entries = []
+    errors = []
+    for index, debit, credit in accepted_rows:
+        try:
+            get_open_loan(debit.loan_id, loans)
+        except (UnknownLoan, ClosedLoan) as e:
+            errors.append({'row': index, 'error': str(e)})
+            continue
+        if debit.bucket_identifier in buckets and credit.bucket_identifier in buckets:
+            ledger_entries.append(debit)
+            ledger_entries.append(credit)
+        else:
+            errors.append({'row': index, 'error': UNKNOWN_BUCKET_ERROR})
+    return ledger_entries, errors
+
+def merge_bulk_errors(errors: List[Dict], other_errors: List[Dict]) -> List[Dict]:
+    return sorted(errors + other_errors, key=lambda error: error['row']) if other_errors else errors
+
+def build_bulk_double_entries(rows: Iterable[Dict], buckets: Buckets, loans: Mapping[int, Loan]) -> Tuple[List[LedgerEntry], List[Dict]]:
+    """
+    Builds double entries for many loans without mutating any bucket, a
+    rejected row leaves no trace while the remaining rows are still
+    accepted
+
+    Args:
+        rows(Iterable[Dict]): Pair entries, each with a loan_id field
+        buckets(Buckets): Buckets keyed by identifier
+        loans(Mapping[int, Loan]): Loans keyed by loan id, rows of loans
+            which are not open are rejected
+    Returns:
+        ledger_entries(List[LedgerEntry]): Entries for every accepted row
+        errors(List[Dict]): Row index and error message for every rejected row,
+            with the path of the field within the row when it does not match the schema
+    """
+    accepted_rows, errors = validate_bulk_rows(rows)
+    ledger_entries, resolution_errors = resolve_bulk_rows(accepted_rows, buckets, loans)
+    return ledger_entries, merge_bulk_errors(errors, resolution_errors)
+
+def create_bulk_double_entries(rows: Iterable[Dict], buckets: Buckets, loans: Mapping[int, Loan]) -> Tuple[List[LedgerEntry], List[Dict]]:
+    buckets = to_bucket_mapping(buckets)
+    ledger_entries, errors = build_bulk_double_entries(rows, buckets, loans)
+    add_to_buckets(ledger_entries, buckets)
+    return ledger_entries, errors
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'add_bulk_double_entries')
+def add_bulk_double_entries(rows: Iterable[Dict], bucket_repo, ledger_repo, loan_repo) -> Tuple[List[LedgerEntry], List[Dict]]:
+    # Rows are validated before any lock is taken, only the loan and bucket checks run under the ledger write lock
+    accepted_rows, errors = validate_bulk_rows(rows)
+    buckets = bucket_repo.get()
+    loans = loan_repo.get()
+    resolution_errors = [] # type: List[Dict]
+
+    def resolve_rows(entries: List[LedgerEntry]) -> List[LedgerEntry]:
+        entries, row_errors = resolve_bulk_rows(accepted_rows, buckets, loans)
+        resolution_errors.extend(row_errors)
+        return entries
+
+    ledger_entries = ledger_repo.add([entry for _, debit, credit in accepted_rows for entry in (debit, credit)], buckets, loans, resolve_rows)
+    return ledger_entries, merge_bulk_errors(errors, resolution_errors)
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_ledger_entries')
 def get_ledger_entries(loan_id: int, ledger: Ledger) -> List[LedgerEntry]:
     return list(ledger.get_entries_by_loan_id(loan_id))
 
+def iter_ledger_entries(loan: Loan) -> Iterator[LedgerEntry]:
+    # Reads the partition of the loan directly, its entries are append-only
+    return iter(loan.entries)
+
+def get_loan_summary(loan: Loan) -> Dict:
+    return {
+        'loan_id': loan.loan_id,
+        'status': loan.status,
+        'first_effective_date': loan.first_effective_date.isoformat() if loan.first_effective_date else None,
+        'last_effective_date': loan.last_effective_date.isoformat() if loan.last_effective_date else None,
+        'entries': loan.entry_count,
+    }
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_loans')
+def get_loans(loans: Iterable[Loan], status: Optional[str] = None) -> List[Dict]:
+    """
+    Lists the loans of the portfolio from the summaries the registry
+    keeps, without reading any entry
+
+    Args:
+        loans(Iterable[Loan]): Snapshot of the registered loans
+        status(Optional[str]): Only list loans with this status, all loans if empty
+    Returns:
+        loans(List[Dict]): Status, effective date range and number of entries
+            of every loan, ordered by loan id
+    """
+    if status and status not in STATUSES:
+        raise InvalidLoanStatus(f'Loan status must be one of {", ".join(STATUSES)}')
+    loans = sorted(loans, key=lambda loan: loan.loan_id)
+    return [get_loan_summary(loan) for loan in loans if not status or loan.status == status]
+
+def encode_cursor(key: EntryKey) -> str:
+    effective_date, sequence = key
+    return base64.urlsafe_b64encode(f'{effective_date.toordinal()}.{sequence}'.encode()).decode()
+
+def decode_cursor(cursor: str) -> EntryKey:
+    try:
+        ordinal, sequence = base64.urlsafe_b64decode(cursor.encode()).decode().split('.')
+        return date.fromordinal(int(ordinal)), int(sequence)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError):
+        raise InvalidCursor('Please provide a cursor returned by a previous page')
 
-def get_buckets_sum(loan_id: int, identifiers: List[str], buckets: List[AccountingBucket], ledger: Ledger) -> Dict[str, float]:
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_ledger_entries_page')
+def get_ledger_entries_page(loan_id: int, ledger: Ledger, limit: Optional[int] = None, cursor: Optional[str] = None,
+                            effective_from: Optional[date] = None, effective_to: Optional[date] = None,
+                            created_from: Optional[date] = None, created_to: Optional[date] = None) -> Tuple[List[LedgerEntry], Optional[str]]:
+    """
+    Returns a page of the entries of a loan ordered by effective date
+
+    Args:
+        loan_id(int): Loan to return entries for
+        ledger(Ledger): Ledger to read entries from
+        limit(Optional[int]): Maximum number of entries in the page
+        cursor(Optional[str]): Cursor returned with the previous page
+        effective_from(Optional[date]): Earliest effective date, inclusive
+        effective_to(Optional[date]): Latest effective date, inclusive
+        created_from(Optional[date]): Earliest creation date, inclusive
+        created_to(Optional[date]): Latest creation date, inclusive
+    Returns:
+        ledger_entries(List[LedgerEntry]): Entries in the page
+        next_cursor(Optional[str]): Cursor for the next page, None on the last page
+    """
+    if limit is None:
+        limit = MAXIMUM_PAGE_SIZE
+    if limit < 1 or limit > MAXIMUM_PAGE_SIZE:
+        raise InvalidPageSize(f'Page size must be between 1 and {MAXIMUM_PAGE_SIZE}')
+
+    after = decode_cursor(cursor) if cursor else None
+    keyed_entries = ledger.get_entries_by_effective_date(loan_id, effective_from, effective_to, after)
+    if created_from or created_to:
+        keyed_entries = (
+            (key, entry) for key, entry in keyed_entries
+            if (not created_from or entry.created_at >= created_from) and (not created_to or entry.created_at <= created_to)
+        )
+
+    page = list(itertools.islice(keyed_entries, limit + 1))
+    next_cursor = encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+    return [entry for _, entry in page[:limit]], next_cursor
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_changes')
+def get_changes(after: int, ledger_repo, buckets: Buckets, limit: Optional[int] = None, loan_id: Optional[int] = None, identifiers: Iterable[str] = ()) -> Tuple[List[Tuple[int, LedgerEntry]], int]:
+    """
+    Returns the entries added after a sequence number, read from the
+    change feed while it still buffers them and from the ledger otherwise:
+    the database of the SQLite engine or the in-memory ledger, which holds
+    every entry recovered from the snapshot and the write-ahead log. The
+    log is not read back, its segments are removed once a snapshot covers
+    them. Only entries published to the feed, durable ones when there is
+    a log, are returned. At most FEED_SCAN_SIZE entries are scanned per call
+
+    Args:
+        after(int): Sequence number to read after, 0 for every entry
+        ledger_repo(LedgerRepository): Repository of the ledger and its change feed
+        buckets(Buckets): Buckets of the ledger
+        limit(Optional[int]): Maximum number of entries returned
+        loan_id(Optional[int]): Only return entries of this loan, all loans if empty
+        identifiers(Iterable[str]): Only return entries of these buckets, all buckets if empty
+    Returns:
+        changes(List[Tuple[int, LedgerEntry]]): Sequence numbers with their entries
+        last_sequence(int): Sequence number of the last entry scanned, to read after next
+    """
+    if limit is None:
+        limit = MAXIMUM_PAGE_SIZE
+    if limit < 1 or limit > MAXIMUM_PAGE_SIZE:
+        raise InvalidPageSize(f'Page size must be between 1 and {MAXIMUM_PAGE_SIZE}')
+
+    buckets = to_bucket_mapping(buckets)
+    identifiers = set(identifiers)
+    for identifier in identifiers:
+        if not is_bucket_present(identifier, buckets):
+            raise InvalidIdentifier('Please provide a valid bucket identifier')
+
+    with ledger_repo.read() as ledger:
+        feed = ledger_repo.feed
+        if after > feed.last_sequence:
+            raise InvalidSequence('Please provide a sequence number returned by the change feed')
+        stop = min(feed.last_sequence, after + FEED_SCAN_SIZE)
+        entries = feed.get_entries(after, stop)
+        if entries is None:
+            # Consumers behind the buffer read the entries back from the ledger
+            entries = ledger.get_entries_range(after, stop)
+
+    changes = []
+    for sequence, entry in enumerate(entries, after + 1):
+        if (not loan_id or entry.loan_id == loan_id) and (not identifiers or entry.bucket_identifier in identifiers):
+            changes.append((sequence, entry))
+            if len(changes) == limit:
+                return changes, sequence
+    return changes, stop
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_buckets_sum')
+def get_buckets_sum(loan_id: int, identifiers: List[str], buckets: Buckets, ledger: Ledger, consistency_check: bool = False, as_of: Optional[date] = None) -> Dict[str, float]:
+    buckets = to_bucket_mapping(buckets)
     buckets_sum = {}
     for identifier in identifiers:
         if not is_bucket_present(identifier, buckets):
             raise InvalidIdentifier('Please provide a valid bucket identifier')
 
-        ledger_entries = ledger.get_entries(loan_id, identifier)
-        buckets_sum[identifier] = sum([entry.value for entry in ledger_entries])
+        if as_of:
+            buckets_sum[identifier] = ledger.get_balance_as_of(loan_id, identifier, as_of)
+        else:
+            balance = ledger.get_balance(loan_id, identifier)
+            buckets_sum[identifier] = balance.sum if balance else 0
+
+        if consistency_check:
+            recomputed_sum = sum(
+                entry.value for entry in ledger.get_entries(loan_id, [identifier])
+                if not as_of or entry.effective_date <= as_of
+            )
+            # Minor units are integers, so any difference at all is drift
+            if recomputed_sum != buckets_sum[identifier]:
+                raise InconsistentBalance(f'Running balance for bucket "{identifier}" does not match its ledger entries')
+
+    return {identifier: to_major_units(value) for identifier, value in buckets_sum.items()}
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_portfolio_balances')
+def get_portfolio_balances(identifiers: List[str], buckets: Buckets, ledger: Ledger, effective_from: Optional[date] = None, effective_to: Optional[date] = None) -> Dict:
+    buckets = to_bucket_mapping(buckets)
+    for identifier in identifiers:
+        if not is_bucket_present(identifier, buckets):
+            raise InvalidIdentifier('Please provide a valid bucket identifier')
+
+    report = aggregation.get_portfolio_balances(ledger, identifiers or list(buckets), effective_from, effective_to)
+    report['balances'] = [[to_major_units(value) for value in row] for row in report['balances']]
+    return report
+
+@metrics.timed(metrics.SERVICE_SECONDS, 'get_trial_balance')
+def get_trial_balance(loan_id: Optional[int], ledger: Ledger, minor_units: bool = False) -> Dict:
+    """
+    Returns the debit and credit totals of every bucket and of the whole
+    loan or ledger, read from the totals the ledger keeps as entries are
+    added so the cost only grows with the number of buckets. A SQLite
+    ledger aggregates them from the entries instead
 
-    return buckets_sum
\ No newline at end of file
+    Args:
+        loan_id(Optional[int]): Loan to restrict the trial balance to, all loans if empty
+        ledger(Ledger): Ledger to read totals from
+        minor_units(bool): Whether to report totals as strings of integer minor
+            units, e.g. for a sharded router adding up the totals of its shards.
+            Strings are exact however large and encoded alike by every serializer
+    Returns:
+        report(Dict): Totals of every bucket, total debit and credit, whether
+            they balance and, across every loan, the loans which do not
+    """
+    to_units = str if minor_units else to_major_units
+    trial_balance = ledger.get_trial_balance(loan_id)
+    report = {
+        'loan_id': loan_id or None,
+        'buckets': [
+            {'identifier': identifier, 'debit': to_units(balance.debit), 'credit': to_units(balance.credit), 'sum': to_units(balance.sum)}
+            for identifier, balance in sorted(ledger.get_balances(loan_id).items())
+        ],
+        'debit': to_units(trial_balance.debit),
+        'credit': to_units(trial_balance.credit),
+        'entries': trial_balance.entries,
+        'balanced': trial_balance.is_balanced(),
+    }
+    if not loan_id:
+        report['unbalanced_loan_ids'] = ledger.get_unbalanced_loan_ids()
+        report['balanced'] = report['balanced'] and not report['unbalanced_loan_ids']
+    return report
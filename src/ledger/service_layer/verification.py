@@ -0,0 +1,113 @@
+import logging
+import threading
+from datetime import (datetime, timezone)
+from typing import (Callable, Dict, List, Optional)
+
+from ledger.domain.ledger import (LedgerEntry, TrialBalance)
+
+VERIFY_CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+def add_to_trial_balances(entries: List[LedgerEntry], trial_balance: TrialBalance, loan_trial_balances: Dict[int, TrialBalance], loan_ids: List[int]):
+    for entry in entries:
+        loan_trial_balance = loan_trial_balances.get(entry.loan_id)
+        if loan_trial_balance is None:
+            loan_trial_balance = loan_trial_balances[entry.loan_id] = TrialBalance()
+            loan_ids.append(entry.loan_id)
+        loan_trial_balance.add_value(entry.value)
+        trial_balance.add_value(entry.value)
+
+def is_same_trial_balance(trial_balance: TrialBalance, other: TrialBalance) -> bool:
+    return (trial_balance.debit, trial_balance.credit, trial_balance.entries) == (other.debit, other.credit, other.entries)
+
+class TrialBalanceVerifier:
+    """
+    Periodically re-derives the trial balance of every loan and of the
+    whole ledger from the raw entries and compares them with the totals
+    the ledger keeps as entries are added
+
+    Entries are read a chunk at a time under the read lock and summed
+    after releasing it, so writers only wait for a chunk to be copied.
+    Totals are then compared a chunk of loans at a time, each time after
+    catching up with the entries added meanwhile. The comparison only
+    happens once the last chunk read reaches the end of the ledger, that
+    chunk being summed under the lock, so both sides of every comparison
+    cover the same entries and writers never wait for more than a chunk.
+
+    A verification which fails is logged and reported by last_error until
+    a later one succeeds, the verifier keeps running meanwhile.
+    """
+    def __init__(self, get_ledger_repo: Callable, interval: float, chunk_size: int = VERIFY_CHUNK_SIZE):
+        self.get_ledger_repo = get_ledger_repo
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.last_result = None # type: Optional[Dict]
+        self.last_error = None # type: Optional[Dict]
+        self.failures = 0
+        self.stopped = threading.Event()
+        self.thread = None # type: Optional[threading.Thread]
+
+    def verify(self) -> Dict:
+        """
+        Returns:
+            result(Dict): Number of entries and loans verified, the loans
+                whose kept totals differ from their entries, whether the
+                totals of the whole ledger match and when it completed
+        """
+        ledger_repo = self.get_ledger_repo()
+        trial_balance = TrialBalance()
+        loan_trial_balances = {} # type: Dict[int, TrialBalance]
+        mismatched_loan_ids = []
+        loan_ids = [] # type: List[int]
+        checked = position = 0
+        while True:
+            with ledger_repo.read() as ledger:
+                count = ledger.count_entries()
+                entries = ledger.get_entries_range(position, min(count, position + self.chunk_size))
+                position += len(entries)
+                caught_up = position == count
+                if caught_up:
+                    # Summed under the lock so the kept totals compared next cover the same entries
+                    add_to_trial_balances(entries, trial_balance, loan_trial_balances, loan_ids)
+                    if checked == len(loan_ids):
+                        totals_match = is_same_trial_balance(ledger.get_trial_balance(None), trial_balance)
+                        break
+                    for loan_id in loan_ids[checked:checked + self.chunk_size]:
+                        if not is_same_trial_balance(ledger.get_trial_balance(loan_id), loan_trial_balances[loan_id]):
+                            mismatched_loan_ids.append(loan_id)
+                    checked = min(checked + self.chunk_size, len(loan_ids))
+            if not caught_up:
+                add_to_trial_balances(entries, trial_balance, loan_trial_balances, loan_ids)
+
+        return {
+            'verified_entries': position,
+            'verified_loans': len(loan_trial_balances),
+            'mismatched_loan_ids': sorted(mismatched_loan_ids),
+            'totals_match': totals_match,
+            'consistent': totals_match and not mismatched_loan_ids,
+            'completed_at': datetime.now(timezone.utc).isoformat(),
+        }
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.last_result = self.verify()
+                self.last_error = None
+            except Exception as e:
+                logger.exception('Verifying the trial balance failed')
+                self.failures += 1
+                self.last_error = {
+                    'error': f'{type(e).__name__}: {e}',
+                    'failures': self.failures,
+                    'failed_at': datetime.now(timezone.utc).isoformat(),
+                }
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='ledger-trial-balance-verifier', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
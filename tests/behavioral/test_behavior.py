@@ -3,11 +3,15 @@ import json
 import math
 import pytest
 
+from ledger.bootstrap import (create_cache, create_repositories)
+from ledger.entrypoints import flask_app
 from ledger.entrypoints.flask_app import app
 
-# TODO: Find out why data saved between requests
 @pytest.fixture()
-def client():
+def client(monkeypatch):
+    # The app keeps its state in module globals created on import, every test starts from empty ones
+    monkeypatch.setattr(flask_app, 'repositories', create_repositories())
+    monkeypatch.setattr(flask_app, 'read_cache', create_cache())
     with app.test_client() as client:
         yield client
 
@@ -26,6 +30,10 @@ def create_buckets(client):
         assert success_response.status_code == 200
 
 def originate_loan(client):
+    response = client.post('/ledger/loans?loan_id=123')
+    assert 'opened successfully' in response.get_json()['message']
+    assert response.status_code == 200
+
     entries = [
         {
             "debit": {
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import pytest
+
+from ledger import metrics
+from ledger.bootstrap import (create_cache, create_idempotency_store, create_repositories)
+from ledger.entrypoints import asgi_app
+from ledger.service_layer import (schema, services)
+
+@pytest.fixture(autouse=True)
+def empty_state(monkeypatch):
+    monkeypatch.setattr(asgi_app, 'repositories', create_repositories())
+    monkeypatch.setattr(asgi_app, 'read_cache', create_cache())
+    monkeypatch.setattr(asgi_app, 'idempotency_store', create_idempotency_store())
+
+def call(method: str, url: str, body=None, headers=None):
+    """
+    Sends a single request through the ASGI application and returns the
+    status, the headers and the joined body of the response
+    """
+    parts = urlsplit(url)
+    content = json.dumps(body).encode() if body is not None and not isinstance(body, bytes) else (body or b'')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': parts.path,
+        'query_string': parts.query.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': content, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app.app(scope, receive, send))
+    start = messages[0]
+    return start['status'], dict(start['headers']), b''.join(message.get('body', b'') for message in messages[1:])
+
+def create_entries(identifier: str, loan_id: int, entries):
+    status, _, _ = call('POST', f'/ledger/buckets?identifier={identifier}')
+    assert status == 200
+    status, _, _ = call('POST', f'/ledger/loans?loan_id={loan_id}')
+    assert status == 200
+    status, _, body = call('POST', f'/ledger/entries?loan_id={loan_id}', entries)
+    assert status == 200, body
+
+class TestAsgiApp:
+    def test_unknown_route_and_method_rejected(self):
+        assert call('GET', '/ledger/unknown')[0] == 404
+        assert call('DELETE', '/ledger/entries')[0] == 405
+
+    def test_missing_loan_id_returns_400(self):
+        status, _, body = call('GET', '/ledger/entries?loan_id=test-loan-id')
+        assert status == 400
+        assert 'loan id' in json.loads(body)['error']
+
+    def test_non_float_value_returns_400(self):
+        entries = [{"debit": {"identifier": "test-debit-bucket", "value": "1"}, "credit": {"identifier": "test-credit-bucket", "value": "-1"}}]
+        status, _, body = call('POST', '/ledger/entries?loan_id=1', entries)
+        assert status == 400
+        assert json.loads(body) == {'error': 'Please provide valid floating point value for each pair entry', 'path': '[0].debit.value'}
+
+    def test_pair_entries_parsed_off_the_event_loop(self, monkeypatch):
+        parsing_threads = []
+        parse_pair_entries = schema.parse_pair_entries
+
+        def record_thread(value):
+            parsing_threads.append(threading.current_thread())
+            return parse_pair_entries(value)
+
+        monkeypatch.setattr(schema, 'parse_pair_entries', record_thread)
+        create_entries('test-asgi-bucket', 2002, [{"debit": {"identifier": "test-asgi-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-bucket", "value": -1.0}}])
+        assert parsing_threads and threading.main_thread() not in parsing_threads
+
+    def test_entry_listings_encoded_off_the_event_loop(self, monkeypatch):
+        encoding_threads = []
+        dumps_entries = asgi_app.serializer.dumps_entries
+
+        def record_thread(entries, **fields):
+            encoding_threads.append(threading.current_thread())
+            return dumps_entries(entries, **fields)
+
+        assert call('POST', '/ledger/loans?loan_id=2010')[0] == 200
+        monkeypatch.setattr(asgi_app.serializer, 'dumps_entries', record_thread)
+        for url in ('/ledger/entries?loan_id=2010', '/ledger/entries?loan_id=2010&limit=1'):
+            assert call('GET', url)[0] == 200
+        assert len(encoding_threads) == 2 and threading.main_thread() not in encoding_threads
+
+    def test_bulk_rows_not_encoded_as_utf8_return_400(self):
+        status, _, body = call('POST', '/ledger/entries/bulk', b'{"loan_id": 1}\n\xff\n', {'Content-Type': 'application/x-ndjson'})
+        assert status == 400
+        assert json.loads(body) == {'error': 'Please provide rows encoded as UTF-8'}
+
+    def test_created_entries_listed_and_summed(self):
+        entries = [
+            {
+                "effective_date": "2021-01-21",
+                "debit": {"identifier": "test-asgi-bucket", "value": 12.5},
+                "credit": {"identifier": "test-asgi-bucket", "value": -12.5}
+            }
+        ]
+        create_entries('test-asgi-bucket', 2001, entries)
+
+        status, _, body = call('GET', '/ledger/entries?loan_id=2001')
+        assert status == 200
+        listed_entries = json.loads(body)['entries']
+        assert [entry['value'] for entry in listed_entries] == [12.5, -12.5]
+        assert listed_entries[0]['effective_date'] == '2021-01-21'
+
+        status, _, body = call('GET', '/ledger/buckets/sum?loan_id=2001&bucket_id=test-asgi-bucket&consistency_check=1')
+        assert status == 200
+        assert json.loads(body) == {'entries': {'test-asgi-bucket': 0.0}}
+
+    def test_entries_streamed_and_paged(self):
+        entries = [
+            {
+                "effective_date": f"2021-01-0{day}",
+                "debit": {"identifier": "test-asgi-stream-bucket", "value": float(day)},
+                "credit": {"identifier": "test-asgi-stream-bucket", "value": -float(day)}
+            }
+            for day in (3, 1, 2)
+        ]
+        create_entries('test-asgi-stream-bucket', 2002, entries)
+
+        status, headers, body = call('GET', '/ledger/entries?loan_id=2002', headers={'Accept': 'application/x-ndjson'})
+        assert status == 200
+        assert headers[b'content-type'] == b'application/x-ndjson'
+        assert [json.loads(line)['value'] for line in body.splitlines()] == [3.0, -3.0, 1.0, -1.0, 2.0, -2.0]
+
+        status, _, body = call('GET', '/ledger/entries?loan_id=2002&limit=3')
+        page = json.loads(body)
+        assert [entry['value'] for entry in page['entries']] == [1.0, -1.0, 2.0]
+        assert page['next_cursor']
+
+        for url in ('/ledger/entries?loan_id=2002&limit=abc', '/ledger/changes?limit=abc'):
+            status, _, body = call('GET', url)
+            assert status == 400
+            assert 'Page size' in json.loads(body)['error']
+
+    def test_bulk_rows_accepted_and_reported(self):
+        status, _, _ = call('POST', '/ledger/buckets?identifier=test-asgi-bulk-bucket')
+        assert status == 200
+        for loan_id in (2003, 2004):
+            assert call('POST', f'/ledger/loans?loan_id={loan_id}')[0] == 200
+        rows = [
+            {"loan_id": loan_id, "debit": {"identifier": "test-asgi-bulk-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-bulk-bucket", "value": -1.0}}
+            for loan_id in (2003, 2004)
+        ]
+        rows.append({"loan_id": 2005})
+        status, _, body = call('POST', '/ledger/entries/bulk', rows)
+        assert status == 200
+        assert [error['row'] for error in json.loads(body)['errors']] == [2]
+        assert json.loads(body)['created_entries'] == 4
+
+        status, _, body = call('GET', '/ledger/reports/balances?bucket_id=test-asgi-bulk-bucket')
+        report = json.loads(body)
+        assert report['loan_ids'] == [2003, 2004]
+        assert report['balances'] == [[0.0], [0.0]]
+
+    def test_trial_balance_returned(self):
+        create_entries('test-asgi-trial-bucket', 2006, [{"debit": {"identifier": "test-asgi-trial-bucket", "value": 2.5}, "credit": {"identifier": "test-asgi-trial-bucket", "value": -2.5}}])
+        assert call('GET', '/ledger/trial-balance?loan_id=test-loan-id')[0] == 400
+
+        status, _, body = call('GET', '/ledger/trial-balance?loan_id=2006')
+        report = json.loads(body)
+        assert status == 200
+        assert report['buckets'] == [{'identifier': 'test-asgi-trial-bucket', 'debit': 2.5, 'credit': -2.5, 'sum': 0.0}]
+        assert report['balanced']
+
+        report = json.loads(call('GET', '/ledger/trial-balance')[2])
+        assert (report['entries'], report['unbalanced_loan_ids'], report['verification']) == (2, [], None)
+
+    def test_loans_opened_listed_and_closed(self):
+        create_entries('test-asgi-loan-bucket', 2007, [{"effective_date": "2021-01-21", "debit": {"identifier": "test-asgi-loan-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-loan-bucket", "value": -1.0}}])
+        assert call('POST', '/ledger/loans?loan_id=2007')[0] == 400
+        assert call('GET', '/ledger/entries?loan_id=2008')[0] == 404
+
+        status, _, body = call('POST', '/ledger/loans/close?loan_id=2007')
+        assert status == 200
+        status, _, body = call('GET', '/ledger/loans')
+        assert json.loads(body) == {'loans': [{'loan_id': 2007, 'status': 'closed', 'first_effective_date': '2021-01-21', 'last_effective_date': '2021-01-21', 'entries': 2}]}
+        status, _, body = call('POST', '/ledger/entries?loan_id=2007', [{"debit": {"identifier": "test-asgi-loan-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-loan-bucket", "value": -1.0}}])
+        assert status == 400
+        assert 'closed' in json.loads(body)['error']
+
+    def test_changes_long_polled(self):
+        entries = [{"debit": {"identifier": "test-asgi-changes-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-changes-bucket", "value": -1.0}}]
+        create_entries('test-asgi-changes-bucket', 2009, entries)
+        assert call('GET', '/ledger/changes?wait=test-wait')[0] == 400
+        assert call('GET', '/ledger/changes?loan_id=2010')[0] == 404
+
+        status, _, body = call('GET', '/ledger/changes?after=1&loan_id=2009')
+        assert status == 200
+        assert [(change['sequence'], change['value']) for change in json.loads(body)['changes']] == [(2, -1.0)]
+
+        timer = threading.Timer(0.1, call, ('POST', '/ledger/entries?loan_id=2009', entries))
+        timer.start()
+        status, _, body = call('GET', '/ledger/changes?after=2&wait=10')
+        timer.join()
+        assert json.loads(body)['last_sequence'] == 4
+        assert not asgi_app.repositories['ledger'].feed.listeners
+
+    def test_idempotent_duplicates_answered_once(self, monkeypatch):
+        entries = [{"debit": {"identifier": "test-asgi-idempotent-bucket", "value": 1.0}, "credit": {"identifier": "test-asgi-idempotent-bucket", "value": -1.0}}]
+        create_entries('test-asgi-idempotent-bucket', 2011, entries)
+        add_double_entries = services.add_double_entries
+        calls = []
+
+        def add_double_entries_slowly(*args):
+            calls.append(args)
+            time.sleep(0.1)
+            return add_double_entries(*args)
+
+        monkeypatch.setattr(services, 'add_double_entries', add_double_entries_slowly)
+        request = asgi_app.to_request({
+            'method': 'POST', 'path': '/ledger/entries', 'query_string': b'loan_id=2011', 'headers': [(b'idempotency-key', b'asgi-concurrent')],
+        }, json.dumps(entries).encode())
+        view = asgi_app.ROUTES['/ledger/entries']['POST']
+
+        async def post_duplicates():
+            return await asyncio.gather(*(view(request) for _ in range(3)))
+
+        responses = asyncio.run(post_duplicates())
+        assert len(calls) == 1
+        assert [response.status for response in responses] == [200, 200, 200]
+        assert sorted(response.headers.get('Idempotent-Replayed', '') for response in responses) == ['', 'true', 'true']
+
+        status, headers, _ = call('POST', '/ledger/entries?loan_id=2011', entries, {'Idempotency-Key': 'asgi-concurrent'})
+        assert (status, headers[b'idempotent-replayed']) == (200, b'true')
+        assert call('POST', '/ledger/entries?loan_id=2011', [], {'Idempotency-Key': 'asgi-concurrent'})[0] == 422
+        assert len(calls) == 1
+
+    def test_metrics_disabled_returns_404(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', False)
+        assert call('GET', '/metrics')[0] == 404
+
+    def test_requests_observed_in_metrics(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        monkeypatch.setattr(asgi_app, 'app', asgi_app.observe_requests(asgi_app.app))
+
+        assert call('POST', '/ledger/loans?loan_id=2006')[0] == 200
+        assert call('GET', '/ledger/entries?loan_id=2006')[0] == 200
+        status, headers, body = call('GET', '/metrics')
+        assert status == 200
+        assert headers[b'content-type'].startswith(b'text/plain')
+        lines = body.decode().splitlines()
+        assert any(line.startswith('ledger_http_requests_total{route="/ledger/entries",method="GET",status="200"}') for line in lines)
+        assert any(line.startswith('ledger_http_request_duration_seconds_count{route="/ledger/loans",method="POST",status="200"}') for line in lines)
+        assert 'ledger_entries 0' in lines
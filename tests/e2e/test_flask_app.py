@@ -1,14 +1,26 @@
 import json
+import threading
 import pytest
 
+from ledger.bootstrap import (create_cache, create_idempotency_store, create_repositories)
+from ledger.entrypoints import flask_app
 from ledger.entrypoints.flask_app import app
+from ledger.service_layer import services
 
-# TODO: Find out why data saved between requests
 @pytest.fixture()
-def client():
+def client(monkeypatch):
+    # The app keeps its state in module globals created on import, every test starts from empty ones
+    monkeypatch.setattr(flask_app, 'repositories', create_repositories())
+    monkeypatch.setattr(flask_app, 'read_cache', create_cache())
+    monkeypatch.setattr(flask_app, 'idempotency_store', create_idempotency_store())
     with app.test_client() as client:
         yield client
 
+def open_loans(client, *loan_ids):
+    for loan_id in loan_ids:
+        response = client.post(f'/ledger/loans?loan_id={loan_id}')
+        assert response.status_code == 200
+
 class TestGetLedgerEntries:
     def test_missing_loan_id_returns_400(self, client):
         response = client.get('/ledger/entries?loan_id=')
@@ -21,11 +33,19 @@ class TestGetLedgerEntries:
         assert response.status_code == 400
 
     def test_loan_id_found_returns_ledger_entries(self, client):
+        open_loans(client, 1)
         response = client.get('/ledger/entries?loan_id=1')
         assert response.get_json()['entries'] == []
         assert response.status_code == 200
 
+    def test_unknown_loan_id_returns_404(self, client):
+        for url in ('/ledger/entries?loan_id=1', '/ledger/entries?loan_id=1&stream=1', '/ledger/entries?loan_id=1&limit=1'):
+            response = client.get(url)
+            assert 'open the loan' in response.get_json()['error']
+            assert response.status_code == 404
+
     def test_loan_id_with_entries_found_returns_ledger_entries(self, client):
+        open_loans(client, 1)
         bucket_created_response = client.post('/ledger/buckets?identifier=test-entries-found-bucket')
         assert 'created successfully' in bucket_created_response.get_json()['message']
         assert bucket_created_response.status_code == 200
@@ -62,6 +82,69 @@ class TestGetLedgerEntries:
         assert credit_entry['bucket_identifier'] == entries[0]['credit']['identifier']
         assert credit_entry['loan_id'] == 1
 
+    def test_stream_requested_returns_ndjson_entries(self, client):
+        open_loans(client, 5)
+        bucket_created_response = client.post('/ledger/buckets?identifier=test-streamed-bucket')
+        assert bucket_created_response.status_code == 200
+
+        entries = [
+            {
+                "effective_date": "2021-01-21",
+                "debit": {"identifier": "test-streamed-bucket", "value": 5.0},
+                "credit": {"identifier": "test-streamed-bucket", "value": -5.0}
+            }
+        ]
+        response = client.post('/ledger/entries?loan_id=5', data=json.dumps(entries), content_type='application/json')
+        assert response.status_code == 200
+
+        for response in (
+            client.get('/ledger/entries?loan_id=5&stream=1'),
+            client.get('/ledger/entries?loan_id=5', headers={'Accept': 'application/x-ndjson'}),
+        ):
+            assert response.status_code == 200
+            assert response.mimetype == 'application/x-ndjson'
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+            assert [line['value'] for line in lines] == [5.0, -5.0]
+            assert lines[0]['effective_date'] == '2021-01-21'
+            assert lines[0]['loan_id'] == 5
+
+    def test_limit_and_date_range_return_page_with_cursor(self, client):
+        open_loans(client, 6)
+        bucket_created_response = client.post('/ledger/buckets?identifier=test-paged-bucket')
+        assert bucket_created_response.status_code == 200
+
+        entries = [
+            {
+                "effective_date": f"2021-01-0{day}",
+                "debit": {"identifier": "test-paged-bucket", "value": float(day)},
+                "credit": {"identifier": "test-paged-bucket", "value": -float(day)}
+            }
+            for day in range(1, 6)
+        ]
+        response = client.post('/ledger/entries?loan_id=6', data=json.dumps(entries), content_type='application/json')
+        assert response.status_code == 200
+
+        response = client.get('/ledger/entries?loan_id=6&limit=3&effective_from=2021-01-02')
+        assert response.status_code == 200
+        assert [entry['value'] for entry in response.get_json()['entries']] == [2.0, -2.0, 3.0]
+
+        cursor = response.get_json()['next_cursor']
+        response = client.get(f'/ledger/entries?loan_id=6&limit=3&effective_from=2021-01-02&effective_to=2021-01-04&cursor={cursor}')
+        assert [entry['value'] for entry in response.get_json()['entries']] == [-3.0, 4.0, -4.0]
+        assert response.get_json()['next_cursor'] is None
+
+    def test_invalid_date_filter_returns_400(self, client):
+        response = client.get('/ledger/entries?loan_id=6&effective_from=test-not-date')
+        assert 'YYYY-MM-DD' in response.get_json()['error']
+        assert response.get_json()['path'] == 'effective_from'
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('url', ['/ledger/entries?loan_id=6&limit=abc', '/ledger/changes?limit=abc', '/ledger/changes?limit=0'])
+    def test_invalid_limit_returns_400(self, client, url):
+        response = client.get(url)
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Page size must be between 1 and 1000', 'path': 'limit'}
+
 class TestCreateBucket:
     def test_missing_bucket_id_param_returns_400(self, client):
         response = client.post('/ledger/buckets?identifier=')
@@ -82,6 +165,63 @@ class TestCreateBucket:
         assert 'please provide a unique value' in failure_response.get_json()['error']
         assert failure_response.status_code == 400
 
+class TestLoans:
+    def test_existing_loan_id_returns_400(self, client):
+        open_loans(client, 7)
+        response = client.post('/ledger/loans?loan_id=7')
+        assert 'unique value' in response.get_json()['error']
+        assert response.status_code == 400
+
+    def test_closed_loan_rejects_entries_and_keeps_them_readable(self, client):
+        open_loans(client, 7)
+        client.post('/ledger/buckets?identifier=test-closed-bucket')
+        entries = [{"debit": {"identifier": "test-closed-bucket", "value": 1.0}, "credit": {"identifier": "test-closed-bucket", "value": -1.0}}]
+        assert client.post('/ledger/entries?loan_id=7', data=json.dumps(entries), content_type='application/json').status_code == 200
+
+        response = client.post('/ledger/loans/close?loan_id=7')
+        assert 'closed successfully' in response.get_json()['message']
+        assert client.post('/ledger/loans/close?loan_id=7').status_code == 400
+
+        response = client.post('/ledger/entries?loan_id=7', data=json.dumps(entries), content_type='application/json')
+        assert 'closed' in response.get_json()['error']
+        assert response.status_code == 400
+        rows = [{"loan_id": 7, **entries[0]}]
+        response = client.post('/ledger/entries/bulk', data=json.dumps(rows), content_type='application/json')
+        assert response.get_json()['errors'] == [{'row': 0, 'error': 'Loan is closed and accepts no more entries'}]
+        assert len(client.get('/ledger/entries?loan_id=7').get_json()['entries']) == 2
+
+    def test_unknown_loan_returns_404(self, client):
+        entries = [{"debit": {"identifier": "test-unknown-bucket", "value": 1.0}, "credit": {"identifier": "test-unknown-bucket", "value": -1.0}}]
+        for response in (
+            client.post('/ledger/entries?loan_id=8', data=json.dumps(entries), content_type='application/json'),
+            client.post('/ledger/loans/close?loan_id=8'),
+            client.get('/ledger/loans?loan_id=8'),
+            client.get('/ledger/buckets/sum?loan_id=8&bucket_id=test-unknown-bucket'),
+            client.get('/ledger/trial-balance?loan_id=8'),
+        ):
+            assert 'open the loan' in response.get_json()['error']
+            assert response.status_code == 404
+
+    def test_loans_listed_with_entry_summaries(self, client):
+        open_loans(client, 9, 8)
+        client.post('/ledger/buckets?identifier=test-listed-bucket')
+        entries = [
+            {"effective_date": effective_date, "debit": {"identifier": "test-listed-bucket", "value": 1.0}, "credit": {"identifier": "test-listed-bucket", "value": -1.0}}
+            for effective_date in ("2021-02-01", "2021-01-01")
+        ]
+        client.post('/ledger/entries?loan_id=9', data=json.dumps(entries), content_type='application/json')
+        client.post('/ledger/loans/close?loan_id=8')
+
+        response = client.get('/ledger/loans')
+        assert response.status_code == 200
+        assert response.get_json()['loans'] == [
+            {'loan_id': 8, 'status': 'closed', 'first_effective_date': None, 'last_effective_date': None, 'entries': 0},
+            {'loan_id': 9, 'status': 'open', 'first_effective_date': '2021-01-01', 'last_effective_date': '2021-02-01', 'entries': 4},
+        ]
+        assert [loan['loan_id'] for loan in client.get('/ledger/loans?status=open').get_json()['loans']] == [9]
+        assert client.get('/ledger/loans?loan_id=9').get_json()['entries'] == 4
+        assert client.get('/ledger/loans?status=test-status').status_code == 400
+
 class TestCreateDoubleEntries:
     def test_missing_loan_id_returns_400(self, client):
         response = client.post('/ledger/entries?loan_id=')
@@ -105,6 +245,7 @@ class TestCreateDoubleEntries:
         ]
         response = client.post('/ledger/entries?loan_id=1', data=json.dumps(entries), content_type='application/json')
         assert 'debit and credit' in response.get_json()['error']
+        assert response.get_json()['path'] == '[0].credit'
         assert response.status_code == 400
 
     def test_non_float_value_returns_400(self, client):
@@ -123,9 +264,38 @@ class TestCreateDoubleEntries:
         ]
         response = client.post('/ledger/entries?loan_id=1', data=json.dumps(entries), content_type='application/json')
         assert 'floating point value' in response.get_json()['error']
+        assert response.get_json()['path'] == '[0].debit.value'
+        assert response.status_code == 400
+
+    def test_too_many_decimal_places_returns_400(self, client):
+        open_loans(client, 1)
+        entries = [
+            {
+                "effective_date": "2021-01-21",
+                "debit": {
+                    "identifier": "test-debit-bucket",
+                    "value": 0.0000001
+                },
+                "credit": {
+                    "identifier": "test-credit-bucket",
+                    "value": -0.0000001
+                }
+            }
+        ]
+        response = client.post('/ledger/entries?loan_id=1', data=json.dumps(entries), content_type='application/json')
+        assert 'decimal places' in response.get_json()['error']
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize('value', ['Infinity', 'NaN'])
+    def test_non_finite_value_returns_400(self, client, value):
+        open_loans(client, 1)
+        body = f'[{{"debit": {{"identifier": "test-debit-bucket", "value": {value}}}, "credit": {{"identifier": "test-credit-bucket", "value": {value}}}}}]'
+        response = client.post('/ledger/entries?loan_id=1', data=body, content_type='application/json')
+        assert response.get_json() == {'error': 'Amounts must be finite numbers', 'path': '[0].debit.value'}
         assert response.status_code == 400
 
     def test_nonexistent_bucket_id_returns_400(self, client):
+        open_loans(client, 1)
         entries = [
             {
                 "effective_date": "2021-01-21",
@@ -144,6 +314,7 @@ class TestCreateDoubleEntries:
         assert response.status_code == 400
 
     def test_proper_values_creates_entries_and_returns_200(self, client):
+        open_loans(client, 1)
         debit_bucket_response = client.post('/ledger/buckets?identifier=test-proper-debit-bucket')
         assert debit_bucket_response.status_code == 200
         credit_bucket_response = client.post('/ledger/buckets?identifier=test-proper-credit-bucket')
@@ -166,6 +337,130 @@ class TestCreateDoubleEntries:
         assert '"2" ledger entries' in response.get_json()['message']
         assert response.status_code == 200
 
+class TestCreateBulkDoubleEntries:
+    def test_non_list_body_returns_400(self, client):
+        response = client.post('/ledger/entries/bulk', data=json.dumps({}), content_type='application/json')
+        assert 'list of pair entries' in response.get_json()['error']
+        assert response.status_code == 400
+
+    def test_json_rows_create_entries_for_each_loan(self, client):
+        open_loans(client, 1001, 1002, 1003)
+        bucket_response = client.post('/ledger/buckets?identifier=test-bulk-json-bucket')
+        assert bucket_response.status_code == 200
+
+        rows = [
+            {
+                "loan_id": loan_id,
+                "effective_date": "2021-01-21",
+                "debit": {"identifier": "test-bulk-json-bucket", "value": 1.0},
+                "credit": {"identifier": "test-bulk-json-bucket", "value": -1.0}
+            }
+            for loan_id in (1001, 1002)
+        ]
+        rows.append({"loan_id": 1003, "debit": {"identifier": "test-bulk-json-bucket", "value": 1.0}})
+        response = client.post('/ledger/entries/bulk', data=json.dumps(rows), content_type='application/json')
+        assert response.status_code == 200
+        assert '"4" ledger entries' in response.get_json()['message']
+        assert response.get_json()['created_entries'] == 4
+        assert response.get_json()['errors'] == [{'row': 2, 'error': 'Please provide valid debit and credit objects for each pair entry', 'path': 'credit'}]
+
+        response = client.get('/ledger/entries?loan_id=1002')
+        assert len(response.get_json()['entries']) == 2
+
+    def test_ndjson_rows_create_entries(self, client):
+        open_loans(client, 1004)
+        bucket_response = client.post('/ledger/buckets?identifier=test-bulk-ndjson-bucket')
+        assert bucket_response.status_code == 200
+
+        row = {
+            "loan_id": 1004,
+            "debit": {"identifier": "test-bulk-ndjson-bucket", "value": 1.0},
+            "credit": {"identifier": "test-bulk-ndjson-bucket", "value": -1.0}
+        }
+        body = '\n'.join([json.dumps(row), 'not-json', json.dumps(row)])
+        response = client.post('/ledger/entries/bulk', data=body, content_type='application/x-ndjson')
+        assert response.status_code == 200
+        assert '"4" ledger entries' in response.get_json()['message']
+        assert [error['row'] for error in response.get_json()['errors']] == [1]
+
+    def test_ndjson_rows_not_encoded_as_utf8_return_400(self, client):
+        response = client.post('/ledger/entries/bulk', data=b'{"loan_id": 1}\n\xff\n', content_type='application/x-ndjson')
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'Please provide rows encoded as UTF-8'}
+
+class TestIdempotencyKeys:
+    entries = [{"debit": {"identifier": "test-idempotent-bucket", "value": 1.0}, "credit": {"identifier": "test-idempotent-bucket", "value": -1.0}}]
+
+    def test_retry_replayed_without_adding_entries(self, client):
+        open_loans(client, 6001)
+        client.post('/ledger/buckets?identifier=test-idempotent-bucket')
+        headers = {'Idempotency-Key': 'retried-request'}
+
+        for replayed in (None, 'true'):
+            response = client.post('/ledger/entries?loan_id=6001', data=json.dumps(self.entries), content_type='application/json', headers=headers)
+            assert response.status_code == 200
+            assert '"2" ledger entries' in response.get_json()['message']
+            assert response.headers.get('Idempotent-Replayed') == replayed
+        assert len(client.get('/ledger/entries?loan_id=6001').get_json()['entries']) == 2
+
+        response = client.post('/ledger/entries?loan_id=6001', data=json.dumps(self.entries * 2), content_type='application/json', headers=headers)
+        assert response.status_code == 422
+        response = client.post('/ledger/entries?loan_id=6001', data=json.dumps(self.entries), content_type='application/json', headers={'Idempotency-Key': 'k' * 256})
+        assert response.status_code == 400
+
+    def test_failed_request_retried_with_same_key(self, client):
+        client.post('/ledger/buckets?identifier=test-idempotent-bucket')
+        headers = {'Idempotency-Key': 'unknown-loan'}
+        response = client.post('/ledger/entries?loan_id=6002', data=json.dumps(self.entries), content_type='application/json', headers=headers)
+        assert response.status_code == 404
+
+        open_loans(client, 6002)
+        response = client.post('/ledger/entries?loan_id=6002', data=json.dumps(self.entries), content_type='application/json', headers=headers)
+        assert response.status_code == 200
+        assert 'Idempotent-Replayed' not in response.headers
+
+    def test_concurrent_duplicates_collapse_onto_request_in_flight(self, client, monkeypatch):
+        open_loans(client, 6003)
+        client.post('/ledger/buckets?identifier=test-idempotent-bucket')
+        release = threading.Event()
+        add_double_entries = services.add_double_entries
+
+        def add_double_entries_slowly(*args):
+            release.wait(10)
+            return add_double_entries(*args)
+
+        monkeypatch.setattr(services, 'add_double_entries', add_double_entries_slowly)
+        responses = []
+
+        def post_entries():
+            with app.test_client() as duplicate_client:
+                responses.append(duplicate_client.post(
+                    '/ledger/entries?loan_id=6003', data=json.dumps(self.entries), content_type='application/json', headers={'Idempotency-Key': 'concurrent'},
+                ))
+
+        threads = [threading.Thread(target=post_entries) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while flask_app.idempotency_store.get_stats()['replays'] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert [response.status_code for response in responses] == [200, 200, 200]
+        assert sorted(response.headers.get('Idempotent-Replayed', '') for response in responses) == ['', 'true', 'true']
+        assert len(client.get('/ledger/entries?loan_id=6003').get_json()['entries']) == 2
+
+    def test_bulk_retry_replayed(self, client):
+        open_loans(client, 6004)
+        client.post('/ledger/buckets?identifier=test-idempotent-bucket')
+        rows = [dict(self.entries[0], loan_id=6004)]
+        for _ in range(2):
+            response = client.post('/ledger/entries/bulk', data=json.dumps(rows), content_type='application/json', headers={'Idempotency-Key': 'bulk'})
+            assert response.status_code == 200
+        assert response.headers['Idempotent-Replayed'] == 'true'
+        assert len(client.get('/ledger/entries?loan_id=6004').get_json()['entries']) == 2
+
 class TestGetBucketsSum:
     def test_missing_loan_id_returns_400(self, client):
         response = client.get('/ledger/buckets/sum?loan_id=')
@@ -178,11 +473,13 @@ class TestGetBucketsSum:
         assert response.status_code == 400
 
     def test_missing_bucket_ids_returns_400(self, client):
+        open_loans(client, 1)
         response = client.get('/ledger/buckets/sum?loan_id=1&bucket_id=')
         assert 'bucket identifier' in response.get_json()['error']
         assert response.status_code == 400
 
     def test_loan_id_with_entries_found_returns_buckets_sum(self, client):
+        open_loans(client, 1)
         debit_bucket_response = client.post('/ledger/buckets?identifier=test-new-debit-bucket')
         assert debit_bucket_response.status_code == 200
         credit_bucket_response = client.post('/ledger/buckets?identifier=test-new-credit-bucket')
@@ -211,3 +508,237 @@ class TestGetBucketsSum:
         assert buckets_sum['test-new-debit-bucket'] == 123.0
         assert buckets_sum['test-new-credit-bucket'] == -123.0
 
+    def test_consistency_check_returns_buckets_sum(self, client):
+        open_loans(client, 2)
+        bucket_response = client.post('/ledger/buckets?identifier=test-checked-bucket')
+        assert bucket_response.status_code == 200
+
+        entries = [
+            {
+                "effective_date": "2021-01-21",
+                "debit": {
+                    "identifier": "test-checked-bucket",
+                    "value": 10.0
+                },
+                "credit": {
+                    "identifier": "test-checked-bucket",
+                    "value": -10.0
+                }
+            }
+        ]
+        entries_response = client.post('/ledger/entries?loan_id=2', data=json.dumps(entries), content_type='application/json')
+        assert entries_response.status_code == 200
+
+        response = client.get('/ledger/buckets/sum?loan_id=2&bucket_id=test-checked-bucket&consistency_check=1')
+        assert response.status_code == 200
+        assert response.get_json()['entries']['test-checked-bucket'] == 0.0
+
+    def test_as_of_returns_buckets_sum_at_effective_date(self, client):
+        open_loans(client, 3)
+        bucket_response = client.post('/ledger/buckets?identifier=test-as-of-debit-bucket')
+        assert bucket_response.status_code == 200
+        bucket_response = client.post('/ledger/buckets?identifier=test-as-of-credit-bucket')
+        assert bucket_response.status_code == 200
+
+        entries = [
+            {
+                "effective_date": effective_date,
+                "debit": {"identifier": "test-as-of-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-as-of-credit-bucket", "value": -10.0}
+            }
+            for effective_date in ("2021-06-30", "2021-07-31", "2021-05-31")
+        ]
+        entries_response = client.post('/ledger/entries?loan_id=3', data=json.dumps(entries), content_type='application/json')
+        assert entries_response.status_code == 200
+
+        response = client.get('/ledger/buckets/sum?loan_id=3&bucket_id=test-as-of-debit-bucket&bucket_id=test-as-of-credit-bucket&as_of=2021-06-30')
+        assert response.status_code == 200
+        buckets_sum = response.get_json()['entries']
+        assert buckets_sum['test-as-of-debit-bucket'] == 20.0
+        assert buckets_sum['test-as-of-credit-bucket'] == -20.0
+
+    def test_invalid_as_of_returns_400(self, client):
+        response = client.get('/ledger/buckets/sum?loan_id=3&bucket_id=test-as-of-debit-bucket&as_of=test-not-date')
+        assert 'YYYY-MM-DD' in response.get_json()['error']
+        assert response.status_code == 400
+
+class TestGetPortfolioBalances:
+    def test_unknown_bucket_id_returns_400(self, client):
+        response = client.get('/ledger/reports/balances?bucket_id=test-missing-report-bucket')
+        assert 'bucket identifier' in response.get_json()['error']
+        assert response.status_code == 400
+
+    def test_balances_returned_for_every_loan(self, client):
+        open_loans(client, 2001, 2002)
+        for identifier in ('test-report-debit-bucket', 'test-report-credit-bucket'):
+            bucket_response = client.post(f'/ledger/buckets?identifier={identifier}')
+            assert bucket_response.status_code == 200
+
+        rows = [
+            {
+                "loan_id": loan_id,
+                "effective_date": "2021-03-01",
+                "debit": {"identifier": "test-report-debit-bucket", "value": float(loan_id)},
+                "credit": {"identifier": "test-report-credit-bucket", "value": -float(loan_id)}
+            }
+            for loan_id in (2001, 2002)
+        ]
+        response = client.post('/ledger/entries/bulk', data=json.dumps(rows), content_type='application/json')
+        assert response.status_code == 200
+
+        response = client.get('/ledger/reports/balances?bucket_id=test-report-debit-bucket&bucket_id=test-report-credit-bucket&effective_from=2021-03-01')
+        assert response.status_code == 200
+        report = response.get_json()
+        assert report['loan_ids'] == [2001, 2002]
+        assert report['bucket_identifiers'] == ['test-report-debit-bucket', 'test-report-credit-bucket']
+        assert report['balances'] == [[2001.0, -2001.0], [2002.0, -2002.0]]
+
+    def test_balances_read_while_snapshot_waits_for_the_ledger(self, client):
+        bucket_repo = flask_app.repositories['bucket']
+        ledger_repo = flask_app.repositories['ledger']
+        responses = []
+        snapshot_written = threading.Event()
+
+        def take_snapshot():
+            with ledger_repo.lock.write():
+                snapshot_written.set()
+
+        def get_balances():
+            with app.test_client() as reader_client:
+                responses.append(reader_client.get('/ledger/reports/balances'))
+
+        # Like a snapshot, which holds the bucket lock while it waits for the ledger write lock
+        with bucket_repo.lock:
+            reader = threading.Thread(target=get_balances)
+            reader.start()
+            threading.Event().wait(0.1)
+            threading.Thread(target=take_snapshot, daemon=True).start()
+            assert snapshot_written.wait(5)
+        reader.join()
+        assert responses[0].status_code == 200
+
+class TestGetTrialBalance:
+    def test_non_integer_loan_id_returns_400(self, client):
+        response = client.get('/ledger/trial-balance?loan_id=test-loan-id')
+        assert 'loan id' in response.get_json()['error']
+        assert response.status_code == 400
+
+    def test_trial_balance_returned_for_loan_and_ledger(self, client, monkeypatch):
+        open_loans(client, 4001, 4002)
+        for identifier in ('test-trial-debit-bucket', 'test-trial-credit-bucket'):
+            bucket_response = client.post(f'/ledger/buckets?identifier={identifier}')
+            assert bucket_response.status_code == 200
+
+        rows = [
+            {
+                "loan_id": loan_id,
+                "debit": {"identifier": "test-trial-debit-bucket", "value": float(loan_id)},
+                "credit": {"identifier": "test-trial-credit-bucket", "value": -float(loan_id)}
+            }
+            for loan_id in (4001, 4002)
+        ]
+        response = client.post('/ledger/entries/bulk', data=json.dumps(rows), content_type='application/json')
+        assert response.status_code == 200
+
+        report = client.get('/ledger/trial-balance?loan_id=4002').get_json()
+        assert report['buckets'] == [
+            {'identifier': 'test-trial-credit-bucket', 'debit': 0.0, 'credit': -4002.0, 'sum': -4002.0},
+            {'identifier': 'test-trial-debit-bucket', 'debit': 4002.0, 'credit': 0.0, 'sum': 4002.0},
+        ]
+        assert report['balanced']
+
+        monkeypatch.setattr(flask_app.trial_balance_verifier, 'last_result', flask_app.trial_balance_verifier.verify())
+        report = client.get('/ledger/trial-balance').get_json()
+        assert (report['debit'], report['credit'], report['entries']) == (8003.0, -8003.0, 4)
+        assert report['balanced'] and report['unbalanced_loan_ids'] == []
+        assert report['verification']['verified_entries'] == 4
+        assert report['verification']['consistent']
+        assert report['verification_error'] is None
+
+    def test_totals_beyond_int64_minor_units_kept_exact(self, client):
+        open_loans(client, 4003)
+        for identifier in ('test-trial-cash-bucket', 'test-trial-income-bucket'):
+            bucket_response = client.post(f'/ledger/buckets?identifier={identifier}')
+            assert bucket_response.status_code == 200
+
+        entries = [{"effective_date": "2021-01-21", "debit": {"identifier": "test-trial-cash-bucket", "value": 9e12}, "credit": {"identifier": "test-trial-income-bucket", "value": -9e12}}]
+        for _ in range(2):
+            response = client.post('/ledger/entries?loan_id=4003', data=json.dumps(entries), content_type='application/json')
+            assert response.status_code == 200
+
+        report = client.get('/ledger/trial-balance?loan_id=4003').get_json()
+        assert (report['debit'], report['credit'], report['entries']) == (18e12, -18e12, 4)
+        assert report['balanced']
+        response = client.get('/ledger/buckets/sum?loan_id=4003&bucket_id=test-trial-cash-bucket&as_of=2021-01-21&consistency_check=1')
+        assert response.get_json()['entries']['test-trial-cash-bucket'] == 18e12
+
+    def test_loan_id_beyond_int64_returns_400(self, client):
+        response = client.post(f'/ledger/loans?loan_id={2 ** 63}')
+        assert '64 bits' in response.get_json()['error']
+        assert response.status_code == 400
+
+class TestGetChanges:
+    def test_invalid_parameters_return_400_or_404(self, client):
+        for url in ('/ledger/changes?after=-1', '/ledger/changes?after=1', '/ledger/changes?wait=31', '/ledger/changes?loan_id=test-loan-id', '/ledger/changes?bucket_id=test-bucket'):
+            response = client.get(url)
+            assert response.status_code == 400, url
+        assert client.get('/ledger/changes?loan_id=1').status_code == 404
+
+    def test_changes_resumed_after_last_sequence(self, client):
+        open_loans(client, 5001, 5002)
+        client.post('/ledger/buckets?identifier=test-changes-bucket')
+        entries = [{"effective_date": "2021-01-21", "debit": {"identifier": "test-changes-bucket", "value": 5.0}, "credit": {"identifier": "test-changes-bucket", "value": -5.0}}]
+        for loan_id in (5001, 5002):
+            response = client.post(f'/ledger/entries?loan_id={loan_id}', data=json.dumps(entries), content_type='application/json')
+            assert response.status_code == 200
+
+        body = client.get('/ledger/changes?loan_id=5002').get_json()
+        assert [(change['sequence'], change['loan_id'], change['value']) for change in body['changes']] == [(3, 5002, 5.0), (4, 5002, -5.0)]
+        assert body['last_sequence'] == 4
+
+        body = client.get('/ledger/changes?after=1&limit=2').get_json()
+        assert [change['sequence'] for change in body['changes']] == [2, 3]
+        assert client.get(f'/ledger/changes?after={body["last_sequence"]}').get_json() == {
+            'changes': [{'sequence': 4, 'loan_id': 5002, 'created_at': body['changes'][1]['created_at'], 'effective_date': '2021-01-21', 'bucket_identifier': 'test-changes-bucket', 'value': -5.0}],
+            'last_sequence': 4,
+        }
+
+    def test_long_poll_returns_entries_added_while_waiting(self, client):
+        open_loans(client, 5003)
+        client.post('/ledger/buckets?identifier=test-changes-bucket')
+        entries = [{"debit": {"identifier": "test-changes-bucket", "value": 1.0}, "credit": {"identifier": "test-changes-bucket", "value": -1.0}}]
+
+        def add_entries():
+            with app.test_client() as writer:
+                writer.post('/ledger/entries?loan_id=5003', data=json.dumps(entries), content_type='application/json')
+
+        timer = threading.Timer(0.1, add_entries)
+        timer.start()
+        body = client.get('/ledger/changes?after=0&loan_id=5003&wait=10').get_json()
+        timer.join()
+        assert [change['sequence'] for change in body['changes']] == [1, 2]
+
+        assert client.get('/ledger/changes?after=2&wait=0.05').get_json() == {'changes': [], 'last_sequence': 2}
+
+class TestReadCache:
+    def test_cached_sum_refreshed_after_write(self, client):
+        open_loans(client, 3001)
+        bucket_response = client.post('/ledger/buckets?identifier=test-cached-bucket')
+        assert bucket_response.status_code == 200
+
+        entries = [{"effective_date": "2021-01-21", "debit": {"identifier": "test-cached-bucket", "value": 5.0}, "credit": {"identifier": "test-cached-bucket", "value": -5.0}}]
+        url = '/ledger/buckets/sum?loan_id=3001&bucket_id=test-cached-bucket'
+        for expected_sum in (0.0, 0.0):
+            assert client.get(url).get_json()['entries'] == {'test-cached-bucket': expected_sum}
+        hits = client.get('/ledger/cache').get_json()['hits']
+
+        entries[0]['credit']['identifier'] = 'test-new-credit-bucket'
+        client.post('/ledger/buckets?identifier=test-new-credit-bucket')
+        response = client.post('/ledger/entries?loan_id=3001', data=json.dumps(entries), content_type='application/json')
+        assert response.status_code == 200
+
+        assert client.get(url).get_json()['entries'] == {'test-cached-bucket': 5.0}
+        assert len(client.get('/ledger/entries?loan_id=3001').get_json()['entries']) == 2
+        stats = client.get('/ledger/cache').get_json()
+        assert stats['hits'] == hits
+        assert stats['invalidations'] >= 1
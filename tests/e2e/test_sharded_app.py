@@ -0,0 +1,320 @@
+import asyncio
+import json
+import os
+import signal
+from urllib.parse import urlsplit
+
+import pytest
+
+from ledger.entrypoints.sharded_app import (ShardedApp, get_shard)
+
+SHARDS = 2
+
+async def call(app: ShardedApp, method: str, url: str, body=None, headers=None):
+    """
+    Sends a single request through the sharded application and returns
+    the status and the decoded body of the response
+    """
+    parts = urlsplit(url)
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': parts.path,
+        'query_string': parts.query.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    }
+    content = json.dumps(body).encode() if body is not None and not isinstance(body, bytes) else (body or b'')
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': content, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages[0]['status'], json.loads(b''.join(message.get('body', b'') for message in messages[1:]))
+
+def pair_entries(identifier: str, value: float):
+    return [{"effective_date": "2021-01-21", "debit": {"identifier": identifier, "value": value}, "credit": {"identifier": identifier, "value": -value}}]
+
+async def open_loans(app: ShardedApp, *loan_ids: int):
+    for loan_id in loan_ids:
+        status, _ = await call(app, 'POST', f'/ledger/loans?loan_id={loan_id}')
+        assert status == 200
+
+@pytest.fixture(scope='module')
+def sharded_app():
+    app = ShardedApp(SHARDS)
+    app.start()
+    yield app
+    app.stop()
+
+class TestShardedApp:
+    def test_loans_spread_over_shards(self):
+        assert {get_shard(loan_id, SHARDS) for loan_id in (1, 2)} == {0, 1}
+
+    def test_bucket_created_on_every_shard(self, sharded_app):
+        async def run():
+            status, _ = await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-bucket')
+            assert status == 200
+            status, body = await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-bucket')
+            assert status == 400
+            assert 'Duplicate bucket identifier' in body['error']
+            await open_loans(sharded_app, 1, 2)
+            for loan_id in (1, 2):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', pair_entries('test-sharded-bucket', 1.0))
+                assert status == 200
+        asyncio.run(run())
+
+    def test_bucket_created_on_some_shards_created_on_the_others_by_a_retry(self, sharded_app):
+        async def run():
+            # Left behind by a creation which failed on the other shards
+            status, _, _ = await sharded_app.clients[0].request(('POST', '/ledger/buckets', b'identifier=test-sharded-retried-bucket', [], b''))
+            assert status == 200
+            status, body = await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-retried-bucket')
+            assert status == 200
+            assert body == {'message': 'Bucket named "test-sharded-retried-bucket" created successfully'}
+            await open_loans(sharded_app, 71, 72)
+            for loan_id in (71, 72):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', pair_entries('test-sharded-retried-bucket', 1.0))
+                assert status == 200
+        asyncio.run(run())
+
+    def test_loan_requests_routed_to_their_shard(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-debit-bucket')
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-credit-bucket')
+            entries = [{"effective_date": "2021-01-21", "debit": {"identifier": "test-sharded-debit-bucket", "value": 2.5}, "credit": {"identifier": "test-sharded-credit-bucket", "value": -2.5}}]
+            await open_loans(sharded_app, 3, 4)
+            for loan_id in (3, 4):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', entries * loan_id)
+                assert status == 200
+
+            for loan_id in (3, 4):
+                status, body = await call(sharded_app, 'GET', f'/ledger/buckets/sum?loan_id={loan_id}&bucket_id=test-sharded-debit-bucket')
+                assert status == 200
+                assert body == {'entries': {'test-sharded-debit-bucket': 2.5 * loan_id}}
+                status, body = await call(sharded_app, 'GET', f'/ledger/entries?loan_id={loan_id}')
+                assert len(body['entries']) == 2 * loan_id
+
+            status, body = await call(sharded_app, 'GET', '/ledger/entries?loan_id=test-loan-id')
+            assert status == 400
+            assert 'loan id' in body['error']
+        asyncio.run(run())
+
+    def test_bulk_rows_split_and_reports_merged(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-bulk-bucket')
+            await open_loans(sharded_app, 10, 11, 12)
+            rows = [{"loan_id": loan_id, **pair_entries('test-sharded-bulk-bucket', 1.0)[0]} for loan_id in (12, 11, 10)]
+            rows.insert(1, {"loan_id": 13})
+            status, body = await call(sharded_app, 'POST', '/ledger/entries/bulk', rows)
+            assert status == 200
+            assert body['message'] == '"6" ledger entries created successfully'
+            assert body['created_entries'] == 6
+            assert [error['row'] for error in body['errors']] == [1]
+
+            status, body = await call(sharded_app, 'GET', '/ledger/reports/balances?bucket_id=test-sharded-bulk-bucket')
+            assert status == 200
+            assert body['loan_ids'] == [10, 11, 12]
+            assert body['balances'] == [[0.0], [0.0], [0.0]]
+        asyncio.run(run())
+
+    def test_bulk_retry_with_idempotency_key_replayed_by_every_shard(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-idempotent-bucket')
+            await open_loans(sharded_app, 51, 52)
+            rows = [{"loan_id": loan_id, **pair_entries('test-sharded-idempotent-bucket', 1.0)[0]} for loan_id in (51, 52)]
+            for _ in range(2):
+                status, body = await call(sharded_app, 'POST', '/ledger/entries/bulk', rows, {'Idempotency-Key': 'sharded-bulk'})
+                assert status == 200
+                assert body['message'] == '"4" ledger entries created successfully'
+
+            for loan_id in (51, 52):
+                status, body = await call(sharded_app, 'GET', f'/ledger/entries?loan_id={loan_id}')
+                assert len(body['entries']) == 2
+            status, _ = await call(sharded_app, 'POST', '/ledger/entries/bulk', rows[:1], {'Idempotency-Key': 'sharded-bulk'})
+            assert status == 422
+        asyncio.run(run())
+
+    def test_bulk_rows_not_encoded_as_utf8_return_400(self, sharded_app):
+        status, body = asyncio.run(call(sharded_app, 'POST', '/ledger/entries/bulk', b'\xff\n', {'Content-Type': 'application/x-ndjson'}))
+        assert status == 400
+        assert body == {'error': 'Please provide rows encoded as UTF-8'}
+
+    def test_trial_balance_merged_across_shards(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-trial-bucket')
+            await open_loans(sharded_app, 21, 22)
+            for loan_id in (21, 22):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', pair_entries('test-sharded-trial-bucket', 0.1))
+                assert status == 200
+
+            status, body = await call(sharded_app, 'GET', '/ledger/trial-balance?loan_id=22')
+            assert status == 200
+            assert body['entries'] == 2
+
+            status, body = await call(sharded_app, 'GET', '/ledger/trial-balance')
+            assert status == 200
+            rows = {row['identifier']: row for row in body['buckets']}
+            assert rows['test-sharded-trial-bucket'] == {'identifier': 'test-sharded-trial-bucket', 'debit': 0.2, 'credit': -0.2, 'sum': 0.0}
+            assert body['debit'] == -body['credit']
+            assert body['balanced'] and body['unbalanced_loan_ids'] == []
+            assert body['verification_error'] is None
+
+            status, body = await call(sharded_app, 'GET', '/ledger/trial-balance?loan_id=test-loan-id')
+            assert status == 400
+        asyncio.run(run())
+
+    def test_trial_balance_totals_beyond_int64_minor_units_merged_exactly(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-large-bucket')
+            await open_loans(sharded_app, 81, 82)
+            for loan_id in (81, 82):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', pair_entries('test-sharded-large-bucket', 9000000000000.0) * 2)
+                assert status == 200
+
+            # Each shard holds more than the largest amount a single entry can have
+            status, body = await call(sharded_app, 'GET', '/ledger/trial-balance')
+            assert status == 200
+            rows = {row['identifier']: row for row in body['buckets']}
+            assert rows['test-sharded-large-bucket'] == {'identifier': 'test-sharded-large-bucket', 'debit': 36000000000000.0, 'credit': -36000000000000.0, 'sum': 0.0}
+        asyncio.run(run())
+
+    def test_loans_listed_across_shards(self, sharded_app):
+        async def run():
+            await open_loans(sharded_app, 32, 31)
+            status, _ = await call(sharded_app, 'POST', '/ledger/loans/close?loan_id=32')
+            assert status == 200
+
+            status, body = await call(sharded_app, 'GET', '/ledger/loans')
+            assert status == 200
+            loan_ids = [loan['loan_id'] for loan in body['loans']]
+            assert loan_ids == sorted(loan_ids) and {31, 32} <= set(loan_ids)
+
+            status, body = await call(sharded_app, 'GET', '/ledger/loans?status=closed')
+            assert [loan['loan_id'] for loan in body['loans']] == [32]
+            status, body = await call(sharded_app, 'GET', '/ledger/loans?loan_id=31')
+            assert (status, body['status']) == (200, 'open')
+            status, _ = await call(sharded_app, 'GET', '/ledger/loans?loan_id=33')
+            assert status == 404
+        asyncio.run(run())
+
+    def test_changes_read_across_shards(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-changes-bucket')
+            await open_loans(sharded_app, 41, 42)
+            status, body = await call(sharded_app, 'GET', '/ledger/changes')
+            assert status == 200
+            last_sequence = body['last_sequence']
+            assert len(last_sequence.split('.')) == SHARDS
+
+            for loan_id in (41, 42):
+                status, _ = await call(sharded_app, 'POST', f'/ledger/entries?loan_id={loan_id}', pair_entries('test-sharded-changes-bucket', 1.0))
+                assert status == 200
+            status, body = await call(sharded_app, 'GET', f'/ledger/changes?after={last_sequence}&wait=5')
+            assert sorted(change['loan_id'] for change in body['changes']) == [41, 41, 42, 42]
+            status, body = await call(sharded_app, 'GET', f'/ledger/changes?after={body["last_sequence"]}&wait=0.1')
+            assert body['changes'] == []
+
+            status, body = await call(sharded_app, 'GET', '/ledger/changes?loan_id=42')
+            assert [change['loan_id'] for change in body['changes']] == [42, 42]
+            status, _ = await call(sharded_app, 'GET', '/ledger/changes?after=1')
+            assert status == 400
+        asyncio.run(run())
+
+    def test_shard_adds_entries_while_a_change_feed_waits(self, sharded_app):
+        async def run():
+            await call(sharded_app, 'POST', '/ledger/buckets?identifier=test-sharded-waiting-bucket')
+            await open_loans(sharded_app, 61)
+            _, body = await call(sharded_app, 'GET', '/ledger/changes?loan_id=61')
+            # Sent to the shard itself, through the router the wait would be kept in the router
+            client = sharded_app.get_client(61)
+            waiting = asyncio.ensure_future(client.request(('GET', '/ledger/changes', f'loan_id=61&after={body["last_sequence"]}&wait=10'.encode(), [], b'')))
+            await asyncio.sleep(0.1)
+            status, _ = await asyncio.wait_for(call(sharded_app, 'POST', '/ledger/entries?loan_id=61', pair_entries('test-sharded-waiting-bucket', 1.0)), 5)
+            assert status == 200
+            status, _, body = await asyncio.wait_for(waiting, 5)
+            assert status == 200
+            assert len(json.loads(body)['changes']) == 2
+        asyncio.run(run())
+
+class TestShardFailures:
+    def test_start_waits_for_every_shard_to_recover(self, tmp_path, monkeypatch):
+        monkeypatch.setenv('LEDGER_DATA_DIR', str(tmp_path))
+        app = ShardedApp(SHARDS)
+        app.start()
+        try:
+            assert all(client.connection.poll() is False for client in app.clients)
+            assert sorted(os.listdir(tmp_path)) == ['shard-000', 'shard-001']
+        finally:
+            app.stop()
+
+    def test_exited_shard_answered_with_503_and_partial_bulk_reported_per_shard(self):
+        app = ShardedApp(SHARDS)
+        app.start()
+        try:
+            async def run():
+                await call(app, 'POST', '/ledger/buckets?identifier=test-failed-shard-bucket')
+                await open_loans(app, 1, 2)
+                client = app.clients[get_shard(2, SHARDS)]
+                client.process.kill()
+                client.process.join()
+
+                rows = [{"loan_id": loan_id, **pair_entries('test-failed-shard-bucket', 1.0)[0]} for loan_id in (2, 1)]
+                status, body = await asyncio.wait_for(call(app, 'POST', '/ledger/entries/bulk', rows), 10)
+                assert status == 207
+                shards = {result['shard']: result for result in body['shards']}
+                assert shards[get_shard(1, SHARDS)]['status'] == 200
+                assert shards[get_shard(1, SHARDS)]['rows'] == [1]
+                assert shards[get_shard(1, SHARDS)]['message'] == '"2" ledger entries created successfully'
+                assert shards[get_shard(1, SHARDS)]['created_entries'] == 2
+                assert shards[get_shard(2, SHARDS)]['status'] == 503
+                assert shards[get_shard(2, SHARDS)]['rows'] == [0]
+
+                status, body = await asyncio.wait_for(call(app, 'GET', '/ledger/entries?loan_id=2'), 10)
+                assert status == 503
+                assert body == {'error': 'Shard is unavailable, please retry later'}
+                status, body = await call(app, 'GET', '/ledger/entries?loan_id=1')
+                assert status == 200
+                assert len(body['entries']) == 2
+
+                for url in ('/ledger/cache', '/ledger/loans', '/ledger/trial-balance'):
+                    status, body = await call(app, 'GET', url)
+                    assert status == 503
+                    assert body == {'error': 'Shard is unavailable, please retry later', 'shard': get_shard(2, SHARDS)}
+            asyncio.run(run())
+        finally:
+            app.stop()
+
+    def test_stalled_shard_answered_with_504(self):
+        app = ShardedApp(SHARDS, timeout=60)
+        app.start()
+        try:
+            async def run():
+                await open_loans(app, 1)
+                # Only the stopped shard times out, the other one has all the time it needs to answer
+                stalled_client = app.clients[get_shard(1, SHARDS)]
+                stalled_client.timeout = 0.5
+                pid = stalled_client.process.pid
+                os.kill(pid, signal.SIGSTOP)
+                try:
+                    status, body = await call(app, 'GET', '/ledger/entries?loan_id=1')
+                    assert status == 504
+                    assert body == {'error': 'Shard did not answer in time, please retry later'}
+
+                    status, body = await call(app, 'POST', '/ledger/buckets?identifier=test-stalled-shard-bucket')
+                    assert status == 207
+                    assert body['error'] == 'Bucket was only created on some shards, please retry to create it on the others'
+                    shards = {result['shard']: result for result in body['shards']}
+                    assert shards[get_shard(1, SHARDS)]['status'] == 504
+                    assert shards[1 - get_shard(1, SHARDS)]['status'] == 200
+                finally:
+                    os.kill(pid, signal.SIGCONT)
+                stalled_client.timeout = 60
+                status, _ = await call(app, 'GET', '/ledger/entries?loan_id=1')
+                assert status == 200
+            asyncio.run(run())
+        finally:
+            app.stop()
@@ -0,0 +1,52 @@
+from datetime import date
+import pytest
+
+from ledger.domain.columnar_ledger import ColumnarLedger
+from ledger.domain.ledger import Ledger, LedgerEntry
+from ledger.service_layer.aggregation import get_portfolio_balances
+
+ENTRIES = [
+    LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', 10),
+    LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 1), 'test-credit-bucket', -10),
+    LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 5), 'test-debit-bucket', 7),
+    LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 5), 'test-credit-bucket', -7),
+    LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 9), 'test-debit-bucket', 3),
+    LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 9), 'test-other-bucket', -3),
+]
+
+@pytest.fixture(params=[Ledger, ColumnarLedger])
+def ledger(request):
+    ledger = request.param()
+    ledger.add_new_entries(ENTRIES)
+    return ledger
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+class TestGetPortfolioBalances:
+    def test_balance_matrix_returned_for_every_loan(self, ledger, use_numpy):
+        report = get_portfolio_balances(ledger, ['test-debit-bucket', 'test-credit-bucket', 'test-empty-bucket'], use_numpy=use_numpy)
+
+        assert report['loan_ids'] == [1, 2]
+        assert report['bucket_identifiers'] == ['test-debit-bucket', 'test-credit-bucket', 'test-empty-bucket']
+        assert report['balances'] == [[7, -7, 0], [13, -10, 0]]
+
+    def test_balance_matrix_filtered_by_effective_date(self, ledger, use_numpy):
+        report = get_portfolio_balances(ledger, ['test-debit-bucket'], date(2021, 1, 2), date(2021, 1, 9), use_numpy=use_numpy)
+
+        assert report['loan_ids'] == [1, 2]
+        assert report['balances'] == [[7], [3]]
+
+    def test_empty_ledger_returns_empty_matrix(self, use_numpy):
+        report = get_portfolio_balances(ColumnarLedger(), ['test-debit-bucket'], use_numpy=use_numpy)
+
+        assert report == {'loan_ids': [], 'bucket_identifiers': ['test-debit-bucket'], 'balances': []}
+
+    def test_sums_beyond_int64_not_wrapped(self, use_numpy):
+        ledger = ColumnarLedger()
+        value = 2 ** 63 - 1
+        ledger.add_new_entries([
+            LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', value),
+            LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', value),
+        ])
+        report = get_portfolio_balances(ledger, ['test-debit-bucket'], use_numpy=use_numpy)
+
+        assert report['balances'] == [[2 * value]]
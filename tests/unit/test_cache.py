@@ -0,0 +1,78 @@
+from ledger.service_layer.cache import ReadCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestReadCache:
+    def test_result_computed_once_until_invalidated(self):
+        cache = ReadCache(maximum_size=10, ttl=60)
+        computed = []
+
+        def compute():
+            computed.append(1)
+            return len(computed)
+
+        assert cache.get_or_compute(1, 'key', compute) == 1
+        assert cache.get_or_compute(1, 'key', compute) == 1
+        cache.invalidate([2])
+        assert cache.get_or_compute(1, 'key', compute) == 1
+        cache.invalidate([1])
+        assert cache.get_or_compute(1, 'key', compute) == 2
+
+        stats = cache.get_stats()
+        assert (stats['hits'], stats['misses'], stats['invalidations']) == (2, 2, 1)
+
+    def test_least_recently_used_result_evicted(self):
+        cache = ReadCache(maximum_size=2, ttl=60)
+        for key in ('a', 'b'):
+            cache.get_or_compute(1, key, lambda: key)
+        cache.get_or_compute(1, 'a', lambda: 'recomputed')
+        cache.get_or_compute(2, 'c', lambda: 'c')
+
+        assert cache.get_or_compute(1, 'a', lambda: 'recomputed') == 'a'
+        assert cache.get_or_compute(1, 'b', lambda: 'recomputed') == 'recomputed'
+        assert cache.get_stats()['evictions'] == 2
+
+    def test_expired_result_recomputed(self):
+        clock = FakeClock()
+        cache = ReadCache(maximum_size=10, ttl=5, clock=clock)
+        cache.get_or_compute(1, 'key', lambda: 'old')
+        clock.now = 4.9
+        assert cache.get_or_compute(1, 'key', lambda: 'new') == 'old'
+        clock.now = 5.0
+        assert cache.get_or_compute(1, 'key', lambda: 'new') == 'new'
+        assert cache.get_stats()['expirations'] == 1
+
+    def test_result_computed_during_write_not_cached(self):
+        cache = ReadCache(maximum_size=10, ttl=60)
+
+        def compute_racing_write():
+            # The loan is written to after the read started
+            cache.invalidate([1])
+            return 'stale'
+
+        assert cache.get_or_compute(1, 'key', compute_racing_write) == 'stale'
+        assert cache.get_or_compute(1, 'key', lambda: 'fresh') == 'fresh'
+        assert cache.get_or_compute(1, 'key', lambda: 'recomputed') == 'fresh'
+
+    def test_failed_computation_not_cached(self):
+        cache = ReadCache(maximum_size=10, ttl=60)
+
+        def fail():
+            raise ValueError('failed')
+
+        try:
+            cache.get_or_compute(1, 'key', fail)
+        except ValueError:
+            pass
+        assert cache.get_or_compute(1, 'key', lambda: 'computed') == 'computed'
+
+    def test_zero_size_disables_caching(self):
+        cache = ReadCache(maximum_size=0, ttl=60)
+        results = [cache.get_or_compute(1, 'key', lambda: object()) for _ in range(2)]
+        assert results[0] is not results[1]
+        assert cache.get_stats()['size'] == 0
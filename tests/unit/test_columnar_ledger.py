@@ -0,0 +1,58 @@
+from datetime import date
+import pytest
+
+from ledger.domain.columnar_ledger import ColumnarLedger
+from ledger.domain.ledger import Ledger, LedgerEntry
+
+ENTRIES = [
+    LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 3), 'test-debit-bucket', 10),
+    LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 3), 'test-credit-bucket', -10),
+    LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 2), 'test-debit-bucket', 7),
+    LedgerEntry(1, date(2021, 2, 2), date(2021, 1, 1), 'test-debit-bucket', 5),
+]
+
+@pytest.fixture(params=[Ledger, ColumnarLedger])
+def ledger(request):
+    ledger = request.param()
+    ledger.add_new_entries(ENTRIES[:2])
+    ledger.add_new_entries(ENTRIES[2:])
+    return ledger
+
+class TestColumnarLedgerMatchesLedger:
+    def test_all_entries_materialized_in_insertion_order(self, ledger):
+        assert list(ledger.get_all_entries()) == ENTRIES
+        assert len(ledger.entries) == 4
+        assert ledger.entries[1:3] == ENTRIES[1:3]
+
+    def test_entries_by_loan_and_bucket(self, ledger):
+        assert list(ledger.get_entries_by_loan_id(1)) == [ENTRIES[0], ENTRIES[1], ENTRIES[3]]
+        assert list(ledger.get_entries_by_bucket_identifier('test-debit-bucket')) == [ENTRIES[0], ENTRIES[2], ENTRIES[3]]
+        assert list(ledger.get_entries(1, ['test-debit-bucket'])) == [ENTRIES[0], ENTRIES[3]]
+        assert list(ledger.get_entries(1, ['test-debit-bucket', 'test-credit-bucket'])) == [ENTRIES[0], ENTRIES[1], ENTRIES[3]]
+        assert list(ledger.get_entries(None, ['test-missing-bucket'])) == []
+        assert list(ledger.get_entries_by_loan_id(3)) == []
+
+    def test_entries_by_effective_date(self, ledger):
+        keyed_entries = list(ledger.get_entries_by_effective_date(1))
+        assert [entry for _, entry in keyed_entries] == [ENTRIES[3], ENTRIES[0], ENTRIES[1]]
+
+        after = keyed_entries[1][0]
+        assert [entry for _, entry in ledger.get_entries_by_effective_date(1, after=after)] == [ENTRIES[1]]
+        assert [entry for _, entry in ledger.get_entries_by_effective_date(1, date(2021, 1, 2), date(2021, 1, 2))] == []
+
+    def test_balances(self, ledger):
+        assert ledger.get_balance(1, 'test-debit-bucket').sum == 15
+        assert ledger.get_balance(None, 'test-debit-bucket').sum == 22
+        assert ledger.get_balance_as_of(1, 'test-debit-bucket', date(2021, 1, 2)) == 5
+
+    def test_as_of_balances_beyond_int64_kept_exact(self, ledger):
+        large_value = 2 ** 63 - 1
+        ledger.add_new_entries([
+            LedgerEntry(3, date(2021, 2, 1), date(2021, 1, 2), 'test-debit-bucket', large_value),
+            LedgerEntry(3, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', large_value),
+        ])
+        assert ledger.get_balance_as_of(3, 'test-debit-bucket', date(2021, 1, 2)) == 2 * large_value
+
+        ledger.add_new_entries([LedgerEntry(3, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', large_value)])
+        assert ledger.get_balance_as_of(3, 'test-debit-bucket', date(2021, 1, 1)) == 2 * large_value
+        assert ledger.get_balance_as_of(None, 'test-debit-bucket', date(2021, 1, 3)) == 3 * large_value + 22
@@ -1,38 +1,40 @@
 from datetime import date
+import threading
 import pytest
 
-from ledger.domain.ledger import Ledger, LedgerEntry
+from ledger.domain.ledger import BalanceHistory, Ledger, LedgerEntry
 from ledger.domain.bucket import AccountingBucket
+from ledger.domain.money import InvalidAmount, to_major_units, to_minor_units
 
 class TestCreateAccountingBucket:
     def test_new_bucket_created_for_valid_identifier(self):
         bucket = AccountingBucket.create(identifier='loan-commitment-liability')
 
         assert isinstance(bucket, AccountingBucket)
-        assert bucket.debit == 0.0
-        assert bucket.credit == 0.0
+        assert bucket.debit == 0
+        assert bucket.credit == 0
 
 class TestAccountingBucketAddValue:
     def test_if_value_is_debit_then_debit_amount_incremented(self):
         bucket = AccountingBucket.create(identifier='test-bucket')
-        bucket.add_value(1.0)
+        bucket.add_value(1)
 
-        assert bucket.debit == 1.0
-        assert bucket.credit == 0.0
+        assert bucket.debit == 1
+        assert bucket.credit == 0
 
     def test_if_value_is_credit_then_credit_amount_incremented(self):
         bucket = AccountingBucket.create(identifier='test-bucket')
-        bucket.add_value(-1.0)
+        bucket.add_value(-1)
 
-        assert bucket.debit == 0.0
-        assert bucket.credit == -1.0
+        assert bucket.debit == 0
+        assert bucket.credit == -1
 
     def test_if_value_is_zero_then_no_amount_is_changed(self):
         bucket = AccountingBucket.create(identifier='test-bucket')
-        bucket.add_value(0.0)
+        bucket.add_value(0)
 
-        assert bucket.debit == 0.0
-        assert bucket.credit == 0.0
+        assert bucket.debit == 0
+        assert bucket.credit == 0
 
 class TestGetEntriesLedger:
     def test_if_ledger_empty_no_entries_returned(self):
@@ -43,7 +45,7 @@ class TestGetEntriesLedger:
     def test_if_loan_id_not_found_no_entries_returned(self):
         ledger = Ledger()
         ledger.add_new_entries([
-            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100.0)
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100)
         ])
         ledger_entries = list(ledger.get_entries_by_loan_id(10000))
         assert not ledger_entries
@@ -51,9 +53,240 @@ class TestGetEntriesLedger:
     def test_if_loan_id_found_all_entries_returned(self):
         ledger = Ledger()
         ledger.add_new_entries([
-            LedgerEntry(1, date.today(), 'test-debit-bucket', 100.0, date.today()),
-            LedgerEntry(1, date.today(), 'test-debit-bucket', 100.0, date.today())
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100),
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100)
             ])
 
         ledger_entries = list(ledger.get_entries_by_loan_id(1))
-        assert len(ledger_entries) == 2
\ No newline at end of file
+        assert len(ledger_entries) == 2
+
+class TestLedgerIndexes:
+    def test_entries_indexed_by_bucket_identifier(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100),
+            LedgerEntry(2, date.today(), date.today(), 'test-debit-bucket', 50),
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -100),
+        ])
+
+        ledger_entries = list(ledger.get_entries_by_bucket_identifier('test-debit-bucket'))
+        assert [entry.loan_id for entry in ledger_entries] == [1, 2]
+
+    def test_entries_filtered_by_loan_id_and_bucket_identifier(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100),
+            LedgerEntry(2, date.today(), date.today(), 'test-debit-bucket', 50),
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -100),
+        ])
+
+        ledger_entries = list(ledger.get_entries(1, ['test-debit-bucket']))
+        assert len(ledger_entries) == 1
+        assert ledger_entries[0].value == 100
+
+    def test_entries_for_multiple_identifiers_kept_in_insertion_order(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100),
+            LedgerEntry(1, date.today(), date.today(), 'test-other-bucket', 10),
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -100),
+        ])
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 20),
+        ])
+
+        ledger_entries = list(ledger.get_entries(1, ['test-credit-bucket', 'test-debit-bucket']))
+        assert [entry.value for entry in ledger_entries] == [100, -100, 20]
+
+    def test_identifier_is_not_matched_as_substring(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'cash', 100),
+        ])
+
+        assert not list(ledger.get_entries(1, ['petty-cash']))
+
+class TestLedgerBalances:
+    def test_if_no_entries_then_no_balance_returned(self):
+        ledger = Ledger()
+        assert ledger.get_balance(1, 'test-debit-bucket') is None
+
+    def test_running_totals_kept_per_loan_and_bucket(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-bucket', 100),
+            LedgerEntry(1, date.today(), date.today(), 'test-bucket', -40),
+            LedgerEntry(2, date.today(), date.today(), 'test-bucket', 7),
+        ])
+
+        loan_balance = ledger.get_balance(1, 'test-bucket')
+        assert loan_balance.debit == 100
+        assert loan_balance.credit == -40
+        assert loan_balance.sum == 60
+
+        assert ledger.get_balance(2, 'test-bucket').sum == 7
+        assert ledger.get_balance(None, 'test-bucket').sum == 67
+
+class TestLedgerTrialBalance:
+    def test_totals_kept_per_loan_and_globally(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 100),
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -100),
+            LedgerEntry(2, date.today(), date.today(), 'test-debit-bucket', 7),
+            LedgerEntry(2, date.today(), date.today(), 'test-credit-bucket', -7),
+        ])
+
+        loan_trial_balance = ledger.get_trial_balance(1)
+        assert (loan_trial_balance.debit, loan_trial_balance.credit, loan_trial_balance.entries) == (100, -100, 2)
+        trial_balance = ledger.get_trial_balance(None)
+        assert (trial_balance.debit, trial_balance.credit, trial_balance.entries) == (107, -107, 4)
+        assert trial_balance.is_balanced()
+        assert ledger.get_trial_balance(3).entries == 0
+
+    def test_unbalanced_loans_checked_after_every_batch(self):
+        ledger = Ledger()
+        ledger.add_new_entries([LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 10)])
+        assert ledger.get_unbalanced_loan_ids() == [1]
+
+        ledger.add_new_entries([LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -10)])
+        assert ledger.get_unbalanced_loan_ids() == []
+
+class TestLedgerEffectiveDateIndex:
+    def test_backdated_entries_ordered_by_effective_date(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date(2021, 1, 3), 'test-bucket', 3),
+            LedgerEntry(1, date.today(), date(2021, 1, 1), 'test-bucket', 1),
+            LedgerEntry(1, date.today(), date(2021, 1, 3), 'test-bucket', 4),
+            LedgerEntry(1, date.today(), date(2021, 1, 2), 'test-bucket', 2),
+        ])
+
+        ledger_entries = [entry for _, entry in ledger.get_entries_by_effective_date(1)]
+        assert [entry.value for entry in ledger_entries] == [1, 2, 3, 4]
+
+    def test_entries_filtered_by_effective_date_range(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date(2021, 1, day), 'test-bucket', day)
+            for day in range(1, 11)
+        ])
+
+        ledger_entries = [entry for _, entry in ledger.get_entries_by_effective_date(1, date(2021, 1, 3), date(2021, 1, 5))]
+        assert [entry.value for entry in ledger_entries] == [3, 4, 5]
+
+    def test_entries_after_key_returned(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date(2021, 1, 1), 'test-bucket', 1),
+            LedgerEntry(1, date.today(), date(2021, 1, 1), 'test-bucket', 2),
+        ])
+        first_key, _ = next(ledger.get_entries_by_effective_date(1))
+
+        ledger_entries = [entry for _, entry in ledger.get_entries_by_effective_date(1, after=first_key)]
+        assert [entry.value for entry in ledger_entries] == [2]
+
+class TestBalanceHistory:
+    def test_if_no_values_then_zero_returned(self):
+        history = BalanceHistory()
+        assert history.sum_as_of(date(2021, 1, 1)) == 0
+
+    def test_sum_as_of_includes_values_up_to_date(self):
+        history = BalanceHistory()
+        history.add_value(date(2021, 1, 1), 10)
+        history.add_value(date(2021, 1, 5), 5)
+        history.add_value(date(2021, 1, 5), 1)
+
+        assert history.sum_as_of(date(2020, 12, 31)) == 0
+        assert history.sum_as_of(date(2021, 1, 4)) == 10
+        assert history.sum_as_of(date(2021, 1, 5)) == 16
+
+    def test_backdated_value_updates_later_sums(self):
+        history = BalanceHistory()
+        history.add_value(date(2021, 1, 1), 10)
+        history.add_value(date(2021, 1, 5), 5)
+        history.add_value(date(2021, 1, 3), -2)
+
+        assert list(history.effective_ordinals) == [date(2021, 1, day).toordinal() for day in (1, 3, 5)]
+        assert history.sum_as_of(date(2021, 1, 3)) == 8
+        assert history.sum_as_of(date(2021, 1, 10)) == 13
+
+    def test_values_added_after_a_read_included_in_later_reads(self):
+        history = BalanceHistory()
+        history.add_value(date(2021, 1, 2), 10)
+        history.add_value(date(2021, 1, 4), 5)
+        assert history.sum_as_of(date(2021, 1, 4)) == 15
+
+        history.add_value(date(2021, 1, 3), 1)
+        history.add_value(date(2021, 1, 1), 2)
+        history.add_value(date(2021, 1, 5), 4)
+        assert [history.sum_as_of(date(2021, 1, day)) for day in range(1, 6)] == [2, 12, 13, 18, 22]
+
+    def test_concurrent_reads_of_stale_totals_agree(self):
+        history = BalanceHistory()
+        for day in range(365, 0, -1):
+            history.add_value(date.fromordinal(date(2021, 1, 1).toordinal() + day), day)
+        sums = []
+
+        def read():
+            sums.append(history.sum_as_of(date(2022, 12, 31)))
+
+        readers = [threading.Thread(target=read) for _ in range(8)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+
+        assert sums == [sum(range(1, 366))] * 8
+
+    def test_sums_beyond_int64_kept_exact(self):
+        history = BalanceHistory()
+        history.add_value(date(2021, 1, 1), 2 ** 63 - 1)
+        history.add_value(date(2021, 1, 1), 2 ** 63 - 1)
+        history.add_value(date(2021, 1, 2), -(2 ** 63 - 1))
+
+        assert history.sum_as_of(date(2021, 1, 1)) == 2 ** 64 - 2
+        assert history.sum_as_of(date(2021, 1, 2)) == 2 ** 63 - 1
+
+class TestLedgerBalanceAsOf:
+    def test_balance_as_of_kept_per_loan_and_bucket(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date(2021, 1, 1), 'test-bucket', 10),
+            LedgerEntry(2, date.today(), date(2021, 1, 1), 'test-bucket', 3),
+            LedgerEntry(1, date.today(), date(2021, 6, 30), 'test-bucket', 5),
+        ])
+
+        assert ledger.get_balance_as_of(1, 'test-bucket', date(2021, 6, 29)) == 10
+        assert ledger.get_balance_as_of(1, 'test-bucket', date(2021, 6, 30)) == 15
+        assert ledger.get_balance_as_of(None, 'test-bucket', date(2021, 6, 29)) == 13
+        assert ledger.get_balance_as_of(1, 'test-missing-bucket', date(2021, 6, 30)) == 0
+
+class TestMoney:
+    def test_amount_converted_to_exact_minor_units(self):
+        assert to_minor_units(0.241095) == 241095
+        assert to_minor_units(-1100.0) == -1100000000
+        assert to_major_units(to_minor_units(0.1)) == 0.1
+
+    def test_minor_units_sum_exactly(self):
+        bucket = AccountingBucket.create('test-bucket')
+        for _ in range(10):
+            bucket.add_value(to_minor_units(0.1))
+
+        assert sum([0.1] * 10) != 1.0
+        assert to_major_units(bucket.sum) == 1.0
+
+    def test_if_too_many_decimal_places_then_error_raised(self):
+        with pytest.raises(InvalidAmount):
+            _ = to_minor_units(0.0000001)
+
+    def test_if_amount_too_large_then_error_raised(self):
+        with pytest.raises(InvalidAmount):
+            _ = to_minor_units(1e20)
+        with pytest.raises(InvalidAmount):
+            _ = to_minor_units(1e308)
+
+    @pytest.mark.parametrize('value', [float('inf'), float('-inf'), float('nan')])
+    def test_if_amount_not_finite_then_error_raised(self, value):
+        with pytest.raises(InvalidAmount, match='finite'):
+            _ = to_minor_units(value)
@@ -0,0 +1,77 @@
+import threading
+
+import pytest
+
+from ledger.service_layer.idempotency import (IdempotencyKeyReused, IdempotencyStore, get_fingerprint)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestIdempotencyStore:
+    def test_handled_request_replayed_until_key_reused(self):
+        store = IdempotencyStore(maximum_size=10, ttl=60)
+        fingerprint = get_fingerprint(b'/ledger/entries', b'loan_id=1', b'[]')
+        request, is_new = store.begin('key', fingerprint)
+        assert is_new
+        store.complete('key', request, ({'message': 'created'}, 200))
+
+        replayed, is_new = store.begin('key', fingerprint)
+        assert not is_new
+        assert replayed.wait() == ({'message': 'created'}, 200)
+        with pytest.raises(IdempotencyKeyReused):
+            store.begin('key', get_fingerprint(b'/ledger/entries', b'loan_id=2', b'[]'))
+        assert store.get_stats()['replays'] == 1
+
+    def test_failed_request_releases_key(self):
+        store = IdempotencyStore(maximum_size=10, ttl=60)
+        request, _ = store.begin('key', 'fingerprint')
+        store.complete('key', request, None)
+        assert request.wait() is None
+        assert store.begin('key', 'other-fingerprint')[1]
+
+    def test_duplicate_in_flight_waits_for_response(self):
+        store = IdempotencyStore(maximum_size=10, ttl=60)
+        request, _ = store.begin('key', 'fingerprint')
+        duplicate, is_new = store.begin('key', 'fingerprint')
+        assert duplicate is request and not is_new
+
+        responses = []
+        waiter = threading.Thread(target=lambda: responses.append(duplicate.wait()))
+        waiter.start()
+        store.complete('key', request, ({}, 200))
+        waiter.join()
+        assert responses == [({}, 200)]
+
+    def test_handled_requests_expire_and_evicted_but_not_in_flight(self):
+        clock = FakeClock()
+        store = IdempotencyStore(maximum_size=2, ttl=5, clock=clock)
+        in_flight, _ = store.begin('in-flight', 'fingerprint')
+        for key in ('a', 'b'):
+            request, _ = store.begin(key, 'fingerprint')
+            store.complete(key, request, ({}, 200))
+
+        # Only the oldest handled request makes room for b
+        assert store.get_stats()['evictions'] == 1
+        assert not store.begin('in-flight', 'fingerprint')[1]
+        assert not store.begin('b', 'fingerprint')[1]
+
+        clock.now = 5.0
+        assert store.begin('b', 'fingerprint')[1]
+        assert store.get_stats()['expirations'] == 1
+
+    def test_requests_evicted_in_the_order_they_were_handled(self):
+        store = IdempotencyStore(maximum_size=3, ttl=5)
+        first, _ = store.begin('first', 'fingerprint')
+        second, _ = store.begin('second', 'fingerprint')
+        store.complete('second', second, ({}, 200))
+        store.complete('first', first, ({}, 200))
+        store.begin('third', 'fingerprint')
+        store.begin('fourth', 'fingerprint')
+
+        # Begun first but handled last, so kept over second
+        assert list(store.requests) == ['first']
+        assert store.get_stats() == {'size': 3, 'maximum_size': 3, 'replays': 0, 'evictions': 1, 'expirations': 0}
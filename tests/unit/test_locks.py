@@ -0,0 +1,62 @@
+import threading
+import time
+
+from ledger.locks import ReadWriteLock
+
+class TestReadWriteLock:
+    def test_readers_share_the_lock(self):
+        lock = ReadWriteLock()
+        acquired = threading.Event()
+
+        def read():
+            with lock.read():
+                acquired.set()
+
+        with lock.read():
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(1)
+
+            assert acquired.is_set()
+
+    def test_writer_waits_for_readers(self):
+        lock = ReadWriteLock()
+        events = []
+
+        def write():
+            with lock.write():
+                events.append('write')
+
+        with lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.05)
+            events.append('read')
+        writer.join(1)
+
+        assert events == ['read', 'write']
+
+    def test_waiting_writer_blocks_new_readers(self):
+        lock = ReadWriteLock()
+        events = []
+
+        def write():
+            with lock:
+                events.append('write')
+
+        def read():
+            with lock.read():
+                events.append('second read')
+
+        with lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.05)
+            reader = threading.Thread(target=read)
+            reader.start()
+            time.sleep(0.05)
+            events.append('first read')
+        writer.join(1)
+        reader.join(1)
+
+        assert events == ['first read', 'write', 'second read']
@@ -0,0 +1,139 @@
+import pytest
+
+from ledger import metrics
+
+def double(value: int) -> int:
+    return value * 2
+
+class TestMetrics:
+    def test_disabled_decorators_return_function_itself(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', False)
+        histogram = metrics.Histogram('test_seconds', 'Test durations', ('function',))
+        assert metrics.timed(histogram, 'double')(double) is double
+        assert metrics.timed_append(double) is double
+        assert metrics.timed_serialization(double) is double
+
+    def test_enabled_decorator_observes_every_call(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        histogram = metrics.Histogram('test_seconds', 'Test durations', ('function',), buckets=(0.5, 1000.0))
+        timed_double = metrics.timed(histogram, 'double')(double)
+
+        assert [timed_double(value) for value in range(3)] == [0, 2, 4]
+        lines = histogram.render()
+        assert lines[:2] == ['# HELP test_seconds Test durations', '# TYPE test_seconds histogram']
+        assert 'test_seconds_bucket{function="double",le="1000"} 3' in lines
+        assert 'test_seconds_bucket{function="double",le="+Inf"} 3' in lines
+        assert 'test_seconds_count{function="double"} 3' in lines
+
+    def test_sampled_decorator_counts_each_sample_for_every_call_of_its_interval(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        histogram = metrics.Histogram('test_seconds', 'Test durations', ('function',), buckets=(1000.0,), sample_interval=3)
+        timed_double = metrics.timed(histogram, 'double')(double)
+
+        assert [timed_double(value) for value in range(7)] == [0, 2, 4, 6, 8, 10, 12]
+        child = histogram.labels('double')
+        child.fold()
+        # The 3rd and the 6th call are timed
+        assert child.counts == [6, 0]
+        assert 'test_seconds_count{function="double"} 6' in histogram.render()
+
+    def test_timed_append_records_every_batch_size_and_samples_durations(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        monkeypatch.setattr(metrics, 'PHASE_SECONDS', metrics.Histogram('test_seconds', 'Test durations', ('phase',), sample_interval=2))
+        monkeypatch.setattr(metrics, 'BATCH_ENTRIES', metrics.Histogram('test_entries', 'Test entries', buckets=metrics.SIZE_BUCKETS))
+
+        def add(repository, entries):
+            return entries
+
+        timed_add = metrics.timed_append(add)
+        assert [len(timed_add(None, [1] * size)) for size in (1, 2, 3)] == [1, 2, 3]
+        assert 'test_entries_count 3' in metrics.BATCH_ENTRIES.render()
+        assert 'test_entries_sum 6.0' in metrics.BATCH_ENTRIES.render()
+        assert 'test_seconds_count{phase="ledger_append"} 2' in metrics.PHASE_SECONDS.render()
+
+    def test_sampled_wrapper_passes_arguments_through(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        histogram = metrics.Histogram('test_seconds', 'Test durations', ('function',), sample_interval=2)
+
+        def scale(value, /, factor=2, *values, offset=0, **fields):
+            return value * factor + offset + sum(values) + len(fields)
+
+        timed_scale = metrics.timed(histogram, 'scale')(scale)
+        assert [timed_scale(1), timed_scale(1, 3), timed_scale(1, 3, 4, 5, offset=1, name='test')] == [2, 3, 14]
+        assert timed_scale.__wrapped__ is scale
+        with pytest.raises(TypeError):
+            timed_scale(value=1)
+
+    def test_timed_serialization_counts_entries_of_any_listing(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        monkeypatch.setattr(metrics, 'RESPONSE_ENTRIES', metrics.Histogram('test_entries', 'Test entries', buckets=metrics.SIZE_BUCKETS))
+
+        def dumps_changes(serializer, changes, **fields):
+            return list(changes), fields
+
+        timed_dumps = metrics.timed_serialization(dumps_changes)
+        assert timed_dumps(None, iter([1, 2]), last_sequence=2) == ([1, 2], {'last_sequence': 2})
+        assert 'test_entries_sum 2.0' in metrics.RESPONSE_ENTRIES.render()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_sizes', 'Test sizes', buckets=(1, 4))
+        for value in (1, 2, 4, 5):
+            histogram.labels().observe(value)
+        assert histogram.render()[2:] == [
+            'test_sizes_bucket{le="1"} 1',
+            'test_sizes_bucket{le="4"} 3',
+            'test_sizes_bucket{le="+Inf"} 4',
+            'test_sizes_sum 12.0',
+            'test_sizes_count 4',
+        ]
+
+    def test_gauge_read_when_rendered(self):
+        entries = [1, 2]
+        registry = metrics.Registry()
+        registry.register(metrics.Gauge('test_entries', 'Test entries', lambda: len(entries)))
+        entries.append(3)
+        assert registry.render().splitlines() == [
+            '# HELP test_entries Test entries',
+            '# TYPE test_entries gauge',
+            'test_entries 3',
+        ]
+
+    def test_timed_view_labels_returned_status(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        monkeypatch.setattr(metrics, 'HTTP_REQUESTS', metrics.Counter('test_requests', 'Test requests', ('route', 'method', 'status')))
+        monkeypatch.setattr(metrics, 'HTTP_SECONDS', metrics.Histogram('test_seconds', 'Test durations', ('route', 'method', 'status')))
+
+        def view():
+            return 'Not found', 404
+
+        def failing_view():
+            raise RuntimeError('Failed')
+
+        assert metrics.timed_view(view, '/test', 'GET')() == ('Not found', 404)
+        with pytest.raises(RuntimeError):
+            metrics.timed_view(failing_view, '/test', 'POST')()
+        lines = metrics.HTTP_REQUESTS.render() + metrics.HTTP_SECONDS.render()
+        assert 'test_requests{route="/test",method="GET",status="404"} 1' in lines
+        assert 'test_requests{route="/test",method="POST",status="500"} 1' in lines
+        assert 'test_seconds_count{route="/test",method="GET",status="404"} 1' in lines
+        assert 'test_seconds_count{route="/test",method="POST",status="500"} 1' in lines
+
+    def test_timed_view_counts_every_request_and_samples_durations(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'ENABLED', True)
+        monkeypatch.setattr(metrics, 'HTTP_REQUESTS', metrics.Counter('test_requests', 'Test requests', ('route', 'method', 'status')))
+        monkeypatch.setattr(metrics, 'HTTP_SECONDS', metrics.Histogram('test_seconds', 'Test durations', ('route', 'method', 'status'), sample_interval=3))
+
+        view = metrics.timed_view(lambda: ('Found', 200), '/test', 'GET')
+        for _ in range(5):
+            view()
+        lines = metrics.HTTP_REQUESTS.render() + metrics.HTTP_SECONDS.render()
+        # The first and the fourth requests are timed, each counting for 3
+        assert 'test_requests{route="/test",method="GET",status="200"} 5' in lines
+        assert 'test_seconds_count{route="/test",method="GET",status="200"} 6' in lines
+
+    def test_queued_observations_folded_into_buckets(self, monkeypatch):
+        monkeypatch.setattr(metrics, 'PENDING_OBSERVATIONS', 2)
+        child = metrics.Histogram('test_sizes', 'Test sizes', buckets=(1, 4)).labels()
+        for value in (1, 2, 5):
+            child.observe(value)
+        assert (child.counts, len(child.pending)) == ([1, 1, 0], 1)
@@ -0,0 +1,362 @@
+import os
+import threading
+import time
+from datetime import date
+import pytest
+
+from ledger.adapters import snapshot
+from ledger.adapters import wal as write_ahead_log
+from ledger.adapters.feed import ChangeFeed
+from ledger.adapters.repository import (BucketRepository, LedgerRepository, LoanRepository, recover)
+from ledger.adapters.snapshot import (Snapshotter, find_latest_snapshot, read_snapshot, write_snapshot)
+from ledger.adapters.wal import (FSYNC_INTERVAL, FSYNC_NEVER, WriteAheadLog)
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import (InvalidEntry, LedgerEntry)
+from ledger.domain.loan import Loan
+
+class TestBucketRepository:
+    def test_added_bucket_keyed_by_identifier(self):
+        bucket_repo = BucketRepository()
+        test_bucket = AccountingBucket.create('test-bucket-name')
+        bucket_repo.add(test_bucket)
+
+        assert bucket_repo.get()['test-bucket-name'] is test_bucket
+        assert 'other-test-bucket-name' not in bucket_repo.get()
+
+    def test_duplicate_bucket_not_added(self):
+        bucket_repo = BucketRepository()
+        test_bucket = AccountingBucket.create('test-bucket-name')
+        assert bucket_repo.add(test_bucket)
+
+        assert not bucket_repo.add(AccountingBucket.create('test-bucket-name'))
+        assert bucket_repo.get()['test-bucket-name'] is test_bucket
+
+    def test_log_synced_after_lock_released(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        loan_repo = LoanRepository(LedgerRepository(wal), wal)
+        commit = wal.commit
+        locked_commits = []
+
+        def commit_checking_locks(record_number):
+            # A sync publishes entries under the ledger lock, which must not be taken while holding a repository lock
+            locked_commits.append(bucket_repo.lock.locked() or loan_repo.lock.locked())
+            commit(record_number)
+
+        wal.commit = commit_checking_locks
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        loan_repo.add(Loan.create(1))
+        loan_repo.close(loan_repo.get()[1])
+        wal.close()
+
+        assert locked_commits == [False, False, False]
+
+class TestChangeFeed:
+    def test_entries_numbered_in_order_added(self):
+        ledger_repo = LedgerRepository(feed=ChangeFeed(3))
+        for value in (1, 2):
+            ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', value)] * 2)
+
+        assert ledger_repo.feed.last_sequence == ledger_repo.get().count_entries() == 4
+        assert [entry.value for entry in ledger_repo.feed.get_entries(1, 4)] == [1, 2, 2]
+        # The oldest entry is no longer buffered
+        assert ledger_repo.feed.get_entries(0, 4) is None
+
+    def test_waiting_consumer_woken_by_publish(self):
+        feed = ChangeFeed()
+        assert not feed.wait(0, 0.01)
+
+        timer = threading.Timer(0.05, feed.publish, ([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', 1)], 1))
+        timer.start()
+        assert feed.wait(0, 5.0)
+        timer.join()
+        assert not feed.listeners
+
+    def test_entries_published_once_synced(self, tmp_path, monkeypatch):
+        wal = WriteAheadLog(str(tmp_path))
+        ledger_repo = LedgerRepository(wal)
+        published_at_fsync = []
+        fsync = os.fsync
+
+        def record_published(descriptor):
+            published_at_fsync.append(ledger_repo.feed.last_sequence)
+            fsync(descriptor)
+
+        monkeypatch.setattr('ledger.adapters.wal.os.fsync', record_published)
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', 1)] * 2)
+        assert published_at_fsync == [0]
+        assert ledger_repo.feed.last_sequence == 2
+        wal.close()
+
+    def test_entries_published_by_flusher_under_interval_policy(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path), FSYNC_INTERVAL, fsync_interval=60.0)
+        ledger_repo = LedgerRepository(wal)
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', 1)] * 2)
+        assert ledger_repo.get().count_entries() == 2
+        assert ledger_repo.feed.last_sequence == 0
+
+        wal.sync()
+        assert ledger_repo.feed.last_sequence == 2
+        assert [entry.value for entry in ledger_repo.feed.get_entries(0, 2)] == [1, 1]
+        wal.close()
+
+class TestWriteAheadLog:
+    def test_if_unknown_fsync_policy_then_error_raised(self, tmp_path):
+        with pytest.raises(ValueError):
+            _ = WriteAheadLog(str(tmp_path), 'test-policy')
+
+    def test_appended_records_read_back_in_order(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path), FSYNC_NEVER)
+        wal.append_bucket('test-bucket')
+        wal.append_entries([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 2), 'test-bucket', 150)])
+        wal.close()
+
+        records = list(WriteAheadLog(str(tmp_path)).read_records())
+        assert records == [
+            {'op': 'bucket', 'identifier': 'test-bucket'},
+            {'op': 'entries', 'entries': [[1, date(2021, 1, 1).toordinal(), date(2021, 1, 2).toordinal(), 'test-bucket', 150]]},
+        ]
+
+    def test_torn_record_dropped_on_open(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        wal.append_bucket('test-bucket')
+        wal.close()
+        with open(wal.get_segment_path(1), 'ab') as segment:
+            segment.write(b'{"op":"bucket","ident')
+
+        wal = WriteAheadLog(str(tmp_path))
+        wal.append_bucket('other-test-bucket')
+        wal.close()
+
+        identifiers = [record['identifier'] for record in WriteAheadLog(str(tmp_path)).read_records()]
+        assert identifiers == ['test-bucket', 'other-test-bucket']
+
+    def test_directory_synced_when_segment_created(self, tmp_path, monkeypatch):
+        synced_directories = []
+        monkeypatch.setattr(write_ahead_log, 'sync_directory', synced_directories.append)
+        wal = WriteAheadLog(str(tmp_path))
+        wal.rotate()
+        wal.close()
+        assert synced_directories == [str(tmp_path)] * 2
+
+        # Reopening the last segment creates nothing
+        WriteAheadLog(str(tmp_path)).close()
+        assert len(synced_directories) == 2
+
+    def test_interval_policy_syncs_pending_records_on_close(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path), FSYNC_INTERVAL, fsync_interval=60.0)
+        wal.append_bucket('test-bucket')
+        wal.append_bucket('other-test-bucket')
+        assert wal.synced_records == 0
+
+        wal.close()
+        assert wal.synced_records == 2
+
+    def test_interval_policy_syncs_pending_records_once_writes_stop(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path), FSYNC_INTERVAL, fsync_interval=0.01)
+        wal.append_bucket('test-bucket')
+        wal.append_bucket('other-test-bucket')
+
+        deadline = time.monotonic() + 5
+        while wal.synced_records < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert wal.synced_records == 2
+        wal.close()
+        assert not wal.flusher.is_alive()
+
+class TestRecover:
+    def test_recover_rebuilds_ledger_and_bucket_totals(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal)
+        bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+        bucket_repo.add(AccountingBucket.create('test-credit-bucket'))
+        ledger_repo.add([
+            LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-debit-bucket', 10),
+            LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-credit-bucket', -10),
+        ])
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        recovered_bucket_repo = BucketRepository(wal)
+        recovered_ledger_repo = LedgerRepository(wal)
+        recover(wal, recovered_ledger_repo, recovered_bucket_repo)
+
+        assert recovered_bucket_repo.get()['test-debit-bucket'].debit == 10
+        assert recovered_bucket_repo.get()['test-credit-bucket'].credit == -10
+        assert len(list(recovered_ledger_repo.get().get_entries_by_loan_id(1))) == 2
+        assert recovered_ledger_repo.get().get_balance(1, 'test-credit-bucket').sum == -10
+        assert len(list(wal.read_records())) == 3
+
+    @pytest.mark.parametrize('columnar', [False, True])
+    def test_totals_beyond_int64_added_and_recovered(self, tmp_path, columnar):
+        value = 9 * 10 ** 18
+        batch = [
+            LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-debit-bucket', value),
+            LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-credit-bucket', -value),
+        ]
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal, columnar)
+        bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+        bucket_repo.add(AccountingBucket.create('test-credit-bucket'))
+        ledger_repo.add(batch, bucket_repo.get())
+        ledger_repo.add(batch, bucket_repo.get())
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        recovered_bucket_repo = BucketRepository(wal)
+        recovered_ledger_repo = LedgerRepository(wal, columnar)
+        recover(wal, recovered_ledger_repo, recovered_bucket_repo)
+
+        for repo, buckets in ((ledger_repo, bucket_repo.get()), (recovered_ledger_repo, recovered_bucket_repo.get())):
+            ledger = repo.get()
+            assert ledger.count_entries() == repo.feed.last_sequence == 4
+            assert buckets['test-debit-bucket'].sum == 2 * value
+            assert ledger.get_balance_as_of(1, 'test-debit-bucket', date(2021, 1, 1)) == 2 * value
+            assert ledger.get_balance_as_of(None, 'test-credit-bucket', date(2021, 1, 1)) == -2 * value
+            assert ledger.get_trial_balance(1).debit == 2 * value
+            assert ledger.get_trial_balance(None).is_balanced()
+
+    def test_batch_which_cannot_be_stored_rejected_before_logging(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal, columnar=True)
+        bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+        with pytest.raises(InvalidEntry):
+            ledger_repo.add([
+                LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-debit-bucket', 10),
+                LedgerEntry(2 ** 63, date(2021, 1, 1), date(2021, 1, 1), 'test-debit-bucket', 10),
+            ], bucket_repo.get())
+
+        assert ledger_repo.get().count_entries() == ledger_repo.feed.last_sequence == 0
+        assert bucket_repo.get()['test-debit-bucket'].sum == 0
+        assert len(list(wal.read_records())) == 1
+
+class TestSnapshot:
+    def test_written_snapshot_read_back(self, tmp_path):
+        entries = [
+            LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 2), 'test-debit-bucket', 1050),
+            LedgerEntry(2, date(2021, 1, 1), date(2020, 12, 31), 'test-credit-bucket', -1050),
+        ]
+        path = str(tmp_path / 'snapshot-000001.bin')
+        write_snapshot(path, 1, ['test-debit-bucket', 'test-credit-bucket', 'test-empty-bucket'], entries)
+
+        segment_number, bucket_identifiers, snapshot_entries, loan_statuses = read_snapshot(path)
+        assert segment_number == 1
+        assert bucket_identifiers == ['test-debit-bucket', 'test-credit-bucket', 'test-empty-bucket']
+        assert snapshot_entries == entries
+        assert loan_statuses == []
+
+    def test_snapshot_directory_synced_before_segments_removed(self, tmp_path, monkeypatch):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        calls = []
+        remove_segments = wal.remove_segments
+
+        def remove_recorded_segments(segment_number):
+            calls.append('remove_segments')
+            remove_segments(segment_number)
+
+        monkeypatch.setattr(write_ahead_log, 'sync_directory', lambda directory: calls.append('sync_directory'))
+        wal.remove_segments = remove_recorded_segments
+        Snapshotter(wal, LedgerRepository(wal), bucket_repo, 60.0).take_snapshot()
+        wal.close()
+
+        # The segment created by the rotation, then the renamed snapshot
+        assert calls == ['sync_directory', 'sync_directory', 'remove_segments']
+
+    def test_snapshot_drops_covered_segments_and_recover_replays_tail(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal)
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', 10)])
+
+        snapshotter = Snapshotter(wal, ledger_repo, bucket_repo, interval=60.0)
+        path = snapshotter.take_snapshot()
+        assert find_latest_snapshot(str(tmp_path)) == path
+        assert wal.get_segment_numbers() == [2]
+
+        bucket_repo.add(AccountingBucket.create('other-test-bucket'))
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'other-test-bucket', 5)])
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        recovered_bucket_repo = BucketRepository(wal)
+        recovered_ledger_repo = LedgerRepository(wal)
+        recover(wal, recovered_ledger_repo, recovered_bucket_repo)
+
+        assert recovered_bucket_repo.get()['test-bucket'].debit == 10
+        assert recovered_bucket_repo.get()['other-test-bucket'].debit == 5
+        assert [entry.value for entry in recovered_ledger_repo.get().get_entries_by_loan_id(1)] == [10, 5]
+
+    def test_snapshot_skipped_when_nothing_logged_since_previous(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal)
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        snapshotter = Snapshotter(wal, ledger_repo, bucket_repo, interval=60.0)
+
+        path = snapshotter.take_snapshot()
+        assert snapshotter.take_snapshot() is None
+        assert find_latest_snapshot(str(tmp_path)) == path
+        assert wal.get_segment_numbers() == [2]
+
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 1), 'test-bucket', 10)])
+        assert snapshotter.take_snapshot() != path
+
+    def test_failed_snapshot_retried_on_next_interval(self, tmp_path, monkeypatch):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal)
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        failures = []
+
+        def fail_once(*args):
+            if not failures:
+                failures.append(args)
+                raise OSError('No space left on device')
+            return write_snapshot(*args)
+
+        monkeypatch.setattr(snapshot, 'write_snapshot', fail_once)
+        snapshotter = Snapshotter(wal, ledger_repo, bucket_repo, interval=0.01)
+        snapshotter.start()
+        deadline = time.monotonic() + 5
+        while find_latest_snapshot(str(tmp_path)) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        snapshotter.stop()
+
+        assert failures
+        assert find_latest_snapshot(str(tmp_path)) is not None
+
+    def test_recover_restores_loan_statuses_and_summaries(self, tmp_path):
+        wal = WriteAheadLog(str(tmp_path))
+        bucket_repo = BucketRepository(wal)
+        ledger_repo = LedgerRepository(wal)
+        loan_repo = LoanRepository(ledger_repo, wal)
+        bucket_repo.add(AccountingBucket.create('test-bucket'))
+        # Loan 1 has entries written before loans were registered
+        ledger_repo.add([LedgerEntry(1, date(2021, 1, 1), date(2021, 1, 2), 'test-bucket', 10)])
+        loan_repo.add(Loan.create(2))
+        Snapshotter(wal, ledger_repo, bucket_repo, 60.0, loan_repo).take_snapshot()
+
+        loan_repo.add(Loan.create(3))
+        ledger_repo.add([LedgerEntry(3, date(2021, 1, 1), date(2021, 1, 5), 'test-bucket', 5)], loans=loan_repo.get())
+        loan_repo.close(loan_repo.get()[2])
+        wal.close()
+
+        wal = WriteAheadLog(str(tmp_path))
+        recovered_ledger_repo = LedgerRepository(wal)
+        recovered_loan_repo = LoanRepository(recovered_ledger_repo, wal)
+        recover(wal, recovered_ledger_repo, BucketRepository(wal), recovered_loan_repo)
+
+        loans = recovered_loan_repo.get()
+        assert {loan_id: (loan.status, loan.entry_count) for loan_id, loan in loans.items()} == {1: ('open', 1), 2: ('closed', 0), 3: ('open', 1)}
+        assert loans[1].last_effective_date == date(2021, 1, 2)
+        assert [entry.value for entry in loans[3].entries] == [5]
+        # Recovered entries are read back from the ledger, new ones numbered after them
+        assert recovered_ledger_repo.feed.get_entries(0, 2) is None
+        recovered_ledger_repo.add([LedgerEntry(3, date(2021, 1, 1), date(2021, 1, 6), 'test-bucket', 6)])
+        assert recovered_ledger_repo.feed.last_sequence == 3
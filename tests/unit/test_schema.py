@@ -0,0 +1,85 @@
+from datetime import date
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from ledger.domain.money import to_minor_units
+from ledger.service_layer.schema import (
+    PairEntry, Posting, SchemaError, parse_pair_entries, validate_bucket_query, validate_bulk_pair_entry, validate_buckets_sum_query,
+    validate_changes_query, validate_entries_query, validate_loans_query,
+)
+
+class TestPairEntriesSchema:
+    def test_pair_entries_parsed_into_typed_entries(self):
+        pair_entries = parse_pair_entries([
+            {"effective_date": "2021-01-21", "debit": {"identifier": "test-debit-bucket", "value": 1.5}, "credit": {"identifier": "test-credit-bucket", "value": -1.5}},
+            {"debit": {"identifier": "test-debit-bucket", "value": 0.25}, "credit": {"identifier": "test-credit-bucket", "value": -0.25}},
+        ])
+        assert pair_entries == [
+            PairEntry(date(2021, 1, 21), Posting('test-debit-bucket', to_minor_units(1.5)), Posting('test-credit-bucket', to_minor_units(-1.5))),
+            PairEntry(None, Posting('test-debit-bucket', to_minor_units(0.25)), Posting('test-credit-bucket', to_minor_units(-0.25))),
+        ]
+
+    @pytest.mark.parametrize('body, path, message', [
+        ({}, '', 'list of pair entries'),
+        ([None], '[0]', 'debit and credit objects'),
+        ([{"debit": {"identifier": "a", "value": 1.0}, "credit": []}], '[0].credit', 'debit and credit objects'),
+        ([{"debit": {"identifier": "a", "value": 1.0}, "credit": {"identifier": "b", "value": -1.0}}, {"debit": {"identifier": "a", "value": 1}}], '[1].debit.value', 'floating point'),
+        ([{"debit": {"identifier": 7, "value": 1.0}}], '[0].debit.identifier', 'bucket identifier'),
+        ([{"effective_date": "2021-13-01"}], '[0].effective_date', 'YYYY-MM-DD'),
+        ([{"debit": {"identifier": "a", "value": 0.0000001}}], '[0].debit.value', 'decimal places'),
+    ])
+    def test_first_mismatch_reported_with_its_path(self, body, path, message):
+        with pytest.raises(SchemaError) as error:
+            parse_pair_entries(body)
+        assert error.value.path == path
+        assert message in str(error.value)
+
+    def test_bulk_row_requires_integer_loan_id(self):
+        row = {"loan_id": 3, "debit": {"identifier": "a", "value": 1.0}, "credit": {"identifier": "b", "value": -1.0}}
+        assert validate_bulk_pair_entry(row).loan_id == 3
+        for loan_id in (None, True, 0, '3'):
+            with pytest.raises(SchemaError) as error:
+                validate_bulk_pair_entry(dict(row, loan_id=loan_id))
+            assert error.value.path == 'loan_id'
+
+class TestQuerySchemas:
+    def test_query_parsed_into_typed_parameters(self):
+        query = validate_buckets_sum_query(MultiDict([('loan_id', '7'), ('bucket_id', 'a'), ('bucket_id', 'b'), ('as_of', '2021-01-21'), ('consistency_check', 'true')]).getlist)
+        assert tuple(query) == (7, ['a', 'b'], date(2021, 1, 21), True)
+        assert tuple(validate_buckets_sum_query(MultiDict([('loan_id', '7'), ('bucket_id', 'a')]).getlist)) == (7, ['a'], None, None)
+
+    @pytest.mark.parametrize('parameters, path', [
+        ([('bucket_id', 'a')], 'loan_id'),
+        ([('loan_id', '0'), ('bucket_id', 'a')], 'loan_id'),
+        ([('loan_id', 'test-loan-id'), ('bucket_id', 'a')], 'loan_id'),
+        ([('loan_id', '7')], 'bucket_id'),
+        ([('loan_id', '7'), ('bucket_id', 'a'), ('as_of', 'test-date')], 'as_of'),
+    ])
+    def test_invalid_parameter_reported_by_name(self, parameters, path):
+        with pytest.raises(SchemaError) as error:
+            validate_buckets_sum_query(MultiDict(parameters).getlist)
+        assert error.value.path == path
+
+    def test_empty_identifier_rejected(self):
+        with pytest.raises(SchemaError):
+            validate_bucket_query(MultiDict([('identifier', '')]).getlist)
+        assert validate_bucket_query(MultiDict([('identifier', 'test-bucket')]).getlist).identifier == 'test-bucket'
+
+    def test_missing_parameters_take_their_default(self):
+        assert tuple(validate_changes_query(MultiDict().getlist)) == (None, 0, None, 0.0, [])
+        assert tuple(validate_changes_query(MultiDict([('loan_id', '7'), ('after', '3'), ('limit', '10'), ('wait', '1.5'), ('bucket_id', 'a')]).getlist)) == (7, 3, 10, 1.5, ['a'])
+        assert tuple(validate_entries_query(MultiDict([('loan_id', '7'), ('effective_from', '2021-01-21')]).getlist)) == (7, None, None, date(2021, 1, 21), None, None, None)
+
+    @pytest.mark.parametrize('validate, parameters, path', [
+        (validate_changes_query, [('after', '-1')], 'after'),
+        (validate_changes_query, [('wait', 'nan')], 'wait'),
+        (validate_changes_query, [('loan_id', 'test-loan-id')], 'loan_id'),
+        (validate_entries_query, [('loan_id', '7'), ('limit', '0')], 'limit'),
+        (validate_entries_query, [('loan_id', '7'), ('created_to', 'test-date')], 'created_to'),
+        (validate_loans_query, [('status', 'test-status')], 'status'),
+    ])
+    def test_invalid_route_parameter_reported_by_name(self, validate, parameters, path):
+        with pytest.raises(SchemaError) as error:
+            validate(MultiDict(parameters).getlist)
+        assert error.value.path == path
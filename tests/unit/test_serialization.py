@@ -0,0 +1,56 @@
+import json
+from datetime import date
+
+import pytest
+
+from ledger.domain.ledger import LedgerEntry
+from ledger.domain.money import to_minor_units
+from ledger.entrypoints.serialization import (SERIALIZERS, InvalidSerializer, create_serializer, generate_ndjson, orjson)
+
+ENTRIES = [
+    LedgerEntry(1, date(2021, 1, 22), date(2021, 1, 21), 'test-bucket', to_minor_units(12.5)),
+    LedgerEntry(2, date(2021, 1, 22), date(2020, 12, 31), 'test-"quoted"-bucket', to_minor_units(-0.1)),
+]
+EXPECTED_ENTRIES = [
+    {'loan_id': 1, 'created_at': '2021-01-22', 'effective_date': '2021-01-21', 'bucket_identifier': 'test-bucket', 'value': 12.5},
+    {'loan_id': 2, 'created_at': '2021-01-22', 'effective_date': '2020-12-31', 'bucket_identifier': 'test-"quoted"-bucket', 'value': -0.1},
+]
+# orjson is optional
+AVAILABLE_SERIALIZERS = [name for name in SERIALIZERS if name != 'orjson' or orjson is not None]
+
+class TestSerializers:
+    @pytest.mark.parametrize('name', AVAILABLE_SERIALIZERS)
+    def test_entries_encoded_with_iso_dates_and_major_units(self, name):
+        serializer = create_serializer(name)
+        assert json.loads(serializer.dumps_entries(ENTRIES)) == {'entries': EXPECTED_ENTRIES}
+        assert json.loads(serializer.dumps_entries([], next_cursor=None)) == {'entries': [], 'next_cursor': None}
+
+    @pytest.mark.parametrize('name', AVAILABLE_SERIALIZERS)
+    def test_changes_encoded_with_sequence_numbers(self, name):
+        serializer = create_serializer(name)
+        content = serializer.dumps_changes(list(zip((7, 9), ENTRIES)), last_sequence=9)
+        assert json.loads(content) == {'changes': [{'sequence': 7, **EXPECTED_ENTRIES[0]}, {'sequence': 9, **EXPECTED_ENTRIES[1]}], 'last_sequence': 9}
+
+    @pytest.mark.parametrize('name', AVAILABLE_SERIALIZERS)
+    def test_other_values_encoded(self, name):
+        serializer = create_serializer(name)
+        assert json.loads(serializer.dumps({'entries': {'test-bucket': 0.1}})) == {'entries': {'test-bucket': 0.1}}
+
+    @pytest.mark.skipif(orjson is None, reason='orjson is not installed')
+    def test_serializers_decode_to_same_values_at_edges(self):
+        # Smallest, tiny, exponent and largest values, whose number text differs between the serializers
+        values = [0, 1, -1, 10, -10 ** 16, 2 ** 63 - 1, -(2 ** 63 - 1)]
+        entries = [LedgerEntry(1, date(2021, 1, 22), date(2021, 1, 21), 'test-bucket', value) for value in values]
+        stdlib, orjson_serializer = create_serializer('stdlib'), create_serializer('orjson')
+
+        assert json.loads(stdlib.dumps_entries(entries)) == json.loads(orjson_serializer.dumps_entries(entries))
+        changes = list(enumerate(entries, 1))
+        assert json.loads(stdlib.dumps_changes(changes, last_sequence=7)) == json.loads(orjson_serializer.dumps_changes(changes, last_sequence=7))
+        assert [json.loads(line) for line in generate_ndjson(iter(entries))] == json.loads(orjson_serializer.dumps_entries(entries))['entries']
+
+    def test_ndjson_lines_match_entries(self):
+        assert [json.loads(line) for line in generate_ndjson(iter(ENTRIES))] == EXPECTED_ENTRIES
+
+    def test_unknown_serializer_rejected(self):
+        with pytest.raises(InvalidSerializer):
+            create_serializer('pickle')
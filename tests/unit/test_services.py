@@ -1,9 +1,18 @@
 from datetime import date
+import threading
+import time
 import pytest
 
+from ledger.adapters.feed import ChangeFeed
+from ledger.adapters.repository import (BucketRepository, LedgerRepository, LoanRepository)
+
 from ledger.domain.bucket import (AccountingBucket)
 from ledger.domain.ledger import (Ledger, LedgerEntry)
-from ledger.service_layer.services import (InvalidDate, InvalidIdentifier, InvalidPairValue, create_bucket, create_double_entries, create_ledger_entry, get_buckets_sum, get_ledger_entries, is_bucket_present, is_valid_new_identifier, is_valid_pair_value)
+from ledger.domain.loan import Loan
+from ledger.domain.money import to_minor_units
+from ledger.service_layer.schema import (SchemaError, parse_pair_entries)
+from ledger.service_layer import services
+from ledger.service_layer.services import (ClosedLoan, InconsistentBalance, InvalidCursor, InvalidIdentifier, InvalidLoanId, InvalidLoanStatus, InvalidPageSize, InvalidSequence, InvalidPairValue, UnknownLoan, add_bucket, add_bulk_double_entries, add_double_entries, close_loan, create_bucket, create_bulk_double_entries, create_double_entries, create_ledger_entry, get_buckets_sum, get_changes, get_ledger_entries, get_ledger_entries_page, get_loans, get_trial_balance, is_bucket_present, is_valid_new_identifier, is_valid_pair_value, iter_ledger_entries, open_loan)
 
 class TestIsValidIdentifier:
     def test_identifier_invalid_if_smaller_than_min_length(self):
@@ -36,6 +45,35 @@ class TestCreateBucket:
         assert isinstance(new_bucket, AccountingBucket)
         assert new_bucket.identifier == 'other-test-bucket-name'
 
+    def test_concurrent_creations_of_same_bucket_add_it_once(self, monkeypatch):
+        bucket_repo = BucketRepository()
+        is_valid_identifier = services.is_valid_new_identifier
+
+        def slow_check(identifier, buckets):
+            # Widens the window between the duplicate check and the add
+            valid = is_valid_identifier(identifier, buckets)
+            time.sleep(0.01)
+            return valid
+
+        monkeypatch.setattr(services, 'is_valid_new_identifier', slow_check)
+        added_buckets = []
+        errors = []
+
+        def create():
+            try:
+                added_buckets.append(add_bucket('test-bucket-name', bucket_repo))
+            except InvalidIdentifier as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(added_buckets) == 1 and len(errors) == 3
+        assert bucket_repo.get()['test-bucket-name'] is added_buckets[0]
+
 class TestIsBucketPresent:
     def test_if_no_bucket_with_identifier_present_then_bucket_not_present(self):
         test_bucket = AccountingBucket.create('test-bucket-name')
@@ -45,21 +83,26 @@ class TestIsBucketPresent:
         test_bucket = AccountingBucket.create('test-bucket-name')
         assert is_bucket_present('test-bucket-name', [test_bucket])
 
+    def test_if_buckets_keyed_by_identifier_then_bucket_present(self):
+        test_bucket = AccountingBucket.create('test-bucket-name')
+        assert is_bucket_present('test-bucket-name', {'test-bucket-name': test_bucket})
+        assert is_bucket_present('other-test-bucket-name', {'test-bucket-name': test_bucket}) is False
+
 class TestCreateLedgerEntry:
     def test_if_no_buckets_then_error_raised(self):
         with pytest.raises(InvalidIdentifier):
-            _ = create_ledger_entry(1, 'test-bucket-name', 100.0, date.today(), [])
+            _ = create_ledger_entry(1, 'test-bucket-name', 100, date.today(), [])
 
     def test_if_invalid_bucket_then_error_raised(self):
         test_bucket = AccountingBucket.create('test-bucket-name')
 
         with pytest.raises(InvalidIdentifier):
-            _ = create_ledger_entry(1, 'other-test-bucket-name', 100.0, date.today(), [test_bucket])
+            _ = create_ledger_entry(1, 'other-test-bucket-name', 100, date.today(), [test_bucket])
 
     def test_if_valid_bucket_then_ledger_entry_is_created(self):
         test_bucket = AccountingBucket.create('test-bucket-name')
 
-        ledger_entry = create_ledger_entry(1, 'test-bucket-name', 100.0, date.today(), [test_bucket])
+        ledger_entry = create_ledger_entry(1, 'test-bucket-name', 100, date.today(), [test_bucket])
 
         assert isinstance(ledger_entry, LedgerEntry)
         assert ledger_entry.effective_date == date.today()
@@ -99,7 +142,21 @@ class TestCreateDoubleEntries:
             }
         ]
         with pytest.raises(InvalidPairValue):
-            _ = create_double_entries(1, pair_entries, [test_debit_bucket, test_credit_bucket])
+            _ = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket, test_credit_bucket])
+
+    def test_if_pair_entries_with_too_many_decimal_places_then_error_raised(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        test_credit_bucket = AccountingBucket.create('test-credit-bucket')
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 0.0000001},
+                "credit": {"identifier": "test-credit-bucket", "value": -0.0000001}
+            }
+        ]
+        with pytest.raises(SchemaError) as error:
+            _ = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket, test_credit_bucket])
+        assert error.value.path == '[0].debit.value'
+        assert test_debit_bucket.debit == 0
 
 
     def test_if_pair_entries_with_invalid_bucket_then_error_raised(self):
@@ -119,7 +176,7 @@ class TestCreateDoubleEntries:
             }
         ]
         with pytest.raises(InvalidIdentifier):
-            _ = create_double_entries(1, pair_entries, [test_debit_bucket])
+            _ = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket])
 
     
     def test_if_pair_entries_with_invalid_effective_date_then_error_raised(self):
@@ -138,8 +195,9 @@ class TestCreateDoubleEntries:
                 }
             }
         ]
-        with pytest.raises(InvalidDate):
-            _ = create_double_entries(1, pair_entries, [test_debit_bucket])
+        with pytest.raises(SchemaError) as error:
+            _ = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket])
+        assert error.value.path == '[0].effective_date'
 
     
     def test_if_pair_entries_valid_then_double_entries_created(self):
@@ -169,14 +227,327 @@ class TestCreateDoubleEntries:
                 }
             }
         ]
-        ledger_entries = create_double_entries(1, pair_entries, [test_debit_bucket, test_credit_bucket, other_test_credit_bucket])
+        ledger_entries = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket, test_credit_bucket, other_test_credit_bucket])
         assert len(ledger_entries) == 4
 
         future_date = date.fromisoformat("2022-01-21")
-        assert ledger_entries[0].value == 123.0 and ledger_entries[0].bucket_identifier == "test-debit-bucket" and ledger_entries[0].effective_date == future_date
-        assert ledger_entries[1].value == -123.0 and ledger_entries[1].bucket_identifier == "test-credit-bucket" and ledger_entries[1].effective_date == future_date
-        assert ledger_entries[2].value == 100.0 and ledger_entries[2].bucket_identifier == "test-debit-bucket" and ledger_entries[2].effective_date == date.today()
-        assert ledger_entries[3].value == -100.0 and ledger_entries[3].bucket_identifier == "other-test-credit-bucket" and ledger_entries[3].effective_date == date.today()
+        assert ledger_entries[0].value == to_minor_units(123.0) and ledger_entries[0].bucket_identifier == "test-debit-bucket" and ledger_entries[0].effective_date == future_date
+        assert ledger_entries[1].value == to_minor_units(-123.0) and ledger_entries[1].bucket_identifier == "test-credit-bucket" and ledger_entries[1].effective_date == future_date
+        assert ledger_entries[2].value == to_minor_units(100.0) and ledger_entries[2].bucket_identifier == "test-debit-bucket" and ledger_entries[2].effective_date == date.today()
+        assert ledger_entries[3].value == to_minor_units(-100.0) and ledger_entries[3].bucket_identifier == "other-test-credit-bucket" and ledger_entries[3].effective_date == date.today()
+
+    def test_if_later_pair_entry_invalid_then_no_bucket_updated(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        test_credit_bucket = AccountingBucket.create('test-credit-bucket')
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-missing-bucket", "value": -10.0}
+            }
+        ]
+        with pytest.raises(InvalidIdentifier):
+            _ = create_double_entries(1, parse_pair_entries(pair_entries), [test_debit_bucket, test_credit_bucket])
+
+        assert test_debit_bucket.debit == 0
+        assert test_credit_bucket.credit == 0
+
+class TestAddDoubleEntries:
+    def create_repositories(self):
+        bucket_repo = BucketRepository()
+        bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+        bucket_repo.add(AccountingBucket.create('test-credit-bucket'))
+        ledger_repo = LedgerRepository()
+        loan_repo = LoanRepository(ledger_repo)
+        for loan_id in range(1, 9):
+            open_loan(loan_id, loan_repo)
+        return bucket_repo, ledger_repo, loan_repo
+
+    def test_if_batch_rejected_then_nothing_added(self):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-missing-bucket", "value": -10.0}
+            }
+        ]
+        with pytest.raises(InvalidIdentifier):
+            _ = add_double_entries(1, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+
+        assert bucket_repo.get()['test-debit-bucket'].debit == 0
+        assert not list(ledger_repo.get().get_all_entries())
+        assert loan_repo.get()[1].entry_count == 0
+
+    def test_if_loan_unknown_or_closed_then_error_raised(self):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            }
+        ]
+        with pytest.raises(UnknownLoan):
+            _ = add_double_entries(9, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+
+        close_loan(1, loan_repo)
+        with pytest.raises(ClosedLoan):
+            _ = add_double_entries(1, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+        assert not list(ledger_repo.get().get_all_entries())
+
+    def test_if_loan_closed_before_write_then_batch_rejected(self, monkeypatch):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        build_double_entries = services.build_double_entries
+
+        def build_double_entries_and_close(loan_id, pair_entries, buckets):
+            ledger_entries = build_double_entries(loan_id, pair_entries, buckets)
+            close_loan(loan_id, loan_repo)
+            return ledger_entries
+
+        monkeypatch.setattr(services, 'build_double_entries', build_double_entries_and_close)
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            }
+        ]
+        with pytest.raises(ClosedLoan):
+            _ = add_double_entries(1, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+        assert not list(ledger_repo.get().get_all_entries())
+        assert bucket_repo.get()['test-debit-bucket'].debit == 0
+
+    def test_if_entries_added_then_loan_summary_updated(self):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        pair_entries = [
+            {
+                "effective_date": effective_date,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            }
+            for effective_date in ("2021-02-01", "2021-01-01")
+        ]
+        ledger_entries = add_double_entries(1, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+
+        loan = loan_repo.get()[1]
+        assert (loan.entry_count, loan.first_effective_date, loan.last_effective_date) == (4, date(2021, 1, 1), date(2021, 2, 1))
+        assert list(iter_ledger_entries(loan)) == ledger_entries
+
+    def test_bulk_rows_validated_before_ledger_locked(self, monkeypatch):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        parse_bulk_row = services.parse_bulk_row
+        locked_rows = []
+
+        def parse_bulk_row_checking_locks(row):
+            locked_rows.append(ledger_repo.lock.writer)
+            return parse_bulk_row(row)
+
+        monkeypatch.setattr(services, 'parse_bulk_row', parse_bulk_row_checking_locks)
+        rows = [
+            {
+                "loan_id": loan_id,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            }
+            for loan_id in (1, 2, 9)
+        ]
+        ledger_entries, errors = add_bulk_double_entries(rows, bucket_repo, ledger_repo, loan_repo)
+
+        assert locked_rows == [False, False, False]
+        assert len(ledger_entries) == 4
+        assert errors == [{'row': 2, 'error': 'Loan not found, please open the loan first'}]
+
+    def test_concurrent_writers_keep_totals_exact(self):
+        bucket_repo, ledger_repo, loan_repo = self.create_repositories()
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 0.1},
+                "credit": {"identifier": "test-credit-bucket", "value": -0.1}
+            }
+        ]
+        bulk_rows = [dict(pair_entries[0], loan_id=loan_id) for loan_id in range(1, 9)]
+
+        def write(loan_id):
+            for _ in range(200):
+                add_double_entries(loan_id, parse_pair_entries(pair_entries), bucket_repo, ledger_repo, loan_repo)
+                add_bulk_double_entries(bulk_rows, bucket_repo, ledger_repo, loan_repo)
+
+        writers = [threading.Thread(target=write, args=(loan_id,)) for loan_id in range(1, 9)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        assert bucket_repo.get()['test-debit-bucket'].debit == to_minor_units(0.1) * 8 * 200 * 9
+        assert bucket_repo.get()['test-credit-bucket'].credit == -to_minor_units(0.1) * 8 * 200 * 9
+        with ledger_repo.read() as ledger:
+            buckets_sum = get_buckets_sum(1, ['test-debit-bucket'], bucket_repo.get(), ledger, consistency_check=True)
+        # 200 batches of its own and 200 bulk rows from each of the 8 writers
+        assert buckets_sum == {'test-debit-bucket': 180.0}
+        assert loan_repo.get()[1].entry_count == 2 * 200 * 9
+
+class TestCreateBulkDoubleEntries:
+    def test_if_rows_valid_then_double_entries_created_for_each_loan(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        test_credit_bucket = AccountingBucket.create('test-credit-bucket')
+        rows = [
+            {
+                "loan_id": 1,
+                "effective_date": "2021-01-21",
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "loan_id": 2,
+                "effective_date": "2021-01-21",
+                "debit": {"identifier": "test-debit-bucket", "value": 5.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -5.0}
+            }
+        ]
+        ledger_entries, errors = create_bulk_double_entries(rows, [test_debit_bucket, test_credit_bucket], {1: Loan.create(1), 2: Loan.create(2)})
+
+        assert not errors
+        assert [entry.loan_id for entry in ledger_entries] == [1, 1, 2, 2]
+        assert ledger_entries[0].effective_date == ledger_entries[2].effective_date == date(2021, 1, 21)
+        assert test_debit_bucket.debit == to_minor_units(15.0)
+        assert test_credit_bucket.credit == to_minor_units(-15.0)
+
+    def test_if_rows_invalid_then_errors_returned_per_row(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        test_credit_bucket = AccountingBucket.create('test-credit-bucket')
+        rows = [
+            {
+                "loan_id": 1,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "loan_id": 1,
+                "effective_date": "test-not-date",
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "loan_id": 1,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-missing-bucket", "value": -10.0}
+            },
+            None,
+            {
+                "loan_id": 2,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+            {
+                "loan_id": 3,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            },
+        ]
+        closed_loan = Loan.create(3)
+        closed_loan.close()
+        ledger_entries, errors = create_bulk_double_entries(rows, [test_debit_bucket, test_credit_bucket], {1: Loan.create(1), 3: closed_loan})
+
+        assert len(ledger_entries) == 2
+        assert [error['row'] for error in errors] == [1, 2, 3, 4, 5, 6]
+        assert 'loan id' in errors[0]['error']
+        assert 'YYYY-MM-DD' in errors[1]['error']
+        assert 'bucket identifier' in errors[2]['error']
+        assert 'open the loan' in errors[4]['error']
+        assert 'closed' in errors[5]['error']
+
+    def test_if_row_rejected_then_buckets_not_updated(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        rows = [
+            {
+                "loan_id": 1,
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-missing-bucket", "value": -10.0}
+            }
+        ]
+        _ = create_bulk_double_entries(rows, [test_debit_bucket], {1: Loan.create(1)})
+
+        assert test_debit_bucket.debit == to_minor_units(0.0)
+
+class TestLoans:
+    def test_if_loan_id_already_opened_then_error_raised(self):
+        loan_repo = LoanRepository(LedgerRepository())
+        open_loan(1, loan_repo)
+        with pytest.raises(InvalidLoanId):
+            _ = open_loan(1, loan_repo)
+
+    def test_if_loan_id_beyond_int64_then_error_raised(self):
+        loan_repo = LoanRepository(LedgerRepository())
+        with pytest.raises(InvalidLoanId):
+            _ = open_loan(2 ** 63, loan_repo)
+        assert loan_repo.get() == {}
+
+    def test_if_loan_unknown_or_closed_then_not_closed(self):
+        loan_repo = LoanRepository(LedgerRepository())
+        with pytest.raises(UnknownLoan):
+            _ = close_loan(1, loan_repo)
+
+        open_loan(1, loan_repo)
+        assert close_loan(1, loan_repo).status == 'closed'
+        with pytest.raises(ClosedLoan):
+            _ = close_loan(1, loan_repo)
+
+    def test_loans_listed_in_loan_id_order(self):
+        loan_repo = LoanRepository(LedgerRepository())
+        for loan_id in (3, 1, 2):
+            open_loan(loan_id, loan_repo)
+        close_loan(2, loan_repo)
+
+        assert [loan['loan_id'] for loan in get_loans(loan_repo.get_all())] == [1, 2, 3]
+        assert [loan['loan_id'] for loan in get_loans(loan_repo.get_all(), 'open')] == [1, 3]
+        assert get_loans(loan_repo.get_all(), 'closed') == [{'loan_id': 2, 'status': 'closed', 'first_effective_date': None, 'last_effective_date': None, 'entries': 0}]
+        with pytest.raises(InvalidLoanStatus):
+            _ = get_loans(loan_repo.get_all(), 'test-status')
+
+class TestGetChanges:
+    def create_ledger_repo(self, feed_size):
+        ledger_repo = LedgerRepository(feed=ChangeFeed(feed_size))
+        for loan_id in (1, 2, 1):
+            ledger_repo.add([
+                LedgerEntry(loan_id, date(2021, 1, 1), date(2021, 1, 1), 'test-debit-bucket', 10),
+                LedgerEntry(loan_id, date(2021, 1, 1), date(2021, 1, 1), 'test-credit-bucket', -10),
+            ])
+        return ledger_repo
+
+    @pytest.mark.parametrize('feed_size', [0, 2, 100])
+    def test_changes_read_from_feed_or_ledger(self, feed_size):
+        ledger_repo = self.create_ledger_repo(feed_size)
+        buckets = [AccountingBucket.create('test-debit-bucket'), AccountingBucket.create('test-credit-bucket')]
+
+        changes, last_sequence = get_changes(0, ledger_repo, buckets)
+        assert [(sequence, entry.loan_id) for sequence, entry in changes] == [(1, 1), (2, 1), (3, 2), (4, 2), (5, 1), (6, 1)]
+        assert last_sequence == 6
+
+        changes, last_sequence = get_changes(2, ledger_repo, buckets, loan_id=1, identifiers=['test-credit-bucket'])
+        assert [sequence for sequence, _ in changes] == [6]
+        assert get_changes(6, ledger_repo, buckets) == ([], 6)
+
+    def test_if_limit_reached_then_resumed_after_last_change(self):
+        ledger_repo = self.create_ledger_repo(100)
+        buckets = [AccountingBucket.create('test-debit-bucket')]
+
+        changes, last_sequence = get_changes(0, ledger_repo, buckets, limit=2, identifiers=['test-debit-bucket'])
+        assert [sequence for sequence, _ in changes] == [1, 3]
+        assert last_sequence == 3
+
+    def test_if_invalid_read_then_error_raised(self):
+        ledger_repo = self.create_ledger_repo(100)
+        with pytest.raises(InvalidSequence):
+            _ = get_changes(7, ledger_repo, [])
+        with pytest.raises(InvalidPageSize):
+            _ = get_changes(0, ledger_repo, [], limit=0)
+        with pytest.raises(InvalidIdentifier):
+            _ = get_changes(0, ledger_repo, [], identifiers=['test-debit-bucket'])
 
 class TestBucketsSum:
     def test_if_identifier_not_found_then_error_raised(self):
@@ -189,7 +560,7 @@ class TestBucketsSum:
         test_debit_bucket = AccountingBucket.create('test-debit-bucket')
         ledger = Ledger()
         ledger.add_new_entries([
-            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 300.0)
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(300.0))
         ])
 
         buckets_sum = get_buckets_sum(None, ['test-debit-bucket'], [test_debit_bucket], ledger)
@@ -200,21 +571,134 @@ class TestBucketsSum:
         test_credit_bucket = AccountingBucket.create('test-credit-bucket')
         ledger = Ledger()
         ledger.add_new_entries([
-            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', 300.0), 
-            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', -300.0), 
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(300.0)), 
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', to_minor_units(-300.0)), 
         ])
 
         buckets_sum = get_buckets_sum(1, ['test-debit-bucket', 'test-credit-bucket'], [test_debit_bucket, test_credit_bucket], ledger)
         assert buckets_sum['test-debit-bucket'] == 300.0
         assert buckets_sum['test-credit-bucket'] == -300.0
 
+    def test_if_bucket_has_no_entries_for_loan_then_zero_returned(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(2, date.today(), date.today(), 'test-debit-bucket', to_minor_units(300.0))
+        ])
+
+        buckets_sum = get_buckets_sum(1, ['test-debit-bucket'], [test_debit_bucket], ledger)
+        assert buckets_sum['test-debit-bucket'] == 0.0
+
+    def test_if_consistency_check_and_balance_matches_then_sum_returned(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(300.0)),
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(-100.0)),
+        ])
+
+        buckets_sum = get_buckets_sum(1, ['test-debit-bucket'], [test_debit_bucket], ledger, consistency_check=True)
+        assert buckets_sum['test-debit-bucket'] == 200.0
+
+    def test_if_consistency_check_and_balance_drifted_then_error_raised(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(300.0))
+        ])
+        ledger.get_balance(1, 'test-debit-bucket').add_value(1)
+
+        with pytest.raises(InconsistentBalance):
+            _ = get_buckets_sum(1, ['test-debit-bucket'], [test_debit_bucket], ledger, consistency_check=True)
+
+    def test_if_as_of_then_sum_up_to_effective_date_returned(self):
+        test_debit_bucket = AccountingBucket.create('test-debit-bucket')
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date(2021, 6, 30), 'test-debit-bucket', to_minor_units(300.0)),
+            LedgerEntry(1, date.today(), date(2021, 7, 1), 'test-debit-bucket', to_minor_units(100.0)),
+        ])
+
+        buckets_sum = get_buckets_sum(1, ['test-debit-bucket'], [test_debit_bucket], ledger, consistency_check=True, as_of=date(2021, 6, 30))
+        assert buckets_sum['test-debit-bucket'] == 300.0
+
 class TestGetLedgerEntries:
     def test_if_all_entries_returned(self):
         test_debit_bucket = AccountingBucket.create('test-debit-bucket')
-        first_debit_entry = create_ledger_entry(1, 'test-debit-bucket', 100.0, date.today(), [test_debit_bucket])
-        second_debit_entry = create_ledger_entry(1, 'test-debit-bucket', 100.0, date.today(), [test_debit_bucket])
+        first_debit_entry = create_ledger_entry(1, 'test-debit-bucket', 100, date.today(), [test_debit_bucket])
+        second_debit_entry = create_ledger_entry(1, 'test-debit-bucket', 100, date.today(), [test_debit_bucket])
         ledger = Ledger()
         ledger.add_new_entries([first_debit_entry, second_debit_entry])
 
         ledger_entries = list(get_ledger_entries(1, ledger))
         assert len(ledger_entries) == 2
+
+class TestGetLedgerEntriesPage:
+    def create_ledger(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date(2021, 2, day), date(2021, 1, day), 'test-debit-bucket', day)
+            for day in range(10, 0, -1)
+        ])
+        return ledger
+
+    def test_pages_follow_cursor_in_effective_date_order(self):
+        ledger = self.create_ledger()
+
+        first_page, cursor = get_ledger_entries_page(1, ledger, limit=4)
+        second_page, cursor = get_ledger_entries_page(1, ledger, limit=4, cursor=cursor)
+        last_page, cursor = get_ledger_entries_page(1, ledger, limit=4, cursor=cursor)
+
+        assert [entry.value for entry in first_page] == [1, 2, 3, 4]
+        assert [entry.value for entry in second_page] == [5, 6, 7, 8]
+        assert [entry.value for entry in last_page] == [9, 10]
+        assert cursor is None
+
+    def test_entries_filtered_by_effective_and_created_dates(self):
+        ledger = self.create_ledger()
+
+        ledger_entries, cursor = get_ledger_entries_page(1, ledger, effective_from=date(2021, 1, 3), effective_to=date(2021, 1, 8), created_to=date(2021, 2, 5))
+        assert [entry.value for entry in ledger_entries] == [3, 4, 5]
+        assert cursor is None
+
+    def test_if_invalid_cursor_then_error_raised(self):
+        with pytest.raises(InvalidCursor):
+            _ = get_ledger_entries_page(1, Ledger(), cursor='test-not-cursor')
+
+    def test_if_page_size_out_of_range_then_error_raised(self):
+        with pytest.raises(InvalidPageSize):
+            _ = get_ledger_entries_page(1, Ledger(), limit=0)
+
+class TestTrialBalance:
+    def test_bucket_totals_returned_for_loan(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(10.5)),
+            LedgerEntry(1, date.today(), date.today(), 'test-credit-bucket', to_minor_units(-10.5)),
+            LedgerEntry(2, date.today(), date.today(), 'test-debit-bucket', to_minor_units(1.0)),
+        ])
+
+        report = get_trial_balance(1, ledger)
+        assert report == {
+            'loan_id': 1,
+            'buckets': [
+                {'identifier': 'test-credit-bucket', 'debit': 0.0, 'credit': -10.5, 'sum': -10.5},
+                {'identifier': 'test-debit-bucket', 'debit': 10.5, 'credit': 0.0, 'sum': 10.5},
+            ],
+            'debit': 10.5,
+            'credit': -10.5,
+            'entries': 2,
+            'balanced': True,
+        }
+
+    def test_unbalanced_loan_unbalances_whole_ledger(self):
+        ledger = Ledger()
+        ledger.add_new_entries([
+            LedgerEntry(1, date.today(), date.today(), 'test-debit-bucket', to_minor_units(10.5)),
+            LedgerEntry(2, date.today(), date.today(), 'test-credit-bucket', to_minor_units(-10.5)),
+        ])
+
+        report = get_trial_balance(None, ledger)
+        assert (report['debit'], report['credit'], report['entries']) == (10.5, -10.5, 2)
+        assert report['unbalanced_loan_ids'] == [1, 2]
+        assert not report['balanced']
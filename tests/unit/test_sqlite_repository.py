@@ -0,0 +1,146 @@
+from datetime import date
+import pytest
+
+from ledger.adapters.sqlite_repository import (SqliteBucketRepository, SqliteDatabase, SqliteLedgerRepository, SqliteLoanRepository)
+from ledger.domain.bucket import AccountingBucket
+from ledger.domain.ledger import (Ledger, LedgerEntry)
+from ledger.domain.loan import Loan
+from ledger.domain.money import to_minor_units
+from ledger.service_layer.schema import parse_pair_entries
+from ledger.service_layer.services import (create_double_entries, get_buckets_sum, get_changes, get_ledger_entries, get_ledger_entries_page, get_trial_balance)
+
+@pytest.fixture()
+def database(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'ledger.db'))
+    yield database
+    database.close()
+
+def add_entries(database):
+    ledger_repo = SqliteLedgerRepository(database)
+    ledger_repo.add([
+        LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 3), 'test-debit-bucket', to_minor_units(10.0)),
+        LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 3), 'test-credit-bucket', to_minor_units(-10.0)),
+        LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', to_minor_units(5.0)),
+        LedgerEntry(2, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', to_minor_units(7.0)),
+    ])
+    return ledger_repo
+
+class TestSqliteLedger:
+    def test_entries_read_back_in_insertion_order(self, database):
+        ledger_repo = add_entries(database)
+
+        ledger_entries = get_ledger_entries(1, ledger_repo.get())
+        assert [entry.value for entry in ledger_entries] == [to_minor_units(value) for value in (10.0, -10.0, 5.0)]
+        assert ledger_entries[0] == LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 3), 'test-debit-bucket', to_minor_units(10.0))
+
+    def test_buckets_sum_computed_in_sql(self, database):
+        ledger_repo = add_entries(database)
+        buckets = [AccountingBucket.create('test-debit-bucket'), AccountingBucket.create('test-credit-bucket')]
+
+        buckets_sum = get_buckets_sum(1, ['test-debit-bucket', 'test-credit-bucket'], buckets, ledger_repo.get(), consistency_check=True)
+        assert buckets_sum == {'test-debit-bucket': 15.0, 'test-credit-bucket': -10.0}
+
+        buckets_sum = get_buckets_sum(None, ['test-debit-bucket'], buckets, ledger_repo.get())
+        assert buckets_sum == {'test-debit-bucket': 22.0}
+
+        buckets_sum = get_buckets_sum(1, ['test-debit-bucket'], buckets, ledger_repo.get(), as_of=date(2021, 1, 2))
+        assert buckets_sum == {'test-debit-bucket': 5.0}
+
+    def test_entries_paged_in_effective_date_order(self, database):
+        ledger_repo = add_entries(database)
+
+        first_page, cursor = get_ledger_entries_page(1, ledger_repo.get(), limit=2)
+        second_page, cursor = get_ledger_entries_page(1, ledger_repo.get(), limit=2, cursor=cursor)
+        assert [entry.value for entry in first_page] == [to_minor_units(5.0), to_minor_units(10.0)]
+        assert [entry.value for entry in second_page] == [to_minor_units(-10.0)]
+        assert cursor is None
+
+    def test_trial_balance_computed_in_sql(self, database):
+        ledger = add_entries(database).get()
+
+        report = get_trial_balance(1, ledger)
+        assert [bucket['identifier'] for bucket in report['buckets']] == ['test-credit-bucket', 'test-debit-bucket']
+        assert (report['debit'], report['credit'], report['entries'], report['balanced']) == (15.0, -10.0, 3, False)
+        assert get_trial_balance(None, ledger)['unbalanced_loan_ids'] == [1, 2]
+        assert [entry.value for entry in ledger.get_entries_range(1, 3)] == [to_minor_units(-10.0), to_minor_units(5.0)]
+
+    def test_totals_beyond_int64_same_as_in_memory_ledger(self, database):
+        largest = 2 ** 63 - 1
+        entries = [
+            LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', largest),
+            LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 2), 'test-debit-bucket', largest),
+            LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 2), 'test-credit-bucket', -largest),
+        ]
+        ledger_repo = SqliteLedgerRepository(database)
+        ledger_repo.add(entries)
+        in_memory_ledger = Ledger()
+        in_memory_ledger.add_new_entries(entries)
+
+        for ledger in (ledger_repo.get(), in_memory_ledger):
+            assert ledger.get_balance(1, 'test-debit-bucket').debit == 2 * largest
+            assert ledger.get_balance(None, 'test-debit-bucket').debit == 2 * largest
+            assert ledger.get_balance_as_of(1, 'test-debit-bucket', date(2021, 1, 2)) == 2 * largest
+            assert ledger.get_balances(1)['test-debit-bucket'].debit == 2 * largest
+            trial_balance = ledger.get_trial_balance(1)
+            assert (trial_balance.debit, trial_balance.credit, trial_balance.entries) == (2 * largest, -largest, 3)
+            assert ledger.get_unbalanced_loan_ids() == [1]
+        assert SqliteBucketRepository(database).buckets == {}
+        database.execute_many('INSERT INTO buckets (identifier) VALUES (?)', [('test-debit-bucket',)])
+        assert SqliteBucketRepository(database).get()['test-debit-bucket'].debit == 2 * largest
+
+class TestSqliteRepositories:
+    def test_buckets_and_totals_loaded_from_database(self, database):
+        bucket_repo = SqliteBucketRepository(database)
+        bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+        bucket_repo.add(AccountingBucket.create('test-credit-bucket'))
+        pair_entries = [
+            {
+                "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+                "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+            }
+        ]
+        SqliteLedgerRepository(database).add(create_double_entries(1, parse_pair_entries(pair_entries), bucket_repo.get()))
+
+        reloaded_bucket_repo = SqliteBucketRepository(database)
+        assert reloaded_bucket_repo.get()['test-debit-bucket'].debit == to_minor_units(10.0)
+        assert reloaded_bucket_repo.get()['test-credit-bucket'].credit == to_minor_units(-10.0)
+
+    def test_loans_and_summaries_loaded_from_database(self, database):
+        ledger_repo = add_entries(database)
+        loan_repo = SqliteLoanRepository(database, ledger_repo)
+        loan_repo.add(Loan.create(3))
+        assert loan_repo.close(loan_repo.get()[2])
+        assert not loan_repo.close(loan_repo.get()[2])
+
+        reloaded_loans = SqliteLoanRepository(database, SqliteLedgerRepository(database)).get()
+        assert [(loan.loan_id, loan.status, loan.entry_count) for loan in reloaded_loans.values()] == [(1, 'open', 3), (2, 'closed', 1), (3, 'open', 0)]
+        assert (reloaded_loans[1].first_effective_date, reloaded_loans[1].last_effective_date) == (date(2021, 1, 1), date(2021, 1, 3))
+        assert [entry.value for entry in reloaded_loans[1].entries[1:]] == [to_minor_units(-10.0), to_minor_units(5.0)]
+        assert len(reloaded_loans[3].entries) == 0
+
+    def test_entries_numbered_by_id_across_restarts(self, database):
+        add_entries(database)
+        ledger_repo = SqliteLedgerRepository(database)
+        assert ledger_repo.feed.last_sequence == 4
+
+        ledger_repo.add([LedgerEntry(2, date(2021, 2, 2), date(2021, 1, 2), 'test-debit-bucket', to_minor_units(1.0))])
+        changes, last_sequence = get_changes(3, ledger_repo, [AccountingBucket.create('test-debit-bucket')], loan_id=2)
+        assert [(sequence, entry.value) for sequence, entry in changes] == [(4, to_minor_units(7.0)), (5, to_minor_units(1.0))]
+        assert last_sequence == 5
+
+    def test_entries_read_as_of_the_start_of_an_iteration(self, database):
+        ledger_repo = SqliteLedgerRepository(database)
+        ledger_repo.add([LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', 1) for _ in range(1500)])
+
+        entries = ledger_repo.get().get_all_entries()
+        next(entries)
+        ledger_repo.add([LedgerEntry(1, date(2021, 2, 1), date(2021, 1, 1), 'test-debit-bucket', 2)])
+        assert len(list(entries)) == 1499
+
+    def test_synchronous_mode_configurable(self, tmp_path):
+        for mode, pragma_value in (('full', 2), ('normal', 1)):
+            database = SqliteDatabase(str(tmp_path / f'{mode}.db'), mode)
+            assert database.fetch_one('PRAGMA synchronous') == (pragma_value,)
+            database.close()
+        with pytest.raises(ValueError):
+            SqliteDatabase(str(tmp_path / 'ledger.db'), 'test-mode')
@@ -0,0 +1,127 @@
+import time
+from contextlib import contextmanager
+
+from ledger.adapters.repository import (BucketRepository, LedgerRepository, LoanRepository)
+from ledger.domain.bucket import AccountingBucket
+from ledger.service_layer.schema import parse_pair_entries
+from ledger.service_layer.services import (add_double_entries, open_loan)
+from ledger.service_layer.verification import TrialBalanceVerifier
+
+PAIR_ENTRIES = [
+    {
+        "debit": {"identifier": "test-debit-bucket", "value": 10.0},
+        "credit": {"identifier": "test-credit-bucket", "value": -10.0}
+    }
+]
+
+def create_repositories(loans: int):
+    bucket_repo = BucketRepository()
+    bucket_repo.add(AccountingBucket.create('test-debit-bucket'))
+    bucket_repo.add(AccountingBucket.create('test-credit-bucket'))
+    ledger_repo = LedgerRepository()
+    loan_repo = LoanRepository(ledger_repo)
+    for loan_id in range(1, loans + 1):
+        open_loan(loan_id, loan_repo)
+        add_double_entries(loan_id, parse_pair_entries(PAIR_ENTRIES), bucket_repo, ledger_repo, loan_repo)
+    return bucket_repo, ledger_repo, loan_repo
+
+class WritingLedgerRepository:
+    """Adds a pair entry for a new loan every time a reader releases the lock"""
+    def __init__(self, bucket_repo, ledger_repo, loan_repo, writes: int):
+        self.bucket_repo = bucket_repo
+        self.ledger_repo = ledger_repo
+        self.loan_repo = loan_repo
+        self.writes = writes
+        self.next_loan_id = 1000
+
+    @contextmanager
+    def read(self):
+        with self.ledger_repo.read() as ledger:
+            yield ledger
+        if self.writes:
+            self.writes -= 1
+            open_loan(self.next_loan_id, self.loan_repo)
+            add_double_entries(self.next_loan_id, parse_pair_entries(PAIR_ENTRIES), self.bucket_repo, self.ledger_repo, self.loan_repo)
+            self.next_loan_id += 1
+
+class TestTrialBalanceVerifier:
+    def test_consistent_ledger_verified(self):
+        _, ledger_repo, _ = create_repositories(5)
+
+        result = TrialBalanceVerifier(lambda: ledger_repo, 0, chunk_size=3).verify()
+        assert (result['verified_entries'], result['verified_loans']) == (10, 5)
+        assert result['consistent']
+
+    def test_drifted_loan_totals_reported(self):
+        _, ledger_repo, _ = create_repositories(5)
+        ledger_repo.get().loan_trial_balances[2].debit += 1
+
+        result = TrialBalanceVerifier(lambda: ledger_repo, 0, chunk_size=3).verify()
+        assert result['mismatched_loan_ids'] == [2]
+        assert result['totals_match']
+        assert not result['consistent']
+
+    def test_entries_written_between_chunks_verified(self):
+        bucket_repo, ledger_repo, loan_repo = create_repositories(5)
+        writing_repo = WritingLedgerRepository(bucket_repo, ledger_repo, loan_repo, 6)
+
+        result = TrialBalanceVerifier(lambda: writing_repo, 0, chunk_size=3).verify()
+        assert result['verified_entries'] == ledger_repo.get().count_entries()
+        assert result['verified_loans'] == 11
+        assert result['consistent']
+
+    def test_catch_up_read_a_chunk_at_a_time(self):
+        bucket_repo, ledger_repo, loan_repo = create_repositories(5)
+        # Writes 3 pairs once, after the 10 entries already added were read
+        writing_repo = WritingLedgerRepository(bucket_repo, ledger_repo, loan_repo, 0)
+        ledger = ledger_repo.get()
+        get_entries_range = ledger.get_entries_range
+        read_sizes = []
+
+        def get_recorded_entries_range(start, stop):
+            read_sizes.append(stop - start)
+            if start == 10 and writing_repo.next_loan_id == 1000:
+                writing_repo.writes = 3
+            return get_entries_range(start, stop)
+
+        ledger.get_entries_range = get_recorded_entries_range
+        result = TrialBalanceVerifier(lambda: writing_repo, 0, chunk_size=1).verify()
+        assert max(read_sizes) == 1
+        assert result['verified_entries'] == 16
+        assert result['consistent']
+
+    def test_failed_verification_reported_and_retried(self):
+        _, ledger_repo, _ = create_repositories(2)
+        calls = []
+
+        def get_ledger_repo():
+            calls.append(None)
+            if len(calls) == 1:
+                raise OverflowError('int too big to convert')
+            return ledger_repo
+
+        verifier = TrialBalanceVerifier(get_ledger_repo, 0.01)
+        verifier.start()
+        deadline = time.monotonic() + 5
+        while verifier.last_result is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        verifier.stop()
+
+        assert verifier.failures == 1
+        assert verifier.last_result['consistent']
+        assert verifier.last_error is None
+
+    def test_failing_verifications_keep_running_and_report_error(self):
+        def get_ledger_repo():
+            raise OverflowError('int too big to convert')
+
+        verifier = TrialBalanceVerifier(get_ledger_repo, 0.01)
+        verifier.start()
+        deadline = time.monotonic() + 5
+        while verifier.failures < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        verifier.stop()
+
+        assert verifier.failures >= 2
+        assert verifier.last_error['error'] == 'OverflowError: int too big to convert'
+        assert verifier.last_result is None